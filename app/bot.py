@@ -4,14 +4,15 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher, types
-from aiogram.fsm.storage.redis import RedisStorage
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import Update, ErrorEvent
 from aiogram.client.default import DefaultBotProperties
 
 from app.config import settings
 from app.middlewares import register_all_middlewares
 from app.database.connection import init_db
+from app.database.engine import db_stats
+from app.utils.fsm_storage import create_fsm_storage, create_events_isolation
+from app.utils.metrics import setup_bot_metrics, start_metrics_server
 
 # 🆕 Импорты для онбординга
 from app.handlers.onboarding import create_onboarding_router, setup_onboarding_logging
@@ -27,11 +28,15 @@ from app.services.video_uniquifier_service import video_uniquifier_service
 from app.handlers.video_uniquifier_handler import register_video_uniquifier_handlers
 
 from app.services.automated_messaging import start_automated_messaging_worker
+from app.services.broadcast_jobs import broadcast_job_runner
 
 from app.handlers import crypto_payment_handler
 
 # 🆕 Импорты для новых функций статистики и отчетов
 from app.services.daily_reports_scheduler import DailyReportsScheduler
+from app.services.partner_stats_reconciler import partner_stats_reconciler
+from app.services.funnel_refresher import funnel_refresher
+from app.services.user_cache_sync import start_user_cache_sync, user_cache_sync
 
 
 
@@ -68,6 +73,7 @@ async def set_bot_commands(bot: Bot):
         types.BotCommand(command="clean_db_user", description="🗑️ Удаление пользователя"),
         types.BotCommand(command="get_info", description="📊 Ежедневный отчет"),
         types.BotCommand(command="segments", description="📈 Статистика по сегментам"),
+        types.BotCommand(command="reload_answers", description="🔄 Обновить автоответы"),
     ]
 
     print(f"DEBUG: Created {len(admin_commands)} commands")
@@ -119,17 +125,19 @@ async def on_startup(bot: Bot):
         logger.info(f"👥 Configured admins ({len(admin_ids)}): {admin_ids}")
         print(f"DEBUG: Configured admins: {admin_ids}")
         
-        # Очищаем webhook если установлен
-        webhook_info = await bot.get_webhook_info()
-        if webhook_info.url:
-            await bot.delete_webhook()
-            logger.info("🗑️ Webhook cleared")
-        
-        # Проверяем и очищаем pending updates
-        updates = await bot.get_updates()
-        if updates:
-            logger.info(f"🔄 Clearing {len(updates)} pending updates")
-            await bot.get_updates(offset=updates[-1].update_id + 1)
+        # В режиме polling очищаем webhook и pending updates
+        # (в режиме webhook их настраивает run_webhook)
+        if settings.BOT_MODE != "webhook":
+            webhook_info = await bot.get_webhook_info()
+            if webhook_info.url:
+                await bot.delete_webhook()
+                logger.info("🗑️ Webhook cleared")
+            
+            # Проверяем и очищаем pending updates
+            updates = await bot.get_updates()
+            if updates:
+                logger.info(f"🔄 Clearing {len(updates)} pending updates")
+                await bot.get_updates(offset=updates[-1].update_id + 1)
         
         # Устанавливаем команды для всех админов
         await set_bot_commands(bot)
@@ -146,6 +154,24 @@ async def on_shutdown(bot: Bot):
     """Функция вызывается при остановке бота"""
     logger.info("🛑 Bot shutdown initiated")
     await bot.session.close()
+    
+    # Незаписанные строки Google Sheets (остаток сохраняется в файл очереди)
+    from app.services.google_sheets import sheets_service
+    from app.services.support_chat_logger import support_chat_logger
+    await sheets_service.close()
+    await support_chat_logger.close()
+    
+    from app.services.deepseek_client import deepseek_client
+    from app.services.auto_answers import auto_answers_service
+    await deepseek_client.close()
+    await auto_answers_service.close()
+    
+    await funnel_refresher.stop()
+    await user_cache_sync.stop()
+    
+    from app.database.connection import engine
+    logger.info(f"🗄️ DB stats: {db_stats.snapshot()}")
+    await engine.dispose()
     logger.info("✅ Bot shutdown completed")
 
 async def handle_update_error(error_event: ErrorEvent):
@@ -334,12 +360,12 @@ async def main():
         logger.info("📱 Initializing bot...")
         bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
         
-        # Инициализация хранилища
-        logger.info("💾 Initializing Memory storage...")
-        storage = MemoryStorage()
+        # Инициализация хранилища (memory / redis - см. FSM_STORAGE)
+        logger.info(f"💾 Initializing FSM storage ({settings.FSM_STORAGE})...")
+        storage = create_fsm_storage()
         
         # Инициализация диспетчера
-        dp = Dispatcher(storage=storage)
+        dp = Dispatcher(storage=storage, events_isolation=create_events_isolation(storage))
         
         # Установка обработчиков событий
         dp.startup.register(on_startup)
@@ -355,6 +381,14 @@ async def main():
         logger.info("🔧 Registering existing middlewares...")
         register_all_middlewares(dp)
         
+        # Метрики хендлеров и Telegram API
+        setup_bot_metrics(dp, bot)
+        if settings.METRICS_PORT:
+            try:
+                start_metrics_server(settings.METRICS_PORT)
+            except Exception as e:
+                logger.error(f"❌ Failed to start metrics server on port {settings.METRICS_PORT}: {e}")
+        
         # 🚨 РЕГИСТРАЦИЯ HANDLERS В ПРАВИЛЬНОМ ПОРЯДКЕ!
         await register_handlers_in_correct_order(dp)
         
@@ -362,6 +396,9 @@ async def main():
         logger.info("🗄️ Initializing database...")
         await init_db()
         
+        # Инвалидация кэша пользователей из веб-процесса (оплаты)
+        await start_user_cache_sync()
+        
         # 🆕 Обновляем admin_id в поддержке
         # enhanced_support.admin_id = settings.ADMIN_ID
         support_handler.admin_id = settings.ADMIN_ID
@@ -398,6 +435,15 @@ async def main():
 
         asyncio.create_task(start_automated_messaging_worker(bot))
 
+        # Продолжение рассылок, прерванных рестартом
+        try:
+            resumed = await broadcast_job_runner.resume_unfinished(bot)
+            if resumed:
+                logger.info(f"📢 Resumed {resumed} broadcast job(s)")
+        except Exception as e:
+            logger.error(f"❌ Failed to resume broadcast jobs: {e}")
+        broadcast_job_runner.start_resume_loop(bot)
+
         # 🆕 Запуск планировщика ежедневных отчетов
         try:
             from datetime import time as dt_time
@@ -407,13 +453,28 @@ async def main():
         except Exception as e:
             logger.error(f"❌ Failed to start daily reports scheduler: {e}")
 
-        # Запуск polling
-        logger.info("🚀 Starting polling...")
-        await dp.start_polling(
-            bot,
-            skip_updates=True,
-            allowed_updates=['message', 'callback_query']
-        )
+        # Периодическая сверка счетчиков партнеров
+        try:
+            await partner_stats_reconciler.start()
+        except Exception as e:
+            logger.error(f"❌ Failed to start partner stats reconciler: {e}")
+
+        # Пересчет дневного среза воронки
+        try:
+            await funnel_refresher.start()
+        except Exception as e:
+            logger.error(f"❌ Failed to start funnel refresher: {e}")
+
+        if settings.BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            # Запуск polling
+            logger.info("🚀 Starting polling...")
+            await dp.start_polling(
+                bot,
+                skip_updates=True,
+                allowed_updates=['message', 'callback_query']
+            )
         
     except Exception as e:
         logger.error(f"💥 Bot crashed: {str(e)}", exc_info=True)
@@ -423,6 +484,52 @@ async def main():
         
         
 
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """
+    Запуск в режиме webhook: FastAPI (app/webapp.py) принимает апдейты
+    и кладет их в очередь, воркеры UpdateQueue передают их в диспетчер
+    """
+    if not settings.WEBHOOK_SECRET:
+        # Без секрета любой может прислать апдейт от имени админа
+        raise RuntimeError("WEBHOOK_SECRET is required for BOT_MODE=webhook")
+    
+    import uvicorn
+    from app.webapp import app as web_app
+    from app.services.update_queue import UpdateQueue
+    
+    update_queue = UpdateQueue(
+        dp, bot,
+        max_size=settings.UPDATE_QUEUE_SIZE,
+        workers=settings.UPDATE_WORKERS
+    )
+    
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+    await update_queue.start()
+    web_app.state.update_queue = update_queue
+    
+    webhook_url = f"{settings.DOMAIN.rstrip('/')}{settings.WEBHOOK_PATH}"
+    await bot.set_webhook(
+        url=webhook_url,
+        secret_token=settings.WEBHOOK_SECRET,
+        allowed_updates=['message', 'callback_query'],
+        drop_pending_updates=True
+    )
+    logger.info(f"🚀 Webhook set: {webhook_url}, serving on {settings.WEBHOOK_HOST}:{settings.WEBHOOK_PORT}")
+    
+    server = uvicorn.Server(uvicorn.Config(
+        web_app,
+        host=settings.WEBHOOK_HOST,
+        port=settings.WEBHOOK_PORT,
+        log_level="info"
+    ))
+    try:
+        await server.serve()
+    finally:
+        web_app.state.update_queue = None
+        await update_queue.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+
+
 async def init_course_videos():
     """Инициализация видео-уроков в базе данных"""
     try:
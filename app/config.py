@@ -13,6 +13,21 @@ class Settings(BaseSettings):
     
     # DeepSeek AI
     DEEPSEEK_API_KEY: str
+    DEEPSEEK_API_URL: str = "https://api.deepseek.com/v1/chat/completions"
+    # Одновременные запросы к модели, таймаут запроса (сек), повторы при 429/5xx
+    # и общий срок вызова вместе с повторами и ожиданием очереди (сек)
+    DEEPSEEK_MAX_CONCURRENCY: int = 8
+    DEEPSEEK_TIMEOUT: float = 30.0
+    DEEPSEEK_MAX_RETRIES: int = 3
+    DEEPSEEK_DEADLINE: float = 60.0
+    # Кэш сопоставления вопросов: время жизни записи (сек) и максимум записей
+    DEEPSEEK_CACHE_TTL: int = 3600
+    DEEPSEEK_CACHE_MAX_SIZE: int = 5000
+    # Локальное сопоставление вопросов (TF-IDF): порог ответа без API,
+    # минимальный отрыв от второго кандидата, сколько кандидатов отдавать в DeepSeek
+    SUPPORT_MATCH_ACCEPT_SCORE: float = 0.8
+    SUPPORT_MATCH_MARGIN: float = 0.1
+    SUPPORT_MATCH_TOP_K: int = 5
     
     ADMIN_ID: int
     ADMIN_IDS: str = ""  # Строка с ID админов через запятую
@@ -24,10 +39,107 @@ class Settings(BaseSettings):
     # Database
     DATABASE_URL: str
     REDIS_URL: str
-    
+
+    # Пул соединений и инструментирование БД
+    DB_ECHO: bool = False
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30  # секунды ожидания свободного соединения
+    DB_POOL_RECYCLE: int = 1800  # секунды
+    DB_POOL_PRE_PING: bool = True
+    # Кэш prepared statements (SQLAlchemy и asyncpg). 0 - для pgbouncer в
+    # transaction mode: оба кэша выключены, имена statements уникальны
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_SLOW_QUERY_MS: int = 200  # 0 - не логировать медленные запросы
+
+    # Кэш состояния пользователей (OnboardingCheckMiddleware)
+    USER_CACHE_MAX_SIZE: int = 50000
+    USER_CACHE_TTL: int = 300  # секунды
+    # Секунды для пользователей без оплаты (оплату завершает веб-процесс) - только
+    # пока нет подписки на инвалидации (USER_CACHE_SYNC=none или Redis недоступен)
+    USER_CACHE_PREPAYMENT_TTL: int = 5
+    # Рассылка инвалидаций кэша между процессами: "redis" (pub/sub) или "none"
+    USER_CACHE_SYNC: str = "redis"
+    USER_CACHE_CHANNEL: str = "user_cache:invalidate"
+
+    # FSM хранилище: "memory" (один процесс) или "redis" (несколько реплик)
+    FSM_STORAGE: str = "memory"
+    FSM_KEY_PREFIX: str = "fsm"
+    FSM_STATE_TTL: int = 7 * 24 * 3600  # секунды, 0 - без TTL
+    FSM_DATA_TTL: int = 7 * 24 * 3600
+    FSM_LOCK_TIMEOUT: int = 60
+
+    # Ограничение частоты запросов (token bucket)
+    THROTTLE_BACKEND: str = "memory"  # memory / redis
+    THROTTLE_RATE: float = 1.0  # токенов в секунду
+    THROTTLE_BURST: float = 5.0  # емкость ведра
+
+    # Автосообщения: период пересинхронизации планировщика с БД (сек)
+    AUTOMATED_MESSAGES_RESYNC_INTERVAL: int = 300
+    # Сколько сообщение может висеть в sending, прежде чем его пометят failed (сек)
+    AUTOMATED_MESSAGES_SENDING_TIMEOUT: int = 600
+    DRIP_CAMPAIGNS_FILE: str = ""  # JSON с кампаниями (пусто - встроенные)
+
+    # Рассылки: общий лимит исходящих сообщений и параллельность
+    BROADCAST_RATE_LIMIT: float = 28.0  # сообщений в секунду (лимит Telegram ~30)
+    BROADCAST_CONCURRENCY: int = 20
+    BROADCAST_BATCH_SIZE: int = 200  # получателей между чекпоинтами задачи
+    BROADCAST_LEASE_SECONDS: int = 120  # без heartbeat дольше - задачу подхватит другой процесс
+
+    # Выгрузка CSV-отчетов: строк за одно чтение курсора, порог сброса на диск, zip
+    REPORT_EXPORT_BATCH_SIZE: int = 1000
+    REPORT_SPOOL_MAX_SIZE: int = 1024 * 1024  # байт в памяти до записи во временный файл
+    REPORT_CSV_ZIP: bool = False
+
+    # Сверка partner_stats с clicks/sales: период в секундах (0 - отключено)
+    PARTNER_STATS_RECONCILE_INTERVAL: int = 3600
+
+    # Пересчет помеченных дней daily_funnel_stats: период в секундах
+    FUNNEL_REFRESH_INTERVAL: float = 10.0
+
+    # Клики /track: пакетная запись (период, размер пачки), длина очереди,
+    # период перезагрузки известных ref_code (сек), попыток записи пачки
+    # до деления и файл для кликов, которые БД так и не приняла
+    CLICK_FLUSH_INTERVAL_MS: int = 200
+    CLICK_FLUSH_BATCH_SIZE: int = 500
+    CLICK_BUFFER_SIZE: int = 50000
+    CLICK_REF_CODES_REFRESH_INTERVAL: int = 300
+    CLICK_FLUSH_MAX_ATTEMPTS: int = 5
+    CLICK_DEAD_LETTER_FILE: str = "clicks_failed.jsonl"
+
+    # Prometheus: порт HTTP-сервера метрик бота (0 - отключено;
+    # 9100 не берем - его обычно занимает node_exporter)
+    METRICS_PORT: int = 9108
+
+    # Режим получения апдейтов: "polling" или "webhook"
+    BOT_MODE: str = "polling"
+    WEBHOOK_PATH: str = "/webhook/telegram"
+    WEBHOOK_SECRET: str = ""  # обязателен при BOT_MODE=webhook
+    WEBHOOK_HOST: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8080
+    UPDATE_QUEUE_SIZE: int = 10000
+    UPDATE_WORKERS: int = 8
+
     # Google Sheets
     GOOGLE_SHEETS_KEY: str
     SPREADSHEET_ID: str
+    # Отложенная запись в Sheets: файл очереди, размер пачки append_rows,
+    # период записи и максимальная задержка повтора (сек).
+    # У каждого процесса свой файл: к имени добавляется PROCESS_ROLE
+    # (data/sheets_payments_queue.bot.json, ...web.json), каталог data
+    # должен быть на постоянном томе
+    PROCESS_ROLE: str = "bot"  # bot / web
+    SHEETS_QUEUE_FILE: str = "data/sheets_payments_queue.json"
+    SHEETS_BATCH_SIZE: int = 100
+    SHEETS_FLUSH_INTERVAL: float = 2.0
+    SHEETS_MAX_BACKOFF: float = 64.0
+    # Период записи переписок поддержки в лист "Чат админов" (сек) и файл для
+    # переписок, которые Sheets отклонил (400/403); к имени добавляется PROCESS_ROLE
+    SUPPORT_CHAT_FLUSH_INTERVAL: float = 5.0
+    SUPPORT_CHAT_FAILED_FILE: str = "data/support_chats.failed"
+    # Снимок автоответов: локальная копия и период проверки таблицы на изменения (сек)
+    AUTO_ANSWERS_SNAPSHOT_FILE: str = "auto_answers_snapshot.json"
+    AUTO_ANSWERS_REFRESH_INTERVAL: int = 300
     
     OAuth_client: str
     GOOGLE_TOKEN_FILE: str
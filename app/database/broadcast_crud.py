@@ -0,0 +1,344 @@
+"""
+CRUD операции для сохраняемых рассылок
+app/database/broadcast_crud.py
+"""
+import json
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import pytz
+from sqlalchemy import func, insert, literal, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.models import (
+    BroadcastDelivery,
+    BroadcastDeliveryStatus,
+    BroadcastJob,
+    BroadcastJobStatus,
+    OnboardingStage,
+    User,
+)
+
+_active = User.status == "active"
+
+# Аудитории рассылки: audience_type -> условия на users. Получатели выбираются
+# при создании задачи одним INSERT ... SELECT, список не проходит через память
+# бота и FSM
+AUDIENCES = {
+    "all_users": [_active],
+    "paid_users": [_active, User.payment_completed == True],
+    "unpaid_users": [_active, User.onboarding_stage.in_([OnboardingStage.NEW_USER, OnboardingStage.INTRO_SHOWN])],
+    "want_join_users": [_active, User.onboarding_stage == OnboardingStage.WANT_JOIN],
+    "payment_page_users": [_active, User.onboarding_stage == OnboardingStage.WAIT_PAYMENT],
+    "specific_users": [_active],  # + telegram_id из списка админа
+    # Сегменты (UserSegmentCRUD)
+    "new_leads": [
+        User.payment_completed == False,
+        User.onboarding_stage.in_([
+            OnboardingStage.NEW_USER, OnboardingStage.INTRO_SHOWN, OnboardingStage.WAIT_PAYMENT
+        ])
+    ],
+    "partners": [User.onboarding_stage == OnboardingStage.COMPLETED],
+    "partners_without_team": [
+        User.payment_completed == True,
+        User.onboarding_stage != OnboardingStage.COMPLETED,
+        User.onboarding_stage != OnboardingStage.GOT_LINK
+    ],
+    "partners_completed": [User.onboarding_stage == OnboardingStage.COMPLETED],
+    "partners_in_team": [User.onboarding_stage == OnboardingStage.GOT_LINK],
+    "learning_users": [
+        User.onboarding_stage.in_([
+            OnboardingStage.WANT_JOIN, OnboardingStage.READY_START,
+            OnboardingStage.PARTNER_LESSON, OnboardingStage.LESSON_DONE
+        ])
+    ],
+}
+
+
+def audience_conditions(audience_type: str, telegram_ids: Optional[Iterable[int]] = None) -> list:
+    """Условия на users для аудитории (specific_users - только telegram_ids)"""
+    if audience_type not in AUDIENCES:
+        raise ValueError(f"Unknown broadcast audience: {audience_type}")
+    conditions = [User.telegram_id.isnot(None), *AUDIENCES[audience_type]]
+    if audience_type == "specific_users":
+        conditions.append(User.telegram_id.in_(list(telegram_ids or [])))
+    return conditions
+
+# Колонки счетчиков задачи по категории ошибки
+ERROR_COUNTERS = {
+    'blocked': 'blocked_count',
+    'not_found': 'not_found_count',
+    'other': 'other_error_count',
+}
+
+
+class BroadcastJobCRUD:
+    """CRUD операции для broadcast_jobs / broadcast_deliveries"""
+
+    @staticmethod
+    async def create_job(
+        session: AsyncSession,
+        admin_id: int,
+        admin_name: str,
+        audience_type: str,
+        media_data: Dict,
+        telegram_ids: Optional[Iterable[int]] = None,
+        progress_chat_id: Optional[int] = None,
+        progress_message_id: Optional[int] = None
+    ) -> BroadcastJob:
+        """
+        Создание задачи и строк доставки в одной транзакции
+
+        Строки доставки создаются INSERT ... SELECT из users по условиям
+        аудитории (см. AUDIENCES); telegram_ids - только для specific_users.
+        """
+        conditions = audience_conditions(audience_type, telegram_ids)
+
+        job = BroadcastJob(
+            admin_id=admin_id,
+            admin_name=admin_name,
+            audience_type=audience_type,
+            media_data=json.dumps(media_data, ensure_ascii=False),
+            status=BroadcastJobStatus.RUNNING,
+            progress_chat_id=progress_chat_id,
+            progress_message_id=progress_message_id,
+            started_at=datetime.now(pytz.UTC)
+        )
+        session.add(job)
+        await session.flush()
+
+        # users.telegram_id уникален - дублей получателей нет
+        result = await session.execute(
+            insert(BroadcastDelivery).from_select(
+                ['job_id', 'telegram_id'],
+                select(literal(job.id), User.telegram_id).where(*conditions).order_by(User.id)
+            )
+        )
+
+        job.total_count = result.rowcount
+        await session.commit()
+        await session.refresh(job)
+        return job
+
+    @staticmethod
+    async def count_audience(
+        session: AsyncSession,
+        audience_type: str,
+        telegram_ids: Optional[Iterable[int]] = None
+    ) -> int:
+        """Количество получателей аудитории (для предпросмотра)"""
+        result = await session.execute(
+            select(func.count(User.id)).where(*audience_conditions(audience_type, telegram_ids))
+        )
+        return result.scalar() or 0
+
+    @staticmethod
+    async def get_job(session: AsyncSession, job_id: int) -> Optional[BroadcastJob]:
+        result = await session.execute(
+            select(BroadcastJob).where(BroadcastJob.id == job_id)
+        )
+        return result.scalar_one_or_none()
+
+    @staticmethod
+    async def get_job_status(session: AsyncSession, job_id: int) -> Optional[str]:
+        result = await session.execute(
+            select(BroadcastJob.status).where(BroadcastJob.id == job_id)
+        )
+        return result.scalar_one_or_none()
+
+    @staticmethod
+    async def get_jobs_by_status(session: AsyncSession, statuses: Sequence[str]) -> List[BroadcastJob]:
+        result = await session.execute(
+            select(BroadcastJob)
+            .where(BroadcastJob.status.in_(statuses))
+            .order_by(BroadcastJob.id)
+        )
+        return result.scalars().all()
+
+    @staticmethod
+    async def get_resumable_jobs(session: AsyncSession, lease_seconds: float) -> List[BroadcastJob]:
+        """Задачи running без живой аренды (процесс-владелец остановлен или упал)"""
+        result = await session.execute(
+            select(BroadcastJob)
+            .where(BroadcastJob.status == BroadcastJobStatus.RUNNING, _lease_expired(lease_seconds))
+            .order_by(BroadcastJob.id)
+        )
+        return result.scalars().all()
+
+    @staticmethod
+    async def claim_job(session: AsyncSession, job_id: int, owner: str, lease_seconds: float) -> bool:
+        """
+        Захват задачи процессом (атомарный UPDATE)
+
+        Returns:
+            True если задача свободна, уже принадлежит owner или аренда просрочена
+        """
+        result = await session.execute(
+            update(BroadcastJob)
+            .where(
+                BroadcastJob.id == job_id,
+                BroadcastJob.status == BroadcastJobStatus.RUNNING,
+                or_(BroadcastJob.claimed_by == owner, _lease_expired(lease_seconds))
+            )
+            .values(claimed_by=owner, heartbeat_at=func.now())
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+    @staticmethod
+    async def renew_lease(session: AsyncSession, job_id: int, owner: str) -> Optional[str]:
+        """
+        Heartbeat владельца (перед пачкой и во время ее отправки)
+
+        Returns:
+            Статус задачи или None, если аренду перехватил другой процесс
+        """
+        result = await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id, BroadcastJob.claimed_by == owner)
+            .values(heartbeat_at=func.now())
+            .returning(BroadcastJob.status)
+        )
+        status = result.scalar_one_or_none()
+        await session.commit()
+        return status
+
+    @staticmethod
+    async def release_job(session: AsyncSession, job_id: int, owner: str) -> None:
+        """Освобождение аренды (пауза, отмена, завершение)"""
+        await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id, BroadcastJob.claimed_by == owner)
+            .values(claimed_by=None, heartbeat_at=None)
+        )
+        await session.commit()
+
+    @staticmethod
+    async def get_recent_jobs(session: AsyncSession, limit: int = 10) -> List[BroadcastJob]:
+        result = await session.execute(
+            select(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(limit)
+        )
+        return result.scalars().all()
+
+    @staticmethod
+    async def get_totals(session: AsyncSession) -> Dict:
+        """Сводка по завершенным рассылкам для /broadcast_stats"""
+        result = await session.execute(
+            select(
+                func.count(BroadcastJob.id),
+                func.coalesce(func.sum(BroadcastJob.sent_count), 0),
+                func.max(BroadcastJob.finished_at)
+            ).where(BroadcastJob.status == BroadcastJobStatus.COMPLETED)
+        )
+        total_broadcasts, total_messages_sent, last_broadcast = result.one()
+        return {
+            'total_broadcasts': total_broadcasts,
+            'total_messages_sent': total_messages_sent,
+            'last_broadcast': last_broadcast
+        }
+
+    @staticmethod
+    async def set_status(
+        session: AsyncSession,
+        job_id: int,
+        status: str,
+        expected: Optional[Sequence[str]] = None
+    ) -> bool:
+        """
+        Смена статуса задачи
+
+        Args:
+            expected: Допустимые текущие статусы (переход атомарный)
+
+        Returns:
+            True если статус изменен
+        """
+        values = {'status': status}
+        if status in (BroadcastJobStatus.COMPLETED, BroadcastJobStatus.CANCELLED, BroadcastJobStatus.FAILED):
+            values['finished_at'] = datetime.now(pytz.UTC)
+
+        stmt = update(BroadcastJob).where(BroadcastJob.id == job_id)
+        if expected:
+            stmt = stmt.where(BroadcastJob.status.in_(expected))
+
+        result = await session.execute(stmt.values(**values))
+        await session.commit()
+        return result.rowcount > 0
+
+    @staticmethod
+    async def stream_pending_deliveries(
+        session: AsyncSession,
+        job_id: int,
+        after_id: int = 0,
+        batch_size: int = 500,
+        limit: Optional[int] = None
+    ) -> AsyncIterator[Sequence[Tuple[int, int]]]:
+        """
+        Ожидающие получатели пачками (id, telegram_id) через серверный курсор
+
+        Сессия держит соединение и транзакцию, пока идет итерация - для записи
+        результатов нужна отдельная сессия, а limit ограничивает время жизни курсора.
+        """
+        result = await session.stream(
+            select(BroadcastDelivery.id, BroadcastDelivery.telegram_id)
+            .where(
+                BroadcastDelivery.job_id == job_id,
+                BroadcastDelivery.status == BroadcastDeliveryStatus.PENDING,
+                BroadcastDelivery.id > after_id
+            )
+            .order_by(BroadcastDelivery.id)
+            .limit(limit)
+            .execution_options(yield_per=batch_size)
+        )
+        async for partition in result.partitions(batch_size):
+            yield partition
+
+    @staticmethod
+    async def record_batch(
+        session: AsyncSession,
+        job_id: int,
+        sent_ids: List[int],
+        failed_ids: Dict[str, List[int]],
+        checkpoint_id: int
+    ) -> None:
+        """
+        Результаты пачки: один UPDATE на статус доставки плюс счетчики
+        и чекпоинт задачи, все в одной транзакции
+
+        Счетчики растут только на доставки, которые действительно вышли из
+        pending - повторная запись той же пачки их не удваивает.
+        """
+        now = datetime.now(pytz.UTC)
+        counters = {}
+
+        async def mark(ids: List[int], column: str, **values) -> None:
+            if not ids:
+                return
+            result = await session.execute(
+                update(BroadcastDelivery)
+                .where(BroadcastDelivery.id.in_(ids), BroadcastDelivery.status == BroadcastDeliveryStatus.PENDING)
+                .values(processed_at=now, **values)
+            )
+            if result.rowcount:
+                counters[column] = counters.get(column, getattr(BroadcastJob, column)) + result.rowcount
+
+        await mark(sent_ids, 'sent_count', status=BroadcastDeliveryStatus.SENT)
+        for error_kind, ids in failed_ids.items():
+            column = ERROR_COUNTERS.get(error_kind, 'other_error_count')
+            await mark(ids, column, status=BroadcastDeliveryStatus.FAILED, error_kind=error_kind)
+
+        await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id)
+            .values(last_delivery_id=checkpoint_id, **counters)
+        )
+        await session.commit()
+
+
+def _lease_expired(lease_seconds: float):
+    """Условие: у задачи нет владельца или его heartbeat старше lease_seconds (часы БД)"""
+    return or_(
+        BroadcastJob.claimed_by.is_(None),
+        BroadcastJob.heartbeat_at.is_(None),
+        BroadcastJob.heartbeat_at < func.now() - timedelta(seconds=lease_seconds)
+    )
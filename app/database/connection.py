@@ -1,16 +1,13 @@
 """
 Подключение к базе данных
 """
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-from app.config import settings
+from app.database.engine import create_db_engine
 
-engine = create_async_engine(
-    settings.DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg://'),
-    echo=True
-)
+engine = create_db_engine()
 
 AsyncSessionLocal = sessionmaker(
     engine,
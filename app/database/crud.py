@@ -2,16 +2,21 @@
 Исправленные CRUD операции для правильного подсчета продаж
 """
 import logging
-from sqlalchemy import select, update, func
+from sqlalchemy import select, update, insert, func
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 from datetime import datetime, timedelta
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict
 
 from app.database.models import (
     User, Click, Sale, Withdrawal, CourseVideo, 
     UserCourseProgress, OnboardingStage, Payment, ReferralHistory,
-    AutomatedMessage, AutomatedMessageStatus  
+    AutomatedMessage, AutomatedMessageStatus, PartnerStats
 )
+from app.database.funnel_crud import FunnelStatsCRUD
+from app.database.partner_stats_crud import PartnerStatsCRUD, sale_deltas
+from app.database.user_cache import user_state_cache
+from app.services.message_scheduler import automated_message_scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +35,7 @@ class ClickCRUD:
             user_telegram_id=user_telegram_id
         )
         session.add(click)
+        await PartnerStatsCRUD.increment(session, ref_code, clicks=1)
         await session.commit()
         await session.refresh(click)
         return click
@@ -49,10 +55,28 @@ class ClickCRUD:
             logger.error(f"Error getting last click for user {user_telegram_id}: {e}")
             return None
 
+    @staticmethod
+    async def get_last_anonymous_click(session: AsyncSession, ref_code: str, since: datetime) -> Optional[Click]:
+        """Последний веб-клик по ref_code без привязки к пользователю, не раньше since"""
+        result = await session.execute(
+            select(Click)
+            .where(
+                Click.ref_code == ref_code,
+                Click.user_telegram_id.is_(None),
+                Click.created_at >= since
+            )
+            .order_by(Click.created_at.desc())
+            .limit(1)
+        )
+        return result.scalar_one_or_none()
+
     @staticmethod
     async def count_clicks_by_ref_code(session: AsyncSession, ref_code: str) -> int:
         """Подсчет кликов по реферальному коду"""
         try:
+            stats = await PartnerStatsCRUD.get(session, ref_code)
+            if stats is not None:
+                return stats.clicks or 0
             result = await session.execute(
                 select(func.count(Click.id)).where(Click.ref_code == ref_code)
             )
@@ -137,6 +161,7 @@ class UserCRUD:
             .values(gender=gender)
         )
         await session.commit()
+        user_state_cache.update(telegram_id, gender=gender)
         return result.rowcount > 0
     
     @staticmethod
@@ -155,6 +180,8 @@ class UserCRUD:
         session.add(user)
         await session.commit()
         await session.refresh(user)
+        user_state_cache.put(user)
+        FunnelStatsCRUD.touch()
         return user
     
     @staticmethod
@@ -173,6 +200,29 @@ class UserCRUD:
         )
         return result.scalar_one_or_none()
     
+    @staticmethod
+    async def get_invite_counts(session: AsyncSession, telegram_ids: List[int]) -> Dict[int, int]:
+        """
+        Количество оплативших приглашенных для нескольких партнеров одним запросом
+
+        Считается по users (referred_by + payment_completed), а не по sales:
+        обнуление баланса удаляет продажи, но приглашенные остаются.
+
+        Returns:
+            {telegram_id: количество}, для партнеров без оплативших - 0
+        """
+        if not telegram_ids:
+            return {}
+        invitee = aliased(User)
+        result = await session.execute(
+            select(User.telegram_id, func.count(invitee.id))
+            .select_from(User)
+            .outerjoin(invitee, (invitee.referred_by == User.ref_code) & (invitee.payment_completed == True))
+            .where(User.telegram_id.in_(telegram_ids))
+            .group_by(User.telegram_id)
+        )
+        return {telegram_id: count for telegram_id, count in result.all()}
+    
     # Методы для онбординга
     
     @staticmethod
@@ -190,6 +240,8 @@ class UserCRUD:
             .values(onboarding_stage=stage)
         )
         await session.commit()
+        user_state_cache.update(telegram_id, onboarding_stage=stage)
+        FunnelStatsCRUD.touch_user(telegram_id)
         return result.rowcount > 0
     
     @staticmethod
@@ -204,6 +256,12 @@ class UserCRUD:
             )
         )
         await session.commit()
+        user_state_cache.update(
+            telegram_id,
+            payment_completed=True,
+            onboarding_stage=OnboardingStage.PAYMENT_OK
+        )
+        FunnelStatsCRUD.touch_user(telegram_id)
         return result.rowcount > 0
     
     @staticmethod
@@ -222,6 +280,8 @@ class UserCRUD:
             )
         )
         await session.commit()
+        user_state_cache.invalidate(telegram_id)
+        FunnelStatsCRUD.touch_user(telegram_id)
         return result.rowcount > 0
         
     @staticmethod
@@ -302,6 +362,8 @@ class UserCRUD:
             )
         )
         await session.commit()
+        user_state_cache.invalidate(telegram_id)
+        FunnelStatsCRUD.touch_user(telegram_id)
         return result.rowcount > 0
     
     @staticmethod
@@ -316,6 +378,8 @@ class UserCRUD:
             )
         )
         await session.commit()
+        user_state_cache.invalidate(telegram_id)
+        FunnelStatsCRUD.touch_user(telegram_id)
         return result.rowcount > 0
     
     @staticmethod
@@ -330,6 +394,8 @@ class UserCRUD:
             )
         )
         await session.commit()
+        user_state_cache.invalidate(telegram_id)
+        FunnelStatsCRUD.touch_user(telegram_id)
         return result.rowcount > 0
 
     # Методы для рассылки
@@ -489,8 +555,10 @@ class SaleCRUD:
             status="confirmed"  # СРАЗУ ПОДТВЕРЖДЕМ для тестовых платежей
         )
         session.add(sale)
+        await PartnerStatsCRUD.increment(session, ref_code, **sale_deltas(sale.status, commission_amount))
         await session.commit()
         await session.refresh(sale)
+        FunnelStatsCRUD.touch()
         return sale
     
     @staticmethod
@@ -511,6 +579,9 @@ class SaleCRUD:
     async def count_user_sales(session: AsyncSession, ref_code: str) -> int:
         """Подсчет количества продаж пользователя"""
         try:
+            stats = await PartnerStatsCRUD.get(session, ref_code)
+            if stats is not None:
+                return stats.total_sales or 0
             result = await session.execute(
                 select(func.count(Sale.id)).where(Sale.ref_code == ref_code)
             )
@@ -524,6 +595,9 @@ class SaleCRUD:
     async def count_confirmed_sales(session: AsyncSession, ref_code: str) -> int:
         """Подсчет количества подтвержденных продаж"""
         try:
+            stats = await PartnerStatsCRUD.get(session, ref_code)
+            if stats is not None:
+                return stats.confirmed_sales or 0
             result = await session.execute(
                 select(func.count(Sale.id)).where(
                     Sale.ref_code == ref_code,
@@ -535,11 +609,14 @@ class SaleCRUD:
         except Exception as e:
             logger.error(f"Error counting confirmed sales for ref_code {ref_code}: {e}")
             return 0
-    
+
     @staticmethod
     async def get_total_commission(session: AsyncSession, ref_code: str) -> float:
         """Получение общей суммы комиссии - ИСПРАВЛЕНО"""
         try:
+            stats = await PartnerStatsCRUD.get(session, ref_code)
+            if stats is not None:
+                return float(stats.confirmed_commission or 0)
             result = await session.execute(
                 select(func.sum(Sale.commission_amount)).where(
                     Sale.ref_code == ref_code,
@@ -553,6 +630,60 @@ class SaleCRUD:
             logger.error(f"Error getting total commission for ref_code {ref_code}: {e}")
             return 0.0
 
+    @staticmethod
+    async def get_partner_stats(session: AsyncSession, ref_code: str) -> dict:
+        """
+        Все показатели экрана статистики партнера одним запросом
+
+        Счетчики берутся из partner_stats, заработок за 30 дней - подзапросом
+        по sales. Если строки счетчиков еще нет (до сверки), все считается
+        по clicks/sales: по статусам - через FILTER, клики - подзапросом.
+        """
+        month_ago = datetime.now() - timedelta(days=30)
+        confirmed = Sale.status == "confirmed"
+        month_earned = select(
+            func.coalesce(func.sum(Sale.commission_amount), 0)
+        ).where(Sale.ref_code == ref_code, confirmed, Sale.created_at >= month_ago).scalar_subquery()
+
+        row = (await session.execute(
+            select(PartnerStats, month_earned.label("month_earned")).where(PartnerStats.ref_code == ref_code)
+        )).one_or_none()
+        if row is not None:
+            counters, month = row
+            return {
+                "clicks": counters.clicks or 0,
+                "total_sales": counters.total_sales or 0,
+                "confirmed_sales": counters.confirmed_sales or 0,
+                "pending_sales": counters.pending_sales or 0,
+                "cancelled_sales": counters.cancelled_sales or 0,
+                "total_earned": float(counters.confirmed_commission or 0),
+                "pending_amount": float(counters.pending_commission or 0),
+                "month_earned": float(month or 0),
+            }
+
+        clicks = select(func.count(Click.id)).where(Click.ref_code == ref_code).scalar_subquery()
+
+        result = await session.execute(
+            select(
+                clicks.label("clicks"),
+                func.count(Sale.id).label("total_sales"),
+                func.count(Sale.id).filter(confirmed).label("confirmed_sales"),
+                func.count(Sale.id).filter(Sale.status == "pending").label("pending_sales"),
+                func.count(Sale.id).filter(Sale.status == "cancelled").label("cancelled_sales"),
+                func.coalesce(func.sum(Sale.commission_amount).filter(confirmed), 0).label("total_earned"),
+                func.coalesce(
+                    func.sum(Sale.commission_amount).filter(Sale.status == "pending"), 0
+                ).label("pending_amount"),
+                func.coalesce(
+                    func.sum(Sale.commission_amount).filter(confirmed, Sale.created_at >= month_ago), 0
+                ).label("month_earned"),
+            ).where(Sale.ref_code == ref_code)
+        )
+        stats = dict(result.one()._mapping)
+        for key in ("total_earned", "pending_amount", "month_earned"):
+            stats[key] = float(stats[key])
+        return stats
+
 
 # CRUD для новых моделей онбординга
 
@@ -713,6 +844,8 @@ class PaymentCRUD:
             
             await session.commit()
             await session.refresh(payment)
+            if status == "paid":
+                FunnelStatsCRUD.touch()
         
         return payment
     
@@ -753,6 +886,7 @@ class AutomatedMessageCRUD:
         session.add(message)
         await session.commit()
         await session.refresh(message)
+        automated_message_scheduler.notify_created(message)
         return message
     
     @staticmethod
@@ -765,6 +899,95 @@ class AutomatedMessageCRUD:
         )
         return result.scalars().all()
     
+    @staticmethod
+    async def get_due_messages_with_stage(session: AsyncSession, limit: int = 100):
+        """
+        Наступившие сообщения одним запросом вместе с текущей стадией пользователя
+        
+        Returns:
+            Строки (id, telegram_id, video_file_id, required_stage, blocked_stages,
+            onboarding_stage); onboarding_stage = None, если пользователя нет
+        """
+        result = await session.execute(
+            select(
+                AutomatedMessage.id,
+                AutomatedMessage.telegram_id,
+                AutomatedMessage.video_file_id,
+                AutomatedMessage.required_stage,
+                AutomatedMessage.blocked_stages,
+                User.onboarding_stage
+            )
+            .outerjoin(User, User.telegram_id == AutomatedMessage.telegram_id)
+            .where(AutomatedMessage.status == AutomatedMessageStatus.SCHEDULED)
+            .where(AutomatedMessage.scheduled_at <= datetime.now())
+            .order_by(AutomatedMessage.scheduled_at).limit(limit)
+        )
+        return result.all()
+    
+    @staticmethod
+    async def claim_messages(session: AsyncSession, message_ids: List[int]) -> List[int]:
+        """
+        Перевод пачки из scheduled в sending перед отправкой
+
+        Returns:
+            id, которые взял этот воркер (остальные уже обработаны или отменены)
+        """
+        if not message_ids:
+            return []
+        result = await session.execute(
+            update(AutomatedMessage)
+            .where(
+                AutomatedMessage.id.in_(message_ids),
+                AutomatedMessage.status == AutomatedMessageStatus.SCHEDULED
+            )
+            .values(status=AutomatedMessageStatus.SENDING, updated_at=func.now())
+            .returning(AutomatedMessage.id)
+        )
+        claimed = list(result.scalars().all())
+        await session.commit()
+        return claimed
+    
+    @staticmethod
+    async def fail_stuck_messages(session: AsyncSession, timeout_seconds: float) -> int:
+        """
+        Сообщения, которые висят в sending дольше timeout_seconds (часы БД), -> failed
+        
+        Воркер упал посреди пачки или не смог записать результат; доставка
+        неизвестна, поэтому сообщение не переотправляется.
+        """
+        result = await session.execute(
+            update(AutomatedMessage)
+            .where(
+                AutomatedMessage.status == AutomatedMessageStatus.SENDING,
+                AutomatedMessage.updated_at < func.now() - timedelta(seconds=timeout_seconds)
+            )
+            .values(
+                status=AutomatedMessageStatus.FAILED,
+                error_message="Interrupted while sending, delivery unknown"
+            )
+        )
+        await session.commit()
+        return result.rowcount
+    
+    @staticmethod
+    async def count_sending_messages(session: AsyncSession) -> int:
+        """Количество сообщений, взятых в отправку (sending)"""
+        result = await session.execute(
+            select(func.count(AutomatedMessage.id))
+            .where(AutomatedMessage.status == AutomatedMessageStatus.SENDING)
+        )
+        return result.scalar() or 0
+    
+    @staticmethod
+    async def count_pending_messages(session: AsyncSession) -> int:
+        """Количество запланированных сообщений, время отправки которых наступило"""
+        result = await session.execute(
+            select(func.count(AutomatedMessage.id))
+            .where(AutomatedMessage.status == AutomatedMessageStatus.SCHEDULED)
+            .where(AutomatedMessage.scheduled_at <= datetime.now())
+        )
+        return result.scalar() or 0
+    
     @staticmethod
     async def update_message_status(session: AsyncSession, message_id: int, 
                                    status: str, error_message: str = None):
@@ -780,6 +1003,31 @@ class AutomatedMessageCRUD:
         await session.commit()
         return result.rowcount > 0
     
+    @staticmethod
+    async def bulk_update_status(session: AsyncSession, updates: dict) -> int:
+        """
+        Запись результатов пачки: один UPDATE на каждую пару (статус, ошибка)
+        
+        Args:
+            updates: {(status, error_message): [message_id, ...]}
+        """
+        now = datetime.now()
+        updated = 0
+        for (status, error_message), message_ids in updates.items():
+            if not message_ids:
+                continue
+            values = {"status": status}
+            if status == AutomatedMessageStatus.SENT:
+                values["sent_at"] = now
+            if error_message:
+                values["error_message"] = error_message
+            result = await session.execute(
+                update(AutomatedMessage).where(AutomatedMessage.id.in_(message_ids)).values(**values)
+            )
+            updated += result.rowcount
+        await session.commit()
+        return updated
+    
     @staticmethod
     async def cancel_user_messages(session: AsyncSession, telegram_id: int, 
                                    video_types: list = None):
@@ -793,8 +1041,42 @@ class AutomatedMessageCRUD:
         
         result = await session.execute(query)
         await session.commit()
+        automated_message_scheduler.notify_cancelled(telegram_id, video_types)
         return result.rowcount
     
+    @staticmethod
+    async def replace_user_messages(session: AsyncSession, telegram_id: int,
+                                    cancel_video_types: Optional[list], messages: List[dict]):
+        """
+        Отмена запланированных сообщений и вставка новых одной транзакцией
+        
+        Args:
+            cancel_video_types: Типы для отмены (None - все сообщения пользователя)
+            messages: Строки automated_messages (один multi-row INSERT)
+        """
+        query = update(AutomatedMessage).where(
+            AutomatedMessage.telegram_id == telegram_id,
+            AutomatedMessage.status == AutomatedMessageStatus.SCHEDULED
+        )
+        if cancel_video_types is not None:
+            query = query.where(AutomatedMessage.video_type.in_(cancel_video_types))
+        await session.execute(query.values(status=AutomatedMessageStatus.CANCELLED))
+        
+        created = []
+        if messages:
+            result = await session.execute(
+                insert(AutomatedMessage)
+                .values([{**message, "status": AutomatedMessageStatus.SCHEDULED} for message in messages])
+                .returning(AutomatedMessage.id, AutomatedMessage.video_type, AutomatedMessage.scheduled_at)
+            )
+            created = result.all()
+        await session.commit()
+        
+        automated_message_scheduler.notify_cancelled(telegram_id, cancel_video_types)
+        for message_id, video_type, scheduled_at in created:
+            automated_message_scheduler.notify_scheduled(message_id, telegram_id, video_type, scheduled_at)
+        return created
+    
     @staticmethod
     async def get_user_scheduled_messages(session: AsyncSession, telegram_id: int):
         result = await session.execute(
@@ -0,0 +1,190 @@
+"""
+Фабрика async-движка SQLAlchemy с настройкой пула и инструментированием
+app/database/engine.py
+
+Используется app/database/connection.py, поэтому бот и FastAPI-приложение
+получают движок с одинаковыми настройками пула и метриками.
+"""
+import logging
+import re
+import time
+from typing import Optional
+from uuid import uuid4
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.config import settings
+from app.utils.metrics import observe_db_query
+
+logger = logging.getLogger(__name__)
+
+
+_STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM_RE = re.compile(r"\$\d+|%\(\w+\)s|(?<![:\w]):[A-Za-z_]\w*")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(statement: str, max_length: int = 1000) -> str:
+    """
+    Приведение SQL к шаблону: литералы и параметры заменяются на ?,
+    списки IN (?, ?, ...) сворачиваются, пробелы схлопываются
+    """
+    sql = _STRING_LITERAL_RE.sub("?", statement)
+    sql = _PARAM_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("(?)", sql)
+    sql = _WHITESPACE_RE.sub(" ", sql).strip()
+    return sql[:max_length]
+
+
+class DatabaseStats:
+    """Накопительная статистика запросов и ожидания пула"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.statements = 0
+        self.statement_time_total = 0.0
+        self.statement_time_max = 0.0
+        self.slow_statements = 0
+        self.errors = 0
+        self.pool_checkouts = 0
+        self.pool_wait_total = 0.0
+        self.pool_wait_max = 0.0
+
+    def record_statement(self, elapsed: float) -> None:
+        self.statements += 1
+        self.statement_time_total += elapsed
+        self.statement_time_max = max(self.statement_time_max, elapsed)
+
+    def record_pool_wait(self, elapsed: float) -> None:
+        self.pool_checkouts += 1
+        self.pool_wait_total += elapsed
+        self.pool_wait_max = max(self.pool_wait_max, elapsed)
+
+    def snapshot(self) -> dict:
+        return {
+            'statements': self.statements,
+            'statement_avg_ms': self.statement_time_total / self.statements * 1000 if self.statements else 0.0,
+            'statement_max_ms': self.statement_time_max * 1000,
+            'slow_statements': self.slow_statements,
+            'errors': self.errors,
+            'pool_checkouts': self.pool_checkouts,
+            'pool_wait_avg_ms': self.pool_wait_total / self.pool_checkouts * 1000 if self.pool_checkouts else 0.0,
+            'pool_wait_max_ms': self.pool_wait_max * 1000,
+        }
+
+
+# Глобальная статистика процесса
+db_stats = DatabaseStats()
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Пул, замеряющий время ожидания свободного соединения"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_stats.record_pool_wait(time.perf_counter() - start)
+
+
+def _attach_instrumentation(engine: AsyncEngine, slow_query_ms: int) -> None:
+    """Подписка на события движка: время каждого запроса и лог медленных"""
+    sync_engine = engine.sync_engine
+    slow_threshold = slow_query_ms / 1000
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        db_stats.record_statement(elapsed)
+        observe_db_query(statement, elapsed)
+
+        if slow_query_ms and elapsed >= slow_threshold:
+            db_stats.slow_statements += 1
+            logger.warning(f"🐢 Slow query {elapsed * 1000:.0f} ms: {normalize_sql(statement)}")
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(exception_context):
+        db_stats.errors += 1
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start_time"):
+            conn.info["query_start_time"].pop()
+
+
+def _statement_cache_args(cache_size: int) -> dict:
+    """
+    connect_args кэшей prepared statements
+
+    prepared_statement_cache_size - кэш SQLAlchemy, statement_cache_size -
+    собственный кэш asyncpg. За pgbouncer (transaction mode) соединение с
+    сервером меняется между транзакциями, поэтому при 0 выключаются оба, а
+    statements получают уникальные имена вместо __asyncpg_stmt_N__.
+    """
+    args = {
+        "prepared_statement_cache_size": cache_size,
+        "statement_cache_size": cache_size,
+    }
+    if cache_size == 0:
+        args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+    return args
+
+
+def create_db_engine(database_url: Optional[str] = None) -> AsyncEngine:
+    """
+    Создание async-движка с параметрами пула из Settings
+
+    Args:
+        database_url: URL БД (по умолчанию settings.DATABASE_URL)
+    """
+    url = (database_url or settings.DATABASE_URL).replace('postgresql://', 'postgresql+asyncpg://')
+
+    engine = create_async_engine(
+        url,
+        echo=settings.DB_ECHO,
+        poolclass=InstrumentedQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        connect_args=_statement_cache_args(settings.DB_STATEMENT_CACHE_SIZE),
+    )
+    _attach_instrumentation(engine, settings.DB_SLOW_QUERY_MS)
+
+    logger.info(
+        f"🗄️ DB engine created: pool_size={settings.DB_POOL_SIZE}, "
+        f"max_overflow={settings.DB_MAX_OVERFLOW}, recycle={settings.DB_POOL_RECYCLE}s, "
+        f"slow_query={settings.DB_SLOW_QUERY_MS}ms"
+    )
+    return engine
+
+
+def get_pool_status(engine: AsyncEngine) -> dict:
+    """Текущее состояние пула соединений"""
+    pool = engine.sync_engine.pool
+    return {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'checked_in': pool.checkedin(),
+    }
+
+
+def dialect_insert(session):
+    """insert() с поддержкой ON CONFLICT для диалекта сессии (PostgreSQL, SQLite в тестах)"""
+    if session.bind.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert
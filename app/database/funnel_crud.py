@@ -0,0 +1,293 @@
+"""
+CRUD операции для дневного среза воронки (daily_funnel_stats)
+app/database/funnel_crud.py
+
+Запись смены стадии, оплаты или продажи только помечает день (и день
+регистрации пользователя) устаревшим - без запросов в пути записи. Фоновый
+funnel_refresher раз в несколько секунд пересчитывает помеченные дни из
+users/payments/sales одним проходом, поэтому отчеты за любой период читают
+несколько сотен готовых строк вместо сырых таблиц. backfill пересобирает
+всю историю за один проход по каждой таблице.
+
+Оплаты Robokassa относятся к дню оплаты (paid_at), как и списки
+покупателей в отчетах.
+"""
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import and_, delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.engine import dialect_insert
+from app.database.models import DailyFunnelStats, OnboardingStage, Payment, Sale, User
+
+logger = logging.getLogger(__name__)
+
+# Стадия -> когортная колонка
+STAGE_COLUMNS = {
+    OnboardingStage.NEW_USER: "stage_new_user",
+    OnboardingStage.INTRO_SHOWN: "stage_intro_shown",
+    OnboardingStage.WAIT_PAYMENT: "stage_wait_payment",
+    OnboardingStage.PAYMENT_OK: "stage_payment_ok",
+    OnboardingStage.WANT_JOIN: "stage_want_join",
+    OnboardingStage.COMPLETED: "stage_completed",
+}
+
+COUNTER_COLUMNS = [
+    "new_users", *STAGE_COLUMNS.values(), "paid_users", "paid_without_team",
+    "partners", "partners_without_team",
+    "payments_count", "payments_amount",
+    "sales_count", "sales_amount", "sales_commission",
+]
+
+# Размер одного multi-row INSERT при backfill
+INSERT_CHUNK_SIZE = 500
+
+# Ключ pg_advisory_xact_lock: пересчеты из разных процессов не пересекаются,
+# иначе более ранний пересчет может перезаписать строку устаревшими суммами
+REFRESH_LOCK_KEY = 0x66756E6E
+
+# Дни и пользователи, чьи строки среза устарели (до пересчета refresh_dirty);
+# TODAY - текущий день по часам БД (пояс процесса может отличаться)
+TODAY = None
+_dirty_days: Set[Optional[date]] = set()
+_dirty_users: Set[int] = set()
+
+
+class FunnelStatsCRUD:
+    """CRUD операции для daily_funnel_stats"""
+
+    @staticmethod
+    async def refresh_days(session: AsyncSession, days: Iterable[date]) -> None:
+        """Пересчет строк указанных дней (upsert, одна транзакция)"""
+        days = sorted(set(days))
+        if not days:
+            return
+
+        if session.bind.dialect.name == "postgresql":
+            await session.execute(select(func.pg_advisory_xact_lock(REFRESH_LOCK_KEY)))
+
+        rows = []
+        for day in days:
+            aggregated = await _aggregate(session, {day})
+            rows.append(aggregated.get(day) or _empty_row(day))
+
+        stmt = dialect_insert(session)(DailyFunnelStats).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[DailyFunnelStats.day],
+            set_={**{column: stmt.excluded[column] for column in COUNTER_COLUMNS}, "updated_at": func.now()}
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+    @staticmethod
+    def touch(*days: Optional[date]) -> None:
+        """Пометка дней после записи в users/payments/sales (по умолчанию - сегодня)"""
+        _dirty_days.update([day for day in days if day] or [TODAY])
+
+    @staticmethod
+    def touch_user(telegram_id: int) -> None:
+        """Пометка после смены стадии: день регистрации (определит пересчет) + сегодня"""
+        _dirty_users.add(telegram_id)
+        _dirty_days.add(TODAY)
+
+    @staticmethod
+    async def days_of(session: AsyncSession, column, *conditions) -> Set[date]:
+        """
+        Дни среза (func.date в поясе БД), в которые попадают строки
+
+        Для изменений в обход CRUD (сырой SQL в админке): дни собираются до
+        удаления или изменения строк, touch(*days) - после коммита.
+        """
+        result = await session.execute(
+            select(func.date(column)).where(column.isnot(None), *conditions).distinct()
+        )
+        return set(filter(None, (_as_date(value) for value in result.scalars())))
+
+    @staticmethod
+    async def days_of_user(session: AsyncSession, telegram_id: int) -> Set[date]:
+        """Дни среза пользователя: регистрация, стадии, его оплаты и продажи по его ref_code"""
+        user = User.telegram_id == telegram_id
+        days = set()
+        for column in (User.created_at, User.stage_payment_ok_at, User.stage_completed_at):
+            days |= await FunnelStatsCRUD.days_of(session, column, user)
+        days |= await FunnelStatsCRUD.days_of(
+            session, Payment.paid_at, Payment.user_id.in_(select(User.id).where(user))
+        )
+        days |= await FunnelStatsCRUD.days_of(
+            session, Sale.created_at, Sale.ref_code.in_(select(User.ref_code).where(user))
+        )
+        return days
+
+    @staticmethod
+    async def refresh_dirty(session: AsyncSession) -> int:
+        """
+        Пересчет помеченных дней одной транзакцией
+
+        При ошибке пометки возвращаются - их подхватит следующий пересчет.
+
+        Returns:
+            Количество пересчитанных дней
+        """
+        marked, users = set(_dirty_days), set(_dirty_users)
+        _dirty_days.clear()
+        _dirty_users.clear()
+        if not marked and not users:
+            return 0
+
+        days = marked - {TODAY}
+        try:
+            if TODAY in marked:
+                days.add(_as_date(await session.scalar(select(func.current_date()))))
+            if users:
+                result = await session.execute(
+                    select(func.date(User.created_at)).where(User.telegram_id.in_(users)).distinct()
+                )
+                days.update(filter(None, (_as_date(value) for value in result.scalars())))
+            await FunnelStatsCRUD.refresh_days(session, days)
+        except Exception:
+            _dirty_days.update(marked)
+            _dirty_users.update(users)
+            raise
+        return len(days)
+
+    @staticmethod
+    async def backfill(session: AsyncSession) -> int:
+        """
+        Полная пересборка среза за один проход
+
+        Returns:
+            Количество дней
+        """
+        aggregated = await _aggregate(session)
+
+        await session.execute(delete(DailyFunnelStats))
+        rows = [aggregated[day] for day in sorted(aggregated)]
+        insert = dialect_insert(session)
+        for offset in range(0, len(rows), INSERT_CHUNK_SIZE):
+            await session.execute(insert(DailyFunnelStats).values(rows[offset:offset + INSERT_CHUNK_SIZE]))
+        await session.commit()
+        return len(rows)
+
+    @staticmethod
+    async def get_days(session: AsyncSession, start_day: date, end_day: date) -> List[DailyFunnelStats]:
+        """Строки за период [start_day, end_day] включительно"""
+        result = await session.execute(
+            select(DailyFunnelStats)
+            .where(DailyFunnelStats.day >= start_day, DailyFunnelStats.day <= end_day)
+            .order_by(DailyFunnelStats.day)
+        )
+        return result.scalars().all()
+
+    @staticmethod
+    async def get_totals(
+        session: AsyncSession,
+        start_day: Optional[date] = None,
+        end_day: Optional[date] = None
+    ) -> Dict[str, float]:
+        """Суммы колонок за период (None - без ограничения)"""
+        conditions = []
+        if start_day is not None:
+            conditions.append(DailyFunnelStats.day >= start_day)
+        if end_day is not None:
+            conditions.append(DailyFunnelStats.day <= end_day)
+
+        result = await session.execute(
+            select(*[
+                func.coalesce(func.sum(getattr(DailyFunnelStats, column)), 0).label(column)
+                for column in COUNTER_COLUMNS
+            ]).where(*conditions)
+        )
+        return dict(result.one()._mapping)
+
+
+def _as_date(value) -> Optional[date]:
+    """func.date() возвращает date (PostgreSQL) или строку (SQLite)"""
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value))
+
+
+def _empty_row(day: date) -> dict:
+    return {"day": day, **{column: 0 for column in COUNTER_COLUMNS}}
+
+
+def _in_days(column, days: Optional[Set[date]]) -> list:
+    """
+    Условие "строка попадает в один из дней"
+
+    День определяется тем же func.date(column), что и группировка, - в часовом
+    поясе сессии БД, как и при backfill. Диапазон с запасом в сутки с каждой
+    стороны только сужает выборку по индексу: наивные datetime asyncpg
+    трактует в поясе процесса, а он может отличаться от пояса БД.
+    """
+    conditions = [column.isnot(None)]
+    if days:
+        conditions += [
+            column >= datetime.combine(min(days) - timedelta(days=1), time()),
+            column < datetime.combine(max(days) + timedelta(days=2), time()),
+            func.date(column).in_(sorted(days)),
+        ]
+    return conditions
+
+
+async def _aggregate(session: AsyncSession, days: Optional[Set[date]] = None) -> Dict[date, dict]:
+    """Строки среза за указанные дни (None - вся история), по одному GROUP BY на таблицу"""
+    rows: Dict[date, dict] = {}
+
+    def merge(result, columns):
+        for record in result:
+            day = _as_date(record[0])
+            row = rows.setdefault(day, _empty_row(day))
+            for column, value in zip(columns, record[1:]):
+                row[column] = value or 0
+
+    not_completed = User.onboarding_stage != OnboardingStage.COMPLETED
+    paid = User.payment_completed == True
+
+    # Когорта дня регистрации
+    day = func.date(User.created_at)
+    cohort_columns = ["new_users", *STAGE_COLUMNS.values(), "paid_users", "paid_without_team"]
+    merge(await session.execute(
+        select(
+            day,
+            func.count(User.id),
+            *[func.count(User.id).filter(User.onboarding_stage == stage) for stage in STAGE_COLUMNS],
+            func.count(User.id).filter(paid),
+            func.count(User.id).filter(and_(paid, not_completed))
+        ).where(*_in_days(User.created_at, days)).group_by(day)
+    ), cohort_columns)
+
+    # Партнеры дня
+    day = func.date(User.stage_completed_at)
+    merge(await session.execute(
+        select(day, func.count(User.id))
+        .where(User.onboarding_stage == OnboardingStage.COMPLETED, *_in_days(User.stage_completed_at, days))
+        .group_by(day)
+    ), ["partners"])
+
+    day = func.date(User.stage_payment_ok_at)
+    merge(await session.execute(
+        select(day, func.count(User.id))
+        .where(paid, not_completed, *_in_days(User.stage_payment_ok_at, days))
+        .group_by(day)
+    ), ["partners_without_team"])
+
+    # Оплаты Robokassa
+    day = func.date(Payment.paid_at)
+    merge(await session.execute(
+        select(day, func.count(Payment.id), func.sum(Payment.amount))
+        .where(Payment.status == "paid", *_in_days(Payment.paid_at, days))
+        .group_by(day)
+    ), ["payments_count", "payments_amount"])
+
+    # Продажи
+    day = func.date(Sale.created_at)
+    merge(await session.execute(
+        select(day, func.count(Sale.id), func.sum(Sale.amount), func.sum(Sale.commission_amount))
+        .where(*_in_days(Sale.created_at, days))
+        .group_by(day)
+    ), ["sales_count", "sales_amount", "sales_commission"])
+
+    return rows
@@ -1,7 +1,7 @@
 """
 Модели базы данных - обновленная версия с онбордингом
 """
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, ForeignKey, BigInteger, Text, Index
+from sqlalchemy import Column, Integer, String, DateTime, Date, Float, Boolean, ForeignKey, BigInteger, Text, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from enum import Enum
@@ -64,6 +64,16 @@ class User(Base):
     stage_payment_ok_at = Column(DateTime(timezone=True), nullable=True)
     stage_want_join_at = Column(DateTime(timezone=True), nullable=True)
     stage_completed_at = Column(DateTime(timezone=True), nullable=True)
+    
+    __table_args__ = (
+        Index('idx_users_stage_created', 'onboarding_stage', 'created_at'),
+        # Пересчет дня в daily_funnel_stats (когорта, партнеры дня)
+        Index('idx_users_created_at', 'created_at'),
+        Index('idx_users_stage_completed_at', 'stage_completed_at'),
+        Index('idx_users_stage_payment_ok_at', 'stage_payment_ok_at'),
+        # Оплатившие приглашенные партнера (UserCRUD.get_invite_counts)
+        Index('idx_users_referred_by', 'referred_by'),
+    )
 
 
 
@@ -84,6 +94,11 @@ class Sale(Base):
     # Relationships
     user = relationship("User", back_populates="sales")
     # УБРАЛИ: payment = relationship("Payment", back_populates="sale")
+    
+    __table_args__ = (
+        Index('idx_sales_ref_code_status', 'ref_code', 'status'),
+        Index('idx_sales_created_at', 'created_at'),
+    )
 
 
 class Withdrawal(Base):
@@ -168,6 +183,10 @@ class Payment(Base):
     # Relationships
     user = relationship("User", back_populates="payments")
     # УБРАЛИ: sale = relationship("Sale", back_populates="payment", uselist=False)
+    
+    __table_args__ = (
+        Index('idx_payments_status_paid_at', 'status', 'paid_at'),
+    )
 
 
 """
@@ -232,6 +251,10 @@ class TicketMessage(Base):
     
     # Связи
     ticket = relationship("Ticket", back_populates="messages")
+    
+    __table_args__ = (
+        Index('idx_ticket_messages_telegram_message_id', 'telegram_message_id'),
+    )
 
 
 # Добавить к модели User связь с тикетами
@@ -255,6 +278,11 @@ class Click(Base):
     
     # Relationships
     user = relationship("User", back_populates="clicks")
+    
+    __table_args__ = (
+        Index('idx_clicks_user_created', 'user_telegram_id', 'created_at'),
+        Index('idx_clicks_ref_code_created', 'ref_code', 'created_at'),
+    )
 
 
 # 2. Добавляем новую модель для аналитики
@@ -279,6 +307,7 @@ class ReferralHistory(Base):
 
 class AutomatedMessageStatus(str, Enum):
     SCHEDULED = "scheduled"
+    SENDING = "sending"  # взято воркером в отправку, результат еще не записан
     SENT = "sent"
     CANCELLED = "cancelled"
     FAILED = "failed"
@@ -303,4 +332,124 @@ class AutomatedMessage(Base):
     
     __table_args__ = (
         Index('idx_automated_messages_status_scheduled', 'status', 'scheduled_at'),
-    )
\ No newline at end of file
+    )
+
+
+class BroadcastJobStatus(str, Enum):
+    RUNNING = "running"
+    PAUSED = "paused"
+    CANCELLED = "cancelled"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class BroadcastJob(Base):
+    """Рассылка, сохраненная в БД - переживает рестарт бота"""
+    __tablename__ = "broadcast_jobs"
+    
+    id = Column(Integer, primary_key=True)
+    admin_id = Column(BigInteger, nullable=False)
+    admin_name = Column(String, nullable=True)
+    audience_type = Column(String, nullable=True)
+    media_data = Column(Text, nullable=False)  # JSON с типом, текстом и file_id
+    status = Column(String, default=BroadcastJobStatus.RUNNING, index=True)
+    
+    # Счетчики
+    total_count = Column(Integer, default=0)
+    sent_count = Column(Integer, default=0)
+    blocked_count = Column(Integer, default=0)
+    not_found_count = Column(Integer, default=0)
+    other_error_count = Column(Integer, default=0)
+    
+    # Чекпоинт: последний обработанный broadcast_deliveries.id
+    last_delivery_id = Column(Integer, default=0)
+    
+    # Сообщение с прогрессом в чате админа
+    progress_chat_id = Column(BigInteger, nullable=True)
+    progress_message_id = Column(Integer, nullable=True)
+    
+    # Аренда: процесс, который отправляет рассылку, и его последний heartbeat
+    claimed_by = Column(String, nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class BroadcastDeliveryStatus(str, Enum):
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+
+
+class BroadcastDelivery(Base):
+    """Состояние доставки рассылки одному получателю"""
+    __tablename__ = "broadcast_deliveries"
+    
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey("broadcast_jobs.id", ondelete="CASCADE"), nullable=False)
+    telegram_id = Column(BigInteger, nullable=False)
+    status = Column(String, default=BroadcastDeliveryStatus.PENDING)
+    error_kind = Column(String, nullable=True)  # blocked / not_found / other
+    processed_at = Column(DateTime(timezone=True), nullable=True)
+    
+    __table_args__ = (
+        UniqueConstraint('job_id', 'telegram_id', name='uq_broadcast_deliveries_job_recipient'),
+        Index('idx_broadcast_deliveries_job_status_id', 'job_id', 'status', 'id'),
+    )
+
+
+class DailyFunnelStats(Base):
+    """
+    Дневной срез воронки (одна строка на день)
+
+    Когортные колонки - пользователи, зарегистрированные в этот день, по их
+    текущей стадии; событийные - партнеры, оплаты и продажи, случившиеся в этот день.
+    """
+    __tablename__ = "daily_funnel_stats"
+    
+    day = Column(Date, primary_key=True)
+    
+    # Когорта дня регистрации
+    new_users = Column(Integer, default=0)
+    stage_new_user = Column(Integer, default=0)
+    stage_intro_shown = Column(Integer, default=0)
+    stage_wait_payment = Column(Integer, default=0)
+    stage_payment_ok = Column(Integer, default=0)
+    stage_want_join = Column(Integer, default=0)
+    stage_completed = Column(Integer, default=0)
+    paid_users = Column(Integer, default=0)  # payment_completed = True
+    paid_without_team = Column(Integer, default=0)  # оплатили, но не completed
+    
+    # События дня
+    partners = Column(Integer, default=0)  # stage_completed_at в этот день
+    partners_without_team = Column(Integer, default=0)  # stage_payment_ok_at в этот день
+    payments_count = Column(Integer, default=0)  # оплаты Robokassa по дню paid_at
+    payments_amount = Column(Float, default=0)
+    sales_count = Column(Integer, default=0)
+    sales_amount = Column(Float, default=0)
+    sales_commission = Column(Float, default=0)
+    
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class PartnerStats(Base):
+    """
+    Счетчики партнера, обновляемые при записи кликов и продаж
+
+    Меняются в той же транзакции, что и clicks/sales; расхождения
+    исправляет периодическая сверка (PartnerStatsCRUD.reconcile).
+    """
+    __tablename__ = "partner_stats"
+    
+    ref_code = Column(String, primary_key=True)
+    clicks = Column(Integer, default=0)
+    total_sales = Column(Integer, default=0)
+    confirmed_sales = Column(Integer, default=0)
+    pending_sales = Column(Integer, default=0)
+    cancelled_sales = Column(Integer, default=0)
+    confirmed_commission = Column(Float, default=0)
+    pending_commission = Column(Float, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
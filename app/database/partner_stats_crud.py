@@ -0,0 +1,215 @@
+"""
+CRUD операции для денормализованных счетчиков партнеров (partner_stats)
+app/database/partner_stats_crud.py
+
+increment/recalculate не делают commit - они вызываются внутри транзакции,
+которая пишет clicks/sales, поэтому счетчики меняются атомарно с данными.
+
+Пересчет сначала блокирует строки partner_stats (FOR UPDATE), потом считает
+clicks/sales. Запись клика или продажи обновляет ту же строку в своей
+транзакции, поэтому она либо уже закоммичена и попадет в подсчет, либо
+дождется пересчета и прибавит свое приращение к новому значению.
+"""
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.engine import dialect_insert
+from app.database.models import Click, PartnerStats, Sale
+
+logger = logging.getLogger(__name__)
+
+COUNTER_COLUMNS = [
+    "clicks",
+    "total_sales",
+    "confirmed_sales",
+    "pending_sales",
+    "cancelled_sales",
+    "confirmed_commission",
+    "pending_commission",
+]
+
+# Допустимое расхождение денежных сумм при сверке
+AMOUNT_TOLERANCE = 0.01
+
+
+def sale_deltas(status: str, commission_amount: float) -> Dict[str, float]:
+    """Приращения счетчиков для новой продажи"""
+    deltas = {"total_sales": 1}
+    if status == "confirmed":
+        deltas.update(confirmed_sales=1, confirmed_commission=commission_amount or 0)
+    elif status == "pending":
+        deltas.update(pending_sales=1, pending_commission=commission_amount or 0)
+    elif status == "cancelled":
+        deltas["cancelled_sales"] = 1
+    return deltas
+
+
+class PartnerStatsCRUD:
+    """CRUD операции для partner_stats"""
+
+    @staticmethod
+    async def increment(session: AsyncSession, ref_code: str, **deltas: float) -> None:
+        """Прибавление к счетчикам одного партнера (без commit)"""
+        await PartnerStatsCRUD.increment_many(session, {ref_code: deltas})
+
+    @staticmethod
+    async def increment_many(session: AsyncSession, deltas_by_ref_code: Dict[str, Dict[str, float]]) -> None:
+        """Прибавление к счетчикам нескольких партнеров одним upsert (без commit)"""
+        if not deltas_by_ref_code:
+            return
+
+        rows = [
+            {"ref_code": ref_code, **{column: deltas.get(column, 0) for column in COUNTER_COLUMNS}}
+            for ref_code, deltas in deltas_by_ref_code.items()
+        ]
+        # executemany: оператор компилируется один раз и кэшируется, размер пачки не важен
+        stmt = dialect_insert(session)(PartnerStats)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[PartnerStats.ref_code],
+            set_={
+                **{column: getattr(PartnerStats, column) + stmt.excluded[column] for column in COUNTER_COLUMNS},
+                "updated_at": func.now()
+            }
+        )
+        await session.execute(stmt, rows)
+
+    @staticmethod
+    async def recalculate(session: AsyncSession, ref_codes: Iterable[str]) -> None:
+        """Пересчет счетчиков партнеров из clicks/sales (без commit)"""
+        ref_codes = sorted(set(ref_codes))
+        if not ref_codes:
+            return
+        await _lock_rows(session, ref_codes)
+        actual = await _actual_counters(session, ref_codes)
+        await _overwrite(session, {ref_code: actual.get(ref_code, {}) for ref_code in ref_codes})
+
+    @staticmethod
+    async def get(session: AsyncSession, ref_code: str) -> Optional[PartnerStats]:
+        result = await session.execute(
+            select(PartnerStats).where(PartnerStats.ref_code == ref_code)
+        )
+        return result.scalar_one_or_none()
+
+    @staticmethod
+    async def reconcile(session: AsyncSession, repair: bool = True) -> List[dict]:
+        """
+        Сверка partner_stats с clicks/sales
+
+        Первый проход без блокировок находит кандидатов; их строки
+        блокируются и сверяются повторно - расхождение из-за записи,
+        закоммиченной между чтениями, не попадает в отчет и не "чинится".
+
+        Args:
+            repair: Перезаписать расходящиеся строки фактическими значениями
+
+        Returns:
+            Расхождения: {ref_code, column, stored, actual}
+        """
+        candidates = _find_drift(await _actual_counters(session), await _stored_counters(session))
+        if not candidates:
+            return []
+
+        ref_codes = sorted({item["ref_code"] for item in candidates})
+        await _lock_rows(session, ref_codes)
+        actual = await _actual_counters(session, ref_codes)
+        drift = _find_drift(actual, await _stored_counters(session, ref_codes))
+
+        if repair and drift:
+            drifted_ref_codes = {item["ref_code"] for item in drift}
+            await _overwrite(session, {ref_code: actual.get(ref_code, {}) for ref_code in drifted_ref_codes})
+        await session.commit()
+
+        return drift
+
+
+def _find_drift(actual: Dict[str, Dict[str, float]], stored: Dict[str, Dict[str, float]]) -> List[dict]:
+    drift = []
+    for ref_code in sorted(actual.keys() | stored.keys()):
+        actual_row = actual.get(ref_code, {})
+        stored_row = stored.get(ref_code, {})
+        for column in COUNTER_COLUMNS:
+            actual_value = actual_row.get(column, 0)
+            stored_value = stored_row.get(column, 0)
+            if abs(actual_value - stored_value) > AMOUNT_TOLERANCE:
+                drift.append({
+                    "ref_code": ref_code,
+                    "column": column,
+                    "stored": stored_value,
+                    "actual": actual_value
+                })
+    return drift
+
+
+async def _stored_counters(session: AsyncSession, ref_codes: Optional[List[str]] = None) -> Dict[str, Dict[str, float]]:
+    stmt = select(PartnerStats)
+    if ref_codes is not None:
+        stmt = stmt.where(PartnerStats.ref_code.in_(ref_codes))
+    return {
+        row.ref_code: {column: getattr(row, column) or 0 for column in COUNTER_COLUMNS}
+        for row in (await session.execute(stmt.execution_options(populate_existing=True))).scalars()
+    }
+
+
+async def _lock_rows(session: AsyncSession, ref_codes: List[str]) -> None:
+    """
+    Блокировка строк partner_stats до конца транзакции (в порядке ref_code)
+
+    Недостающие строки создаются нулевыми, иначе блокировать нечего и
+    параллельная первая запись партнера потеряется при перезаписи.
+    """
+    stmt = dialect_insert(session)(PartnerStats).on_conflict_do_nothing(index_elements=[PartnerStats.ref_code])
+    await session.execute(stmt, [
+        {"ref_code": ref_code, **{column: 0 for column in COUNTER_COLUMNS}} for ref_code in ref_codes
+    ])
+    await session.execute(
+        select(PartnerStats.ref_code)
+        .where(PartnerStats.ref_code.in_(ref_codes))
+        .order_by(PartnerStats.ref_code)
+        .with_for_update()
+    )
+
+
+async def _actual_counters(session: AsyncSession, ref_codes: Optional[List[str]] = None) -> Dict[str, Dict[str, float]]:
+    """Фактические счетчики из clicks/sales (все партнеры или указанные)"""
+    counters: Dict[str, Dict[str, float]] = {}
+
+    clicks_stmt = select(Click.ref_code, func.count(Click.id)).group_by(Click.ref_code)
+    if ref_codes is not None:
+        clicks_stmt = clicks_stmt.where(Click.ref_code.in_(ref_codes))
+    for ref_code, clicks in await session.execute(clicks_stmt):
+        counters.setdefault(ref_code, {})["clicks"] = clicks
+
+    confirmed = Sale.status == "confirmed"
+    pending = Sale.status == "pending"
+    sales_stmt = select(
+        Sale.ref_code,
+        func.count(Sale.id),
+        func.count(Sale.id).filter(confirmed),
+        func.count(Sale.id).filter(pending),
+        func.count(Sale.id).filter(Sale.status == "cancelled"),
+        func.coalesce(func.sum(Sale.commission_amount).filter(confirmed), 0),
+        func.coalesce(func.sum(Sale.commission_amount).filter(pending), 0),
+    ).group_by(Sale.ref_code)
+    if ref_codes is not None:
+        sales_stmt = sales_stmt.where(Sale.ref_code.in_(ref_codes))
+    for ref_code, *values in await session.execute(sales_stmt):
+        counters.setdefault(ref_code, {}).update(zip(COUNTER_COLUMNS[1:], values))
+
+    counters.pop(None, None)
+    return counters
+
+
+async def _overwrite(session: AsyncSession, values_by_ref_code: Dict[str, Dict[str, float]]) -> None:
+    rows = [
+        {"ref_code": ref_code, **{column: values.get(column, 0) for column in COUNTER_COLUMNS}}
+        for ref_code, values in values_by_ref_code.items()
+    ]
+    stmt = dialect_insert(session)(PartnerStats)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PartnerStats.ref_code],
+        set_={**{column: stmt.excluded[column] for column in COUNTER_COLUMNS}, "updated_at": func.now()}
+    )
+    await session.execute(stmt, rows)
@@ -2,9 +2,9 @@
 CRUD функции для статистики и сегментации пользователей
 """
 from datetime import datetime, timedelta
-from sqlalchemy import select, and_, or_, func
+from sqlalchemy import Select, select, and_, or_, func
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Dict, Optional
+from typing import AsyncIterator, List, Dict, Optional, Sequence
 from app.database.models import User, Sale, Payment, OnboardingStage
 
 
@@ -437,6 +437,219 @@ class StatisticsCRUD:
         result = await session.execute(stmt)
         return result.scalars().all()
 
+    # ---- Агрегаты на стороне БД и легкие строки для CSV ----
+    #
+    # Методы ниже возвращают счетчики/суммы одним запросом или строки из
+    # нужных колонок (Row с доступом по имени) вместо ORM-объектов.
+    # start/end - границы [start, end), None - без ограничения.
+
+    @staticmethod
+    async def get_sales_summary(
+        session: AsyncSession,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> Dict:
+        """Количество продаж, сумма и комиссия"""
+        stmt = select(
+            func.count(Sale.id),
+            func.coalesce(func.sum(Sale.amount), 0),
+            func.coalesce(func.sum(Sale.commission_amount), 0)
+        ).where(*_range_conditions(Sale.created_at, start, end))
+
+        count, total_amount, total_commission = (await session.execute(stmt)).one()
+        return {
+            "count": count,
+            "total_amount": float(total_amount),
+            "total_commission": float(total_commission)
+        }
+
+    @staticmethod
+    async def get_sales_by_day(session: AsyncSession, start: datetime, end: datetime) -> List:
+        """Продажи по дням: строки (day, count, total_amount, total_commission)"""
+        day = func.date(Sale.created_at).label("day")
+        stmt = select(
+            day,
+            func.count(Sale.id).label("count"),
+            func.coalesce(func.sum(Sale.amount), 0).label("total_amount"),
+            func.coalesce(func.sum(Sale.commission_amount), 0).label("total_commission")
+        ).where(*_range_conditions(Sale.created_at, start, end)).group_by(day).order_by(day)
+
+        return (await session.execute(stmt)).all()
+
+    @staticmethod
+    async def get_users_by_stage(session: AsyncSession) -> Dict[str, int]:
+        """Количество пользователей на каждой стадии онбординга"""
+        stmt = select(User.onboarding_stage, func.count(User.id)).group_by(User.onboarding_stage)
+        return dict((await session.execute(stmt)).all())
+
+    @staticmethod
+    async def get_report_counts(
+        session: AsyncSession,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> Dict[str, int]:
+        """
+        Счетчики разделов отчета: лиды, покупатели, партнеры, партнеры без команды
+
+        Условия те же, что у get_*_rows, но считаются в БД.
+        """
+        users_stmt = select(
+            _count_where(User.id, _range_conditions(User.created_at, start, end)),
+            _count_where(User.id, _partner_conditions(start, end)),
+            _count_where(User.id, _partner_without_team_conditions(start, end))
+        )
+        leads, partners, partners_without_team = (await session.execute(users_stmt)).one()
+
+        buyers_stmt = select(func.count(Payment.id)).join(
+            User, User.id == Payment.user_id
+        ).where(
+            Payment.status == "paid",
+            *_range_conditions(Payment.paid_at, start, end)
+        )
+        buyers = (await session.execute(buyers_stmt)).scalar() or 0
+
+        return {
+            "leads": leads,
+            "buyers": buyers,
+            "partners": partners,
+            "partners_without_team": partners_without_team
+        }
+
+    @staticmethod
+    async def get_buyer_rows(
+        session: AsyncSession,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: Optional[int] = None,
+        newest_first: bool = False
+    ) -> List:
+        """Покупатели: строки (full_name, username, telegram_id, amount, purchased_at)"""
+        stmt = buyer_rows_query(start, end)
+        if newest_first:
+            stmt = stmt.order_by(Payment.paid_at.desc())
+        return (await session.execute(stmt.limit(limit))).all()
+
+    @staticmethod
+    async def get_lead_rows(
+        session: AsyncSession,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: Optional[int] = None
+    ) -> List:
+        """Лиды: строки (full_name, username, telegram_id, created_at, onboarding_stage)"""
+        return (await session.execute(lead_rows_query(start, end).limit(limit))).all()
+
+    @staticmethod
+    async def get_partner_rows(
+        session: AsyncSession,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: Optional[int] = None
+    ) -> List:
+        """Партнеры: строки (full_name, username, telegram_id, stage_completed_at, onboarding_stage)"""
+        return (await session.execute(partner_rows_query(start, end).limit(limit))).all()
+
+    @staticmethod
+    async def get_partner_without_team_rows(
+        session: AsyncSession,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: Optional[int] = None
+    ) -> List:
+        """Партнеры без команды: строки (full_name, username, telegram_id, stage_payment_ok_at, onboarding_stage)"""
+        return (await session.execute(partner_without_team_rows_query(start, end).limit(limit))).all()
+
+    @staticmethod
+    async def stream_rows(session: AsyncSession, stmt, batch_size: int = 1000) -> AsyncIterator[Sequence]:
+        """
+        Строки запроса пачками через серверный курсор (yield_per)
+
+        В памяти одновременно не больше batch_size строк.
+        """
+        result = await session.stream(stmt.execution_options(yield_per=batch_size))
+        async for partition in result.partitions(batch_size):
+            yield partition
+
+
+def buyer_rows_query(start: Optional[datetime] = None, end: Optional[datetime] = None) -> Select:
+    """Покупатели: (full_name, username, telegram_id, amount, purchased_at)"""
+    return select(
+        User.full_name,
+        User.username,
+        User.telegram_id,
+        Payment.amount,
+        Payment.paid_at.label("purchased_at")
+    ).join(
+        Payment, User.id == Payment.user_id
+    ).where(
+        Payment.status == "paid",
+        *_range_conditions(Payment.paid_at, start, end)
+    )
+
+
+def lead_rows_query(start: Optional[datetime] = None, end: Optional[datetime] = None) -> Select:
+    """Лиды: (full_name, username, telegram_id, created_at, onboarding_stage)"""
+    return select(
+        User.full_name, User.username, User.telegram_id, User.created_at, User.onboarding_stage
+    ).where(*_range_conditions(User.created_at, start, end))
+
+
+def partner_rows_query(start: Optional[datetime] = None, end: Optional[datetime] = None) -> Select:
+    """Партнеры: (full_name, username, telegram_id, stage_completed_at, onboarding_stage)"""
+    return select(
+        User.full_name, User.username, User.telegram_id, User.stage_completed_at, User.onboarding_stage
+    ).where(*_partner_conditions(start, end))
+
+
+def partner_without_team_rows_query(start: Optional[datetime] = None, end: Optional[datetime] = None) -> Select:
+    """Партнеры без команды: (full_name, username, telegram_id, stage_payment_ok_at, onboarding_stage)"""
+    return select(
+        User.full_name, User.username, User.telegram_id, User.stage_payment_ok_at, User.onboarding_stage
+    ).where(*_partner_without_team_conditions(start, end))
+
+
+def day_bounds(date: datetime) -> tuple:
+    """Границы дня [00:00, 00:00 следующего дня)"""
+    start = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    return start, start + timedelta(days=1)
+
+
+def period_bounds(start_date: datetime, end_date: datetime) -> tuple:
+    """Границы периода с включением последнего дня"""
+    start = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = end_date.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    return start, end
+
+
+def _range_conditions(column, start: Optional[datetime], end: Optional[datetime]) -> list:
+    conditions = []
+    if start is not None:
+        conditions.append(column >= start)
+    if end is not None:
+        conditions.append(column < end)
+    return conditions
+
+
+def _count_where(column, conditions: list):
+    """count(column) FILTER (WHERE ...); без условий - обычный count"""
+    if not conditions:
+        return func.count(column)
+    return func.count(column).filter(and_(*conditions))
+
+
+def _partner_conditions(start: Optional[datetime], end: Optional[datetime]) -> list:
+    return [
+        User.onboarding_stage == OnboardingStage.COMPLETED,
+        *_range_conditions(User.stage_completed_at, start, end)
+    ]
+
+
+def _partner_without_team_conditions(start: Optional[datetime], end: Optional[datetime]) -> list:
+    return [
+        User.payment_completed == True,
+        User.onboarding_stage != OnboardingStage.COMPLETED,
+        *_range_conditions(User.stage_payment_ok_at, start, end)
+    ]
 
 class UserSegmentCRUD:
     """CRUD для сегментации пользователей"""
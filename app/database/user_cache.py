@@ -0,0 +1,152 @@
+"""
+Кэш состояния онбординга пользователей (stage, gender, ref_code, оплата)
+app/database/user_cache.py
+
+Используется OnboardingCheckMiddleware, чтобы не ходить в БД на каждый апдейт.
+Ограничен по размеру (LRU) и по времени жизни записи (TTL).
+
+Кэш локален для процесса, а оплату завершает веб-процесс (Robokassa):
+изменения рассылаются другим процессам через app/services/user_cache_sync.py.
+Пока подписки на инвалидации нет (синхронизация выключена или Redis
+недоступен), записи пользователей без оплаты живут всего prepayment_ttl секунд.
+"""
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Callable, Optional
+
+from app.config import settings
+from app.utils.metrics import USER_CACHE_ENTRIES, USER_CACHE_EVICTIONS, USER_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CachedUser:
+    """Снимок полей пользователя, нужных middleware и хендлерам"""
+    telegram_id: int
+    onboarding_stage: str
+    gender: Optional[str]
+    ref_code: Optional[str]
+    payment_completed: bool
+
+    @classmethod
+    def from_user(cls, user) -> "CachedUser":
+        return cls(
+            telegram_id=user.telegram_id,
+            onboarding_stage=user.onboarding_stage,
+            gender=user.gender,
+            ref_code=user.ref_code,
+            payment_completed=bool(user.payment_completed),
+        )
+
+
+class UserStateCache:
+    """LRU + TTL кэш снимков пользователей по telegram_id"""
+
+    def __init__(self, max_size: int = 50000, ttl: float = 300.0, prepayment_ttl: float = 5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.prepayment_ttl = prepayment_ttl
+        self._entries: "OrderedDict[int, tuple[float, CachedUser]]" = OrderedDict()
+        # Уведомление других процессов об изменении пользователя (UserCacheSync)
+        self._publish: Optional[Callable[[int], None]] = None
+        # Инвалидации других процессов доходят (подписка UserCacheSync активна)
+        self._synced = False
+
+        # Счетчики для мониторинга
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, telegram_id: int) -> Optional[CachedUser]:
+        """Получение снимка; None если записи нет или она устарела"""
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            self.misses += 1
+            USER_CACHE_LOOKUPS.labels("miss").inc()
+            return None
+
+        expires_at, cached = entry
+        if expires_at < time.monotonic():
+            del self._entries[telegram_id]
+            self.misses += 1
+            USER_CACHE_LOOKUPS.labels("miss").inc()
+            return None
+
+        self._entries.move_to_end(telegram_id)
+        self.hits += 1
+        USER_CACHE_LOOKUPS.labels("hit").inc()
+        return cached
+
+    def put(self, user) -> CachedUser:
+        """Сохранение пользователя (ORM User или CachedUser) в кэш"""
+        cached = user if isinstance(user, CachedUser) else CachedUser.from_user(user)
+        self._store(cached)
+        return cached
+
+    def update(self, telegram_id: int, **fields) -> None:
+        """Обновление полей существующей записи (если записи нет - ничего не делаем)"""
+        self._notify(telegram_id)
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return
+        self._store(replace(entry[1], **fields))
+
+    def invalidate(self, telegram_id: int, broadcast: bool = True) -> None:
+        """
+        Удаление записи из кэша
+
+        Args:
+            broadcast: Сообщить другим процессам (False - инвалидация пришла от них)
+        """
+        self._entries.pop(telegram_id, None)
+        if broadcast:
+            self._notify(telegram_id)
+
+    def set_publisher(self, publish: Optional[Callable[[int], None]]) -> None:
+        """Подключение рассылки инвалидаций (None - только локальный кэш)"""
+        self._publish = publish
+
+    def set_synced(self, synced: bool) -> None:
+        """Подписка на инвалидации активна: короткий prepayment_ttl не нужен"""
+        self._synced = synced
+
+    def _notify(self, telegram_id: int) -> None:
+        if self._publish is not None:
+            self._publish(telegram_id)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """Статистика попаданий для мониторинга"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def _store(self, cached: CachedUser) -> None:
+        ttl = self.ttl if cached.payment_completed or self._synced else self.prepayment_ttl
+        self._entries[cached.telegram_id] = (time.monotonic() + ttl, cached)
+        self._entries.move_to_end(cached.telegram_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            USER_CACHE_EVICTIONS.inc()
+
+
+# Глобальный экземпляр кэша
+user_state_cache = UserStateCache(
+    max_size=settings.USER_CACHE_MAX_SIZE,
+    ttl=settings.USER_CACHE_TTL,
+    prepayment_ttl=settings.USER_CACHE_PREPAYMENT_TTL
+)
+USER_CACHE_ENTRIES.set_function(lambda: len(user_state_cache._entries))
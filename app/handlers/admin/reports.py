@@ -1,19 +1,19 @@
 """
 Обработчики для админских отчетов
 """
-import csv
-import io
 import logging
 from datetime import datetime, timedelta
 from aiogram import Router, types, F
 from aiogram.filters import Command
-from aiogram.types import BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 
 from app.config import settings
 from app.database.connection import AsyncSessionLocal
-from app.database.statistics_crud import StatisticsCRUD, UserSegmentCRUD
+from app.database.funnel_crud import FunnelStatsCRUD
+from app.database.statistics_crud import StatisticsCRUD, UserSegmentCRUD, day_bounds, period_bounds
 from app.handlers.admin.report_states import ReportStates
+from app.services.report_exporter import ALL_TIME_SECTIONS, PERIOD_SECTIONS, report_exporter
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +22,9 @@ router = Router()
 # Максимальная длина сообщения в Telegram
 MAX_MESSAGE_LENGTH = 4096
 
+# Сколько записей раздела показывать в тексте отчета (полный список - в CSV)
+TEXT_LIST_LIMIT = 50
+
 
 async def send_long_message(message_or_callback, text: str, parse_mode: str = "HTML", **kwargs):
     """
@@ -102,6 +105,22 @@ def get_period_keyboard() -> InlineKeyboardMarkup:
     )
 
 
+def format_more(total: int, shown: int) -> str:
+    """Строка про записи, не вошедшие в текст отчета"""
+    if total <= shown:
+        return ""
+    return f"\n... и еще {total - shown} (полный список в CSV)\n"
+
+
+def sales_from_funnel(totals: dict) -> dict:
+    """Блок продаж отчета из сумм daily_funnel_stats"""
+    return {
+        "count": totals["sales_count"],
+        "total_amount": totals["sales_amount"],
+        "total_commission": totals["sales_commission"]
+    }
+
+
 def validate_date(date_str: str) -> tuple[bool, datetime | None]:
     """
     Валидация даты в формате ДД.ММ.ГГГГ
@@ -154,20 +173,23 @@ async def report_daily_handler(callback: types.CallbackQuery, state: FSMContext)
             # Получаем данные за сегодня
             today = datetime.now()
 
-            # 1. Продажи за день
-            sales_data = await StatisticsCRUD.get_daily_sales(session, today)
+            start, end = day_bounds(today)
+
+            # 1. Продажи за день (из daily_funnel_stats)
+            sales_data = sales_from_funnel(await FunnelStatsCRUD.get_totals(session, today.date(), today.date()))
 
             # 2. Покупатели за день
-            buyers = await StatisticsCRUD.get_daily_buyers(session, today)
+            buyers = await StatisticsCRUD.get_buyer_rows(session, start, end, limit=TEXT_LIST_LIMIT)
 
             # 3. Новые лиды
-            new_leads = await StatisticsCRUD.get_new_leads(session, today)
+            new_leads = await StatisticsCRUD.get_lead_rows(session, start, end, limit=TEXT_LIST_LIMIT)
 
             # 4. Новые партнеры
-            new_partners = await StatisticsCRUD.get_new_partners(session, today)
+            new_partners = await StatisticsCRUD.get_partner_rows(session, start, end, limit=TEXT_LIST_LIMIT)
 
             # 5. Партнеры без команды (за день)
-            partners_no_team = await StatisticsCRUD.get_partners_without_team(session, today)
+            partners_no_team = await StatisticsCRUD.get_partner_without_team_rows(session, start, end, limit=TEXT_LIST_LIMIT)
+            counts = await StatisticsCRUD.get_report_counts(session, start, end)
 
             # Формируем текстовый отчет
             report_text = f"""
@@ -183,23 +205,24 @@ async def report_daily_handler(callback: types.CallbackQuery, state: FSMContext)
 
 ━━━━━━━━━━━━━━━━━━━━━━
 
-👥 <b>ПОКУПАТЕЛИ ({len(buyers)})</b>
+👥 <b>ПОКУПАТЕЛИ ({counts['buyers']})</b>
 """
             if buyers:
                 for buyer in buyers:
-                    username = f"@{buyer['username']}" if buyer['username'] else "Нет username"
-                    time_str = buyer['purchased_at'].strftime('%H:%M')
-                    report_text += f"\n• {buyer['full_name']} ({username})\n"
-                    report_text += f"  ID: {buyer['telegram_id']}\n"
-                    report_text += f"  Сумма: {buyer['amount']:,.0f} руб.\n"
+                    username = f"@{buyer.username}" if buyer.username else "Нет username"
+                    time_str = buyer.purchased_at.strftime('%H:%M')
+                    report_text += f"\n• {buyer.full_name} ({username})\n"
+                    report_text += f"  ID: {buyer.telegram_id}\n"
+                    report_text += f"  Сумма: {buyer.amount:,.0f} руб.\n"
                     report_text += f"  Время: {time_str}\n"
+                report_text += format_more(counts['buyers'], len(buyers))
             else:
                 report_text += "\nНет покупателей за сегодня\n"
 
             report_text += f"""
 ━━━━━━━━━━━━━━━━━━━━━━
 
-🆕 <b>НОВЫЕ ЛИДЫ ({len(new_leads)})</b>
+🆕 <b>НОВЫЕ ЛИДЫ ({counts['leads']})</b>
 """
             if new_leads:
                 for lead in new_leads:
@@ -208,13 +231,14 @@ async def report_daily_handler(callback: types.CallbackQuery, state: FSMContext)
                     report_text += f"\n• {lead.full_name} ({username})\n"
                     report_text += f"  ID: {lead.telegram_id}\n"
                     report_text += f"  Время: {time_str}\n"
+                report_text += format_more(counts['leads'], len(new_leads))
             else:
                 report_text += "\nНет новых лидов за сегодня\n"
 
             report_text += f"""
 ━━━━━━━━━━━━━━━━━━━━━━
 
-🤝 <b>НОВЫЕ ПАРТНЕРЫ ({len(new_partners)})</b>
+🤝 <b>НОВЫЕ ПАРТНЕРЫ ({counts['partners']})</b>
 """
             if new_partners:
                 for partner in new_partners:
@@ -223,13 +247,14 @@ async def report_daily_handler(callback: types.CallbackQuery, state: FSMContext)
                     report_text += f"\n• {partner.full_name} ({username})\n"
                     report_text += f"  ID: {partner.telegram_id}\n"
                     report_text += f"  Время: {time_str}\n"
+                report_text += format_more(counts['partners'], len(new_partners))
             else:
                 report_text += "\nНет новых партнеров за сегодня\n"
 
             report_text += f"""
 ━━━━━━━━━━━━━━━━━━━━━━
 
-⚠️ <b>ПАРТНЕРЫ БЕЗ КОМАНДЫ ({len(partners_no_team)})</b>
+⚠️ <b>ПАРТНЕРЫ БЕЗ КОМАНДЫ ({counts['partners_without_team']})</b>
 <i>Купили партнерку, но не нажали "Команда"</i>
 """
             if partners_no_team:
@@ -240,6 +265,7 @@ async def report_daily_handler(callback: types.CallbackQuery, state: FSMContext)
                     report_text += f"  ID: {user.telegram_id}\n"
                     report_text += f"  Оплата: {payment_time}\n"
                     report_text += f"  Стадия: {user.onboarding_stage}\n"
+                report_text += format_more(counts['partners_without_team'], len(partners_no_team))
             else:
                 report_text += "\nНет таких пользователей за сегодня\n"
 
@@ -247,74 +273,17 @@ async def report_daily_handler(callback: types.CallbackQuery, state: FSMContext)
             await send_long_message(status_msg, report_text, parse_mode="HTML")
 
             # Генерируем CSV файл
-            csv_buffer = io.StringIO()
-            csv_writer = csv.writer(csv_buffer)
-
-            # Заголовки CSV
-            csv_writer.writerow([
-                "Категория", "Имя", "Username", "Telegram ID",
-                "Сумма", "Время", "Стадия"
-            ])
-
-            # Добавляем покупателей
-            for buyer in buyers:
-                csv_writer.writerow([
-                    "Покупатель",
-                    buyer['full_name'],
-                    buyer['username'] or "",
-                    buyer['telegram_id'],
-                    buyer['amount'],
-                    buyer['purchased_at'].strftime('%Y-%m-%d %H:%M:%S'),
-                    "Paid"
-                ])
-
-            # Добавляем новых лидов
-            for lead in new_leads:
-                csv_writer.writerow([
-                    "Новый лид",
-                    lead.full_name,
-                    lead.username or "",
-                    lead.telegram_id,
-                    "",
-                    lead.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    lead.onboarding_stage
-                ])
-
-            # Добавляем новых партнеров
-            for partner in new_partners:
-                csv_writer.writerow([
-                    "Новый партнер",
-                    partner.full_name,
-                    partner.username or "",
-                    partner.telegram_id,
-                    "",
-                    partner.stage_completed_at.strftime('%Y-%m-%d %H:%M:%S') if partner.stage_completed_at else "",
-                    partner.onboarding_stage
-                ])
-
-            # Добавляем партнеров без команды
-            for user in partners_no_team:
-                csv_writer.writerow([
-                    "Партнер без команды",
-                    user.full_name,
-                    user.username or "",
-                    user.telegram_id,
-                    "",
-                    user.stage_payment_ok_at.strftime('%Y-%m-%d %H:%M:%S') if user.stage_payment_ok_at else "",
-                    user.onboarding_stage
-                ])
-
-            # Отправляем CSV файл
-            csv_data = csv_buffer.getvalue().encode('utf-8-sig')  # utf-8-sig для корректного отображения в Excel
-            csv_file = BufferedInputFile(
-                csv_data,
-                filename=f"daily_report_{today.strftime('%Y%m%d')}.csv"
-            )
-
-            await callback.message.answer_document(
-                document=csv_file,
-                caption=f"📊 CSV отчет за {today.strftime('%d.%m.%Y')}"
+            csv_file = await report_exporter.export(
+                session, PERIOD_SECTIONS, f"daily_report_{today.strftime('%Y%m%d')}.csv",
+                start, end, time_header="Время"
             )
+            try:
+                await callback.message.answer_document(
+                    document=csv_file,
+                    caption=f"📊 CSV отчет за {today.strftime('%d.%m.%Y')}"
+                )
+            finally:
+                csv_file.close()
 
             logger.info(f"Daily report sent to admin {callback.from_user.id}")
 
@@ -418,11 +387,15 @@ async def process_end_date(message: types.Message, state: FSMContext):
     try:
         async with AsyncSessionLocal() as session:
             # Получаем данные за период
-            sales_data = await StatisticsCRUD.get_period_sales(session, start_date, end_date)
-            buyers = await StatisticsCRUD.get_period_buyers(session, start_date, end_date)
-            new_leads = await StatisticsCRUD.get_period_leads(session, start_date, end_date)
-            new_partners = await StatisticsCRUD.get_period_partners(session, start_date, end_date)
-            partners_no_team = await StatisticsCRUD.get_period_partners_without_team(session, start_date, end_date)
+            start, end = period_bounds(start_date, end_date)
+            sales_data = sales_from_funnel(
+                await FunnelStatsCRUD.get_totals(session, start_date.date(), end_date.date())
+            )
+            buyers = await StatisticsCRUD.get_buyer_rows(session, start, end, limit=TEXT_LIST_LIMIT)
+            new_leads = await StatisticsCRUD.get_lead_rows(session, start, end, limit=TEXT_LIST_LIMIT)
+            new_partners = await StatisticsCRUD.get_partner_rows(session, start, end, limit=TEXT_LIST_LIMIT)
+            partners_no_team = await StatisticsCRUD.get_partner_without_team_rows(session, start, end, limit=TEXT_LIST_LIMIT)
+            counts = await StatisticsCRUD.get_report_counts(session, start, end)
 
             # Формируем текстовый отчет
             report_text = f"""
@@ -438,23 +411,24 @@ async def process_end_date(message: types.Message, state: FSMContext):
 
 ━━━━━━━━━━━━━━━━━━━━━━
 
-👥 <b>ПОКУПАТЕЛИ ({len(buyers)})</b>
+👥 <b>ПОКУПАТЕЛИ ({counts['buyers']})</b>
 """
             if buyers:
                 for buyer in buyers:
-                    username = f"@{buyer['username']}" if buyer['username'] else "Нет username"
-                    time_str = buyer['purchased_at'].strftime('%d.%m.%Y %H:%M')
-                    report_text += f"\n• {buyer['full_name']} ({username})\n"
-                    report_text += f"  ID: {buyer['telegram_id']}\n"
-                    report_text += f"  Сумма: {buyer['amount']:,.0f} руб.\n"
+                    username = f"@{buyer.username}" if buyer.username else "Нет username"
+                    time_str = buyer.purchased_at.strftime('%d.%m.%Y %H:%M')
+                    report_text += f"\n• {buyer.full_name} ({username})\n"
+                    report_text += f"  ID: {buyer.telegram_id}\n"
+                    report_text += f"  Сумма: {buyer.amount:,.0f} руб.\n"
                     report_text += f"  Дата: {time_str}\n"
+                report_text += format_more(counts['buyers'], len(buyers))
             else:
                 report_text += "\nНет покупателей за период\n"
 
             report_text += f"""
 ━━━━━━━━━━━━━━━━━━━━━━
 
-🆕 <b>НОВЫЕ ЛИДЫ ({len(new_leads)})</b>
+🆕 <b>НОВЫЕ ЛИДЫ ({counts['leads']})</b>
 """
             if new_leads:
                 for lead in new_leads:
@@ -463,13 +437,14 @@ async def process_end_date(message: types.Message, state: FSMContext):
                     report_text += f"\n• {lead.full_name} ({username})\n"
                     report_text += f"  ID: {lead.telegram_id}\n"
                     report_text += f"  Дата: {time_str}\n"
+                report_text += format_more(counts['leads'], len(new_leads))
             else:
                 report_text += "\nНет новых лидов за период\n"
 
             report_text += f"""
 ━━━━━━━━━━━━━━━━━━━━━━
 
-🤝 <b>НОВЫЕ ПАРТНЕРЫ ({len(new_partners)})</b>
+🤝 <b>НОВЫЕ ПАРТНЕРЫ ({counts['partners']})</b>
 """
             if new_partners:
                 for partner in new_partners:
@@ -478,13 +453,14 @@ async def process_end_date(message: types.Message, state: FSMContext):
                     report_text += f"\n• {partner.full_name} ({username})\n"
                     report_text += f"  ID: {partner.telegram_id}\n"
                     report_text += f"  Дата: {time_str}\n"
+                report_text += format_more(counts['partners'], len(new_partners))
             else:
                 report_text += "\nНет новых партнеров за период\n"
 
             report_text += f"""
 ━━━━━━━━━━━━━━━━━━━━━━
 
-⚠️ <b>ПАРТНЕРЫ БЕЗ КОМАНДЫ ({len(partners_no_team)})</b>
+⚠️ <b>ПАРТНЕРЫ БЕЗ КОМАНДЫ ({counts['partners_without_team']})</b>
 <i>Купили партнерку, но не нажали "Команда"</i>
 """
             if partners_no_team:
@@ -495,6 +471,7 @@ async def process_end_date(message: types.Message, state: FSMContext):
                     report_text += f"  ID: {user.telegram_id}\n"
                     report_text += f"  Оплата: {payment_time}\n"
                     report_text += f"  Стадия: {user.onboarding_stage}\n"
+                report_text += format_more(counts['partners_without_team'], len(partners_no_team))
             else:
                 report_text += "\nНет таких пользователей за период\n"
 
@@ -502,68 +479,18 @@ async def process_end_date(message: types.Message, state: FSMContext):
             await send_long_message(status_msg, report_text, parse_mode="HTML")
 
             # Генерируем CSV файл
-            csv_buffer = io.StringIO()
-            csv_writer = csv.writer(csv_buffer)
-
-            csv_writer.writerow([
-                "Категория", "Имя", "Username", "Telegram ID",
-                "Сумма", "Дата/Время", "Стадия"
-            ])
-
-            for buyer in buyers:
-                csv_writer.writerow([
-                    "Покупатель",
-                    buyer['full_name'],
-                    buyer['username'] or "",
-                    buyer['telegram_id'],
-                    buyer['amount'],
-                    buyer['purchased_at'].strftime('%Y-%m-%d %H:%M:%S'),
-                    "Paid"
-                ])
-
-            for lead in new_leads:
-                csv_writer.writerow([
-                    "Новый лид",
-                    lead.full_name,
-                    lead.username or "",
-                    lead.telegram_id,
-                    "",
-                    lead.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    lead.onboarding_stage
-                ])
-
-            for partner in new_partners:
-                csv_writer.writerow([
-                    "Новый партнер",
-                    partner.full_name,
-                    partner.username or "",
-                    partner.telegram_id,
-                    "",
-                    partner.stage_completed_at.strftime('%Y-%m-%d %H:%M:%S') if partner.stage_completed_at else "",
-                    partner.onboarding_stage
-                ])
-
-            for user in partners_no_team:
-                csv_writer.writerow([
-                    "Партнер без команды",
-                    user.full_name,
-                    user.username or "",
-                    user.telegram_id,
-                    "",
-                    user.stage_payment_ok_at.strftime('%Y-%m-%d %H:%M:%S') if user.stage_payment_ok_at else "",
-                    user.onboarding_stage
-                ])
-
-            csv_data = csv_buffer.getvalue().encode('utf-8-sig')
-            csv_file = BufferedInputFile(
-                csv_data,
-                filename=f"period_report_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.csv"
-            )
-
-            await message.answer_document(
-                document=csv_file,
-                caption=f"📊 CSV отчет за период {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}"
+            csv_file = await report_exporter.export(
+                session, PERIOD_SECTIONS,
+                f"period_report_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.csv",
+                start, end
             )
+            try:
+                await message.answer_document(
+                    document=csv_file,
+                    caption=f"📊 CSV отчет за период {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}"
+                )
+            finally:
+                csv_file.close()
 
             logger.info(f"Period report sent to admin {message.from_user.id}")
 
@@ -589,12 +516,16 @@ async def report_all_time_handler(callback: types.CallbackQuery, state: FSMConte
 
     try:
         async with AsyncSessionLocal() as session:
-            # Получаем данные за всё время
-            sales_data = await StatisticsCRUD.get_all_time_sales(session)
-            buyers = await StatisticsCRUD.get_all_time_buyers(session)
-            new_leads = await StatisticsCRUD.get_all_time_leads(session)
-            new_partners = await StatisticsCRUD.get_all_time_partners(session)
-            partners_no_team = await StatisticsCRUD.get_all_time_partners_without_team(session)
+            # Текст отчета - суммы по daily_funnel_stats и последние 10 покупателей
+            totals = await FunnelStatsCRUD.get_totals(session)
+            sales_data = sales_from_funnel(totals)
+            counts = {
+                "leads": totals["new_users"],
+                "buyers": totals["payments_count"],
+                "partners": totals["stage_completed"],
+                "partners_without_team": totals["paid_without_team"]
+            }
+            recent_buyers = await StatisticsCRUD.get_buyer_rows(session, limit=10, newest_first=True)
 
             # Формируем текстовый отчет
             report_text = f"""
@@ -609,18 +540,18 @@ async def report_all_time_handler(callback: types.CallbackQuery, state: FSMConte
 
 ━━━━━━━━━━━━━━━━━━━━━━
 
-👥 <b>ПОКУПАТЕЛИ ({len(buyers)})</b>
+👥 <b>ПОКУПАТЕЛИ ({counts['buyers']})</b>
 """
             # Для всех времени показываем только статистику, не весь список
-            if buyers:
-                report_text += f"\nВсего покупателей: {len(buyers)}\n"
+            if recent_buyers:
+                report_text += f"\nВсего покупателей: {counts['buyers']}\n"
                 report_text += "\nПоследние 10 покупателей:\n"
-                for buyer in sorted(buyers, key=lambda x: x['purchased_at'], reverse=True)[:10]:
-                    username = f"@{buyer['username']}" if buyer['username'] else "Нет username"
-                    time_str = buyer['purchased_at'].strftime('%d.%m.%Y %H:%M')
-                    report_text += f"\n• {buyer['full_name']} ({username})\n"
-                    report_text += f"  ID: {buyer['telegram_id']}\n"
-                    report_text += f"  Сумма: {buyer['amount']:,.0f} руб.\n"
+                for buyer in recent_buyers:
+                    username = f"@{buyer.username}" if buyer.username else "Нет username"
+                    time_str = buyer.purchased_at.strftime('%d.%m.%Y %H:%M')
+                    report_text += f"\n• {buyer.full_name} ({username})\n"
+                    report_text += f"  ID: {buyer.telegram_id}\n"
+                    report_text += f"  Сумма: {buyer.amount:,.0f} руб.\n"
                     report_text += f"  Дата: {time_str}\n"
             else:
                 report_text += "\nНет покупателей\n"
@@ -629,85 +560,31 @@ async def report_all_time_handler(callback: types.CallbackQuery, state: FSMConte
 ━━━━━━━━━━━━━━━━━━━━━━
 
 🆕 <b>ЛИДЫ</b>
-Всего лидов: {len(new_leads)}
+Всего лидов: {counts['leads']}
 
 ━━━━━━━━━━━━━━━━━━━━━━
 
 🤝 <b>ПАРТНЕРЫ</b>
-Всего партнеров: {len(new_partners)}
+Всего партнеров: {counts['partners']}
 
 ━━━━━━━━━━━━━━━━━━━━━━
 
 ⚠️ <b>ПАРТНЕРЫ БЕЗ КОМАНДЫ</b>
-Всего: {len(partners_no_team)}
+Всего: {counts['partners_without_team']}
 """
 
             # Отправляем текстовый отчет (с автоматическим разбиением на части если нужно)
             await send_long_message(status_msg, report_text, parse_mode="HTML")
 
-            # Генерируем CSV файл
-            csv_buffer = io.StringIO()
-            csv_writer = csv.writer(csv_buffer)
-
-            csv_writer.writerow([
-                "Категория", "Имя", "Username", "Telegram ID",
-                "Сумма", "Дата/Время", "Стадия"
-            ])
-
-            for buyer in buyers:
-                csv_writer.writerow([
-                    "Покупатель",
-                    buyer['full_name'],
-                    buyer['username'] or "",
-                    buyer['telegram_id'],
-                    buyer['amount'],
-                    buyer['purchased_at'].strftime('%Y-%m-%d %H:%M:%S'),
-                    "Paid"
-                ])
-
-            for lead in new_leads:
-                csv_writer.writerow([
-                    "Лид",
-                    lead.full_name,
-                    lead.username or "",
-                    lead.telegram_id,
-                    "",
-                    lead.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    lead.onboarding_stage
-                ])
-
-            for partner in new_partners:
-                csv_writer.writerow([
-                    "Партнер",
-                    partner.full_name,
-                    partner.username or "",
-                    partner.telegram_id,
-                    "",
-                    partner.stage_completed_at.strftime('%Y-%m-%d %H:%M:%S') if partner.stage_completed_at else "",
-                    partner.onboarding_stage
-                ])
-
-            for user in partners_no_team:
-                csv_writer.writerow([
-                    "Партнер без команды",
-                    user.full_name,
-                    user.username or "",
-                    user.telegram_id,
-                    "",
-                    user.stage_payment_ok_at.strftime('%Y-%m-%d %H:%M:%S') if user.stage_payment_ok_at else "",
-                    user.onboarding_stage
-                ])
-
-            csv_data = csv_buffer.getvalue().encode('utf-8-sig')
-            csv_file = BufferedInputFile(
-                csv_data,
-                filename="full_report.csv"
-            )
-
-            await callback.message.answer_document(
-                document=csv_file,
-                caption="📊 CSV отчет за всё время"
-            )
+            # Генерируем CSV файл (строки читаются курсором, в памяти не держатся)
+            csv_file = await report_exporter.export(session, ALL_TIME_SECTIONS, "full_report.csv")
+            try:
+                await callback.message.answer_document(
+                    document=csv_file,
+                    caption="📊 CSV отчет за всё время"
+                )
+            finally:
+                csv_file.close()
 
             logger.info(f"All-time report sent to admin {callback.from_user.id}")
 
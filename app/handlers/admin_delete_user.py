@@ -11,6 +11,8 @@ from sqlalchemy import text
 from aiogram.filters import Command
 
 from app.database.connection import AsyncSessionLocal
+from app.database.funnel_crud import FunnelStatsCRUD
+from app.database.user_cache import user_state_cache
 from app.config import settings, is_admin  # Импортируем функцию is_admin
 
 logger = logging.getLogger(__name__)
@@ -199,6 +201,9 @@ async def confirm_delete_user(callback: types.CallbackQuery, state: FSMContext):
             user_id = user_data.id
             ref_code = user_data.ref_code
             
+            # Дни среза воронки, которые изменит удаление
+            funnel_days = await FunnelStatsCRUD.days_of_user(session, telegram_id)
+            
             # КАСКАДНОЕ УДАЛЕНИЕ в правильном порядке
             
             # 1. Удаляем платежи (ссылаются на user_id)
@@ -222,6 +227,11 @@ async def confirm_delete_user(callback: types.CallbackQuery, state: FSMContext):
             )
             clicks_count = clicks_deleted.rowcount
             
+            await session.execute(
+                text("DELETE FROM partner_stats WHERE ref_code = :ref_code"),
+                {"ref_code": ref_code}
+            )
+            
             # 4. Удаляем тикеты поддержки (если есть таблица tickets)
             try:
                 tickets_deleted = await session.execute(
@@ -250,6 +260,8 @@ async def confirm_delete_user(callback: types.CallbackQuery, state: FSMContext):
             
             # Коммитим все изменения
             await session.commit()
+            user_state_cache.invalidate(telegram_id)
+            FunnelStatsCRUD.touch(*funnel_days)
             
             # Подтверждение полного удаления
             success_text = f"""
@@ -9,6 +9,10 @@ from aiogram.fsm.state import State, StatesGroup
 
 from app.database.connection import AsyncSessionLocal
 from app.database.crud import UserCRUD, SaleCRUD
+from app.database.funnel_crud import FunnelStatsCRUD
+from app.database.models import Sale
+from app.database.partner_stats_crud import PartnerStatsCRUD
+from app.services.auto_answers import auto_answers_service
 from app.config import settings, is_admin  # Импортируем функцию is_admin
 from aiogram.filters import Command
 
@@ -55,6 +59,32 @@ async def reset_balance_command(message: types.Message, state: FSMContext):
     await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
     await state.set_state(AdminStates.waiting_for_user_id)
 
+@router.message(Command("reload_answers"), admin_filter())
+async def reload_answers_command(message: types.Message):
+    """Команда /reload_answers [force] - обновить снимок автоответов из Google Sheets"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет прав доступа к админ панели")
+        return
+
+    force = "force" in (message.text or "").split()[1:]
+    version_before = auto_answers_service.qa_version
+    success = await auto_answers_service.reload_answers(force=force)
+    stats = auto_answers_service.stats()
+
+    pairs_text = "\n".join(f"• {sheet}: {count}" for sheet, count in stats['pairs'].items()) or "• нет данных"
+    if not success:
+        status = f"❌ Таблица недоступна, используется снимок v{stats['version']}"
+    elif stats['version'] != version_before:
+        status = f"✅ Автоответы обновлены: v{version_before} → v{stats['version']}"
+    else:
+        status = f"ℹ️ Изменений нет, снимок v{stats['version']}"
+
+    await message.answer(
+        f"{status}\n\n{pairs_text}\n\n🕒 Загружен: {stats['loaded_at'] or '—'}",
+        parse_mode="HTML"
+    )
+    logger.info(f"🔄 Auto answers reload by admin {message.from_user.id}: {status}")
+
 @router.callback_query(F.data == "admin_cancel")
 async def admin_cancel(callback: types.CallbackQuery, state: FSMContext):
     """Отмена операции"""
@@ -175,12 +205,19 @@ async def confirm_full_reset(callback: types.CallbackQuery, state: FSMContext):
                     await state.clear()
                     return
                 
+                # Дни среза воронки с этими продажами
+                funnel_days = await FunnelStatsCRUD.days_of(session, Sale.created_at, Sale.ref_code == target_ref_code)
+                
                 # Удаляем все продажи
                 delete_query = text("DELETE FROM sales WHERE ref_code = :ref_code")
                 delete_result = await session.execute(delete_query, {"ref_code": target_ref_code})
                 deleted_count = delete_result.rowcount
                 
                 logger.info(f"🗑️ Deleted {deleted_count} sales for user {target_user_id} (ref_code: {target_ref_code})")
+
+                # Счетчики партнера - в той же транзакции
+                await PartnerStatsCRUD.recalculate(session, [target_ref_code])
+        FunnelStatsCRUD.touch(*funnel_days)
         
         # Форматируем сумму
         formatted_balance = f"{current_balance:,.0f} руб.".replace(",", " ")
@@ -296,6 +333,7 @@ async def process_partial_amount(message: types.Message, state: FSMContext):
                 """)
                 result = await session.execute(select_query, {"ref_code": target_ref_code})
                 sales = result.fetchall()
+                funnel_days = await FunnelStatsCRUD.days_of(session, Sale.created_at, Sale.ref_code == target_ref_code)
                 
                 if not sales:
                     await message.answer("❌ У пользователя нет подтвержденных продаж")
@@ -382,6 +420,10 @@ async def process_partial_amount(message: types.Message, state: FSMContext):
                         
                         actual_deleted = amount - remaining_amount
                         method = f"Удалено {len(sales_to_delete)} продаж, изменено {len(sales_to_update)}"
+
+                # Счетчики партнера - в той же транзакции
+                await PartnerStatsCRUD.recalculate(session, [target_ref_code])
+        FunnelStatsCRUD.touch(*funnel_days)
         
         formatted_amount = f"{actual_deleted:,.0f} руб.".replace(",", " ")
         new_balance = current_balance - actual_deleted
@@ -5,10 +5,9 @@ app/handlers/broadcast/broadcast_handler.py
 ОБНОВЛЕНО: Добавлена поддержка медиа (фото, видео, аудио, голосовые, круглые видео)
 ОБНОВЛЕНО: Добавлены новые типы рассылок (не оплатившим, обучающимся)
 """
-import asyncio
 import logging
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from aiogram import Router, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
@@ -16,6 +15,9 @@ from aiogram.fsm.context import FSMContext
 from app.config import settings, is_admin
 from app.database.connection import AsyncSessionLocal
 from app.database.crud import UserCRUD
+from app.database.broadcast_crud import BroadcastJobCRUD
+from app.database.models import BroadcastJobStatus
+from app.services.broadcast_jobs import broadcast_job_runner, processed_count
 from app.handlers.broadcast.broadcast_states import BroadcastStates
 from app.handlers.broadcast.broadcast_utils import (
     parse_telegram_ids,
@@ -33,13 +35,6 @@ logger = logging.getLogger(__name__)
 
 router = Router()
 
-broadcast_stats = {
-    'total_broadcasts': 0,
-    'total_messages_sent': 0,
-    'last_broadcast': None
-}
-
-
 def admin_filter():
     """Создает фильтр для проверки множественных админов"""
     admin_ids = settings.admin_ids_list
@@ -108,26 +103,17 @@ async def choose_all_users(callback: types.CallbackQuery, state: FSMContext):
     
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserCRUD.get_all_active_users(session)
-        
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "all_users")
         
         await state.update_data(
             audience_type="all_users",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
         
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} пользователей\n\n"
+            f"👥 <b>Получатели:</b> {recipient_count} пользователей\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
         )
@@ -151,26 +137,17 @@ async def choose_paid_users(callback: types.CallbackQuery, state: FSMContext):
     
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserCRUD.get_paid_users(session)
-        
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "paid_users")
         
         await state.update_data(
             audience_type="paid_users",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
         
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} пользователей (оплативших курс)\n\n"
+            f"👥 <b>Получатели:</b> {recipient_count} пользователей (оплативших курс)\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
         )
@@ -194,26 +171,17 @@ async def choose_unpaid_users(callback: types.CallbackQuery, state: FSMContext):
     
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserCRUD.get_unpaid_users(session)
-        
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "unpaid_users")
         
         await state.update_data(
             audience_type="unpaid_users",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
         
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} пользователей (не оплативших курс)\n\n"
+            f"👥 <b>Получатели:</b> {recipient_count} пользователей (не оплативших курс)\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
         )
@@ -237,26 +205,17 @@ async def choose_learning_users(callback: types.CallbackQuery, state: FSMContext
     
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserCRUD.get_learning_users(session)
-        
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "want_join_users")
         
         await state.update_data(
-            audience_type="learning_users",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            audience_type="want_join_users",
+            recipient_count=recipient_count
         )
         
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} пользователей (проходят обучение)\n\n"
+            f"👥 <b>Получатели:</b> {recipient_count} пользователей (проходят обучение)\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
         )
@@ -280,26 +239,17 @@ async def choose_payment_page_users(callback: types.CallbackQuery, state: FSMCon
     
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserCRUD.get_payment_page_users(session)
-        
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "payment_page_users")
         
         await state.update_data(
             audience_type="payment_page_users",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
         
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} пользователей (на странице оплаты)\n\n"
+            f"👥 <b>Получатели:</b> {recipient_count} пользователей (на странице оплаты)\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
         )
@@ -381,8 +331,9 @@ async def process_user_ids(message: types.Message, state: FSMContext):
         
         preview_text = format_user_list_preview(recipients, telegram_ids)
         
+        # Список ID вводит админ вручную - он небольшой; получатели
+        # повторно выбираются по нему из БД при запуске рассылки
         await state.update_data(
-            recipients=recipients,
             recipient_count=len(recipients),
             requested_ids=telegram_ids
         )
@@ -410,10 +361,9 @@ async def confirm_user_list(callback: types.CallbackQuery, state: FSMContext):
         return
         
     data = await state.get_data()
-    recipients = data.get('recipients', [])
     recipient_count = data.get('recipient_count', 0)
     
-    if not recipients or recipient_count == 0:
+    if recipient_count == 0:
         await callback.answer("❌ Нет получателей для рассылки", show_alert=True)
         return
     
@@ -459,7 +409,6 @@ async def handle_message_input(message: types.Message, state: FSMContext):
     
     try:
         data = await state.get_data()
-        recipients = data.get('recipients', [])
         recipient_count = data.get('recipient_count', 0)
         admin_name = data.get('admin_name', 'Неизвестно')
         audience_type = data.get('audience_type', '')
@@ -473,6 +422,7 @@ async def handle_message_input(message: types.Message, state: FSMContext):
             "partners_without_team": "партнерам без команды",
             "partners_in_team": "партнерам в команде",
             "learning_users": "пользователям, которые еще обучаются",
+            "want_join_users": "пользователям, которые проходят обучение",
             "specific_users": "выбранным пользователям",
             "paid_users": "пользователям, оплатившим курс",
             "unpaid_users": "пользователям, не оплатившим курс",
@@ -586,41 +536,40 @@ async def confirm_broadcast_send(callback: types.CallbackQuery, state: FSMContex
     
     try:
         data = await state.get_data()
-        recipients = data.get('recipients', [])
+        recipient_count = data.get('recipient_count', 0)
         media_data = data.get('media_data', {})
         admin_id = data.get('admin_id')
         admin_name = data.get('admin_name', 'Неизвестно')
-        start_time_str = data.get('start_time')
         
-        if not recipients:
+        if not recipient_count:
             await callback.answer("❌ Список получателей пуст", show_alert=True)
             return
         
-        start_time = datetime.fromisoformat(start_time_str) if start_time_str else datetime.now()
-        
         progress_message = await callback.message.edit_text(
             f"🚀 <b>Запуск рассылки...</b>\n\n"
             f"👤 <b>Инициатор:</b> {admin_name}\n"
-            f"👥 <b>Получателей:</b> {len(recipients)}\n\n"
+            f"👥 <b>Получателей:</b> {recipient_count}\n\n"
             f"Пожалуйста, подождите...",
             parse_mode="HTML"
         )
         
-        await state.set_state(BroadcastStates.broadcasting)
-        
-        # Запуск в фоне
-        asyncio.create_task(
-            execute_broadcast(
-                bot=callback.bot,
-                recipients=recipients,
-                media_data=media_data,
-                progress_message=progress_message,
-                start_time=start_time,
-                state=state,
+        # Задача и получатели сохраняются в БД - рассылка переживет рестарт бота.
+        # Получатели выбираются INSERT ... SELECT по аудитории, без списка в памяти
+        async with AsyncSessionLocal() as session:
+            job = await BroadcastJobCRUD.create_job(
+                session,
                 admin_id=admin_id,
-                admin_name=admin_name
+                admin_name=admin_name,
+                audience_type=data.get('audience_type'),
+                media_data=media_data,
+                telegram_ids=data.get('requested_ids'),
+                progress_chat_id=progress_message.chat.id,
+                progress_message_id=progress_message.message_id
             )
-        )
+        
+        await state.clear()
+        broadcast_job_runner.start(callback.bot, job.id)
+        logger.info(f"Broadcast job {job.id} created for {job.total_count} recipients by admin {admin_id}")
         
         await callback.answer("✅ Рассылка запущена")
         
@@ -629,171 +578,6 @@ async def confirm_broadcast_send(callback: types.CallbackQuery, state: FSMContex
         await callback.answer("❌ Ошибка запуска рассылки", show_alert=True)
 
 
-async def execute_broadcast(
-    bot,
-    recipients: List[Dict],
-    media_data: Dict,
-    progress_message: types.Message,
-    start_time: datetime,
-    state: FSMContext,
-    admin_id: int,
-    admin_name: str
-):
-    """
-    Выполнение рассылки в фоне с поддержкой медиа
-    """
-    logger.info(f"Starting broadcast execution for {len(recipients)} recipients by admin {admin_id}")
-    
-    total = len(recipients)
-    successful = 0
-    errors = 0
-    error_details = {'blocked': 0, 'not_found': 0, 'other': 0}
-    
-    update_interval = max(1, total // 20)
-    
-    try:
-        for i, recipient in enumerate(recipients, 1):
-            telegram_id = recipient['telegram_id']
-            
-            try:
-                # Отправляем в зависимости от типа медиа
-                media_type = media_data.get('type', 'text')
-                
-                if media_type == 'text':
-                    await bot.send_message(
-                        chat_id=telegram_id,
-                        text=media_data.get('text', ''),
-                        parse_mode="HTML"
-                    )
-                    
-                elif media_type == 'photo':
-                    await bot.send_photo(
-                        chat_id=telegram_id,
-                        photo=media_data.get('file_id'),
-                        caption=media_data.get('caption'),
-                        parse_mode="HTML"
-                    )
-                    
-                elif media_type == 'video':
-                    await bot.send_video(
-                        chat_id=telegram_id,
-                        video=media_data.get('file_id'),
-                        caption=media_data.get('caption'),
-                        parse_mode="HTML"
-                    )
-                    
-                elif media_type == 'video_note':
-                    await bot.send_video_note(
-                        chat_id=telegram_id,
-                        video_note=media_data.get('file_id')
-                    )
-                    
-                elif media_type == 'audio':
-                    await bot.send_audio(
-                        chat_id=telegram_id,
-                        audio=media_data.get('file_id'),
-                        caption=media_data.get('caption'),
-                        parse_mode="HTML"
-                    )
-                    
-                elif media_type == 'voice':
-                    await bot.send_voice(
-                        chat_id=telegram_id,
-                        voice=media_data.get('file_id'),
-                        caption=media_data.get('caption'),
-                        parse_mode="HTML"
-                    )
-                
-                successful += 1
-                await asyncio.sleep(0.05)
-                
-            except Exception as e:
-                errors += 1
-                error_str = str(e).lower()
-                
-                if "blocked" in error_str or "user is deactivated" in error_str:
-                    error_details['blocked'] += 1
-                elif "not found" in error_str or "chat not found" in error_str:
-                    error_details['not_found'] += 1
-                else:
-                    error_details['other'] += 1
-                
-                logger.warning(f"Failed to send to {telegram_id}: {e}")
-            
-            # Обновляем прогресс
-            if i % update_interval == 0 or i == total:
-                try:
-                    progress_text = format_progress_message(
-                        current=i,
-                        total=total,
-                        successful=successful,
-                        errors=errors,
-                        admin_name=admin_name
-                    )
-                    
-                    await progress_message.edit_text(
-                        progress_text,
-                        parse_mode="HTML"
-                    )
-                except:
-                    pass
-        
-        # Финальный отчет
-        end_time = datetime.now()
-        duration = end_time - start_time
-        
-        global broadcast_stats
-        broadcast_stats['total_broadcasts'] += 1
-        broadcast_stats['total_messages_sent'] += successful
-        broadcast_stats['last_broadcast'] = end_time
-        
-        final_report = format_final_report(
-            total=total,
-            successful=successful,
-            errors=errors,
-            error_details=error_details,
-            duration=duration,
-            admin_name=admin_name,
-            admin_id=admin_id
-        )
-        
-        await progress_message.edit_text(
-            final_report,
-            parse_mode="HTML"
-        )
-        
-        # Уведомляем других админов
-        admin_ids = settings.admin_ids_list
-        for other_admin_id in admin_ids:
-            if other_admin_id != admin_id:
-                try:
-                    await bot.send_message(
-                        chat_id=other_admin_id,
-                        text=f"📢 <b>Уведомление о рассылке</b>\n\n{final_report}",
-                        parse_mode="HTML"
-                    )
-                except Exception as e:
-                    logger.warning(f"Failed to notify admin {other_admin_id}: {e}")
-        
-        logger.info(f"Broadcast completed: {successful}/{total} successful by admin {admin_id}")
-        
-    except Exception as e:
-        logger.error(f"Critical error in broadcast execution: {e}")
-        try:
-            await progress_message.edit_text(
-                f"❌ <b>Критическая ошибка рассылки</b>\n\n"
-                f"👤 <b>Инициатор:</b> {admin_name}\n"
-                f"Обработано: {successful + errors}/{total}\n"
-                f"Ошибка: {str(e)}",
-                parse_mode="HTML"
-            )
-        except:
-            pass
-    
-    finally:
-        await state.clear()
-
-
 @router.callback_query(F.data == "cancel_broadcast")
 async def cancel_broadcast(callback: types.CallbackQuery, state: FSMContext):
     """Отмена рассылки"""
@@ -816,11 +600,10 @@ async def show_broadcast_stats(message: types.Message):
         await message.answer("❌ У вас нет прав для просмотра статистики")
         return
         
-    global broadcast_stats
-    
     try:
         async with AsyncSessionLocal() as session:
             user_stats = await UserCRUD.get_broadcast_statistics(session)
+            broadcast_stats = await BroadcastJobCRUD.get_totals(session)
         
         last_broadcast_str = "Никогда"
         if broadcast_stats['last_broadcast']:
@@ -845,6 +628,7 @@ async def show_broadcast_stats(message: types.Message):
 • В процессе: {user_stats['incomplete_onboarding']}
 
 💡 Для новой рассылки используйте /broadcast
+📋 Задачи рассылок: /broadcast_jobs
 """
         
         await message.answer(stats_text, parse_mode="HTML")
@@ -857,6 +641,118 @@ async def show_broadcast_stats(message: types.Message):
         )
 
 
+JOB_STATUS_LABELS = {
+    BroadcastJobStatus.RUNNING: "🚀 выполняется",
+    BroadcastJobStatus.PAUSED: "⏸ на паузе",
+    BroadcastJobStatus.CANCELLED: "❌ отменена",
+    BroadcastJobStatus.COMPLETED: "✅ завершена",
+    BroadcastJobStatus.FAILED: "💥 ошибка",
+}
+
+
+@router.message(Command("broadcast_jobs"), admin_filter())
+async def show_broadcast_jobs(message: types.Message):
+    """Последние задачи рассылок"""
+    try:
+        async with AsyncSessionLocal() as session:
+            jobs = await BroadcastJobCRUD.get_recent_jobs(session, limit=10)
+        
+        if not jobs:
+            await message.answer("📋 Задач рассылок пока нет")
+            return
+        
+        lines = ["📋 <b>Последние рассылки</b>\n"]
+        for job in jobs:
+            created = job.created_at.strftime("%d.%m %H:%M") if job.created_at else "—"
+            lines.append(
+                f"<b>#{job.id}</b> {JOB_STATUS_LABELS.get(job.status, job.status)} · {created}\n"
+                f"   👤 {job.admin_name} · {processed_count(job)}/{job.total_count}, "
+                f"доставлено {job.sent_count}"
+            )
+        lines.append(
+            "\n⏸ /broadcast_pause [id] · ▶️ /broadcast_resume [id] · ❌ /broadcast_cancel [id]"
+        )
+        
+        await message.answer("\n".join(lines), parse_mode="HTML")
+        
+    except Exception as e:
+        logger.error(f"Error showing broadcast jobs: {e}")
+        await message.answer("❌ Ошибка получения списка рассылок")
+
+
+async def _resolve_job_id(message: types.Message, statuses: List[str]) -> Optional[int]:
+    """id задачи из аргумента команды или последняя задача в одном из статусов"""
+    args = message.text.split()
+    if len(args) > 1 and args[1].lstrip('#').isdigit():
+        return int(args[1].lstrip('#'))
+    
+    async with AsyncSessionLocal() as session:
+        jobs = await BroadcastJobCRUD.get_jobs_by_status(session, statuses)
+    return jobs[-1].id if jobs else None
+
+
+@router.message(Command("broadcast_pause"), admin_filter())
+async def pause_broadcast_job(message: types.Message):
+    """Пауза выполняющейся рассылки"""
+    job_id = await _resolve_job_id(message, [BroadcastJobStatus.RUNNING])
+    if not job_id:
+        await message.answer("❌ Нет выполняющихся рассылок")
+        return
+    
+    async with AsyncSessionLocal() as session:
+        changed = await BroadcastJobCRUD.set_status(
+            session, job_id, BroadcastJobStatus.PAUSED, expected=[BroadcastJobStatus.RUNNING]
+        )
+    
+    if changed:
+        logger.info(f"Admin {message.from_user.id} paused broadcast job {job_id}")
+        await message.answer(f"⏸ Рассылка #{job_id} поставлена на паузу\n▶️ Продолжить: /broadcast_resume {job_id}")
+    else:
+        await message.answer(f"❌ Рассылка #{job_id} не выполняется")
+
+
+@router.message(Command("broadcast_resume"), admin_filter())
+async def resume_broadcast_job(message: types.Message):
+    """Продолжение рассылки с чекпоинта"""
+    job_id = await _resolve_job_id(message, [BroadcastJobStatus.PAUSED])
+    if not job_id:
+        await message.answer("❌ Нет рассылок на паузе")
+        return
+    
+    async with AsyncSessionLocal() as session:
+        changed = await BroadcastJobCRUD.set_status(
+            session, job_id, BroadcastJobStatus.RUNNING, expected=[BroadcastJobStatus.PAUSED]
+        )
+    
+    if changed:
+        broadcast_job_runner.start(message.bot, job_id)
+        logger.info(f"Admin {message.from_user.id} resumed broadcast job {job_id}")
+        await message.answer(f"▶️ Рассылка #{job_id} продолжена")
+    else:
+        await message.answer(f"❌ Рассылка #{job_id} не на паузе")
+
+
+@router.message(Command("broadcast_cancel"), admin_filter())
+async def cancel_broadcast_job(message: types.Message):
+    """Отмена выполняющейся или приостановленной рассылки"""
+    active = [BroadcastJobStatus.RUNNING, BroadcastJobStatus.PAUSED]
+    job_id = await _resolve_job_id(message, active)
+    if not job_id:
+        await message.answer("❌ Нет активных рассылок")
+        return
+    
+    async with AsyncSessionLocal() as session:
+        changed = await BroadcastJobCRUD.set_status(
+            session, job_id, BroadcastJobStatus.CANCELLED, expected=active
+        )
+    
+    if changed:
+        logger.info(f"Admin {message.from_user.id} cancelled broadcast job {job_id}")
+        await message.answer(f"❌ Рассылка #{job_id} отменена")
+    else:
+        await message.answer(f"❌ Рассылка #{job_id} уже завершена")
+
+
 def register_broadcast_handlers(dp):
     """Регистрация хендлеров рассылки"""
     dp.include_router(router)
\ No newline at end of file
@@ -8,7 +8,7 @@ from aiogram.fsm.context import FSMContext
 
 from app.config import is_admin
 from app.database.connection import AsyncSessionLocal
-from app.database.statistics_crud import UserSegmentCRUD
+from app.database.broadcast_crud import BroadcastJobCRUD
 from app.handlers.broadcast.broadcast_states import BroadcastStates
 
 logger = logging.getLogger(__name__)
@@ -27,26 +27,17 @@ async def choose_new_leads(callback: types.CallbackQuery, state: FSMContext):
 
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserSegmentCRUD.get_segment_new_leads(session)
-
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "new_leads")
 
         await state.update_data(
             audience_type="new_leads",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
 
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} новых лидов (не оплативших)\n"
+            f"👥 <b>Получатели:</b> {recipient_count} новых лидов (не оплативших)\n"
             f"🆕 <b>Сегмент:</b> Пользователи, которые еще не совершили покупку\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
@@ -71,26 +62,17 @@ async def choose_partners(callback: types.CallbackQuery, state: FSMContext):
 
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserSegmentCRUD.get_segment_partners(session)
-
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "partners")
 
         await state.update_data(
             audience_type="partners",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
 
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} партнеров\n"
+            f"👥 <b>Получатели:</b> {recipient_count} партнеров\n"
             f"🤝 <b>Сегмент:</b> Пользователи, которые полностью завершили онбординг\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
@@ -115,26 +97,17 @@ async def choose_partners_without_team(callback: types.CallbackQuery, state: FSM
 
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserSegmentCRUD.get_segment_partners_without_team(session)
-
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "partners_without_team")
 
         await state.update_data(
             audience_type="partners_without_team",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
 
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} партнеров без команды\n"
+            f"👥 <b>Получатели:</b> {recipient_count} партнеров без команды\n"
             f"⚠️ <b>Сегмент:</b> Пользователи, которые купили партнерку, но не нажали кнопку 'Команда'\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
@@ -159,26 +132,17 @@ async def choose_partners_completed(callback: types.CallbackQuery, state: FSMCon
 
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserSegmentCRUD.get_segment_partners_completed(session)
-
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "partners_completed")
 
         await state.update_data(
             audience_type="partners_completed",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
 
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} партнеров\n"
+            f"👥 <b>Получатели:</b> {recipient_count} партнеров\n"
             f"🎓 <b>Сегмент:</b> Партнёры, завершившие обучение\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
@@ -203,26 +167,17 @@ async def choose_partners_in_team(callback: types.CallbackQuery, state: FSMConte
 
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserSegmentCRUD.get_segment_partners_in_team(session)
-
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "partners_in_team")
 
         await state.update_data(
             audience_type="partners_in_team",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
 
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} партнеров\n"
+            f"👥 <b>Получатели:</b> {recipient_count} партнеров\n"
             f"💪 <b>Сегмент:</b> Партнёры, вступившие в команду\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
@@ -247,26 +202,17 @@ async def choose_learning_users(callback: types.CallbackQuery, state: FSMContext
 
     try:
         async with AsyncSessionLocal() as session:
-            recipients_db = await UserSegmentCRUD.get_segment_learning_users(session)
-
-        recipients = []
-        for user in recipients_db:
-            recipients.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'full_name': user.full_name,
-                'ref_code': user.ref_code
-            })
+            # В FSM только тип аудитории - получатели выбираются из БД при запуске
+            recipient_count = await BroadcastJobCRUD.count_audience(session, "learning_users")
 
         await state.update_data(
             audience_type="learning_users",
-            recipients=recipients,
-            recipient_count=len(recipients)
+            recipient_count=recipient_count
         )
 
         await callback.message.edit_text(
             f"📝 <b>Введите сообщение для рассылки</b>\n\n"
-            f"👥 <b>Получатели:</b> {len(recipients)} пользователей\n"
+            f"👥 <b>Получатели:</b> {recipient_count} пользователей\n"
             f"📚 <b>Сегмент:</b> Пользователи, которые еще обучаются\n\n"
             f"<i>Отправьте текст, фото, видео, аудио или голосовое сообщение:</i>",
             parse_mode="HTML"
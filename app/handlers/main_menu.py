@@ -143,11 +143,10 @@ async def main_stats_handler(callback: types.CallbackQuery):
             
             # Получаем продажи и общую комиссию
             try:
-                # Считаем подтвержденные продажи
-                sales_count = await SaleCRUD.count_confirmed_sales(session, user.ref_code)
-                
-                # Считаем общую комиссию из подтвержденных продаж
-                total_commission = await SaleCRUD.get_total_commission(session, user.ref_code)
+                # Подтвержденные продажи и комиссия - одним запросом
+                stats = await SaleCRUD.get_partner_stats(session, user.ref_code)
+                sales_count = stats["confirmed_sales"]
+                total_commission = stats["total_earned"]
                 
                 logger.info(f"📊 User {user.ref_code}: {sales_count} sales, total commission: {total_commission}")
                 
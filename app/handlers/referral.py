@@ -67,22 +67,17 @@ async def link_stats_handler(callback: types.CallbackQuery):
     ref_code = callback.data.split(":")[1]
     
     async with AsyncSessionLocal() as session:
-        from app.database.crud import ClickCRUD, SaleCRUD
+        from app.database.crud import SaleCRUD
         
-        clicks_count = await ClickCRUD.count_clicks_by_ref_code(session, ref_code)
-        sales = await SaleCRUD.get_user_sales(session, ref_code)
-        
-        total_sales = len(sales)
-        confirmed_sales = len([s for s in sales if s.status == "confirmed"])
-        total_earned = sum(s.commission_amount for s in sales if s.status == "confirmed")
+        stats = await SaleCRUD.get_partner_stats(session, ref_code)
         
         text = f"""
 📊 <b>Статистика вашей реферальной ссылки:</b>
 
-👆 Переходов: {clicks_count}
-🛒 Всего продаж: {total_sales}
-✅ Подтвержденных продаж: {confirmed_sales}
-💰 Заработано: {total_earned:.2f} {settings.CURRENCY}
+👆 Переходов: {stats['clicks']}
+🛒 Всего продаж: {stats['total_sales']}
+✅ Подтвержденных продаж: {stats['confirmed_sales']}
+💰 Заработано: {stats['total_earned']:.2f} {settings.CURRENCY}
 
 🔄 Обновлено: только что
 """
@@ -7,7 +7,9 @@ from aiogram.filters import Command
 from sqlalchemy import text
 
 from app.database.connection import AsyncSessionLocal
+from app.database.funnel_crud import FunnelStatsCRUD
 from app.database.models import OnboardingStage
+from app.database.user_cache import user_state_cache
 from app.helpers.stage_helper import StageUpdateHelper
 from app.config import settings
 
@@ -51,6 +53,9 @@ async def reset_user_command(message: types.Message):
                 # ===== ПОЛНОЕ ОБНУЛЕНИЕ для ВСЕХ =====
                 logger.info(f"🔄 User {telegram_id} - performing FULL reset")
                 
+                # Дни среза воронки с оплатами и стадиями пользователя
+                funnel_days = await FunnelStatsCRUD.days_of_user(session, telegram_id)
+                
                 # 1. Удаляем payments
                 await session.execute(
                     text("DELETE FROM payments WHERE user_id = :uid"),
@@ -91,6 +96,7 @@ async def reset_user_command(message: types.Message):
                     {"tid": telegram_id}
                 )
                 logger.info(f"✅ Full reset for user {telegram_id}")
+                user_state_cache.invalidate(telegram_id)
                 
                 if is_early_stage:
                     # ===== НЕ ОПЛАТИВШИЕ - стандартный сброс =====
@@ -104,6 +110,7 @@ async def reset_user_command(message: types.Message):
                     
                     # Коммитим изменения для раннего этапа
                     await session.commit()
+                    FunnelStatsCRUD.touch(*funnel_days)
                     logger.info(f"✅ All changes committed for early-stage user {telegram_id}")
                     
                 else:
@@ -127,6 +134,7 @@ async def reset_user_command(message: types.Message):
                     
                     # Коммитим изменения
                     await session.commit()
+                    FunnelStatsCRUD.touch(*funnel_days)
                     logger.info(f"✅ All changes committed for user {telegram_id}")
                     
                     # КАСКАД: Автоматическая отправка одобрения и первого урока
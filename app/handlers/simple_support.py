@@ -12,6 +12,7 @@ from app.config import settings
 from app.services.support_chat_logger import support_chat_logger
 from app.services.deepseek_client import deepseek_client
 from app.services.auto_answers import auto_answers_service
+from app.services.question_matcher import question_matchers
 from app.database.crud import UserCRUD
 
 logger = logging.getLogger(__name__)
@@ -198,12 +199,24 @@ class SimpleSupportHandler:
         
         logger.info(f"📋 Loaded {len(qa_pairs)} Q&A pairs for stage {user_stage}")
         
-        # 4. Используем AI для поиска похожего вопроса (минимум 80% совпадение)
-        logger.info(f"🤖 Searching for matching answer (≥80% similarity) using AI...")
-        ai_answer = await deepseek_client.find_matching_answer(
-            user_question=message.text,
-            qa_pairs=qa_pairs
-        )
+        # 4. Локальное сопоставление: уверенное совпадение отвечаем сразу,
+        #    иначе AI выбирает среди top-k кандидатов (минимум 80% совпадение)
+        sheet = auto_answers_service.sheet_for_stage(user_stage)
+        prematch = question_matchers.match(sheet, auto_answers_service.qa_version, qa_pairs, message.text)
+        if prematch.confident:
+            logger.info(f"🔎 Local match (score {prematch.best_score:.2f}), DeepSeek skipped")
+            ai_answer = prematch.answer
+        else:
+            logger.info(
+                f"🤖 Searching for matching answer (≥80% similarity) using AI among "
+                f"{len(prematch.candidates)} candidates (best local score {prematch.best_score:.2f})..."
+            )
+            ai_answer = await deepseek_client.find_matching_answer(
+                user_question=message.text,
+                qa_pairs=prematch.candidates,
+                sheet=sheet,
+                qa_version=auto_answers_service.qa_version
+            )
         
         if ai_answer:
             # Найден подходящий ответ - отправляем его
@@ -2,10 +2,9 @@
 Хендлер статистики пользователя
 """
 from aiogram import Router, types, F
-from datetime import datetime, timedelta
 
 from app.database.connection import AsyncSessionLocal
-from app.database.crud import UserCRUD, ClickCRUD, SaleCRUD
+from app.database.crud import UserCRUD, SaleCRUD
 from app.config import settings
 from app.utils.helpers import format_money
 
@@ -24,27 +23,15 @@ async def show_statistics(message: types.Message):
             await message.answer("❌ Ошибка: пользователь не найден")
             return
         
-        # Получаем все данные
-        clicks_count = await ClickCRUD.count_clicks_by_ref_code(session, user.ref_code)
-        sales = await SaleCRUD.get_user_sales(session, user.ref_code)
-        
-        # Расчеты
-        total_sales = len(sales)
-        pending_sales = len([s for s in sales if s.status == "pending"])
-        confirmed_sales = len([s for s in sales if s.status == "confirmed"])
-        cancelled_sales = len([s for s in sales if s.status == "cancelled"])
-        
-        total_earned = sum(s.commission_amount for s in sales if s.status == "confirmed")
-        pending_amount = sum(s.commission_amount for s in sales if s.status == "pending")
+        # Все показатели одним запросом
+        stats = await SaleCRUD.get_partner_stats(session, user.ref_code)
+        clicks_count = stats["clicks"]
+        confirmed_sales = stats["confirmed_sales"]
+        total_earned = stats["total_earned"]
         
         # Конверсия
         conversion = (confirmed_sales / clicks_count * 100) if clicks_count > 0 else 0
         
-        # Статистика за последние 30 дней
-        month_ago = datetime.now() - timedelta(days=30)
-        recent_sales = [s for s in sales if s.created_at >= month_ago]
-        month_earned = sum(s.commission_amount for s in recent_sales if s.status == "confirmed")
-        
         text = f"""
 📊 <b>Ваша статистика</b>
 
@@ -55,16 +42,16 @@ async def show_statistics(message: types.Message):
 
 📈 <b>Общие показатели:</b>
 ├ 👆 Переходов: {clicks_count}
-├ 🛒 Всего продаж: {total_sales}
+├ 🛒 Всего продаж: {stats['total_sales']}
 ├ ✅ Подтверждено: {confirmed_sales}
-├ ⏳ Ожидает: {pending_sales}
-├ ❌ Отменено: {cancelled_sales}
+├ ⏳ Ожидает: {stats['pending_sales']}
+├ ❌ Отменено: {stats['cancelled_sales']}
 └ 📊 Конверсия: {conversion:.2f}%
 
 💰 <b>Финансы:</b>
 ├ 💵 Заработано: {format_money(total_earned, settings.CURRENCY)}
-├ ⏳ Ожидает подтверждения: {format_money(pending_amount, settings.CURRENCY)}
-└ 📅 За последние 30 дней: {format_money(month_earned, settings.CURRENCY)}
+├ ⏳ Ожидает подтверждения: {format_money(stats['pending_amount'], settings.CURRENCY)}
+└ 📅 За последние 30 дней: {format_money(stats['month_earned'], settings.CURRENCY)}
 
 🏆 <b>Ваш статус:</b>
 {get_partner_status(total_earned)}
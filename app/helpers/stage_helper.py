@@ -10,6 +10,8 @@ from aiogram import Bot
 
 from app.database.models import User, OnboardingStage
 from app.database.crud import UserCRUD
+from app.database.funnel_crud import FunnelStatsCRUD
+from app.database.user_cache import user_state_cache
 
 logger = logging.getLogger(__name__)
 
@@ -73,6 +75,8 @@ class StageUpdateHelper:
             
             if result.rowcount > 0:
                 logger.info(f"Updated user {telegram_id} stage: {old_stage} -> {new_stage}")
+                user_state_cache.update(telegram_id, onboarding_stage=new_stage)
+                FunnelStatsCRUD.touch_user(telegram_id)
                 
                 # Планируем автоматические сообщения если передан bot
                 if bot:
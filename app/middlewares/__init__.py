@@ -9,5 +9,7 @@ from app.middlewares.logging import LoggingMiddleware
 
 def register_all_middlewares(dp: Dispatcher):
     """Регистрация всех middleware"""
-    dp.message.middleware(ThrottlingMiddleware())
+    throttling = ThrottlingMiddleware()
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
     dp.message.middleware(LoggingMiddleware())
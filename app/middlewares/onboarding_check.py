@@ -9,6 +9,7 @@ from aiogram.types import Message, CallbackQuery
 
 from app.database.connection import AsyncSessionLocal
 from app.database.crud import UserCRUD
+from app.database.user_cache import user_state_cache
 from app.database.models import OnboardingStage
 from app.config import settings
 
@@ -19,6 +20,7 @@ class OnboardingCheckMiddleware(BaseMiddleware):
     """
     Middleware для проверки стадии онбординга пользователя.
     Добавляет в data информацию о пользователе и статусе онбординга.
+    Состояние берется из user_state_cache, БД читается только при промахе.
     """
 
     async def __call__(
@@ -39,27 +41,31 @@ class OnboardingCheckMiddleware(BaseMiddleware):
             return await handler(event, data)
         
         try:
-            # Получаем пользователя из БД
-            async with AsyncSessionLocal() as session:
-                user = await UserCRUD.get_user_by_telegram_id(session, user_id)
-                
-                # Добавляем информацию в data для использования в handlers
-                data['onboarding_user'] = user
-                data['onboarding_completed'] = (
-                    user and user.onboarding_stage == OnboardingStage.COMPLETED
-                )
-                data['onboarding_stage'] = (
-                    user.onboarding_stage if user else OnboardingStage.NEW_USER
+            # Сначала смотрим в кэш, в БД идем только при промахе
+            user = user_state_cache.get(user_id)
+            if user is None:
+                async with AsyncSessionLocal() as session:
+                    db_user = await UserCRUD.get_user_by_telegram_id(session, user_id)
+                if db_user:
+                    user = user_state_cache.put(db_user)
+            
+            # Добавляем информацию в data для использования в handlers
+            data['onboarding_user'] = user
+            data['onboarding_completed'] = (
+                user and user.onboarding_stage == OnboardingStage.COMPLETED
+            )
+            data['onboarding_stage'] = (
+                user.onboarding_stage if user else OnboardingStage.NEW_USER
+            )
+            
+            # Логируем для отладки
+            if user:
+                logger.debug(
+                    f"User {user_id} (@{event.from_user.username}) "
+                    f"onboarding stage: {user.onboarding_stage}"
                 )
-                
-                # Логируем для отладки
-                if user:
-                    logger.debug(
-                        f"User {user_id} (@{event.from_user.username}) "
-                        f"onboarding stage: {user.onboarding_stage}"
-                    )
-                else:
-                    logger.debug(f"New user {user_id} (@{event.from_user.username})")
+            else:
+                logger.debug(f"New user {user_id} (@{event.from_user.username})")
         
         except Exception as e:
             logger.error(f"Error in OnboardingCheckMiddleware: {e}")
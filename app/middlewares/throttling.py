@@ -1,31 +1,222 @@
 """
-Middleware для ограничения частоты запросов
+Middleware для ограничения частоты запросов (token bucket)
+
+Каждому пользователю выдается "ведро" на THROTTLE_BURST токенов, которое
+пополняется со скоростью THROTTLE_RATE токенов в секунду. Апдейт списывает
+стоимость маршрута (тяжелые команды стоят дороже); если токенов не хватает,
+апдейт отбрасывается.
 """
+import logging
 import time
-from typing import Callable, Dict, Any, Awaitable
+from typing import Callable, Dict, Any, Awaitable, Optional, Union
 
 from aiogram import BaseMiddleware
-from aiogram.types import Message
+from aiogram.types import Message, CallbackQuery
+
+from app.config import settings
+from app.utils.metrics import THROTTLED_UPDATES
+
+logger = logging.getLogger(__name__)
+
+
+# Стоимость маршрутов в токенах (по умолчанию 1)
+DEFAULT_ROUTE_COSTS = {
+    "/start": 3,
+    "📊 Статистика": 2,
+}
+
+
+class MemoryTokenBucket:
+    """
+    Token bucket в памяти процесса.
+
+    Пользователи, чье ведро успело полностью наполниться, периодически
+    удаляются - для них новое ведро эквивалентно старому, поэтому память
+    ограничена числом активных за последние burst / rate секунд.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        sweep_interval: float = 60.0,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+
+        self._buckets: Dict[int, tuple] = {}  # user_id -> (tokens, updated_at)
+        self._idle_after = burst / rate
+        self._next_sweep = clock() + sweep_interval
+        self.evicted = 0
+
+    def try_consume(self, key: int, cost: float = 1) -> bool:
+        now = self.clock()
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens, updated_at = bucket
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return False
+
+        self._buckets[key] = (tokens - cost, now)
+        return True
+
+    async def consume(self, key: int, cost: float = 1) -> bool:
+        return self.try_consume(key, cost)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Удаление ведер, которые уже наполнились до краев"""
+        now = self.clock() if now is None else now
+        threshold = now - self._idle_after
+        idle = [key for key, (_, updated_at) in self._buckets.items() if updated_at <= threshold]
+        for key in idle:
+            del self._buckets[key]
+
+        self.evicted += len(idle)
+        self._next_sweep = now + self.sweep_interval
+        return len(idle)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+# Атомарное списание токенов в Redis: ведро хранится как hash {tokens, ts}
+# и само истекает, когда успевает наполниться
+_REDIS_TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+if tokens == nil then
+    tokens = burst
+else
+    tokens = math.min(burst, tokens + (now - ts) * rate)
+end
+
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return allowed
+"""
+
+
+class RedisTokenBucket:
+    """Token bucket в Redis - лимиты общие для всех реплик бота"""
+
+    def __init__(self, redis_url: str, rate: float, burst: float, prefix: str = "throttle"):
+        from redis.asyncio import Redis
+
+        self.redis = Redis.from_url(redis_url)
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self._script = self.redis.register_script(_REDIS_TOKEN_BUCKET_LUA)
+
+    async def consume(self, key: int, cost: float = 1) -> bool:
+        try:
+            allowed = await self._script(
+                keys=[f"{self.prefix}:{key}"],
+                args=[self.rate, self.burst, time.time(), cost]
+            )
+            return bool(allowed)
+        except Exception as e:
+            # Redis недоступен - не блокируем пользователей
+            logger.error(f"Redis throttling error: {e}")
+            return True
 
 
 class ThrottlingMiddleware(BaseMiddleware):
-    def __init__(self, rate_limit: int = 1):
-        self.rate_limit = rate_limit
-        self.user_timestamps = {}
-    
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        costs: Optional[Dict[str, float]] = None,
+        limiter: Optional[Union[MemoryTokenBucket, RedisTokenBucket]] = None
+    ):
+        """
+        Args:
+            rate: Пополнение токенов в секунду (по умолчанию settings.THROTTLE_RATE)
+            burst: Емкость ведра (по умолчанию settings.THROTTLE_BURST)
+            costs: Стоимость маршрутов - текст сообщения/команда -> токены
+            limiter: Готовый лимитер (общий для message и callback_query)
+        """
+        self.costs = DEFAULT_ROUTE_COSTS if costs is None else costs
+        # is None: пустой MemoryTokenBucket ложен (__len__ == 0)
+        self.limiter = limiter if limiter is not None else create_limiter(rate, burst)
+
+        # Счетчики
+        self.allowed = 0
+        self.shed = 0
+
+    def get_cost(self, event: Union[Message, CallbackQuery]) -> float:
+        if isinstance(event, Message) and event.text:
+            command = event.text.split(maxsplit=1)[0]
+            return self.costs.get(event.text, self.costs.get(command, 1))
+        return 1
+
     async def __call__(
         self,
-        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
-        event: Message,
+        handler: Callable[[Union[Message, CallbackQuery], Dict[str, Any]], Awaitable[Any]],
+        event: Union[Message, CallbackQuery],
         data: Dict[str, Any]
     ) -> Any:
         user_id = event.from_user.id
-        current_time = time.time()
-        
-        if user_id in self.user_timestamps:
-            if current_time - self.user_timestamps[user_id] < self.rate_limit:
-                await event.answer("⚠️ Слишком много запросов. Подождите немного.")
-                return
-        
-        self.user_timestamps[user_id] = current_time
-        return await handler(event, data)
+
+        if user_id in settings.admin_ids_list:
+            return await handler(event, data)
+
+        if await self.limiter.consume(user_id, self.get_cost(event)):
+            self.allowed += 1
+            THROTTLED_UPDATES.labels("allowed").inc()
+            return await handler(event, data)
+
+        self.shed += 1
+        THROTTLED_UPDATES.labels("shed").inc()
+        logger.debug(f"Throttled update from user {user_id}")
+
+        # Для callback это всплывающее уведомление, для сообщения - ответ в чат
+        await event.answer("⚠️ Слишком много запросов. Подождите немного.")
+        return
+
+    def stats(self) -> dict:
+        """Счетчики для мониторинга"""
+        result = {'allowed': self.allowed, 'shed': self.shed}
+        if isinstance(self.limiter, MemoryTokenBucket):
+            result['tracked_users'] = len(self.limiter)
+            result['evicted'] = self.limiter.evicted
+        return result
+
+
+def create_limiter(
+    rate: Optional[float] = None,
+    burst: Optional[float] = None
+) -> Union[MemoryTokenBucket, RedisTokenBucket]:
+    """Создание лимитера согласно settings.THROTTLE_BACKEND"""
+    rate = rate or settings.THROTTLE_RATE
+    burst = burst or settings.THROTTLE_BURST
+
+    if settings.THROTTLE_BACKEND.lower() == "redis":
+        logger.info(f"🚦 Throttling: Redis token bucket (rate={rate}/s, burst={burst})")
+        return RedisTokenBucket(settings.REDIS_URL, rate, burst)
+
+    logger.info(f"🚦 Throttling: memory token bucket (rate={rate}/s, burst={burst})")
+    return MemoryTokenBucket(rate, burst)
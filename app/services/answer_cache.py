@@ -0,0 +1,112 @@
+"""
+Кэш результатов сопоставления вопросов поддержки через DeepSeek
+app/services/answer_cache.py
+
+Ключ - (лист автоответов, нормализованный текст вопроса, версия набора
+Q&A). Хранится и найденный ответ, и результат "НЕТ" (None), поэтому
+повторный вопрос без совпадения тоже не идет в API. Ограничен по размеру
+(LRU) и по времени жизни записи (TTL); при загрузке новых пар из таблицы
+кэш очищается (AutoAnswersService).
+"""
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from app.config import settings
+from app.utils.metrics import DEEPSEEK_CACHE_LOOKUPS, DEEPSEEK_LATENCY_SAVED
+
+logger = logging.getLogger(__name__)
+
+# Маркер отсутствия записи (None - закэшированный "НЕТ")
+MISS = object()
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """'Как  оплатить?!' -> 'как оплатить': регистр, ё, пунктуация, пробелы"""
+    text = text.lower().replace("ё", "е")
+    text = _NON_WORD.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+class AnswerCache:
+    """LRU + TTL кэш ответов find_matching_answer"""
+
+    def __init__(self, max_size: int = 5000, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        # ключ -> (истекает, ответ или None, время запроса к API)
+        self._entries: "OrderedDict[Tuple[str, str, int], tuple[float, Optional[str], float]]" = OrderedDict()
+
+        # Счетчики для мониторинга
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+
+    def get(self, sheet: str, question: str, version: int):
+        """
+        Закэшированный результат
+
+        Returns:
+            Ответ, None (закэшированный "НЕТ") или MISS
+        """
+        key = (sheet, normalize_question(question), version)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            DEEPSEEK_CACHE_LOOKUPS.labels("miss").inc()
+            return MISS
+
+        _, answer, latency = entry
+        self._entries.move_to_end(key)
+        self.hits += 1
+        if answer is None:
+            self.negative_hits += 1
+        self.saved_seconds += latency
+        DEEPSEEK_CACHE_LOOKUPS.labels("hit").inc()
+        DEEPSEEK_LATENCY_SAVED.inc(latency)
+        return answer
+
+    def put(self, sheet: str, question: str, version: int, answer: Optional[str], latency: float) -> None:
+        """Сохранение результата; latency - время запроса к API, которое сэкономит попадание"""
+        key = (sheet, normalize_question(question), version)
+        self._entries[key] = (time.monotonic() + self.ttl, answer, latency)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        if self._entries:
+            logger.info(f"🧹 Answer cache cleared ({len(self._entries)} entries)")
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """Статистика попаданий для мониторинга"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+            'saved_seconds': round(self.saved_seconds, 3),
+        }
+
+
+# Глобальный экземпляр кэша
+answer_cache = AnswerCache(
+    max_size=settings.DEEPSEEK_CACHE_MAX_SIZE,
+    ttl=settings.DEEPSEEK_CACHE_TTL
+)
@@ -1,29 +1,124 @@
 """
 Сервис для работы с автоответами из Google Sheets
 app/services/auto_answers.py
+
+Пары вопрос-ответ обоих листов хранятся в памяти неизменяемым снимком
+(QASnapshot): вопрос поддержки не обращается к таблице. Снимок
+обновляется в фоне раз в AUTO_ANSWERS_REFRESH_INTERVAL и командой
+/reload_answers. Перед чтением значений сверяется время изменения таблицы
+(Drive modifiedTime) - если таблица не менялась, значения не скачиваются.
+Снимок сохраняется в AUTO_ANSWERS_SNAPSHOT_FILE: после рестарта и при
+недоступности Sheets ответы берутся из файла.
 """
+import asyncio
+import hashlib
+import json
 import logging
 import os
-from typing import List, Dict, Optional
+from dataclasses import dataclass, replace
+from datetime import datetime
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
 import gspread
 from google.oauth2.service_account import Credentials
 
 from app.config import settings
 from app.database.models import OnboardingStage
+from app.services.answer_cache import answer_cache
+from app.services.sheets_writer import run_in_sheets_thread
 
 logger = logging.getLogger(__name__)
 
+SHEET_NON_PAID = "Автоответы_Не_оплатил"
+SHEET_PARTNERS = "Автоответы_Партнеры"
+QA_SHEETS = (SHEET_NON_PAID, SHEET_PARTNERS)
+
+QAPairs = Tuple[Mapping[str, str], ...]
+
+
+@dataclass(frozen=True)
+class QASnapshot:
+    """Неизменяемый снимок пар вопрос-ответ всех листов"""
+    version: int  # растет при изменении пар; входит в ключ кэша ответов DeepSeek
+    pairs: Mapping[str, QAPairs]  # лист -> пары
+    fingerprint: str  # хэш содержимого
+    source_version: Optional[str]  # modifiedTime таблицы на момент чтения
+    loaded_at: str
+
+    @classmethod
+    def build(cls, version: int, pairs: Dict[str, List[Dict[str, str]]], source_version: Optional[str]) -> "QASnapshot":
+        frozen = {
+            sheet: tuple(MappingProxyType(dict(qa)) for qa in sheet_pairs)
+            for sheet, sheet_pairs in pairs.items()
+        }
+        return cls(
+            version=version,
+            pairs=MappingProxyType(frozen),
+            fingerprint=fingerprint_pairs(pairs),
+            source_version=source_version,
+            loaded_at=datetime.now().isoformat(timespec="seconds")
+        )
+
+    def to_json(self) -> dict:
+        return {
+            "version": self.version,
+            "pairs": {sheet: [dict(qa) for qa in sheet_pairs] for sheet, sheet_pairs in self.pairs.items()},
+            "fingerprint": self.fingerprint,
+            "source_version": self.source_version,
+            "loaded_at": self.loaded_at,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "QASnapshot":
+        snapshot = cls.build(data["version"], data["pairs"], data.get("source_version"))
+        return replace(snapshot, loaded_at=data.get("loaded_at", snapshot.loaded_at))
+
+
+def fingerprint_pairs(pairs: Dict[str, List[Dict[str, str]]]) -> str:
+    """Хэш содержимого, одинаковый между процессами (в отличие от hash())"""
+    normalized = {sheet: [[qa['question'], qa['answer']] for qa in sheet_pairs] for sheet, sheet_pairs in pairs.items()}
+    return hashlib.sha1(json.dumps(normalized, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+def parse_qa_rows(rows: List[List[str]]) -> List[Dict[str, str]]:
+    """
+    Пары вопрос-ответ из значений листа
+
+    Args:
+        rows: Строки листа (первая - заголовок), столбцы A - вопрос, B - ответ
+    """
+    qa_pairs = []
+
+    # Пропускаем заголовок (первую строку) и читаем данные
+    for row in rows[1:]:
+        if len(row) >= 2:
+            question = row[0].strip()  # Столбец A
+            answer = row[1].strip()    # Столбец B
+
+            # Пропускаем пустые строки
+            if question and answer:
+                qa_pairs.append({
+                    'question': question,
+                    'answer': answer
+                })
+    return qa_pairs
+
 
 class AutoAnswersService:
     """Сервис для получения автоответов из Google Sheets"""
-    
+
     # Стадии для неоплативших пользователей (ТОЛЬКО эти две!)
     NON_PAID_STAGES = [
         OnboardingStage.NEW_USER,
         OnboardingStage.INTRO_SHOWN
     ]
-    
-    def __init__(self):
+
+    def __init__(self, snapshot_file: str = "auto_answers_snapshot.json", refresh_interval: float = 300.0):
+        """
+        Args:
+            snapshot_file: Локальная копия снимка (JSON)
+            refresh_interval: Период проверки таблицы на изменения (сек)
+        """
         self.scope = [
             'https://spreadsheets.google.com/feeds',
             'https://www.googleapis.com/auth/drive'
@@ -31,126 +126,260 @@ class AutoAnswersService:
         self.creds = None
         self.client = None
         self.spreadsheet = None
-        self.non_paid_worksheet = None
-        self.partners_worksheet = None
-        
+        self.snapshot_file = snapshot_file
+        self.refresh_interval = refresh_interval
+
+        self.snapshot: Optional[QASnapshot] = None
+        self._snapshot_file_checked = False
+        self._refresh_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        # Счетчики
+        self.refreshes = 0
+        self.not_modified = 0
+        self.failed_refreshes = 0
+
+    @property
+    def qa_version(self) -> int:
+        """Версия набора пар для ключа кэша ответов DeepSeek"""
+        return self.snapshot.version if self.snapshot else 0
+
     async def init(self):
-        """Инициализация подключения к Google Sheets"""
+        """
+        Инициализация: снимок из файла, подключение к таблице, свежий снимок
+        и запуск фонового обновления
+
+        Returns:
+            True если пары доступны (из таблицы или из файла)
+        """
+        self._ensure_snapshot()
+        if self.spreadsheet is not None:
+            return await self.reload_answers()
         try:
             # Путь к файлу ключей
             key_file_path = os.path.join(os.getcwd(), settings.GOOGLE_SHEETS_KEY)
-            
+
             if not os.path.exists(key_file_path):
                 logger.error(f"❌ Google Sheets key file not found: {key_file_path}")
-                return False
-            
-            # Создаем credentials
-            self.creds = Credentials.from_service_account_file(
-                key_file_path, 
-                scopes=self.scope
-            )
-            
-            # Авторизуемся
-            self.client = gspread.authorize(self.creds)
-            
-            # Открываем таблицу
-            self.spreadsheet = self.client.open_by_key(settings.SPREADSHEET_ID)
-            
-            # Получаем листы с автоответами
-            try:
-                self.non_paid_worksheet = self.spreadsheet.worksheet("Автоответы_Не_оплатил")
-                logger.info("✅ Found 'Автоответы_Не_оплатил' worksheet")
-            except gspread.WorksheetNotFound:
-                logger.error("❌ 'Автоответы_Не_оплатил' worksheet not found")
-                return False
-            
-            try:
-                self.partners_worksheet = self.spreadsheet.worksheet("Автоответы_Партнеры")
-                logger.info("✅ Found 'Автоответы_Партнеры' worksheet")
-            except gspread.WorksheetNotFound:
-                logger.error("❌ 'Автоответы_Партнеры' worksheet not found")
-                return False
-            
+                return self.snapshot is not None
+
+            spreadsheet = await run_in_sheets_thread(self._open_spreadsheet_sync, key_file_path)
+            await self.bind_spreadsheet(spreadsheet)
+
             logger.info("✅ Auto Answers Service initialized")
-            return True
-            
+            return self.snapshot is not None
+
         except Exception as e:
             logger.error(f"❌ Error initializing Auto Answers Service: {e}")
-            return False
-    
-    def _get_qa_pairs_from_sheet(self, worksheet) -> List[Dict[str, str]]:
-        """
-        Получает пары вопрос-ответ из листа
-        
-        Args:
-            worksheet: Лист Google Sheets
-            
-        Returns:
-            Список словарей с ключами 'question' и 'answer'
-        """
+            return self.snapshot is not None
+
+    def _open_spreadsheet_sync(self, key_file_path: str):
+        """Авторизация и проверка листов с автоответами (в потоке Sheets)"""
+        # Создаем credentials
+        self.creds = Credentials.from_service_account_file(
+            key_file_path,
+            scopes=self.scope
+        )
+
+        # Авторизуемся
+        self.client = gspread.authorize(self.creds)
+
+        # Открываем таблицу
+        spreadsheet = self.client.open_by_key(settings.SPREADSHEET_ID)
+
+        # Проверяем листы с автоответами
+        for title in QA_SHEETS:
+            spreadsheet.worksheet(title)
+            logger.info(f"✅ Found '{title}' worksheet")
+        return spreadsheet
+
+    async def bind_spreadsheet(self, spreadsheet):
+        """Подключение таблицы (gspread.Spreadsheet или FakeSpreadsheet), снимок и фоновое обновление"""
+        self.spreadsheet = spreadsheet
         try:
-            # Получаем все значения листа
-            all_values = worksheet.get_all_values()
-            
-            if not all_values or len(all_values) < 2:
-                logger.warning("⚠️ Worksheet is empty or has no data rows")
-                return []
-            
-            qa_pairs = []
-            
-            # Пропускаем заголовок (первую строку) и читаем данные
-            for row in all_values[1:]:
-                if len(row) >= 2:
-                    question = row[0].strip()  # Столбец A
-                    answer = row[1].strip()    # Столбец B
-                    
-                    # Пропускаем пустые строки
-                    if question and answer:
-                        qa_pairs.append({
-                            'question': question,
-                            'answer': answer
-                        })
-            
-            logger.info(f"📋 Loaded {len(qa_pairs)} Q&A pairs from worksheet")
-            return qa_pairs
-            
+            await self.refresh()
         except Exception as e:
-            logger.error(f"❌ Error reading Q&A pairs: {e}", exc_info=True)
-            return []
-    
-    async def get_qa_pairs_for_stage(self, stage: str) -> List[Dict[str, str]]:
+            self.failed_refreshes += 1
+            logger.error(f"❌ Failed to load auto answers from Google Sheets, using local snapshot: {e}")
+        self.start()
+
+    async def get_qa_pairs_for_stage(self, stage: str) -> QAPairs:
         """
         Получает пары вопрос-ответ в зависимости от стадии пользователя
-        
+
         Args:
             stage: Стадия пользователя (из OnboardingStage)
-            
+
+        Returns:
+            Пары вопрос-ответ из текущего снимка (без обращения к таблице)
+        """
+        snapshot = self._ensure_snapshot()
+        sheet = self.sheet_for_stage(stage)
+        logger.info(f"📄 Using '{sheet}' for stage {stage}")
+        if snapshot is None:
+            logger.warning("⚠️ Auto answers are not loaded")
+            return ()
+        return snapshot.pairs.get(sheet, ())
+
+    def sheet_for_stage(self, stage: str) -> str:
+        """Название листа автоответов для стадии пользователя"""
+        if stage in self.NON_PAID_STAGES:
+            return SHEET_NON_PAID
+        return SHEET_PARTNERS
+
+    # ---- Обновление снимка ----
+
+    async def refresh(self, force: bool = False) -> bool:
+        """
+        Проверка таблицы и обновление снимка
+
+        Args:
+            force: Скачать значения, даже если modifiedTime не изменился
+
+        Returns:
+            True если пары изменились (новая версия снимка)
+        """
+        if self.spreadsheet is None:
+            raise RuntimeError("Auto answers spreadsheet is not connected")
+        async with self._refresh_lock:
+            current = self.snapshot
+            known_version = None if force or current is None else current.source_version
+            source_version, pairs = await run_in_sheets_thread(self._fetch_sync, known_version)
+            self.refreshes += 1
+
+            if pairs is None:
+                self.not_modified += 1
+                logger.debug("Auto answers: spreadsheet not modified")
+                return False
+
+            if current is not None and fingerprint_pairs(pairs) == current.fingerprint:
+                # Таблица менялась, но не пары автоответов
+                self.snapshot = replace(current, source_version=source_version)
+                self._persist()
+                return False
+
+            version = current.version + 1 if current else 1
+            self.snapshot = QASnapshot.build(version, pairs, source_version)
+            answer_cache.clear()
+            self._persist()
+            counts = ", ".join(f"{sheet}: {len(sheet_pairs)}" for sheet, sheet_pairs in pairs.items())
+            logger.info(f"📋 Auto answers snapshot v{version} loaded ({counts})")
+            return True
+
+    def _fetch_sync(self, known_version: Optional[str]):
+        """
+        modifiedTime таблицы и, если он изменился, значения обоих листов
+        одним запросом batchGet (в потоке Sheets)
+
+        Returns:
+            (modifiedTime, {лист: пары} или None если таблица не менялась)
+        """
+        source_version = self.spreadsheet.get_lastUpdateTime()
+        if known_version is not None and source_version == known_version:
+            return source_version, None
+
+        response = self.spreadsheet.values_batch_get([f"'{title}'!A:B" for title in QA_SHEETS])
+        pairs = {}
+        for title, value_range in zip(QA_SHEETS, response.get("valueRanges", [])):
+            rows = value_range.get("values", [])
+            if len(rows) < 2:
+                logger.warning(f"⚠️ Worksheet '{title}' is empty or has no data rows")
+            pairs[title] = parse_qa_rows(rows)
+        return source_version, pairs
+
+    async def reload_answers(self, force: bool = False):
+        """
+        Обновление снимка из Google Sheets (команда /reload_answers)
+
         Returns:
-            Список пар вопрос-ответ
+            True если снимок актуален (обновлен или таблица не менялась)
         """
+        logger.info("🔄 Reloading auto answers from Google Sheets...")
+        if self.spreadsheet is None:
+            return await self.init()
         try:
-            # Определяем какой лист использовать
-            if stage in self.NON_PAID_STAGES:
-                worksheet = self.non_paid_worksheet
-                logger.info(f"📄 Using 'Автоответы_Не_оплатил' for stage {stage}")
-            else:
-                worksheet = self.partners_worksheet
-                logger.info(f"📄 Using 'Автоответы_Партнеры' for stage {stage}")
-            
-            return self._get_qa_pairs_from_sheet(worksheet)
-            
+            await self.refresh(force=force)
+            return True
         except Exception as e:
-            logger.error(f"❌ Error getting Q&A pairs for stage {stage}: {e}")
-            return []
-    
-    async def reload_answers(self):
-        """Перезагрузка данных из Google Sheets (для обновления)"""
-        logger.info("🔄 Reloading auto answers from Google Sheets...")
-        return await self.init()
+            self.failed_refreshes += 1
+            logger.error(f"❌ Failed to reload auto answers: {e}")
+            return False
+
+    def start(self):
+        """Запуск фоновой проверки таблицы"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop(), name="auto-answers-refresh")
+            logger.info(f"✅ Auto answers refresh started ({self.refresh_interval}s)")
+
+    async def close(self):
+        """Остановка фоновой проверки"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Sheets недоступен - отвечаем по текущему снимку
+                self.failed_refreshes += 1
+                logger.error(f"❌ Auto answers refresh failed, keeping snapshot v{self.qa_version}: {e}")
+
+    # ---- Локальная копия снимка ----
+
+    def _ensure_snapshot(self) -> Optional[QASnapshot]:
+        """Снимок из файла, если из таблицы еще ничего не загружено (один раз)"""
+        if self.snapshot is None and not self._snapshot_file_checked:
+            self._snapshot_file_checked = True
+            self._load_snapshot_file()
+        return self.snapshot
+
+    def _load_snapshot_file(self):
+        if not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file, encoding="utf-8") as f:
+                self.snapshot = QASnapshot.from_json(json.load(f))
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"❌ Failed to load auto answers snapshot {self.snapshot_file}: {e}")
+            return
+        logger.info(f"📥 Auto answers snapshot v{self.snapshot.version} restored from {self.snapshot_file} ({self.snapshot.loaded_at})")
+
+    def _persist(self):
+        """Атомарная перезапись файла снимка"""
+        try:
+            tmp_path = f"{self.snapshot_file}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot.to_json(), f, ensure_ascii=False)
+            os.replace(tmp_path, self.snapshot_file)
+        except OSError as e:
+            logger.error(f"❌ Failed to persist auto answers snapshot: {e}")
+
+    def stats(self) -> dict:
+        snapshot = self.snapshot
+        return {
+            'version': self.qa_version,
+            'loaded_at': snapshot.loaded_at if snapshot else None,
+            'source_version': snapshot.source_version if snapshot else None,
+            'pairs': {sheet: len(pairs) for sheet, pairs in snapshot.pairs.items()} if snapshot else {},
+            'refreshes': self.refreshes,
+            'not_modified': self.not_modified,
+            'failed_refreshes': self.failed_refreshes,
+        }
 
 
 # Глобальный экземпляр
-auto_answers_service = AutoAnswersService()
+auto_answers_service = AutoAnswersService(
+    snapshot_file=settings.AUTO_ANSWERS_SNAPSHOT_FILE,
+    refresh_interval=settings.AUTO_ANSWERS_REFRESH_INTERVAL
+)
 
 
 async def init_auto_answers_service():
@@ -161,4 +390,4 @@ async def init_auto_answers_service():
         logger.info("✅ Auto Answers Service initialized successfully")
     else:
         logger.warning("⚠️ Auto Answers Service initialization failed")
-    return success
\ No newline at end of file
+    return success
@@ -0,0 +1,306 @@
+"""
+Выполнение сохраняемых рассылок (broadcast_jobs)
+app/services/broadcast_jobs.py
+
+Получатели читаются из broadcast_deliveries серверным курсором, результаты
+пишутся пачками вместе с чекпоинтом. Статус задачи проверяется между пачками,
+поэтому пауза/отмена из админ-команды срабатывают в течение одной пачки,
+а после рестарта бота задачи в статусе running продолжаются с чекпоинта.
+
+Задачу отправляет только процесс, который взял ее в аренду (claimed_by):
+heartbeat продлевается перед каждой пачкой и фоновой задачей во время ее
+отправки (ожидание RetryAfter может быть дольше аренды), а продолжают только задачи,
+чей владелец не подавал heartbeat дольше BROADCAST_LEASE_SECONDS - при
+нескольких репликах бота рассылка не уходит дважды.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+import pytz
+from aiogram import Bot
+
+from app.config import settings
+from app.database.broadcast_crud import BroadcastJobCRUD
+from app.database.connection import AsyncSessionLocal
+from app.database.models import BroadcastJob, BroadcastJobStatus
+from app.services.broadcast_sender import BroadcastSender
+from app.utils.metrics import ACTIVE_BROADCASTS
+
+logger = logging.getLogger(__name__)
+
+
+# Сколько получателей читается одним открытием курсора
+CURSOR_WINDOW = 10000
+
+# Сколько раз за время аренды heartbeat продлевается во время отправки пачки
+HEARTBEATS_PER_LEASE = 3
+
+
+class BroadcastJobRunner:
+    """Фоновые задачи рассылок текущего процесса"""
+
+    def __init__(
+        self,
+        batch_size: Optional[int] = None,
+        progress_interval: float = 5.0,
+        lease_seconds: Optional[float] = None
+    ):
+        self.batch_size = batch_size or settings.BROADCAST_BATCH_SIZE
+        self.progress_interval = progress_interval
+        self.lease_seconds = lease_seconds or settings.BROADCAST_LEASE_SECONDS
+        # Владелец аренды: уникален для процесса
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._restart: Set[int] = set()
+        self._resume_task: Optional[asyncio.Task] = None
+
+    def is_running(self, job_id: int) -> bool:
+        task = self._tasks.get(job_id)
+        return task is not None and not task.done()
+
+    def start(self, bot: Bot, job_id: int) -> None:
+        """Запуск задачи (если она уже выполняется - продолжит после текущей пачки)"""
+        if self.is_running(job_id):
+            # Задача могла уже решить остановиться - перезапустим ее по завершении
+            self._restart.add(job_id)
+            return
+        self._tasks[job_id] = asyncio.create_task(self._run(bot, job_id))
+
+    async def resume_unfinished(self, bot: Bot) -> int:
+        """Продолжение задач running без живого владельца (рестарт или падение процесса)"""
+        async with AsyncSessionLocal() as session:
+            jobs = await BroadcastJobCRUD.get_resumable_jobs(session, self.lease_seconds)
+
+        jobs = [job for job in jobs if not self.is_running(job.id)]
+        for job in jobs:
+            logger.info(f"📢 Resuming broadcast job {job.id} from delivery {job.last_delivery_id}")
+            self.start(bot, job.id)
+        return len(jobs)
+
+    def start_resume_loop(self, bot: Bot) -> None:
+        """Периодический подхват задач, чья аренда истекла (упавшая реплика)"""
+        if self._resume_task is None or self._resume_task.done():
+            self._resume_task = asyncio.create_task(self._resume_loop(bot))
+
+    async def _resume_loop(self, bot: Bot) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds)
+            try:
+                resumed = await self.resume_unfinished(bot)
+                if resumed:
+                    logger.info(f"📢 Took over {resumed} broadcast job(s) with expired lease")
+            except Exception as e:
+                logger.error(f"Failed to check broadcast jobs for takeover: {e}")
+
+    async def _edit_progress(self, bot: Bot, job: BroadcastJob, text: str) -> None:
+        if not job.progress_chat_id or not job.progress_message_id:
+            return
+        try:
+            await bot.edit_message_text(
+                text=text,
+                chat_id=job.progress_chat_id,
+                message_id=job.progress_message_id,
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            logger.debug(f"Failed to update broadcast progress: {e}")
+
+    async def _run(self, bot: Bot, job_id: int) -> None:
+        ACTIVE_BROADCASTS.inc()
+        try:
+            async with AsyncSessionLocal() as session:
+                job = await BroadcastJobCRUD.get_job(session, job_id)
+                if not job or job.status != BroadcastJobStatus.RUNNING:
+                    return
+                if not await BroadcastJobCRUD.claim_job(session, job_id, self.owner, self.lease_seconds):
+                    logger.info(f"📢 Broadcast job {job_id} is running in another process")
+                    return
+
+            stopped_status = await self._process(bot, job)
+
+            if stopped_status is None:
+                await self._finish(bot, job_id)
+            else:
+                logger.info(f"📢 Broadcast job {job_id} stopped: {stopped_status}")
+
+        except Exception as e:
+            logger.error(f"Critical error in broadcast job {job_id}: {e}", exc_info=True)
+            async with AsyncSessionLocal() as session:
+                await BroadcastJobCRUD.set_status(session, job_id, BroadcastJobStatus.FAILED)
+                job = await BroadcastJobCRUD.get_job(session, job_id)
+            if job:
+                await self._edit_progress(
+                    bot, job,
+                    f"❌ <b>Критическая ошибка рассылки #{job_id}</b>\n\n"
+                    f"👤 <b>Инициатор:</b> {job.admin_name}\n"
+                    f"Обработано: {processed_count(job)}/{job.total_count}\n"
+                    f"Ошибка: {str(e)}"
+                )
+
+        finally:
+            ACTIVE_BROADCASTS.dec()
+            try:
+                async with AsyncSessionLocal() as session:
+                    await BroadcastJobCRUD.release_job(session, job_id, self.owner)
+            except Exception as e:
+                # Аренда истечет сама через lease_seconds
+                logger.warning(f"Failed to release broadcast job {job_id}: {e}")
+            self._tasks.pop(job_id, None)
+            if job_id in self._restart:
+                self._restart.discard(job_id)
+                self.start(bot, job_id)
+
+    async def _process(self, bot: Bot, job: BroadcastJob) -> Optional[str]:
+        """
+        Отправка ожидающим получателям
+
+        Returns:
+            None если получатели закончились, иначе статус, из-за которого остановились
+        """
+        # Импорт здесь: пакет app.handlers.broadcast сам импортирует этот модуль
+        from app.handlers.broadcast.broadcast_utils import format_progress_message
+
+        media_data = json.loads(job.media_data)
+        sender = BroadcastSender(bot)
+        checkpoint = job.last_delivery_id or 0
+        last_progress = 0.0
+
+        while True:
+            window_rows = 0
+
+            # Курсор переоткрывается каждые CURSOR_WINDOW строк, чтобы не держать
+            # транзакцию открытой на все время рассылки
+            async with AsyncSessionLocal() as stream_session:
+                async for batch in BroadcastJobCRUD.stream_pending_deliveries(
+                    stream_session, job.id, checkpoint, self.batch_size, CURSOR_WINDOW
+                ):
+                    async with AsyncSessionLocal() as session:
+                        status = await BroadcastJobCRUD.renew_lease(session, job.id, self.owner)
+                    if status is None:
+                        return "lease lost"
+                    if status != BroadcastJobStatus.RUNNING:
+                        return status
+
+                    delivery_ids = {telegram_id: delivery_id for delivery_id, telegram_id in batch}
+                    sent_ids = []
+                    failed_ids = defaultdict(list)
+
+                    def on_result(chat_id: int, error_kind: Optional[str]):
+                        if error_kind is None:
+                            sent_ids.append(delivery_ids[chat_id])
+                        else:
+                            failed_ids[error_kind].append(delivery_ids[chat_id])
+
+                    sending = asyncio.create_task(
+                        sender.run(list(delivery_ids), media_data, on_result=on_result)
+                    )
+                    heartbeat = asyncio.create_task(self._heartbeat(job.id, sending))
+                    try:
+                        await sending
+                    except asyncio.CancelledError:
+                        # Отправку остановил heartbeat - аренду перехватил другой процесс
+                        if heartbeat.done():
+                            return "lease lost"
+                        raise
+                    finally:
+                        heartbeat.cancel()
+
+                    checkpoint = batch[-1][0]
+                    window_rows += len(batch)
+                    async with AsyncSessionLocal() as session:
+                        await BroadcastJobCRUD.record_batch(session, job.id, sent_ids, dict(failed_ids), checkpoint)
+                        job = await BroadcastJobCRUD.get_job(session, job.id)
+
+                    if time.monotonic() - last_progress >= self.progress_interval:
+                        last_progress = time.monotonic()
+                        await self._edit_progress(bot, job, format_progress_message(
+                            current=processed_count(job),
+                            total=job.total_count,
+                            successful=job.sent_count,
+                            errors=error_count(job),
+                            admin_name=job.admin_name
+                        ))
+
+            if window_rows < CURSOR_WINDOW:
+                return None
+
+    async def _heartbeat(self, job_id: int, sending: asyncio.Task) -> None:
+        """
+        Продление аренды, пока отправляется пачка
+
+        Если аренду перехватил другой процесс - отменяет отправку пачки.
+        """
+        while True:
+            await asyncio.sleep(self.lease_seconds / HEARTBEATS_PER_LEASE)
+            try:
+                async with AsyncSessionLocal() as session:
+                    status = await BroadcastJobCRUD.renew_lease(session, job_id, self.owner)
+            except Exception as e:
+                logger.warning(f"Failed to renew broadcast job {job_id} lease: {e}")
+                continue
+            if status is None:
+                logger.warning(f"📢 Broadcast job {job_id} lease lost while sending, stopping batch")
+                sending.cancel()
+                return
+
+    async def _finish(self, bot: Bot, job_id: int) -> None:
+        """Завершение задачи: статус, финальный отчет, уведомление админов"""
+        from app.handlers.broadcast.broadcast_utils import format_final_report
+
+        async with AsyncSessionLocal() as session:
+            completed = await BroadcastJobCRUD.set_status(
+                session, job_id, BroadcastJobStatus.COMPLETED, expected=[BroadcastJobStatus.RUNNING]
+            )
+            job = await BroadcastJobCRUD.get_job(session, job_id)
+        if not completed:
+            return
+
+        duration = (job.finished_at or datetime.now(pytz.UTC)) - (job.started_at or job.created_at)
+        final_report = format_final_report(
+            total=job.total_count,
+            successful=job.sent_count,
+            errors=error_count(job),
+            error_details={
+                'blocked': job.blocked_count,
+                'not_found': job.not_found_count,
+                'other': job.other_error_count
+            },
+            duration=duration,
+            admin_name=job.admin_name,
+            admin_id=job.admin_id
+        )
+        await self._edit_progress(bot, job, final_report)
+
+        # Уведомляем других админов
+        for other_admin_id in settings.admin_ids_list:
+            if other_admin_id != job.admin_id:
+                try:
+                    await bot.send_message(
+                        chat_id=other_admin_id,
+                        text=f"📢 <b>Уведомление о рассылке</b>\n\n{final_report}",
+                        parse_mode="HTML"
+                    )
+                except Exception as e:
+                    logger.warning(f"Failed to notify admin {other_admin_id}: {e}")
+
+        logger.info(f"Broadcast job {job_id} completed: {job.sent_count}/{job.total_count} successful")
+
+
+def error_count(job: BroadcastJob) -> int:
+    return job.blocked_count + job.not_found_count + job.other_error_count
+
+
+def processed_count(job: BroadcastJob) -> int:
+    return job.sent_count + error_count(job)
+
+
+# Глобальный экземпляр
+broadcast_job_runner = BroadcastJobRunner()
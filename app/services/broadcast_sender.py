@@ -0,0 +1,267 @@
+"""
+Движок отправки рассылок с учетом лимитов Telegram
+app/services/broadcast_sender.py
+
+- общий token bucket на ~30 сообщений в секунду для всего бота;
+- ограниченный пул параллельных задач отправки;
+- TelegramRetryAfter ставит весь bucket на паузу и повторяет отправку;
+- ошибки классифицируются по типам исключений aiogram.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTokenBucket:
+    """Асинхронный token bucket: acquire() ждет, пока появится токен"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate: Токенов в секунду
+            capacity: Максимальный запас токенов (по умолчанию = rate, т.е. 1 секунда)
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        """Пауза для всех отправителей (например, по RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self, tokens: float = 1) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return
+
+            await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+# Общий лимитер исходящих сообщений для всего процесса бота
+telegram_send_limiter = AsyncTokenBucket(rate=settings.BROADCAST_RATE_LIMIT)
+
+
+def classify_send_error(error: Exception) -> str:
+    """Категория ошибки отправки для отчета рассылки"""
+    if isinstance(error, TelegramForbiddenError):
+        # Бот заблокирован, пользователь удален/деактивирован
+        return 'blocked'
+    if isinstance(error, (TelegramNotFound, TelegramBadRequest)):
+        # В рассылке BadRequest почти всегда означает "chat not found"
+        return 'not_found'
+    return 'other'
+
+
+@dataclass
+class BroadcastResult:
+    """Счетчики рассылки (обновляются по ходу отправки)"""
+    total: int = 0
+    processed: int = 0
+    successful: int = 0
+    errors: int = 0
+    retries: int = 0
+    error_details: Dict[str, int] = field(
+        default_factory=lambda: {'blocked': 0, 'not_found': 0, 'other': 0}
+    )
+
+
+class BroadcastSender:
+    """Параллельная отправка одного сообщения списку получателей"""
+
+    def __init__(
+        self,
+        bot: Bot,
+        limiter: Optional[AsyncTokenBucket] = None,
+        concurrency: Optional[int] = None,
+        max_retries: int = 3
+    ):
+        """
+        Args:
+            bot: Экземпляр бота
+            limiter: Token bucket (по умолчанию общий telegram_send_limiter)
+            concurrency: Количество параллельных задач отправки
+            max_retries: Повторы при RetryAfter и сетевых/серверных ошибках
+        """
+        self.bot = bot
+        self.limiter = limiter or telegram_send_limiter
+        self.concurrency = concurrency or settings.BROADCAST_CONCURRENCY
+        self.max_retries = max_retries
+
+    async def send_one(self, chat_id: int, media_data: Dict) -> None:
+        """Отправка сообщения одному получателю в зависимости от типа медиа"""
+        media_type = media_data.get('type', 'text')
+
+        if media_type == 'text':
+            await self.bot.send_message(
+                chat_id=chat_id,
+                text=media_data.get('text', ''),
+                parse_mode="HTML"
+            )
+        elif media_type == 'photo':
+            await self.bot.send_photo(
+                chat_id=chat_id,
+                photo=media_data.get('file_id'),
+                caption=media_data.get('caption'),
+                parse_mode="HTML"
+            )
+        elif media_type == 'video':
+            await self.bot.send_video(
+                chat_id=chat_id,
+                video=media_data.get('file_id'),
+                caption=media_data.get('caption'),
+                parse_mode="HTML"
+            )
+        elif media_type == 'video_note':
+            await self.bot.send_video_note(
+                chat_id=chat_id,
+                video_note=media_data.get('file_id')
+            )
+        elif media_type == 'audio':
+            await self.bot.send_audio(
+                chat_id=chat_id,
+                audio=media_data.get('file_id'),
+                caption=media_data.get('caption'),
+                parse_mode="HTML"
+            )
+        elif media_type == 'voice':
+            await self.bot.send_voice(
+                chat_id=chat_id,
+                voice=media_data.get('file_id'),
+                caption=media_data.get('caption'),
+                parse_mode="HTML"
+            )
+
+    async def deliver(self, chat_id: int, media_data: Dict, result: BroadcastResult) -> Optional[str]:
+        """
+        Доставка одному получателю с повторами.
+
+        Returns:
+            None при успехе, иначе категория ошибки
+        """
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                await self.send_one(chat_id, media_data)
+                return None
+
+            except TelegramRetryAfter as e:
+                # Флуд-контроль: останавливаем всех отправителей и повторяем
+                self.limiter.pause(e.retry_after)
+                logger.warning(f"Flood control on {chat_id}: retry after {e.retry_after}s")
+                error = e
+
+            except (TelegramNetworkError, TelegramServerError) as e:
+                await asyncio.sleep(2 ** attempt)
+                error = e
+
+            except Exception as e:
+                logger.warning(f"Failed to send to {chat_id}: {e}")
+                return classify_send_error(e)
+
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.warning(f"Failed to send to {chat_id} after {self.max_retries} retries: {error}")
+                return 'other'
+            result.retries += 1
+
+    async def run(
+        self,
+        chat_ids: Iterable[int],
+        media_data: Dict,
+        total: Optional[int] = None,
+        progress_callback: Optional[Callable[[BroadcastResult], Awaitable[None]]] = None,
+        progress_interval: float = 3.0,
+        on_result: Optional[Callable[[int, Optional[str]], None]] = None
+    ) -> BroadcastResult:
+        """
+        Рассылка по списку chat_id
+
+        Args:
+            chat_ids: Получатели
+            media_data: Содержимое сообщения (см. send_one)
+            total: Количество получателей (если chat_ids - генератор)
+            progress_callback: Вызывается раз в progress_interval секунд и в конце
+            on_result: Вызывается для каждого получателя: (chat_id, категория ошибки или None)
+        """
+        if total is None and hasattr(chat_ids, '__len__'):
+            total = len(chat_ids)
+        result = BroadcastResult(total=total or 0)
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                try:
+                    error_kind = await self.deliver(chat_id, media_data, result)
+                    if error_kind is None:
+                        result.successful += 1
+                    else:
+                        result.errors += 1
+                        result.error_details[error_kind] += 1
+                    result.processed += 1
+                    if on_result:
+                        on_result(chat_id, error_kind)
+                finally:
+                    queue.task_done()
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(progress_interval)
+                try:
+                    await progress_callback(result)
+                except Exception as e:
+                    logger.debug(f"Progress callback failed: {e}")
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(report_progress()) if progress_callback else None
+
+        try:
+            for chat_id in chat_ids:
+                await queue.put(chat_id)
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            if reporter:
+                reporter.cancel()
+            await asyncio.gather(*workers, *([reporter] if reporter else []), return_exceptions=True)
+
+        if not result.total:
+            result.total = result.processed
+        if progress_callback:
+            try:
+                await progress_callback(result)
+            except Exception as e:
+                logger.debug(f"Progress callback failed: {e}")
+
+        return result
@@ -0,0 +1,341 @@
+"""
+Буферизованная запись кликов по реферальным ссылкам
+app/services/click_buffer.py
+
+/track/{ref_code} проверяет код по множеству известных ref_code в памяти,
+кладет клик в очередь и сразу отдает редирект. Фоновый флашер пишет клики
+пачками (каждые CLICK_FLUSH_INTERVAL_MS или по CLICK_FLUSH_BATCH_SIZE строк)
+одним multi-row INSERT и в той же транзакции обновляет partner_stats.
+При остановке очередь дописывается до конца.
+
+Пачка, которую БД отклоняет из-за данных (DataError/IntegrityError)
+max_attempts раз подряд, делится пополам, чтобы найти "ядовитый" клик;
+одиночный клик после max_attempts неудач уходит в файл dead_letter_file
+(JSON-строки) и больше не блокирует очередь. Недоступность БД (соединение,
+таймауты) так не считается: пачка повторяется с растущей паузой, а новые
+клики сверх ограниченной очереди отбрасываются в submit.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import Counter, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Set
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError
+
+from app.config import settings
+from app.database.connection import AsyncSessionLocal
+from app.database.models import Click, User
+from app.database.partner_stats_crud import PartnerStatsCRUD
+from app.utils.helpers import is_valid_ref_code
+
+logger = logging.getLogger(__name__)
+
+# Предел отрицательного кэша неизвестных кодов (мусорные ссылки, перебор)
+MAX_REJECTED_CODES = 10000
+
+# Маркер остановки в очереди: будит флашер, ждущий кликов
+_STOP = None
+
+# Пауза перед повтором пачки после ошибки БД (сек), удваивается до максимума
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+
+
+def is_data_error(error: Exception) -> bool:
+    """Ошибка в самих данных пачки (повтор не поможет), а не в доступности БД"""
+    if isinstance(error, (DataError, IntegrityError, ValueError, TypeError)):
+        return True
+    if isinstance(error, DBAPIError):
+        # asyncpg передает ошибки сервера как DBAPIError с sqlstate:
+        # класс 22 - data exception, 23 - integrity constraint violation
+        sqlstate = str(getattr(error.orig, "sqlstate", None) or "")
+        return sqlstate[:2] in ("22", "23") or isinstance(error.orig.__cause__, (ValueError, TypeError))
+    return False
+
+
+class ClickBuffer:
+    """
+    Очередь кликов с пакетной записью.
+
+    Коды, которых еще нет в памяти (партнер зарегистрировался после загрузки
+    множества), не отбрасываются сразу: флашер проверяет их одним запросом
+    на пачку. Несуществующие коды запоминаются до следующего обновления
+    множества, их клики сразу пропускаются.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 500,
+        flush_interval: float = 0.2,
+        max_size: int = 50000,
+        refresh_interval: float = 300.0,
+        max_attempts: int = 5,
+        dead_letter_file: str = "clicks_failed.jsonl"
+    ):
+        """
+        Args:
+            batch_size: Максимум строк в одном INSERT
+            flush_interval: Максимальная задержка записи клика (сек)
+            max_size: Максимальная длина очереди (при переполнении клик теряется)
+            refresh_interval: Период перезагрузки известных ref_code из БД (сек)
+            max_attempts: Попыток записи пачки с ошибкой данных до деления (одиночного клика - до dead letter)
+            dead_letter_file: Файл для кликов, которые не удалось записать
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.max_attempts = max_attempts
+        self.dead_letter_file = dead_letter_file
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._known: Set[str] = set()
+        self._rejected: Set[str] = set()
+        self._next_refresh = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight = 0
+        self.is_running = False
+
+        # Счетчики
+        self.accepted = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.split_batches = 0
+        self.dead_lettered = 0
+
+    def submit(
+        self,
+        ref_code: str,
+        ip_address: str,
+        user_agent: str,
+        source: str = None,
+        user_telegram_id: int = None
+    ) -> bool:
+        """
+        Постановка клика в очередь (без ожидания)
+
+        Returns:
+            False если код некорректен, заведомо неизвестен или очередь переполнена
+        """
+        if not is_valid_ref_code(ref_code):
+            self.invalid += 1
+            logger.debug(f"Click buffer: malformed ref code {ref_code!r} rejected")
+            return False
+
+        if ref_code in self._rejected:
+            self.invalid += 1
+            return False
+
+        try:
+            self._queue.put_nowait({
+                "ref_code": ref_code,
+                "ip_address": ip_address,
+                "user_agent": user_agent,
+                "source": source,
+                "user_telegram_id": user_telegram_id,
+                "created_at": datetime.now()
+            })
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"⚠️ Click queue is full ({self._queue.maxsize}), click for {ref_code} dropped")
+            return False
+
+        self.accepted += 1
+        return True
+
+    async def refresh_known_codes(self) -> None:
+        """Перезагрузка множества ref_code из users"""
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(select(User.ref_code).where(User.ref_code.isnot(None)))
+            self._known = set(result.scalars().all())
+        self._rejected.clear()
+        self._next_refresh = time.monotonic() + self.refresh_interval
+        logger.debug(f"Click buffer: {len(self._known)} known ref codes")
+
+    async def start(self) -> None:
+        """Загрузка известных кодов и запуск флашера"""
+        if self.is_running:
+            return
+        try:
+            await self.refresh_known_codes()
+        except Exception as e:
+            # Коды проверит флашер при записи
+            logger.error(f"❌ Failed to load ref codes for click buffer: {e}")
+
+        self.is_running = True
+        self._task = asyncio.create_task(self._flusher(), name="click-flusher")
+        logger.info(
+            f"✅ Click buffer started: batch {self.batch_size}, "
+            f"interval {self.flush_interval * 1000:.0f} ms, {len(self._known)} ref codes"
+        )
+
+    async def stop(self, drain_timeout: float = 10.0) -> None:
+        """Остановка: флашер дописывает очередь (с таймаутом) и завершается"""
+        if not self.is_running:
+            return
+        self.is_running = False
+        try:
+            self._queue.put_nowait(_STOP)
+        except asyncio.QueueFull:
+            pass  # очередь полна - флашер не ждет кликов
+
+        try:
+            await asyncio.wait_for(self._task, timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            lost = self._queue.qsize() + self._in_flight
+            logger.warning(f"⚠️ Click queue not drained in {drain_timeout}s, {lost} clicks lost")
+        self._task = None
+        logger.info(f"🛑 Click buffer stopped, {self.written} clicks written")
+
+    async def _flusher(self) -> None:
+        retry_delay = RETRY_DELAY
+        attempts = 0
+        # Пачки на запись: новая из очереди или половинки отклоненной
+        batches: Deque[List[dict]] = deque()
+
+        while self.is_running or batches or not self._queue.empty():
+            if not batches:
+                batch = await self._collect()
+                if not batch:
+                    continue
+                batches.append(batch)
+
+            batch = batches[0]
+            self._in_flight = sum(len(pending) for pending in batches)
+            try:
+                if self.is_running and time.monotonic() >= self._next_refresh:
+                    await self.refresh_known_codes()
+                await self.flush(batch)
+                batches.popleft()
+                self._in_flight = 0
+                attempts = 0
+                retry_delay = RETRY_DELAY
+            except Exception as e:
+                self.failed_flushes += 1
+                if is_data_error(e):
+                    attempts += 1
+                    if attempts >= self.max_attempts:
+                        batches.popleft()
+                        attempts = 0
+                        self._give_up(batch, batches, e)
+                        continue
+                logger.error(f"❌ Failed to write {len(batch)} clicks, retry in {retry_delay:.1f}s: {e}")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+
+    def _give_up(self, batch: List[dict], batches: Deque[List[dict]], error: Exception) -> None:
+        """Пачка исчерпала попытки: делим пополам, одиночный клик - в dead letter"""
+        if len(batch) > 1:
+            middle = len(batch) // 2
+            batches.appendleft(batch[middle:])
+            batches.appendleft(batch[:middle])
+            self.split_batches += 1
+            logger.warning(f"⚠️ {len(batch)} clicks failed {self.max_attempts} times, splitting batch: {error}")
+            return
+
+        self.dead_lettered += 1
+        click = batch[0]
+        logger.error(f"❌ Click for {click['ref_code']!r} failed {self.max_attempts} times, moved to {self.dead_letter_file}: {error}")
+        try:
+            with open(self.dead_letter_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(click, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            logger.error(f"❌ Failed to save rejected click: {e}")
+
+    async def _collect(self) -> List[dict]:
+        """Пачка до batch_size кликов: ждем первый клик, добираем остальные до flush_interval"""
+        batch: List[dict] = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            try:
+                click = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                if not self.is_running:
+                    break
+                # Первый клик ждем flush_interval, остальные - до срока пачки
+                timeout = self.flush_interval if deadline is None else deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    click = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            if click is _STOP:
+                break
+            batch.append(click)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+        return batch
+
+    async def flush(self, clicks: List[dict]) -> int:
+        """
+        Запись пачки кликов одной транзакцией
+
+        Returns:
+            Количество записанных кликов (клики с несуществующим кодом отбрасываются)
+        """
+        async with AsyncSessionLocal() as session:
+            unknown = {click["ref_code"] for click in clicks} - self._known
+            if unknown:
+                result = await session.execute(select(User.ref_code).where(User.ref_code.in_(unknown)))
+                found = set(result.scalars().all())
+                self._known |= found
+                self._reject(unknown - found)
+
+            rows = [click for click in clicks if click["ref_code"] in self._known]
+            self.invalid += len(clicks) - len(rows)
+            if not rows:
+                return 0
+
+            await session.execute(insert(Click), rows)
+            counts: Dict[str, Dict[str, int]] = {
+                ref_code: {"clicks": count}
+                for ref_code, count in Counter(row["ref_code"] for row in rows).items()
+            }
+            await PartnerStatsCRUD.increment_many(session, counts)
+            await session.commit()
+
+        self.written += len(rows)
+        self.flushes += 1
+        return len(rows)
+
+    def _reject(self, ref_codes: Set[str]) -> None:
+        if len(self._rejected) + len(ref_codes) > MAX_REJECTED_CODES:
+            self._rejected.clear()
+        self._rejected |= ref_codes
+        if ref_codes:
+            logger.info(f"Click buffer: unknown ref codes {sorted(ref_codes)[:10]}")
+
+    def stats(self) -> dict:
+        """Состояние буфера для мониторинга"""
+        return {
+            'queue_depth': self._queue.qsize(),
+            'max_size': self._queue.maxsize,
+            'known_ref_codes': len(self._known),
+            'accepted': self.accepted,
+            'dropped': self.dropped,
+            'invalid': self.invalid,
+            'written': self.written,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'split_batches': self.split_batches,
+            'dead_lettered': self.dead_lettered,
+        }
+
+
+# Глобальный экземпляр
+click_buffer = ClickBuffer(
+    batch_size=settings.CLICK_FLUSH_BATCH_SIZE,
+    flush_interval=settings.CLICK_FLUSH_INTERVAL_MS / 1000,
+    max_size=settings.CLICK_BUFFER_SIZE,
+    refresh_interval=settings.CLICK_REF_CODES_REFRESH_INTERVAL,
+    max_attempts=settings.CLICK_FLUSH_MAX_ATTEMPTS,
+    dead_letter_file=settings.CLICK_DEAD_LETTER_FILE
+)
@@ -2,16 +2,15 @@
 Планировщик для автоматической ежедневной отправки отчетов администратору
 """
 import asyncio
-import csv
-import io
 import logging
 from datetime import datetime, timedelta, time as dt_time
 from aiogram import Bot
-from aiogram.types import BufferedInputFile
 
 from app.config import settings
 from app.database.connection import AsyncSessionLocal
-from app.database.statistics_crud import StatisticsCRUD
+from app.database.funnel_crud import FunnelStatsCRUD
+from app.database.statistics_crud import StatisticsCRUD, day_bounds
+from app.services.report_exporter import PERIOD_SECTIONS, report_exporter
 
 logger = logging.getLogger(__name__)
 
@@ -46,12 +45,15 @@ class DailyReportsScheduler:
 
         try:
             async with AsyncSessionLocal() as session:
-                # Получаем данные за день
-                sales_data = await StatisticsCRUD.get_daily_sales(session, date)
-                buyers = await StatisticsCRUD.get_daily_buyers(session, date)
-                new_leads = await StatisticsCRUD.get_new_leads(session, date)
-                new_partners = await StatisticsCRUD.get_new_partners(session, date)
-                partners_no_team = await StatisticsCRUD.get_partners_without_team(session, date)
+                # Пересчитываем строку дня (сверка с сырыми таблицами) и берем итоги из нее
+                await FunnelStatsCRUD.refresh_days(session, [date.date()])
+                day_stats = await FunnelStatsCRUD.get_totals(session, date.date(), date.date())
+
+                start, end = day_bounds(date)
+                buyers = await StatisticsCRUD.get_buyer_rows(session, start, end, limit=10)
+                new_leads = await StatisticsCRUD.get_lead_rows(session, start, end, limit=10)
+                new_partners = await StatisticsCRUD.get_partner_rows(session, start, end, limit=10)
+                partners_no_team = await StatisticsCRUD.get_partner_without_team_rows(session, start, end, limit=10)
 
             # Формируем текстовый отчет
             report_text = f"""
@@ -61,67 +63,67 @@ class DailyReportsScheduler:
 ━━━━━━━━━━━━━━━━━━━━━━
 
 💰 <b>ПРОДАЖИ ЗА ДЕНЬ</b>
-• Количество: {sales_data['count']}
-• Сумма: {sales_data['total_amount']:,.0f} руб.
-• Комиссия: {sales_data['total_commission']:,.0f} руб.
+• Количество: {day_stats['sales_count']}
+• Сумма: {day_stats['sales_amount']:,.0f} руб.
+• Комиссия: {day_stats['sales_commission']:,.0f} руб.
 
 ━━━━━━━━━━━━━━━━━━━━━━
 
-👥 <b>ПОКУПАТЕЛИ ({len(buyers)})</b>
+👥 <b>ПОКУПАТЕЛИ ({day_stats['payments_count']})</b>
 """
             if buyers:
-                for buyer in buyers[:10]:  # Первые 10
-                    username = f"@{buyer['username']}" if buyer['username'] else "Нет username"
-                    time_str = buyer['purchased_at'].strftime('%H:%M')
-                    report_text += f"\n• {buyer['full_name']} ({username})\n"
-                    report_text += f"  Сумма: {buyer['amount']:,.0f} руб., {time_str}\n"
-                if len(buyers) > 10:
-                    report_text += f"\n... и еще {len(buyers) - 10} покупателей\n"
+                for buyer in buyers:  # Первые 10
+                    username = f"@{buyer.username}" if buyer.username else "Нет username"
+                    time_str = buyer.purchased_at.strftime('%H:%M')
+                    report_text += f"\n• {buyer.full_name} ({username})\n"
+                    report_text += f"  Сумма: {buyer.amount:,.0f} руб., {time_str}\n"
+                if day_stats['payments_count'] > len(buyers):
+                    report_text += f"\n... и еще {day_stats['payments_count'] - len(buyers)} покупателей\n"
             else:
                 report_text += "\nНет покупателей за этот день\n"
 
             report_text += f"""
 ━━━━━━━━━━━━━━━━━━━━━━
 
-🆕 <b>НОВЫЕ ЛИДЫ ({len(new_leads)})</b>
+🆕 <b>НОВЫЕ ЛИДЫ ({day_stats['new_users']})</b>
 """
             if new_leads:
-                for lead in new_leads[:10]:  # Первые 10
+                for lead in new_leads:  # Первые 10
                     username = f"@{lead.username}" if lead.username else "Нет username"
                     time_str = lead.created_at.strftime('%H:%M')
                     report_text += f"• {lead.full_name} ({username}), {time_str}\n"
-                if len(new_leads) > 10:
-                    report_text += f"\n... и еще {len(new_leads) - 10} лидов\n"
+                if day_stats['new_users'] > len(new_leads):
+                    report_text += f"\n... и еще {day_stats['new_users'] - len(new_leads)} лидов\n"
             else:
                 report_text += "Нет новых лидов за этот день\n"
 
             report_text += f"""
 ━━━━━━━━━━━━━━━━━━━━━━
 
-🤝 <b>НОВЫЕ ПАРТНЕРЫ ({len(new_partners)})</b>
+🤝 <b>НОВЫЕ ПАРТНЕРЫ ({day_stats['partners']})</b>
 """
             if new_partners:
-                for partner in new_partners[:10]:  # Первые 10
+                for partner in new_partners:  # Первые 10
                     username = f"@{partner.username}" if partner.username else "Нет username"
                     time_str = partner.stage_completed_at.strftime('%H:%M') if partner.stage_completed_at else "N/A"
                     report_text += f"• {partner.full_name} ({username}), {time_str}\n"
-                if len(new_partners) > 10:
-                    report_text += f"\n... и еще {len(new_partners) - 10} партнеров\n"
+                if day_stats['partners'] > len(new_partners):
+                    report_text += f"\n... и еще {day_stats['partners'] - len(new_partners)} партнеров\n"
             else:
                 report_text += "Нет новых партнеров за этот день\n"
 
             report_text += f"""
 ━━━━━━━━━━━━━━━━━━━━━━
 
-⚠️ <b>ПАРТНЕРЫ БЕЗ КОМАНДЫ ({len(partners_no_team)})</b>
+⚠️ <b>ПАРТНЕРЫ БЕЗ КОМАНДЫ ({day_stats['partners_without_team']})</b>
 """
             if partners_no_team:
-                for user in partners_no_team[:10]:  # Первые 10
+                for user in partners_no_team:  # Первые 10
                     username = f"@{user.username}" if user.username else "Нет username"
                     report_text += f"• {user.full_name} ({username})\n"
                     report_text += f"  Стадия: {user.onboarding_stage}\n"
-                if len(partners_no_team) > 10:
-                    report_text += f"\n... и еще {len(partners_no_team) - 10} пользователей\n"
+                if day_stats['partners_without_team'] > len(partners_no_team):
+                    report_text += f"\n... и еще {day_stats['partners_without_team'] - len(partners_no_team)} пользователей\n"
             else:
                 report_text += "Нет таких пользователей за этот день\n"
 
@@ -132,76 +134,20 @@ class DailyReportsScheduler:
                 parse_mode="HTML"
             )
 
-            # Генерируем и отправляем CSV файл
-            csv_buffer = io.StringIO()
-            csv_writer = csv.writer(csv_buffer)
-
-            # Заголовки CSV
-            csv_writer.writerow([
-                "Категория", "Имя", "Username", "Telegram ID",
-                "Сумма", "Время", "Стадия"
-            ])
-
-            # Добавляем покупателей
-            for buyer in buyers:
-                csv_writer.writerow([
-                    "Покупатель",
-                    buyer['full_name'],
-                    buyer['username'] or "",
-                    buyer['telegram_id'],
-                    buyer['amount'],
-                    buyer['purchased_at'].strftime('%Y-%m-%d %H:%M:%S'),
-                    "Paid"
-                ])
-
-            # Добавляем новых лидов
-            for lead in new_leads:
-                csv_writer.writerow([
-                    "Новый лид",
-                    lead.full_name,
-                    lead.username or "",
-                    lead.telegram_id,
-                    "",
-                    lead.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    lead.onboarding_stage
-                ])
-
-            # Добавляем новых партнеров
-            for partner in new_partners:
-                csv_writer.writerow([
-                    "Новый партнер",
-                    partner.full_name,
-                    partner.username or "",
-                    partner.telegram_id,
-                    "",
-                    partner.stage_completed_at.strftime('%Y-%m-%d %H:%M:%S') if partner.stage_completed_at else "",
-                    partner.onboarding_stage
-                ])
-
-            # Добавляем партнеров без команды
-            for user in partners_no_team:
-                csv_writer.writerow([
-                    "Партнер без команды",
-                    user.full_name,
-                    user.username or "",
-                    user.telegram_id,
-                    "",
-                    user.stage_payment_ok_at.strftime('%Y-%m-%d %H:%M:%S') if user.stage_payment_ok_at else "",
-                    user.onboarding_stage
-                ])
-
-            # Отправляем CSV файл
-            csv_data = csv_buffer.getvalue().encode('utf-8-sig')  # utf-8-sig для корректного отображения в Excel
-            csv_file = BufferedInputFile(
-                csv_data,
-                filename=f"daily_report_{date.strftime('%Y%m%d')}.csv"
-            )
-
-            await self.bot.send_document(
-                document=csv_file,
-                chat_id=admin_id,
-                caption=f"📊 CSV отчет за {date.strftime('%d.%m.%Y')}"
-            )
+            # Генерируем и отправляем CSV файл (строки читаются курсором пачками)
+            async with AsyncSessionLocal() as session:
+                csv_file = await report_exporter.export(
+                    session, PERIOD_SECTIONS, f"daily_report_{date.strftime('%Y%m%d')}.csv",
+                    start, end, time_header="Время"
+                )
+            try:
+                await self.bot.send_document(
+                    document=csv_file,
+                    chat_id=admin_id,
+                    caption=f"📊 CSV отчет за {date.strftime('%d.%m.%Y')}"
+                )
+            finally:
+                csv_file.close()
 
             logger.info(f"Daily report sent successfully to admin {admin_id}")
 
@@ -1,33 +1,192 @@
 """
 Клиент для работы с DeepSeek API
 app/services/deepseek_client.py
+
+Все запросы идут через одну долгоживущую aiohttp-сессию (keep-alive, без
+повторных DNS/TCP/TLS на каждый вызов). Число одновременных запросов к
+модели ограничено семафором, 429/5xx и сетевые ошибки повторяются с
+экспоненциальной задержкой и джиттером. Retry-After больше MAX_RETRY_DELAY
+не ждем, а весь вызов вместе с повторами ограничен сроком deadline.
 """
+import asyncio
 import logging
+import random
+import time
 import aiohttp
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 
 from app.config import settings
+from app.services.answer_cache import MISS, answer_cache
+from app.utils.metrics import DEEPSEEK_API_LATENCY
 
 logger = logging.getLogger(__name__)
 
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 
+# Коды ответа, после которых запрос повторяется
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Начальная задержка повтора (сек), удваивается на каждой попытке;
+# это же - предел ожидания по Retry-After
+RETRY_BASE_DELAY = 0.5
+MAX_RETRY_DELAY = 8.0
+
 
 class DeepSeekClient:
     """Клиент для взаимодействия с DeepSeek API"""
     
-    def __init__(self):
-        self.api_url = DEEPSEEK_API_URL
+    def __init__(
+        self,
+        api_url: str = DEEPSEEK_API_URL,
+        max_concurrency: int = 8,
+        timeout: float = 30.0,
+        max_retries: int = 3,
+        deadline: float = 60.0
+    ):
+        """
+        Args:
+            api_url: Адрес chat/completions (в тестах - локальная заглушка)
+            max_concurrency: Максимум одновременных запросов к модели
+            timeout: Таймаут одного запроса (сек)
+            max_retries: Число повторов при 429/5xx и сетевых ошибках
+            deadline: Общий срок вызова с повторами и ожиданием семафора (сек)
+        """
+        self.api_url = api_url
         self.api_key = settings.DEEPSEEK_API_KEY
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        self.max_concurrency = max_concurrency
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_retries = max_retries
+        self.deadline = deadline
+        
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        
+        # Счетчики
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.in_flight = 0
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Общая сессия, создается при первом запросе (нужен запущенный event loop)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=self.timeout
+            )
+        return self._session
+    
+    async def close(self):
+        """Закрытие сессии при остановке бота"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("🛑 DeepSeek client session closed")
+        self._session = None
+    
+    async def _chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int
+    ) -> Optional[str]:
+        """
+        Запрос chat/completions с повторами
+        
+        Returns:
+            Текст ответа модели или None, если API ответил ошибкой
+        
+        Raises:
+            aiohttp.ClientError, asyncio.TimeoutError: сеть недоступна после всех
+                повторов или истек срок deadline
+        """
+        payload = {
+            "model": "deepseek-chat",
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        
+        with DEEPSEEK_API_LATENCY.time():
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            try:
+                return await asyncio.wait_for(self._post_with_retries(payload), timeout=self.deadline)
+            except asyncio.TimeoutError:
+                # Таймаут запроса после всех повторов уже посчитан в _post_with_retries
+                if loop.time() - started >= self.deadline:
+                    self.errors += 1
+                    logger.error(f"❌ DeepSeek request exceeded {self.deadline}s deadline")
+                raise
+
+    async def _post_with_retries(self, payload: dict) -> Optional[str]:
+        """Попытки запроса с задержками между ними (срок вызова - в _chat_completion)"""
+        attempt = 0
+        while True:
+            status = None
+            try:
+                async with self._semaphore:
+                    self.requests += 1
+                    self.in_flight += 1
+                    try:
+                        async with self._get_session().post(self.api_url, json=payload) as response:
+                            status = response.status
+                            if status == 200:
+                                data = await response.json()
+                                return data['choices'][0]['message']['content']
+                            retry_after = response.headers.get("Retry-After")
+                    finally:
+                        self.in_flight -= 1
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    self.errors += 1
+                    raise
+                logger.warning(f"⚠️ DeepSeek request failed ({type(e).__name__}), retry {attempt + 1}/{self.max_retries}")
+                retry_after = None
+            else:
+                if status not in RETRYABLE_STATUSES or attempt >= self.max_retries:
+                    self.errors += 1
+                    logger.error(f"❌ DeepSeek API error: {status}")
+                    return None
+                logger.warning(f"⚠️ DeepSeek API {status}, retry {attempt + 1}/{self.max_retries}")
+            
+            # Полный джиттер: одновременные запросы не повторяются синхронно
+            delay = random.uniform(0, min(RETRY_BASE_DELAY * 2 ** attempt, MAX_RETRY_DELAY))
+            if retry_after and retry_after.isdigit():
+                if float(retry_after) > MAX_RETRY_DELAY:
+                    # Пользователь ждет ответа в чате - такую паузу не выдерживаем
+                    self.errors += 1
+                    logger.error(f"❌ DeepSeek API {status}: Retry-After {retry_after}s is too long, giving up")
+                    return None
+                delay = max(delay, float(retry_after))
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+    
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'answer_cache': answer_cache.stats(),
+        }
     
     async def find_matching_answer(
         self, 
         user_question: str, 
-        qa_pairs: List[Dict[str, str]]
+        qa_pairs: List[Dict[str, str]],
+        sheet: Optional[str] = None,
+        qa_version: int = 0
     ) -> Optional[str]:
         """
         Сравнивает вопрос пользователя с вопросами из базы и возвращает подходящий ответ
@@ -35,6 +194,8 @@ class DeepSeekClient:
         Args:
             user_question: Вопрос пользователя
             qa_pairs: Список словарей с ключами 'question' и 'answer'
+            sheet: Лист, из которого взяты qa_pairs (если указан - результат кэшируется)
+            qa_version: Версия набора пар (AutoAnswersService.qa_version)
         
         Returns:
             Ответ из базы если найдено совпадение, иначе None
@@ -42,6 +203,26 @@ class DeepSeekClient:
         if not qa_pairs:
             return None
         
+        if sheet is not None:
+            cached = answer_cache.get(sheet, user_question, qa_version)
+            if cached is not MISS:
+                logger.info(f"💾 Answer cache hit ({'answer' if cached else 'НЕТ'}) for sheet '{sheet}'")
+                return cached
+        
+        started = time.perf_counter()
+        answer, cacheable = await self._match_question(user_question, qa_pairs)
+        if sheet is not None and cacheable:
+            answer_cache.put(sheet, user_question, qa_version, answer, time.perf_counter() - started)
+        return answer
+    
+    async def _match_question(self, user_question: str, qa_pairs: List[Dict[str, str]]) -> Tuple[Optional[str], bool]:
+        """
+        Запрос сопоставления к модели
+        
+        Returns:
+            (ответ или None, можно ли кэшировать): ошибки API и нераспознанные
+            ответы модели не кэшируются
+        """
         # Формируем список вопросов для анализа
         questions_text = "\n".join([
             f"{i+1}. {qa['question']}" 
@@ -70,49 +251,38 @@ class DeepSeekClient:
 Есть ли вопрос похожий минимум на 80% по смыслу? Ответь ТОЛЬКО номером или словом "НЕТ"."""
 
         try:
-            async with aiohttp.ClientSession() as session:
-                payload = {
-                    "model": "deepseek-chat",
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    "temperature": 0,  # Строгое сопоставление без креативности
-                    "max_tokens": 10
-                }
-                
-                async with session.post(
-                    self.api_url, 
-                    headers=self.headers, 
-                    json=payload
-                ) as response:
-                    if response.status != 200:
-                        logger.error(f"❌ DeepSeek API error: {response.status}")
-                        return None
-                    
-                    data = await response.json()
-                    ai_response = data['choices'][0]['message']['content'].strip()
-                    
-                    logger.info(f"🤖 DeepSeek response: {ai_response}")
-                    
-                    # Проверяем ответ
-                    if ai_response.upper() == "НЕТ":
-                        return None
-                    
-                    # Пытаемся извлечь номер
-                    try:
-                        question_number = int(ai_response) - 1  # -1 т.к. нумерация с 0
-                        if 0 <= question_number < len(qa_pairs):
-                            return qa_pairs[question_number]['answer']
-                    except ValueError:
-                        logger.warning(f"⚠️ Не удалось распарсить номер: {ai_response}")
-                        return None
-                    
-                    return None
+            ai_response = await self._chat_completion(
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0,  # Строгое сопоставление без креативности
+                max_tokens=10
+            )
+            if ai_response is None:
+                return None, False
+            ai_response = ai_response.strip()
+            
+            logger.info(f"🤖 DeepSeek response: {ai_response}")
+            
+            # Проверяем ответ
+            if ai_response.upper() == "НЕТ":
+                return None, True
+            
+            # Пытаемся извлечь номер
+            try:
+                question_number = int(ai_response) - 1  # -1 т.к. нумерация с 0
+                if 0 <= question_number < len(qa_pairs):
+                    return qa_pairs[question_number]['answer'], True
+            except ValueError:
+                logger.warning(f"⚠️ Не удалось распарсить номер: {ai_response}")
+                return None, False
+            
+            return None, False
                     
         except Exception as e:
             logger.error(f"❌ Error calling DeepSeek API: {e}", exc_info=True)
-            return None
+            return None, False
     
     async def classify_message_type(self, user_message: str) -> str:
         """
@@ -148,37 +318,26 @@ class DeepSeekClient:
 Это приветствие или вопрос? Ответь ТОЛЬКО "greeting" или "question"."""
 
         try:
-            async with aiohttp.ClientSession() as session:
-                payload = {
-                    "model": "deepseek-chat",
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    "temperature": 0,  # Строгая классификация без креативности
-                    "max_tokens": 10
-                }
-                
-                async with session.post(
-                    self.api_url, 
-                    headers=self.headers, 
-                    json=payload
-                ) as response:
-                    if response.status != 200:
-                        logger.error(f"❌ DeepSeek API error: {response.status}")
-                        # Возвращаем question по умолчанию
-                        return "question"
-                    
-                    data = await response.json()
-                    ai_response = data['choices'][0]['message']['content'].strip().lower()
-                    
-                    logger.info(f"🤖 Message type classification: {ai_response}")
-                    
-                    # Проверяем ответ
-                    if "greeting" in ai_response:
-                        return "greeting"
-                    else:
-                        return "question"
+            ai_response = await self._chat_completion(
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0,  # Строгая классификация без креативности
+                max_tokens=10
+            )
+            if ai_response is None:
+                # Возвращаем question по умолчанию
+                return "question"
+            ai_response = ai_response.strip().lower()
+            
+            logger.info(f"🤖 Message type classification: {ai_response}")
+            
+            # Проверяем ответ
+            if "greeting" in ai_response:
+                return "greeting"
+            else:
+                return "question"
                     
         except Exception as e:
             logger.error(f"❌ Error classifying message: {e}", exc_info=True)
@@ -237,36 +396,25 @@ class DeepSeekClient:
 Ответь подходящим приветствием:"""
 
         try:
-            async with aiohttp.ClientSession() as session:
-                payload = {
-                    "model": "deepseek-chat",
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    "temperature": 0.3,
-                    "max_tokens": 50
-                }
-                
-                async with session.post(
-                    self.api_url, 
-                    headers=self.headers, 
-                    json=payload
-                ) as response:
-                    if response.status != 200:
-                        logger.error(f"❌ DeepSeek API error: {response.status}")
-                        # Возвращаем дефолт в зависимости от типа сессии
-                        if is_new_session:
-                            return "👋 Здравствуйте! Чем могу помочь?"
-                        else:
-                            return "👋 Здравствуйте!"
-                    
-                    data = await response.json()
-                    ai_response = data['choices'][0]['message']['content'].strip()
-                    
-                    logger.info(f"🤖 Generated greeting ({'new session' if is_new_session else 'continuation'}): {ai_response}")
-                    
-                    return ai_response
+            ai_response = await self._chat_completion(
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.3,
+                max_tokens=50
+            )
+            if ai_response is None:
+                # Возвращаем дефолт в зависимости от типа сессии
+                if is_new_session:
+                    return "👋 Здравствуйте! Чем могу помочь?"
+                else:
+                    return "👋 Здравствуйте!"
+            ai_response = ai_response.strip()
+            
+            logger.info(f"🤖 Generated greeting ({'new session' if is_new_session else 'continuation'}): {ai_response}")
+            
+            return ai_response
                     
         except Exception as e:
             logger.error(f"❌ Error generating greeting: {e}", exc_info=True)
@@ -278,4 +426,10 @@ class DeepSeekClient:
 
 
 # Глобальный экземпляр
-deepseek_client = DeepSeekClient()
\ No newline at end of file
+deepseek_client = DeepSeekClient(
+    api_url=settings.DEEPSEEK_API_URL,
+    max_concurrency=settings.DEEPSEEK_MAX_CONCURRENCY,
+    timeout=settings.DEEPSEEK_TIMEOUT,
+    max_retries=settings.DEEPSEEK_MAX_RETRIES,
+    deadline=settings.DEEPSEEK_DEADLINE
+)
\ No newline at end of file
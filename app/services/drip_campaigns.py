@@ -0,0 +1,221 @@
+"""
+Декларативные drip-кампании автоматических кружков
+app/services/drip_campaigns.py
+
+Кампания описывается данными: на какие стадии срабатывает, какие сообщения
+отменяет и какие шаги планирует. Шаг задается смещением от момента смены
+стадии ("after_minutes") или якорем "ближайшие 11:00 МСК через N суток"
+("at" + "days"). Кампании можно переопределить JSON-файлом
+(settings.DRIP_CAMPAIGNS_FILE) без изменения кода.
+"""
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import pytz
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database.crud import AutomatedMessageCRUD
+
+logger = logging.getLogger(__name__)
+
+# Московская временная зона
+MSK = pytz.timezone('Europe/Moscow')
+
+
+DEFAULT_CAMPAIGNS = [
+    {
+        # Пришел в бота / посмотрел интро, но не дошел до оплаты
+        "name": "new_user",
+        "trigger_stages": ["new_user", "intro_shown"],
+        "required_stages": ["new_user", "intro_shown"],
+        "blocked_stages": ["wait_payment"],
+        "cancel": ["K_VIDEO_ID1", "K_VIDEO_ID2", "K_VIDEO_ID3", "K_VIDEO_ID4"],
+        "steps": [
+            {"video": "K_VIDEO_ID1", "after_minutes": 30},
+            {"video": "K_VIDEO_ID2", "after_minutes": 210},
+            {"video": "K_VIDEO_ID3", "at": "11:00", "days": 1},
+            {"video": "K_VIDEO_ID4", "at": "11:00", "days": 3},
+        ],
+    },
+    {
+        # Открыл страницу оплаты, но не оплатил
+        "name": "wait_payment",
+        "trigger_stages": ["wait_payment"],
+        "required_stages": ["wait_payment"],
+        "blocked_stages": ["payment_ok", "want_join"],
+        "cancel": ["K_VIDEO_ID1", "K_VIDEO_ID2", "K_VIDEO_ID3", "K_VIDEO_ID4",
+                   "K_VIDEO_ID5", "K_VIDEO_ID6", "K_VIDEO_ID7"],
+        "steps": [
+            {"video": "K_VIDEO_ID5", "after_minutes": 180},
+            {"video": "K_VIDEO_ID6", "at": "11:00", "days": 1},
+            {"video": "K_VIDEO_ID7", "at": "11:00", "days": 2},
+        ],
+    },
+    {
+        # Хочет стать партнером, но не завершил онбординг
+        "name": "want_join",
+        "trigger_stages": ["want_join"],
+        "required_stages": ["want_join"],
+        "blocked_stages": ["completed"],
+        "cancel": ["K_VIDEO_ID1", "K_VIDEO_ID2", "K_VIDEO_ID3", "K_VIDEO_ID4",
+                   "K_VIDEO_ID5", "K_VIDEO_ID6", "K_VIDEO_ID7",
+                   "K_VIDEO_ID8", "K_VIDEO_ID9", "K_VIDEO_ID10"],
+        "steps": [
+            {"video": "K_VIDEO_ID8", "at": "11:00", "days": 3},
+            {"video": "K_VIDEO_ID9", "at": "11:00", "days": 6},
+            {"video": "K_VIDEO_ID10", "at": "11:00", "days": 9},
+        ],
+    },
+    {
+        # Оплатил или завершил онбординг - догревающие сообщения не нужны
+        "name": "stop",
+        "trigger_stages": ["payment_ok", "completed"],
+        "cancel": "all",
+        "steps": [],
+    },
+]
+
+
+@dataclass(frozen=True)
+class CampaignStep:
+    video_type: str
+    after: Optional[timedelta] = None  # смещение от смены стадии
+    at: Optional[Tuple[int, int]] = None  # (час, минута) по МСК
+    days: int = 0
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CampaignStep":
+        if "at" in data:
+            hour, minute = (int(part) for part in data["at"].split(":"))
+            return cls(video_type=data["video"], at=(hour, minute), days=int(data.get("days", 0)))
+        return cls(video_type=data["video"], after=timedelta(minutes=float(data["after_minutes"])))
+
+    def scheduled_at(self, now_utc: datetime) -> datetime:
+        """
+        Время отправки в формате automated_messages: смещения - naive локальное
+        время (как datetime.now()), якоря МСК - naive UTC
+        """
+        if self.after is not None:
+            return (now_utc.astimezone() + self.after).replace(tzinfo=None)
+
+        now_msk = now_utc.astimezone(MSK)
+        target = (now_msk + timedelta(days=self.days)).replace(
+            hour=self.at[0], minute=self.at[1], second=0, microsecond=0
+        )
+        # Если время уже прошло, берем следующий день
+        if target <= now_msk:
+            target += timedelta(days=1)
+        return target.astimezone(pytz.UTC).replace(tzinfo=None)
+
+
+@dataclass(frozen=True)
+class Campaign:
+    name: str
+    trigger_stages: Tuple[str, ...]
+    required_stages: Tuple[str, ...] = ()
+    blocked_stages: Tuple[str, ...] = ()
+    cancel: Optional[Tuple[str, ...]] = None  # None - отменить все сообщения пользователя
+    steps: Tuple[CampaignStep, ...] = ()
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Campaign":
+        cancel = data.get("cancel", [])
+        return cls(
+            name=data["name"],
+            trigger_stages=tuple(data["trigger_stages"]),
+            required_stages=tuple(data.get("required_stages", data["trigger_stages"])),
+            blocked_stages=tuple(data.get("blocked_stages", [])),
+            cancel=None if cancel == "all" else tuple(cancel),
+            steps=tuple(CampaignStep.from_dict(step) for step in data.get("steps", [])),
+        )
+
+
+def load_campaigns(path: Optional[str] = None) -> List[Campaign]:
+    """Кампании из JSON-файла (если задан) или DEFAULT_CAMPAIGNS"""
+    data = DEFAULT_CAMPAIGNS
+    if path:
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            logger.info(f"📅 Drip campaigns loaded from {path}")
+        except Exception as e:
+            logger.error(f"Failed to load drip campaigns from {path}, using defaults: {e}")
+    return [Campaign.from_dict(item) for item in data]
+
+
+class DripCampaignEngine:
+    """Планирование кампании при смене стадии: отмена + вставка одной транзакцией"""
+
+    def __init__(self, campaigns: List[Campaign], video_mapping: Optional[Dict[str, str]] = None):
+        """
+        Args:
+            campaigns: Кампании
+            video_mapping: video_type -> file_id (по умолчанию одноименные поля settings)
+        """
+        self.video_mapping = video_mapping
+        self._by_stage: Dict[str, Campaign] = {}
+        for campaign in campaigns:
+            for stage in campaign.trigger_stages:
+                self._by_stage[stage] = campaign
+
+    def resolve_video(self, video_type: str) -> str:
+        if self.video_mapping is not None:
+            return self.video_mapping[video_type]
+        return getattr(settings, video_type)
+
+    def campaign_for_stage(self, stage: str) -> Optional[Campaign]:
+        return self._by_stage.get(stage)
+
+    def build_messages(
+        self,
+        campaign: Campaign,
+        user_id: int,
+        telegram_id: int,
+        now_utc: Optional[datetime] = None
+    ) -> List[dict]:
+        """Строки automated_messages для всех шагов кампании"""
+        now_utc = now_utc or datetime.now(pytz.UTC)
+        required_stage = json.dumps(list(campaign.required_stages), separators=(",", ":"))
+        blocked_stages = json.dumps(list(campaign.blocked_stages)) if campaign.blocked_stages else None
+
+        return [
+            {
+                "user_id": user_id,
+                "telegram_id": telegram_id,
+                "video_file_id": self.resolve_video(step.video_type),
+                "video_type": step.video_type,
+                "required_stage": required_stage,
+                "blocked_stages": blocked_stages,
+                "scheduled_at": step.scheduled_at(now_utc),
+            }
+            for step in campaign.steps
+        ]
+
+    async def apply(self, session: AsyncSession, user_id: int, telegram_id: int, stage: str) -> int:
+        """
+        Применение кампании для новой стадии
+
+        Returns:
+            Количество запланированных сообщений (0, если для стадии кампании нет)
+        """
+        campaign = self.campaign_for_stage(stage)
+        if campaign is None:
+            return 0
+
+        messages = self.build_messages(campaign, user_id, telegram_id)
+        await AutomatedMessageCRUD.replace_user_messages(
+            session,
+            telegram_id,
+            cancel_video_types=list(campaign.cancel) if campaign.cancel is not None else None,
+            messages=messages
+        )
+        logger.info(f"Drip campaign '{campaign.name}' for user {telegram_id}: {len(messages)} messages scheduled")
+        return len(messages)
+
+
+# Глобальный экземпляр
+drip_engine = DripCampaignEngine(load_campaigns(settings.DRIP_CAMPAIGNS_FILE))
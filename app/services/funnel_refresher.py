@@ -0,0 +1,92 @@
+"""
+Фоновый пересчет дневного среза воронки
+app/services/funnel_refresher.py
+
+Пути записи (регистрация, смена стадии, оплата, продажа) только помечают
+дни через FunnelStatsCRUD.touch/touch_user. Здесь помеченные дни
+пересчитываются раз в interval секунд - одна транзакция на все изменения
+за период вместо пересчета на каждую запись.
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from app.config import settings
+from app.database.connection import AsyncSessionLocal
+from app.database.funnel_crud import FunnelStatsCRUD
+
+logger = logging.getLogger(__name__)
+
+
+class FunnelRefresher:
+    """Пересчет помеченных дней daily_funnel_stats раз в interval секунд"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.is_running = False
+        self.task: Optional[asyncio.Task] = None
+
+        # Счетчики
+        self.runs = 0
+        self.refreshed_days = 0
+        self.failures = 0
+
+    async def refresh_once(self) -> int:
+        """Один пересчет, возвращает количество дней"""
+        async with AsyncSessionLocal() as session:
+            days = await FunnelStatsCRUD.refresh_dirty(session)
+
+        self.runs += 1
+        self.refreshed_days += days
+        if days:
+            logger.debug(f"Daily funnel stats refreshed for {days} day(s)")
+        return days
+
+    async def _loop(self):
+        while self.is_running:
+            try:
+                await asyncio.sleep(self.interval)
+                await self.refresh_once()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Error refreshing daily funnel stats: {e}")
+
+    async def start(self):
+        """Запустить пересчет (no-op при interval = 0)"""
+        if self.is_running or self.interval <= 0:
+            return
+
+        self.is_running = True
+        self.task = asyncio.create_task(self._loop())
+        logger.info(f"✅ Funnel refresher started (every {self.interval}s)")
+
+    async def stop(self):
+        """Остановить пересчет, последние пометки пересчитываются сразу"""
+        if not self.is_running:
+            return
+
+        self.is_running = False
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+        try:
+            await self.refresh_once()
+        except Exception as e:
+            logger.error(f"Final daily funnel stats refresh failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            'runs': self.runs,
+            'refreshed_days': self.refreshed_days,
+            'failures': self.failures,
+        }
+
+
+# Глобальный экземпляр
+funnel_refresher = FunnelRefresher(settings.FUNNEL_REFRESH_INTERVAL)
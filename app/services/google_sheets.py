@@ -6,16 +6,41 @@ from google.oauth2.service_account import Credentials
 from datetime import datetime
 import asyncio
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, List
 import json
 import os
 
 from app.config import settings
+from app.database.connection import AsyncSessionLocal
+from app.database.crud import UserCRUD
+from app.services.sheets_writer import SheetsWriter, role_queue_file, run_in_sheets_thread
 
 logger = logging.getLogger(__name__)
 
 
+# Колонки листа "Оплаты"
+PAYMENTS_HEADERS = [
+    "Telegram ID",
+    "Username", 
+    "Дата оплаты",
+    "Реферальный код пользователя",
+    "Пригласивший (Telegram ID)",
+    "Количество приглашённых"
+]
+INVITED_BY_COLUMN = 4  # индекс "Пригласивший (Telegram ID)" в строке
+INVITED_COUNT_COLUMN_LETTER = "F"  # "Количество приглашённых"
+
+
 class GoogleSheetsService:
+    """
+    Лист "Оплаты". Все вызовы gspread выполняются в потоке Sheets
+    (run_in_sheets_thread), строки оплат пишутся пачками через SheetsWriter.
+
+    Номера строк хранятся в карте telegram_id -> строка: она строится по
+    колонке A при подключении листа и дополняется после каждой записи,
+    поэтому обновление счетчика не скачивает лист целиком.
+    """
+
     def __init__(self):
         self.scope = [
             'https://spreadsheets.google.com/feeds',
@@ -25,9 +50,21 @@ class GoogleSheetsService:
         self.client = None
         self.spreadsheet = None
         self.worksheet = None
+        self._row_by_telegram_id: Dict[str, int] = {}
+        self._next_row = 2
+        self.payments_writer = SheetsWriter(
+            "payments",
+            queue_file=role_queue_file(settings.SHEETS_QUEUE_FILE, settings.PROCESS_ROLE),
+            batch_size=settings.SHEETS_BATCH_SIZE,
+            flush_interval=settings.SHEETS_FLUSH_INTERVAL,
+            max_backoff=settings.SHEETS_MAX_BACKOFF,
+            after_flush=self._after_payments_flush
+        )
         
     async def init(self):
-        """Инициализация подключения к Google Sheets"""
+        """Инициализация подключения к Google Sheets (повторный вызов - no-op)"""
+        if self.worksheet is not None:
+            return True
         try:
             # Путь к файлу ключей
             key_file_path = os.path.join(os.getcwd(), settings.GOOGLE_SHEETS_KEY)
@@ -36,37 +73,8 @@ class GoogleSheetsService:
                 logger.error(f"❌ Google Sheets key file not found: {key_file_path}")
                 return False
             
-            # Создаем credentials
-            self.creds = Credentials.from_service_account_file(
-                key_file_path, 
-                scopes=self.scope
-            )
-            
-            # Авторизуемся
-            self.client = gspread.authorize(self.creds)
-            
-            # Открываем таблицу
-            self.spreadsheet = self.client.open_by_key(settings.SPREADSHEET_ID)
-            
-            # Получаем или создаем лист "Оплаты"
-            try:
-                self.worksheet = self.spreadsheet.worksheet("Оплаты")
-                logger.info("✅ Found existing 'Оплаты' worksheet")
-            except gspread.WorksheetNotFound:
-                logger.info("📝 Creating new 'Оплаты' worksheet")
-                self.worksheet = self.spreadsheet.add_worksheet(title="Оплаты", rows="1000", cols="10")
-                
-                # Добавляем заголовки
-                headers = [
-                    "Telegram ID",
-                    "Username", 
-                    "Дата оплаты",
-                    "Реферальный код пользователя",
-                    "Пригласивший (Telegram ID)",
-                    "Количество приглашённых"
-                ]
-                self.worksheet.append_row(headers)
-                logger.info("✅ Headers added to new worksheet")
+            worksheet = await run_in_sheets_thread(self._open_worksheet_sync, key_file_path)
+            await self.bind_worksheet(worksheet)
             
             logger.info(f"✅ Google Sheets initialized: {self.spreadsheet.title}")
             return True
@@ -74,15 +82,54 @@ class GoogleSheetsService:
         except Exception as e:
             logger.error(f"❌ Error initializing Google Sheets: {e}")
             return False
+
+    def _open_worksheet_sync(self, key_file_path: str):
+        """Авторизация и получение листа "Оплаты" (в потоке Sheets)"""
+        # Создаем credentials
+        self.creds = Credentials.from_service_account_file(
+            key_file_path, 
+            scopes=self.scope
+        )
+        
+        # Авторизуемся
+        self.client = gspread.authorize(self.creds)
+        
+        # Открываем таблицу
+        self.spreadsheet = self.client.open_by_key(settings.SPREADSHEET_ID)
+        
+        # Получаем или создаем лист "Оплаты"
+        try:
+            worksheet = self.spreadsheet.worksheet("Оплаты")
+            logger.info("✅ Found existing 'Оплаты' worksheet")
+        except gspread.WorksheetNotFound:
+            logger.info("📝 Creating new 'Оплаты' worksheet")
+            worksheet = self.spreadsheet.add_worksheet(title="Оплаты", rows="1000", cols="10")
+            
+            # Добавляем заголовки
+            worksheet.append_row(PAYMENTS_HEADERS)
+            logger.info("✅ Headers added to new worksheet")
+        return worksheet
+
+    async def bind_worksheet(self, worksheet):
+        """Подключение листа (gspread.Worksheet или FakeWorksheet) и запуск записи"""
+        self.worksheet = worksheet
+        await run_in_sheets_thread(self._load_row_index_sync)
+        self.payments_writer.bind(worksheet)
+        await self.payments_writer.start()
+
+    async def close(self):
+        """Запись оставшихся строк при остановке (остаток сохраняется в файл)"""
+        await self.payments_writer.stop()
     
     async def add_payment_record(self, payment_data: Dict[str, Any]):
-        """Добавление записи об оплате + ОБНОВЛЕНИЕ реферера"""
+        """
+        Постановка записи об оплате в очередь
+
+        Строка уходит в таблицу пачкой в фоне; счетчики рефереров
+        обновляются после записи пачки (_after_payments_flush).
+        """
         try:
-            if not self.worksheet:
-                logger.error("❌ Google Sheets not initialized")
-                return False
-            
-            # Считаем сколько людей пригласил ЭТОТ пользователь (на момент регистрации будет 0)
+            # Сколько людей пригласил ЭТОТ пользователь (на момент оплаты обычно 0)
             invited_count = await self.get_user_invites_count(payment_data['telegram_id'])
             
             # Подготавливаем данные для записи
@@ -92,77 +139,96 @@ class GoogleSheetsService:
                 payment_data['payment_date'],
                 payment_data['user_ref_code'],
                 payment_data['invited_by_telegram_id'] or "",
-                invited_count  # Для нового пользователя будет 0
+                invited_count
             ]
             
-            logger.info(f"📊 Adding to Google Sheets: {row_data}")
-            
-            # Добавляем строку в таблицу
-            self.worksheet.append_row(row_data)
-            
-            # 🆕 ЕСЛИ ЕСТЬ РЕФЕРЕР - ОБНОВЛЯЕМ ЕГО СЧЕТЧИК
-            if payment_data['invited_by_telegram_id']:
-                await self.update_referrer_invite_count(payment_data['invited_by_telegram_id'])
-            
-            logger.info(f"✅ Payment record added to Google Sheets: {payment_data['telegram_id']}")
+            logger.info(f"📊 Queued for Google Sheets: {row_data}")
+            self.payments_writer.append(row_data)
             return True
             
         except Exception as e:
             logger.error(f"❌ Error adding payment record: {e}", exc_info=True)
             return False
 
-    async def update_referrer_invite_count(self, referrer_telegram_id: int):
-        """🆕 ОБНОВЛЕНИЕ количества приглашенных у реферера"""
+    # ---- Номера строк листа ----
+
+    def _load_row_index_sync(self):
+        """Карта telegram_id -> номер строки по колонке A (один запрос, в потоке Sheets)"""
+        column = self.worksheet.col_values(1)
+        self._row_by_telegram_id = {}
+        for row_number, value in enumerate(column[1:], start=2):  # строка 1 - заголовки
+            value = str(value).strip()
+            if value:
+                self._row_by_telegram_id.setdefault(value, row_number)
+        self._next_row = len(column) + 1
+        logger.info(f"📊 Sheets row index: {len(self._row_by_telegram_id)} users")
+
+    def _index_appended_rows(self, rows: List[list], response) -> None:
+        """Номера добавленных строк - из updatedRange ответа append_rows"""
+        first_row = self._next_row
         try:
-            logger.info(f"🔄 Updating invite count for referrer {referrer_telegram_id}")
-            
-            # Получаем все записи
-            all_records = self.worksheet.get_all_values()
-            
-            # Находим строку с рефрером
-            referrer_row_index = None
-            for i, row in enumerate(all_records):
-                if i == 0:  # Пропускаем заголовки
+            updated_range = response["updates"]["updatedRange"]
+            start = updated_range.split("!")[-1].split(":")[0]
+            first_row = int("".join(ch for ch in start if ch.isdigit()))
+        except (TypeError, KeyError, ValueError):
+            pass
+        for offset, row in enumerate(rows):
+            self._row_by_telegram_id.setdefault(str(row[0]), first_row + offset)
+        self._next_row = first_row + len(rows)
+
+    # ---- Счетчики приглашенных ----
+
+    async def _after_payments_flush(self, rows: List[list], response):
+        """После записи пачки: номера новых строк и счетчики рефереров из этой пачки"""
+        self._index_appended_rows(rows, response)
+        referrers = {int(row[INVITED_BY_COLUMN]) for row in rows if row[INVITED_BY_COLUMN]}
+        await self.update_referrer_invite_counts(referrers)
+
+    async def update_referrer_invite_counts(self, referrer_telegram_ids: Iterable[int]):
+        """
+        Обновление колонки "Количество приглашённых" у нескольких рефереров
+
+        Счетчики - одним запросом к БД, строки - из карты номеров,
+        запись - одним batch_update.
+        """
+        referrer_telegram_ids = list(referrer_telegram_ids)
+        if not referrer_telegram_ids or not self.worksheet:
+            return
+        try:
+            counts = await self.get_invite_counts(referrer_telegram_ids)
+
+            data = []
+            for telegram_id in referrer_telegram_ids:
+                row_number = self._row_by_telegram_id.get(str(telegram_id))
+                if not row_number:
+                    logger.warning(f"⚠️ Referrer {telegram_id} not found in Google Sheets")
                     continue
-                if len(row) > 0 and str(row[0]).strip() == str(referrer_telegram_id):
-                    referrer_row_index = i + 1  # +1 потому что индексы в Google Sheets начинаются с 1
-                    break
-            
-            if not referrer_row_index:
-                logger.warning(f"⚠️ Referrer {referrer_telegram_id} not found in Google Sheets")
+                data.append({
+                    "range": f"{INVITED_COUNT_COLUMN_LETTER}{row_number}",
+                    "values": [[counts.get(telegram_id, 0)]]
+                })
+            if not data:
                 return
-            
-            # Считаем НОВОЕ количество приглашенных
-            new_invite_count = await self.get_user_invites_count(referrer_telegram_id)
-            
-            # Обновляем ячейку в столбце F (колонка 6)
-            cell_address = f"F{referrer_row_index}"
-            self.worksheet.update(cell_address, [[new_invite_count]])
-            
-            logger.info(f"✅ Updated {cell_address} for referrer {referrer_telegram_id}: {new_invite_count} invites")
-            
+
+            await run_in_sheets_thread(self.worksheet.batch_update, data)
+            logger.info(f"✅ Updated invite counts for {len(data)} referrers: {[item['range'] for item in data]}")
         except Exception as e:
-            logger.error(f"❌ Error updating referrer invite count: {e}", exc_info=True)
+            logger.error(f"❌ Error updating referrer invite counts: {e}", exc_info=True)
+
+    async def update_referrer_invite_count(self, referrer_telegram_id: int):
+        """🆕 ОБНОВЛЕНИЕ количества приглашенных у реферера"""
+        await self.update_referrer_invite_counts([int(referrer_telegram_id)])
+
+    async def get_invite_counts(self, telegram_ids: List[int]) -> Dict[int, int]:
+        """Количество оплативших приглашенных по данным БД"""
+        async with AsyncSessionLocal() as session:
+            return await UserCRUD.get_invite_counts(session, telegram_ids)
 
     async def get_user_invites_count(self, telegram_id: int) -> int:
         """Подсчет количества приглашенных пользователем"""
         try:
-            if not self.worksheet:
-                return 0
-            
-            # Получаем все записи
-            records = self.worksheet.get_all_records()
-            
-            # Считаем сколько людей пригласил ЭТОТ пользователь
-            count = 0
-            for record in records:
-                inviter_id = str(record.get('Пригласивший (Telegram ID)', '')).strip()
-                if inviter_id == str(telegram_id):
-                    count += 1
-            
-            logger.info(f"📊 User {telegram_id} has invited {count} people")
-            return count
-            
+            counts = await self.get_invite_counts([telegram_id])
+            return counts.get(telegram_id, 0)
         except Exception as e:
             logger.error(f"❌ Error counting invites: {e}")
             return 0
@@ -198,7 +264,7 @@ async def add_payment_to_sheets(
             'invited_by_telegram_id': invited_by_telegram_id or "",
         }
         
-        # Запускаем в фоне, чтобы не блокировать бота
+        # Строка ставится в очередь, запись в таблицу - в фоне пачкой
         await sheets_service.add_payment_record(payment_data)
         
     except Exception as e:
@@ -0,0 +1,193 @@
+"""
+Планировщик автоматических сообщений на куче таймеров
+app/services/message_scheduler.py
+
+Ближайшие запланированные AutomatedMessage держатся в min-heap по scheduled_at.
+Воркер спит ровно до ближайшего сообщения; AutomatedMessageCRUD.create_message
+и cancel_user_messages будят его сразу. Периодическая пересинхронизация с БД
+подхватывает строки, записанные другими процессами.
+"""
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.database.connection import AsyncSessionLocal
+from app.database.models import AutomatedMessage, AutomatedMessageStatus
+
+logger = logging.getLogger(__name__)
+
+
+def _to_timestamp(value: datetime) -> float:
+    """scheduled_at -> unix time (naive значения - локальное время, как datetime.now())"""
+    return value.timestamp()
+
+
+class AutomatedMessageScheduler:
+    """
+    Min-heap ближайших сообщений.
+
+    В куче только сообщения в пределах горизонта (resync_interval * 2), более
+    поздние подгружаются при очередной пересинхронизации. Отмененные сообщения
+    удаляются лениво: запись пропускается, если ее уже нет в _entries.
+    """
+
+    def __init__(self, resync_interval: float = 300.0):
+        self.resync_interval = resync_interval
+        self.horizon = timedelta(seconds=resync_interval * 2)
+
+        self._heap: List[Tuple[float, int]] = []  # (due_ts, message_id)
+        self._entries: Dict[int, Tuple[int, str]] = {}  # message_id -> (telegram_id, video_type)
+        self._wakeup = asyncio.Event()
+        self._running = False
+        self._next_resync = 0.0
+
+        # Счетчики
+        self.wakeups = 0
+        self.resyncs = 0
+
+    # ---- Хуки из AutomatedMessageCRUD ----
+
+    def notify_created(self, message: AutomatedMessage) -> None:
+        """Новое сообщение: попадает в кучу, если укладывается в горизонт"""
+        self.notify_scheduled(message.id, message.telegram_id, message.video_type, message.scheduled_at)
+
+    def notify_scheduled(self, message_id: int, telegram_id: int, video_type: str, scheduled_at: datetime) -> None:
+        if not self._running or not scheduled_at:
+            return
+        due = _to_timestamp(scheduled_at)
+        if due > time.time() + self.horizon.total_seconds():
+            return
+
+        self._push(message_id, telegram_id, video_type, due)
+        if self._heap[0][1] == message_id:
+            self._wakeup.set()
+
+    def notify_cancelled(self, telegram_id: int, video_types: Optional[List[str]] = None) -> None:
+        """Отмена сообщений пользователя (всех или указанных типов)"""
+        if not self._running:
+            return
+        cancelled = [
+            message_id for message_id, (entry_telegram_id, video_type) in self._entries.items()
+            if entry_telegram_id == telegram_id and (not video_types or video_type in video_types)
+        ]
+        for message_id in cancelled:
+            del self._entries[message_id]
+        if cancelled:
+            self._wakeup.set()
+
+    # ---- Куча ----
+
+    def _push(self, message_id: int, telegram_id: int, video_type: str, due: float) -> None:
+        if message_id in self._entries:
+            return
+        self._entries[message_id] = (telegram_id, video_type)
+        heapq.heappush(self._heap, (due, message_id))
+
+    def _next_due(self) -> Optional[float]:
+        """Время ближайшего живого сообщения (мертвые записи выбрасываются)"""
+        while self._heap and self._heap[0][1] not in self._entries:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def _pop_due(self, now: float) -> int:
+        """Снятие всех наступивших сообщений, возвращает их количество"""
+        count = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, message_id = heapq.heappop(self._heap)
+            if self._entries.pop(message_id, None) is not None:
+                count += 1
+        return count
+
+    async def resync(self) -> None:
+        """Перезагрузка кучи из БД (сообщения в пределах горизонта)"""
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(
+                    AutomatedMessage.id,
+                    AutomatedMessage.telegram_id,
+                    AutomatedMessage.video_type,
+                    AutomatedMessage.scheduled_at
+                )
+                .where(AutomatedMessage.status == AutomatedMessageStatus.SCHEDULED)
+                .where(AutomatedMessage.scheduled_at <= datetime.now() + self.horizon)
+            )
+            rows = result.all()
+
+        self._heap = []
+        self._entries = {}
+        for message_id, telegram_id, video_type, scheduled_at in rows:
+            self._push(message_id, telegram_id, video_type, _to_timestamp(scheduled_at))
+
+        self.resyncs += 1
+        self._next_resync = time.time() + self.resync_interval
+        logger.debug(f"Automated messages resync: {len(self._entries)} upcoming")
+
+    async def run(
+        self,
+        process_due: Callable[[], Awaitable[bool]],
+        on_resync: Optional[Callable[[], Awaitable[Any]]] = None
+    ) -> None:
+        """
+        Основной цикл
+
+        Args:
+            process_due: Обработка наступивших сообщений из БД; возвращает True,
+                если в БД остались наступившие сообщения (вызывается повторно)
+            on_resync: Обслуживание после каждой пересинхронизации (ошибки
+                только логируются)
+        """
+        self._running = True
+        logger.info(f"⏰ Automated messages scheduler started (resync every {self.resync_interval:.0f}s)")
+
+        while True:
+            try:
+                if time.time() >= self._next_resync:
+                    await self.resync()
+                    if on_resync is not None:
+                        try:
+                            await on_resync()
+                        except Exception as e:
+                            logger.error(f"Error in automated messages resync hook: {e}")
+
+                now = time.time()
+                next_due = self._next_due()
+
+                if next_due is not None and next_due <= now:
+                    self._pop_due(now)
+                    while await process_due():
+                        pass
+                    continue
+
+                deadline = self._next_resync if next_due is None else min(next_due, self._next_resync)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, deadline - now))
+                    self.wakeups += 1
+                except asyncio.TimeoutError:
+                    pass
+
+            except asyncio.CancelledError:
+                self._running = False
+                raise
+            except Exception as e:
+                logger.error(f"Error in automated messages scheduler: {e}")
+                await asyncio.sleep(5)
+
+    def stats(self) -> dict:
+        return {
+            'upcoming': len(self._entries),
+            'heap_size': len(self._heap),
+            'next_due_in': (self._next_due() - time.time()) if self._next_due() is not None else None,
+            'wakeups': self.wakeups,
+            'resyncs': self.resyncs,
+        }
+
+
+# Глобальный экземпляр (хуки CRUD - no-op, пока планировщик не запущен)
+automated_message_scheduler = AutomatedMessageScheduler(settings.AUTOMATED_MESSAGES_RESYNC_INTERVAL)
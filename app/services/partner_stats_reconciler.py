@@ -0,0 +1,84 @@
+"""
+Периодическая сверка partner_stats с clicks/sales
+app/services/partner_stats_reconciler.py
+
+Счетчики обновляются в транзакциях записи, но прямые правки в БД
+(ручные UPDATE, старые скрипты) могут их рассинхронизировать. Сверка
+пересчитывает счетчики из сырых таблиц, логирует и исправляет расхождения.
+"""
+import asyncio
+import logging
+from typing import List, Optional
+
+from app.config import settings
+from app.database.connection import AsyncSessionLocal
+from app.database.partner_stats_crud import PartnerStatsCRUD
+
+logger = logging.getLogger(__name__)
+
+
+class PartnerStatsReconciler:
+    """Фоновая сверка счетчиков партнеров раз в interval секунд"""
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.is_running = False
+        self.task: Optional[asyncio.Task] = None
+
+        # Счетчики
+        self.runs = 0
+        self.repaired = 0
+
+    async def reconcile_once(self) -> List[dict]:
+        """Одна сверка с исправлением, возвращает найденные расхождения"""
+        async with AsyncSessionLocal() as session:
+            drift = await PartnerStatsCRUD.reconcile(session, repair=True)
+
+        self.runs += 1
+        if drift:
+            ref_codes = {item["ref_code"] for item in drift}
+            self.repaired += len(ref_codes)
+            logger.warning(f"⚠️ partner_stats drift repaired for {len(ref_codes)} partner(s)")
+            for item in drift[:20]:
+                logger.warning(
+                    f"   {item['ref_code']}.{item['column']}: stored={item['stored']}, actual={item['actual']}"
+                )
+        else:
+            logger.debug("partner_stats reconciled: no drift")
+        return drift
+
+    async def _loop(self):
+        while self.is_running:
+            try:
+                await asyncio.sleep(self.interval)
+                await self.reconcile_once()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in partner stats reconciler: {e}")
+
+    async def start(self):
+        """Запустить сверку (no-op при interval = 0)"""
+        if self.is_running or self.interval <= 0:
+            return
+
+        self.is_running = True
+        self.task = asyncio.create_task(self._loop())
+        logger.info(f"✅ Partner stats reconciler started (every {self.interval}s)")
+
+    async def stop(self):
+        """Остановить сверку"""
+        if not self.is_running:
+            return
+
+        self.is_running = False
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
+# Глобальный экземпляр
+partner_stats_reconciler = PartnerStatsReconciler(settings.PARTNER_STATS_RECONCILE_INTERVAL)
@@ -0,0 +1,197 @@
+"""
+Локальное сопоставление вопросов поддержки (до запроса к DeepSeek)
+app/services/question_matcher.py
+
+Вопросы листа автоответов переводятся в TF-IDF векторы по символьным
+n-граммам (устойчивы к опечаткам и окончаниям) один раз на версию листа.
+Вопрос пользователя сравнивается со всеми сразу одним умножением матрицы
+на вектор (косинусная близость). Уверенное совпадение отвечается без API,
+иначе в DeepSeek уходят только top-k кандидатов вместо всего листа.
+
+Оценка порогов: evaluate_question_matcher.py
+"""
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+from app.services.answer_cache import normalize_question
+from app.utils.metrics import SUPPORT_PREMATCH_RESULTS
+
+logger = logging.getLogger(__name__)
+
+# Длины символьных n-грамм
+NGRAM_RANGE = (2, 4)
+
+# Отрицания: "Как не оплатить курс?" близок к "Как оплатить курс?" по n-граммам,
+# но это другой вопрос - уверенное совпадение требует одинаковой полярности
+NEGATIONS = frozenset({"не", "нет", "ни"})
+
+
+def char_ngrams(text: str, ngram_range: Tuple[int, int] = NGRAM_RANGE) -> List[str]:
+    """n-граммы слов с границами: 'как' -> ' к', 'ка', 'ак', 'к ', ' ка', ..."""
+    grams = []
+    for word in normalize_question(text).split():
+        word = f" {word} "
+        for n in range(ngram_range[0], ngram_range[1] + 1):
+            grams.extend(word[i:i + n] for i in range(len(word) - n + 1))
+    return grams
+
+
+def has_negation(text: str) -> bool:
+    return not NEGATIONS.isdisjoint(normalize_question(text).split())
+
+
+@dataclass
+class PreMatch:
+    """Результат локального сопоставления"""
+    candidates: List[Dict[str, str]]  # top-k пар, от лучшей к худшей
+    scores: List[float]
+    confident: bool
+
+    @property
+    def answer(self) -> Optional[str]:
+        """Ответ лучшей пары, если совпадение уверенное"""
+        return self.candidates[0]['answer'] if self.confident else None
+
+    @property
+    def best_score(self) -> float:
+        return self.scores[0] if self.scores else 0.0
+
+
+class QuestionMatcher:
+    """TF-IDF индекс вопросов одного листа"""
+
+    def __init__(self, qa_pairs: List[Dict[str, str]]):
+        self.qa_pairs = qa_pairs
+        documents = [char_ngrams(qa['question']) for qa in qa_pairs]
+
+        self.vocabulary: Dict[str, int] = {}
+        for grams in documents:
+            for gram in grams:
+                self.vocabulary.setdefault(gram, len(self.vocabulary))
+
+        counts = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, grams in enumerate(documents):
+            for gram in grams:
+                counts[row, self.vocabulary[gram]] += 1
+
+        # Сглаженный IDF: n-граммы, общие для многих вопросов ("как "), весят меньше
+        document_frequency = np.count_nonzero(counts, axis=0)
+        self.idf = (np.log((1 + len(documents)) / (1 + document_frequency)) + 1).astype(np.float32)
+        # Вес n-граммы, которой нет ни в одном вопросе листа (df = 0)
+        self.unseen_idf = float(np.log(1 + len(documents)) + 1)
+        self.matrix = self._normalize(np.log1p(counts) * self.idf)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def _vectorize(self, text: str) -> np.ndarray:
+        """
+        Нормированный вектор вопроса в словаре листа
+
+        n-граммы вне словаря в вектор не попадают, но входят в норму с
+        максимальным IDF: лишние слова ("Как НЕ оплатить курс?") снижают
+        близость, а не отбрасываются.
+        """
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        unseen: Dict[str, int] = {}
+        for gram in char_ngrams(text):
+            index = self.vocabulary.get(gram)
+            if index is not None:
+                vector[index] += 1
+            else:
+                unseen[gram] = unseen.get(gram, 0) + 1
+
+        vector = np.log1p(vector) * self.idf
+        unseen_weights = np.log1p(np.fromiter(unseen.values(), dtype=np.float32, count=len(unseen))) * self.unseen_idf
+        norm = np.sqrt(np.dot(vector, vector) + np.dot(unseen_weights, unseen_weights))
+        return vector / norm if norm else vector
+
+    def similarities(self, question: str) -> np.ndarray:
+        """Косинусная близость вопроса ко всем вопросам листа"""
+        if not self.qa_pairs:
+            return np.zeros(0, dtype=np.float32)
+        return self.matrix @ self._vectorize(question)
+
+    def match(self, question: str, top_k: int = 5, accept_score: float = 0.8, margin: float = 0.1) -> PreMatch:
+        """
+        top-k ближайших вопросов
+
+        Совпадение уверенное, если лучшая близость не ниже accept_score,
+        отрывается от второй хотя бы на margin (два похожих вопроса с
+        разными ответами решает модель) и отрицание есть либо в обоих
+        вопросах, либо ни в одном.
+        """
+        scores = self.similarities(question)
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        top_scores = [float(scores[i]) for i in order]
+
+        confident = bool(top_scores) and top_scores[0] >= accept_score
+        if confident and len(top_scores) > 1:
+            confident = top_scores[0] - top_scores[1] >= margin
+        if confident:
+            confident = has_negation(question) == has_negation(self.qa_pairs[order[0]]['question'])
+        return PreMatch(
+            candidates=[self.qa_pairs[i] for i in order],
+            scores=top_scores,
+            confident=confident
+        )
+
+
+class QuestionMatcherRegistry:
+    """Индексы по листам; перестраиваются при смене версии набора пар"""
+
+    def __init__(self, top_k: int = 5, accept_score: float = 0.8, margin: float = 0.1):
+        self.top_k = top_k
+        self.accept_score = accept_score
+        self.margin = margin
+        self._matchers: Dict[str, Tuple[int, QuestionMatcher]] = {}
+
+        # Счетчики
+        self.local_answers = 0
+        self.llm_fallbacks = 0
+
+    def get(self, sheet: str, qa_version: int, qa_pairs: List[Dict[str, str]]) -> QuestionMatcher:
+        entry = self._matchers.get(sheet)
+        if entry is None or entry[0] != qa_version or len(entry[1].qa_pairs) != len(qa_pairs):
+            entry = (qa_version, QuestionMatcher(qa_pairs))
+            self._matchers[sheet] = entry
+            logger.info(
+                f"🔎 Question matcher for '{sheet}' built: {len(qa_pairs)} questions, "
+                f"{len(entry[1].vocabulary)} n-grams"
+            )
+        return entry[1]
+
+    def match(self, sheet: str, qa_version: int, qa_pairs: List[Dict[str, str]], question: str) -> PreMatch:
+        result = self.get(sheet, qa_version, qa_pairs).match(
+            question, top_k=self.top_k, accept_score=self.accept_score, margin=self.margin
+        )
+        if result.confident:
+            self.local_answers += 1
+            SUPPORT_PREMATCH_RESULTS.labels("local").inc()
+        else:
+            self.llm_fallbacks += 1
+            SUPPORT_PREMATCH_RESULTS.labels("llm").inc()
+        return result
+
+    def stats(self) -> dict:
+        total = self.local_answers + self.llm_fallbacks
+        return {
+            'sheets': len(self._matchers),
+            'local_answers': self.local_answers,
+            'llm_fallbacks': self.llm_fallbacks,
+            'local_rate': self.local_answers / total if total else 0.0,
+        }
+
+
+# Глобальный экземпляр
+question_matchers = QuestionMatcherRegistry(
+    top_k=settings.SUPPORT_MATCH_TOP_K,
+    accept_score=settings.SUPPORT_MATCH_ACCEPT_SCORE,
+    margin=settings.SUPPORT_MATCH_MARGIN
+)
@@ -0,0 +1,164 @@
+"""
+Потоковая выгрузка CSV-отчетов
+app/services/report_exporter.py
+
+Строки читаются серверным курсором пачками и сразу пишутся в
+SpooledTemporaryFile (в памяти до REPORT_SPOOL_MAX_SIZE, дальше - на диск),
+при необходимости внутри zip-архива. Память не зависит от числа строк.
+Разделы отчета (покупатели, лиды, партнеры, партнеры без команды) описаны
+один раз и общие для всех отчетов.
+"""
+import codecs
+import csv
+import logging
+import tempfile
+import zipfile
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncGenerator, Callable, List, Optional
+
+from aiogram.types import InputFile
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database.statistics_crud import (
+    StatisticsCRUD,
+    buyer_rows_query,
+    lead_rows_query,
+    partner_rows_query,
+    partner_without_team_rows_query,
+)
+
+logger = logging.getLogger(__name__)
+
+CSV_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _timestamp(value: Optional[datetime]) -> str:
+    return value.strftime(CSV_TIMESTAMP_FORMAT) if value else ""
+
+
+@dataclass(frozen=True)
+class ReportSection:
+    """Раздел CSV: категория, запрос строк и преобразование строки в колонки"""
+    category: str
+    query: Callable[[Optional[datetime], Optional[datetime]], Select]
+    # Row -> [Имя, Username, Telegram ID, Сумма, Время, Стадия]
+    to_columns: Callable[[object], list]
+
+
+def _buyer_columns(row) -> list:
+    return [row.full_name, row.username or "", row.telegram_id, row.amount, _timestamp(row.purchased_at), "Paid"]
+
+
+def _lead_columns(row) -> list:
+    return [row.full_name, row.username or "", row.telegram_id, "", _timestamp(row.created_at), row.onboarding_stage]
+
+
+def _partner_columns(row) -> list:
+    return [
+        row.full_name, row.username or "", row.telegram_id, "",
+        _timestamp(row.stage_completed_at), row.onboarding_stage
+    ]
+
+
+def _partner_without_team_columns(row) -> list:
+    return [
+        row.full_name, row.username or "", row.telegram_id, "",
+        _timestamp(row.stage_payment_ok_at), row.onboarding_stage
+    ]
+
+
+def report_sections(lead_category: str = "Новый лид", partner_category: str = "Новый партнер") -> List[ReportSection]:
+    return [
+        ReportSection("Покупатель", buyer_rows_query, _buyer_columns),
+        ReportSection(lead_category, lead_rows_query, _lead_columns),
+        ReportSection(partner_category, partner_rows_query, _partner_columns),
+        ReportSection("Партнер без команды", partner_without_team_rows_query, _partner_without_team_columns),
+    ]
+
+
+# Разделы отчетов за день/период и за всё время
+PERIOD_SECTIONS = report_sections()
+ALL_TIME_SECTIONS = report_sections(lead_category="Лид", partner_category="Партнер")
+
+
+class SpooledInputFile(InputFile):
+    """Загрузка в Telegram из файлового объекта кусками, без копии в bytes"""
+
+    def __init__(self, file, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, *args) -> AsyncGenerator[bytes, None]:
+        # Аргумент - bot (aiogram >= 3.4) или chunk_size (более ранние 3.x), не нужен
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ReportExporter:
+    """Выгрузка разделов отчета в CSV (utf-8-sig для корректного отображения в Excel)"""
+
+    def __init__(
+        self,
+        batch_size: Optional[int] = None,
+        spool_max_size: Optional[int] = None,
+        compress: Optional[bool] = None
+    ):
+        self.batch_size = batch_size or settings.REPORT_EXPORT_BATCH_SIZE
+        self.spool_max_size = spool_max_size or settings.REPORT_SPOOL_MAX_SIZE
+        self.compress = settings.REPORT_CSV_ZIP if compress is None else compress
+
+    async def export(
+        self,
+        session: AsyncSession,
+        sections: List[ReportSection],
+        filename: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        time_header: str = "Дата/Время"
+    ) -> SpooledInputFile:
+        """
+        CSV с разделами за [start, end) (None - без ограничения)
+
+        Returns:
+            Файл для answer_document/send_document; после отправки нужно вызвать close()
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size, mode="w+b")
+        archive = None
+        try:
+            if self.compress:
+                archive = zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_DEFLATED)
+                binary = archive.open(filename, "w")
+            else:
+                binary = spool
+
+            binary.write(codecs.BOM_UTF8)
+            writer = csv.writer(codecs.getwriter("utf-8")(binary))
+            writer.writerow(["Категория", "Имя", "Username", "Telegram ID", "Сумма", time_header, "Стадия"])
+
+            rows = 0
+            for section in sections:
+                async for batch in StatisticsCRUD.stream_rows(session, section.query(start, end), self.batch_size):
+                    writer.writerows([section.category, *section.to_columns(row)] for row in batch)
+                    rows += len(batch)
+
+            if archive is not None:
+                binary.close()
+                archive.close()
+                filename += ".zip"
+        except Exception:
+            spool.close()
+            raise
+
+        logger.info(f"📄 Report {filename} exported: {rows} rows, {spool.tell()} bytes")
+        return SpooledInputFile(spool, filename=filename)
+
+
+# Глобальный экземпляр
+report_exporter = ReportExporter()
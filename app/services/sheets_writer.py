@@ -0,0 +1,342 @@
+"""
+Отложенная (write-behind) запись строк в Google Sheets
+app/services/sheets_writer.py
+
+gspread синхронный: каждый вызов API - сетевой запрос на сотни мс. Все
+вызовы выполняются в одном фоновом потоке (run_in_sheets_thread), а строки
+копятся в очереди и уходят пачкой одним append_rows. Очередь сохраняется в
+локальный файл при каждом изменении, поэтому рестарт не теряет строки.
+Файл очереди принадлежит одному процессу (flock на <queue_file>.lock):
+каждый процесс перезаписывает файл целиком своим списком строк. Процесс,
+не получивший блокировку, пишет в <queue_file>.<pid>; такие файлы умерших
+процессов забирает в свою очередь владелец основного файла при загрузке.
+При 429 (квота Sheets API в минуту) и 5xx пачка повторяется с
+экспоненциальной задержкой.
+"""
+import asyncio
+import fcntl
+import functools
+import glob
+import json
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# gspread не потокобезопасен: все вызовы API - в одном потоке, по очереди
+sheets_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets")
+
+# Коды ответа, после которых запрос имеет смысл повторить
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Начальная задержка повтора (сек), удваивается до max_backoff
+INITIAL_BACKOFF = 1.0
+
+
+async def run_in_sheets_thread(func: Callable, *args, **kwargs) -> Any:
+    """Вызов gspread в потоке Sheets, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(sheets_executor, functools.partial(func, *args, **kwargs))
+
+
+def role_queue_file(queue_file: str, role: str) -> str:
+    """Файл очереди процесса: data/queue.json + "web" -> data/queue.web.json"""
+    if not role:
+        return queue_file
+    base, ext = os.path.splitext(queue_file)
+    return f"{base}.{role}{ext}"
+
+
+def is_retryable(error: Exception) -> bool:
+    """429/5xx и сетевые ошибки без ответа - повторяем, остальные 4xx - нет"""
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if status_code is None:
+        return True
+    return status_code in RETRYABLE_STATUS_CODES
+
+
+class SheetsWriter:
+    """
+    Очередь строк для одного листа.
+
+    Строки пишутся в порядке постановки. Пачка удаляется из очереди только
+    после успешного append_rows; неповторяемая ошибка (400, 403) переносит
+    пачку в файл <queue_file>.failed, чтобы не блокировать очередь.
+    Доставка "хотя бы один раз": если процесс упадет между append_rows и
+    сохранением очереди, пачка запишется повторно.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        queue_file: str,
+        batch_size: int = 100,
+        flush_interval: float = 2.0,
+        max_backoff: float = 64.0,
+        after_flush: Optional[Callable[[List[list], Any], Awaitable[None]]] = None
+    ):
+        """
+        Args:
+            name: Имя очереди для логов
+            queue_file: Файл с незаписанными строками (JSON)
+            batch_size: Максимум строк в одном append_rows
+            flush_interval: Как долго копить строки перед записью (сек)
+            max_backoff: Максимальная задержка повтора (сек)
+            after_flush: Корутина после записи пачки: (строки, ответ append_rows)
+        """
+        self.name = name
+        self.queue_file = queue_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.after_flush = after_flush
+
+        self.worksheet = None
+        self._pending: List[list] = []
+        self._loaded = False
+        self._lock_file = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.is_running = False
+
+        # Счетчики
+        self.written = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0
+
+    def bind(self, worksheet) -> None:
+        """Лист для записи (gspread.Worksheet или FakeWorksheet)"""
+        self.worksheet = worksheet
+        self._wakeup.set()
+
+    def append(self, row: list) -> None:
+        """Постановка строки в очередь (без ожидания, сохраняется на диск)"""
+        self._ensure_loaded()
+        self._pending.append(row)
+        self._persist()
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        """Загрузка сохраненной очереди и запуск фоновой записи"""
+        if self.is_running:
+            return
+        self._ensure_loaded()
+        self.is_running = True
+        self._task = asyncio.create_task(self._run(), name=f"sheets-writer-{self.name}")
+        logger.info(f"✅ Sheets writer '{self.name}' started (batch {self.batch_size}, {self.flush_interval}s)")
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Остановка: последняя попытка записать очередь, остаток остается в файле"""
+        if not self.is_running:
+            return
+        self.is_running = False
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Sheets queue '{self.name}' not flushed in {timeout}s")
+        self._task = None
+        if self._pending:
+            logger.warning(f"⚠️ Sheets queue '{self.name}': {len(self._pending)} rows saved to {self.queue_file}")
+
+    async def flush(self) -> int:
+        """
+        Запись всех строк очереди пачками
+
+        Returns:
+            Количество записанных строк
+        """
+        self._ensure_loaded()
+        written = 0
+        while self._pending and self.worksheet is not None:
+            batch = self._pending[:self.batch_size]
+            await self._write_batch(batch)
+            del self._pending[:len(batch)]
+            self._persist()
+            written += len(batch)
+        return written
+
+    async def _run(self) -> None:
+        backoff = INITIAL_BACKOFF
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+                backoff = INITIAL_BACKOFF
+            except Exception as e:
+                if not self.is_running:
+                    return
+                self.retries += 1
+                # Полный джиттер: параллельные процессы не бьют в квоту одновременно
+                delay = random.uniform(0, backoff)
+                logger.warning(f"⚠️ Sheets write '{self.name}' failed, retry in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+                self._wakeup.set()
+                continue
+
+            if not self.is_running:
+                return
+
+    async def _write_batch(self, batch: List[list]) -> None:
+        try:
+            response = await run_in_sheets_thread(
+                self.worksheet.append_rows, batch, value_input_option="USER_ENTERED"
+            )
+        except Exception as e:
+            if is_retryable(e):
+                raise
+            self.failed += len(batch)
+            self._dead_letter(batch)
+            logger.error(f"❌ Sheets rejected {len(batch)} rows for '{self.name}', moved to {self.queue_file}.failed: {e}")
+            return
+
+        self.written += len(batch)
+        self.batches += 1
+        logger.info(f"📊 Sheets '{self.name}': {len(batch)} rows appended")
+
+        if self.after_flush:
+            try:
+                await self.after_flush(batch, response)
+            except Exception as e:
+                logger.error(f"❌ Sheets post-write hook failed for '{self.name}': {e}")
+
+    # ---- Локальная копия очереди ----
+
+    def _persist(self) -> None:
+        """Атомарная перезапись файла очереди"""
+        try:
+            if not self._pending:
+                if os.path.exists(self.queue_file):
+                    os.remove(self.queue_file)
+                return
+            tmp_path = f"{self.queue_file}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._pending, f, ensure_ascii=False)
+            os.replace(tmp_path, self.queue_file)
+        except OSError as e:
+            logger.error(f"❌ Failed to persist sheets queue '{self.name}': {e}")
+
+    def _ensure_loaded(self) -> None:
+        """Строки, не записанные до рестарта, - в начало очереди (один раз)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        owns_queue = self._lock_queue_file()
+
+        restored = self._read_queue(self.queue_file) or []
+        orphaned = []
+        if owns_queue:
+            for path in self._orphaned_queue_files():
+                rows = self._read_queue(path)
+                if rows is not None:
+                    restored.extend(rows)
+                    orphaned.append(path)
+        if not restored:
+            return
+
+        self._pending = restored + self._pending
+        if orphaned:
+            # Сначала сохраняем объединенную очередь, потом удаляем файлы-сироты
+            self._persist()
+            for path in orphaned:
+                for leftover in (path, f"{path}.lock"):
+                    try:
+                        os.remove(leftover)
+                    except OSError:
+                        pass
+            logger.info(f"📥 Sheets queue '{self.name}': merged {len(orphaned)} queue file(s) of stopped processes")
+        logger.info(f"📥 Sheets queue '{self.name}': {len(restored)} unsent rows restored")
+
+    def _read_queue(self, path: str) -> Optional[List[list]]:
+        """Строки из файла очереди ([] если файла нет, None если он не читается)"""
+        if not os.path.exists(path):
+            return []
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Failed to load sheets queue {path}: {e}")
+            return None
+
+    def _lock_queue_file(self) -> bool:
+        """
+        Эксклюзивная блокировка файла очереди на время жизни процесса
+
+        Если файл уже занят (два процесса с одинаковым PROCESS_ROLE), очередь
+        переходит в файл с pid (тоже под блокировкой), чтобы процессы не
+        затирали строки друг друга.
+
+        Returns:
+            True если процесс владеет основным файлом очереди
+        """
+        try:
+            directory = os.path.dirname(self.queue_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._lock_file = open(f"{self.queue_file}.lock", "w")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            self._lock_file.close()
+            fallback = f"{self.queue_file}.{os.getpid()}"
+            logger.error(
+                f"❌ Sheets queue {self.queue_file} is used by another process (same PROCESS_ROLE?), "
+                f"'{self.name}' rows go to {fallback}"
+            )
+            self.queue_file = fallback
+            try:
+                self._lock_file = open(f"{fallback}.lock", "w")
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                logger.error(f"❌ Failed to lock sheets queue {fallback}: {e}")
+            return False
+        except OSError as e:
+            logger.error(f"❌ Failed to lock sheets queue {self.queue_file}: {e}")
+            return False
+
+    def _orphaned_queue_files(self) -> List[str]:
+        """Файлы <queue_file>.<pid>, чьи процессы больше не держат блокировку"""
+        orphaned = []
+        for path in sorted(glob.glob(f"{glob.escape(self.queue_file)}.*")):
+            if not path[len(self.queue_file) + 1:].isdigit():
+                continue
+            try:
+                with open(f"{path}.lock", "w") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Процесс с этой очередью еще работает
+                continue
+            except OSError as e:
+                logger.error(f"❌ Failed to check sheets queue {path}: {e}")
+                continue
+            orphaned.append(path)
+        return orphaned
+
+    def _dead_letter(self, batch: List[list]) -> None:
+        try:
+            with open(f"{self.queue_file}.failed", "a", encoding="utf-8") as f:
+                for row in batch:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error(f"❌ Failed to save rejected rows for '{self.name}': {e}")
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'written': self.written,
+            'batches': self.batches,
+            'retries': self.retries,
+            'failed': self.failed,
+        }
@@ -2,15 +2,19 @@
 Сервис для логирования чата поддержки в Google Sheets
 app/services/support_chat_logger.py
 """
+import asyncio
+import json
 import logging
+import random
 from datetime import datetime
 import pytz
-from typing import Optional
+from typing import Dict, List, Optional
 import gspread
 from google.oauth2.service_account import Credentials
 import os
 
 from app.config import settings
+from app.services.sheets_writer import INITIAL_BACKOFF, is_retryable, role_queue_file, run_in_sheets_thread
 
 logger = logging.getLogger(__name__)
 
@@ -18,8 +22,30 @@ logger = logging.getLogger(__name__)
 MSK_TZ = pytz.timezone('Europe/Moscow')
 
 
+# Колонки листа "Чат админов"
+CHAT_HEADERS = [
+    "Telegram ID",
+    "Дата",
+    "Время обновления",
+    "Пол админа",
+    "Переписка"
+]
+
+
 class SupportChatLogger:
-    def __init__(self):
+    """
+    Лист "Чат админов": одна строка на пользователя, переписка дописывается.
+
+    Лист читается один раз при подключении: карта telegram_id -> номер
+    строки и текущий текст переписки хранятся в памяти и обновляются при
+    каждой записи. save_chat_to_sheets только ставит переписку в очередь,
+    фоновая задача раз в SUPPORT_CHAT_FLUSH_INTERVAL пишет все изменения
+    одним batch_update (и одним append_rows для новых пользователей) в
+    потоке Sheets. Переписки, которые Sheets отклонил (400, 403), строками
+    листа дописываются в failed_file (JSON Lines), как в SheetsWriter.
+    """
+
+    def __init__(self, flush_interval: float = 5.0, failed_file: Optional[str] = None):
         self.scope = [
             'https://spreadsheets.google.com/feeds',
             'https://www.googleapis.com/auth/drive'
@@ -29,9 +55,27 @@ class SupportChatLogger:
         self.spreadsheet = None
         self.worksheet = None
         self.chat_buffer = {}  # user_id -> list of messages
+        self.flush_interval = flush_interval
+        self.failed_file = failed_file or role_queue_file(settings.SUPPORT_CHAT_FAILED_FILE, settings.PROCESS_ROLE)
+        
+        self._row_by_telegram_id: Dict[str, int] = {}
+        self._chat_by_telegram_id: Dict[str, str] = {}  # текст колонки "Переписка"
+        self._next_row = 2
+        self._pending: Dict[int, dict] = {}  # user_id -> переписка к записи
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.is_running = False
+        
+        # Счетчики
+        self.flushes = 0
+        self.saved_chats = 0
+        self.failed_flushes = 0
+        self.failed_chats = 0
         
     async def init(self):
         """Инициализация подключения к Google Sheets для листа 'Чат админов'"""
+        if self.worksheet is not None:
+            return True
         try:
             # Путь к файлу ключей
             key_file_path = os.path.join(os.getcwd(), settings.GOOGLE_SHEETS_KEY)
@@ -40,54 +84,8 @@ class SupportChatLogger:
                 logger.error(f"❌ Google Sheets key file not found: {key_file_path}")
                 return False
             
-            # Создаем credentials
-            self.creds = Credentials.from_service_account_file(
-                key_file_path, 
-                scopes=self.scope
-            )
-            
-            # Авторизуемся
-            self.client = gspread.authorize(self.creds)
-            
-            # Открываем таблицу
-            self.spreadsheet = self.client.open_by_key(settings.SPREADSHEET_ID)
-            
-            # Получаем или создаем лист "Чат админов"
-            try:
-                self.worksheet = self.spreadsheet.worksheet("Чат админов")
-                logger.info("✅ Found existing 'Чат админов' worksheet")
-                
-                # Проверяем наличие заголовков
-                first_row = self.worksheet.row_values(1)
-                if not first_row or first_row[0] != "Telegram ID":
-                    logger.info("📝 Adding headers to existing worksheet")
-                    headers = [
-                        "Telegram ID",
-                        "Дата",
-                        "Время обновления",
-                        "Пол админа",
-                        "Переписка"
-                    ]
-                    self.worksheet.insert_row(headers, 1)
-                    
-            except gspread.WorksheetNotFound:
-                logger.info("📝 Creating new 'Чат админов' worksheet")
-                self.worksheet = self.spreadsheet.add_worksheet(
-                    title="Чат админов", 
-                    rows="1000", 
-                    cols="5"
-                )
-                
-                # Добавляем заголовки
-                headers = [
-                    "Telegram ID",
-                    "Дата",
-                    "Время обновления",
-                    "Пол админа",
-                    "Переписка"
-                ]
-                self.worksheet.append_row(headers)
-                logger.info("✅ Headers added to 'Чат админов' worksheet")
+            worksheet = await run_in_sheets_thread(self._open_worksheet_sync, key_file_path)
+            await self.bind_worksheet(worksheet)
             
             logger.info("✅ Support Chat Logger initialized")
             return True
@@ -95,6 +93,64 @@ class SupportChatLogger:
         except Exception as e:
             logger.error(f"❌ Error initializing Support Chat Logger: {e}")
             return False
+
+    def _open_worksheet_sync(self, key_file_path: str):
+        """Авторизация и получение листа "Чат админов" (в потоке Sheets)"""
+        # Создаем credentials
+        self.creds = Credentials.from_service_account_file(
+            key_file_path, 
+            scopes=self.scope
+        )
+        
+        # Авторизуемся
+        self.client = gspread.authorize(self.creds)
+        
+        # Открываем таблицу
+        self.spreadsheet = self.client.open_by_key(settings.SPREADSHEET_ID)
+        
+        # Получаем или создаем лист "Чат админов"
+        try:
+            worksheet = self.spreadsheet.worksheet("Чат админов")
+            logger.info("✅ Found existing 'Чат админов' worksheet")
+            
+            # Проверяем наличие заголовков
+            first_row = worksheet.row_values(1)
+            if not first_row or first_row[0] != "Telegram ID":
+                logger.info("📝 Adding headers to existing worksheet")
+                worksheet.insert_row(CHAT_HEADERS, 1)
+                
+        except gspread.WorksheetNotFound:
+            logger.info("📝 Creating new 'Чат админов' worksheet")
+            worksheet = self.spreadsheet.add_worksheet(
+                title="Чат админов", 
+                rows="1000", 
+                cols="5"
+            )
+            
+            # Добавляем заголовки
+            worksheet.append_row(CHAT_HEADERS)
+            logger.info("✅ Headers added to 'Чат админов' worksheet")
+        return worksheet
+
+    async def bind_worksheet(self, worksheet):
+        """Подключение листа (gspread.Worksheet или FakeWorksheet): загрузка строк и запуск записи"""
+        await run_in_sheets_thread(self._load_rows_sync, worksheet)
+        self.worksheet = worksheet
+        await self.start()
+
+    def _load_rows_sync(self, worksheet):
+        """Карта строк и текущие переписки - одним чтением листа (в потоке Sheets)"""
+        values = worksheet.get_all_values()
+        self._row_by_telegram_id = {}
+        self._chat_by_telegram_id = {}
+        for row_number, row in enumerate(values[1:], start=2):  # строка 1 - заголовки
+            telegram_id = str(row[0]).strip() if row else ""
+            if not telegram_id or telegram_id in self._row_by_telegram_id:
+                continue
+            self._row_by_telegram_id[telegram_id] = row_number
+            self._chat_by_telegram_id[telegram_id] = row[4] if len(row) > 4 else ""
+        self._next_row = len(values) + 1
+        logger.info(f"💬 Support chat rows loaded: {len(self._row_by_telegram_id)} users")
     
     def add_message_to_buffer(self, user_id: int, sender: str, text: str, gender: str):
         """Добавление сообщения в буфер с временной меткой"""
@@ -111,27 +167,16 @@ class SupportChatLogger:
         # Добавляем сообщение с временной меткой
         self.chat_buffer[user_id]['messages'].append(f"[{time_str}]\n{sender}: {text}")
     
-    async def find_user_row(self, user_id: int) -> Optional[int]:
-        """Найти строку пользователя в таблице по Telegram ID"""
-        try:
-            # Получаем все значения из первого столбца (Telegram ID)
-            all_values = self.worksheet.col_values(1)
-            
-            # Ищем строку с нужным user_id (начинаем с индекса 2, т.к. 1 - заголовок)
-            for idx, value in enumerate(all_values[1:], start=2):
-                if str(value).strip() == str(user_id):
-                    logger.info(f"📍 Found existing row {idx} for user {user_id}")
-                    return idx
-            
-            logger.info(f"📍 No existing row found for user {user_id}")
-            return None
-            
-        except Exception as e:
-            logger.error(f"❌ Error finding user row: {e}")
-            return None
+    def find_user_row(self, user_id: int) -> Optional[int]:
+        """Строка пользователя в таблице по Telegram ID (из карты в памяти)"""
+        return self._row_by_telegram_id.get(str(user_id))
     
     async def save_chat_to_sheets(self, user_id: int, user_name: str, gender: str):
-        """Сохранение накопленной переписки в Google Sheets (обновление или создание)"""
+        """
+        Постановка накопленной переписки в очередь записи
+
+        В таблицу переписка попадает при ближайшей записи очереди (flush).
+        """
         try:
             if not self.worksheet:
                 logger.error("❌ Support Chat Logger not initialized")
@@ -144,71 +189,195 @@ class SupportChatLogger:
             
             # Получаем текущее время в МСК
             now_msk = datetime.now(MSK_TZ)
-            date_str = now_msk.strftime("%d.%m.%Y")
-            time_str = now_msk.strftime("%H:%M МСК")
-            
-            # Форматируем пол
-            gender_text = "для мужчин" if gender == 'male' else "для женщин"
             
             # Собираем НОВЫЕ сообщения из буфера
             new_messages = "\n\n".join(self.chat_buffer[user_id]['messages'])
             
-            # Ищем существующую строку пользователя
-            user_row = await self.find_user_row(user_id)
-            
-            if user_row:
-                # ОБНОВЛЯЕМ существующую строку
-                logger.info(f"🔄 Updating existing row {user_row} for user {user_id}")
-                
-                # Получаем старую переписку из ячейки E (столбец 5)
-                old_chat = self.worksheet.cell(user_row, 5).value or ""
-                
-                # Добавляем новые сообщения к старым
-                if old_chat and "Пользователь:" in old_chat:
-                    # Если уже есть заголовок "Пользователь:", просто добавляем сообщения
-                    updated_chat = f"{old_chat}\n\n{new_messages}"
-                else:
-                    # Если заголовка нет, добавляем
-                    updated_chat = f"Пользователь: {user_name}\n\n{new_messages}"
-                
-                # Обновляем ячейки (столбцы: B=2, C=3, D=4, E=5)
-                self.worksheet.update_cell(user_row, 2, date_str)           # Дата
-                self.worksheet.update_cell(user_row, 3, time_str)           # Время обновления
-                self.worksheet.update_cell(user_row, 4, gender_text)        # Пол админа
-                self.worksheet.update_cell(user_row, 5, updated_chat)       # Переписка
-                
-                logger.info(f"✅ Updated row {user_row} for user {user_id}")
-                
-            else:
-                # СОЗДАЕМ новую строку
-                logger.info(f"➕ Creating new row for user {user_id}")
-                
-                full_chat = f"Пользователь: {user_name}\n\n{new_messages}"
-                
-                row_data = [
-                    user_id,           # Telegram ID
-                    date_str,          # Дата
-                    time_str,          # Время обновления
-                    gender_text,       # Пол админа
-                    full_chat          # Переписка
-                ]
-                
-                self.worksheet.append_row(row_data)
-                logger.info(f"✅ Created new row for user {user_id}")
+            pending = self._pending.get(user_id)
+            if pending:
+                new_messages = f"{pending['messages']}\n\n{new_messages}"
+            self._pending[user_id] = {
+                'user_name': user_name,
+                'date': now_msk.strftime("%d.%m.%Y"),
+                'time': now_msk.strftime("%H:%M МСК"),
+                'gender_text': "для мужчин" if gender == 'male' else "для женщин",
+                'messages': new_messages
+            }
             
             # Очищаем буфер для этого пользователя
             self.chat_buffer[user_id]['messages'].clear()
             
-            logger.info(f"✅ Chat saved to Google Sheets for user {user_id}")
+            logger.info(f"💬 Chat queued for Google Sheets for user {user_id}")
             return True
             
         except Exception as e:
             logger.error(f"❌ Error saving chat to sheets: {e}", exc_info=True)
             return False
 
+    # ---- Фоновая запись ----
+
+    async def start(self):
+        """Запуск периодической записи очереди"""
+        if self.is_running:
+            return
+        self.is_running = True
+        self._stop.clear()
+        self._task = asyncio.create_task(self._run(), name="support-chat-flusher")
+        logger.info(f"✅ Support chat flusher started ({self.flush_interval}s)")
+
+    async def close(self, timeout: float = 10.0):
+        """Остановка с записью оставшихся переписок"""
+        if not self.is_running:
+            return
+        self.is_running = False
+        self._stop.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Support chats not saved in {timeout}s")
+        self._task = None
+        if self._pending:
+            logger.warning(f"⚠️ Support chats lost on shutdown: {list(self._pending)}")
+
+    async def _run(self):
+        backoff = INITIAL_BACKOFF
+        while True:
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+                backoff = INITIAL_BACKOFF
+            except Exception as e:
+                self.failed_flushes += 1
+                # Полный джиттер, как в SheetsWriter; при остановке повторы ограничены таймаутом close()
+                delay = random.uniform(0, backoff)
+                logger.warning(f"⚠️ Support chat flush failed, retry in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, settings.SHEETS_MAX_BACKOFF)
+                continue
+            if not self.is_running:
+                return
+
+    async def flush(self) -> int:
+        """
+        Запись очереди: существующие строки - одним batch_update,
+        новые пользователи - одним append_rows
+
+        Returns:
+            Количество записанных переписок
+        """
+        if not self._pending or self.worksheet is None:
+            return 0
+        pending, self._pending = self._pending, {}
+
+        # user_id -> строка листа [Telegram ID, Дата, Время, Пол админа, Переписка]
+        updates: Dict[int, list] = {}
+        new_rows: Dict[int, list] = {}
+        for user_id, chat in pending.items():
+            key = str(user_id)
+            row_number = self._row_by_telegram_id.get(key)
+            old_chat = self._chat_by_telegram_id.get(key, "")
+            
+            # Добавляем новые сообщения к старым
+            if row_number and old_chat and "Пользователь:" in old_chat:
+                # Если уже есть заголовок "Пользователь:", просто добавляем сообщения
+                full_chat = f"{old_chat}\n\n{chat['messages']}"
+            else:
+                # Если заголовка нет, добавляем
+                full_chat = f"Пользователь: {chat['user_name']}\n\n{chat['messages']}"
+
+            values = [user_id, chat['date'], chat['time'], chat['gender_text'], full_chat]
+            if row_number:
+                updates[user_id] = values
+            else:
+                new_rows[user_id] = values
+
+        # Каждый шаг фиксируется сразу после записи: при ошибке следующего
+        # в очередь возвращаются только незаписанные переписки
+        steps = [(rows, write) for rows, write in ((updates, self._update_rows), (new_rows, self._append_rows)) if rows]
+        saved = 0
+        for index, (rows, write) in enumerate(steps):
+            try:
+                await write(rows)
+            except Exception as e:
+                if is_retryable(e):
+                    self._requeue({user_id: pending[user_id] for rows, _ in steps[index:] for user_id in rows})
+                    raise
+                self._dead_letter(rows, e)
+                continue
+            for user_id, values in rows.items():
+                self._chat_by_telegram_id[str(user_id)] = values[-1]
+            saved += len(rows)
+
+        self.flushes += 1
+        self.saved_chats += saved
+        logger.info(f"✅ Support chats saved to Google Sheets: {len(updates)} updated, {len(new_rows)} new")
+        return saved
+
+    async def _update_rows(self, rows: Dict[int, list]) -> None:
+        """Существующие строки - одним batch_update"""
+        updates = []
+        for user_id, values in rows.items():
+            row_number = self._row_by_telegram_id[str(user_id)]
+            # Столбцы: B - Дата, C - Время обновления, D - Пол админа, E - Переписка
+            updates.append({"range": f"B{row_number}:E{row_number}", "values": [values[1:]]})
+        await run_in_sheets_thread(self.worksheet.batch_update, updates)
+
+    async def _append_rows(self, rows: Dict[int, list]) -> None:
+        """Новые пользователи - одним append_rows"""
+        new_rows = list(rows.values())
+        response = await run_in_sheets_thread(self.worksheet.append_rows, new_rows)
+        self._index_appended_rows(new_rows, response)
+
+    def _requeue(self, pending: Dict[int, dict]) -> None:
+        """Возврат переписок в очередь; более новые сообщения - после"""
+        for user_id, chat in pending.items():
+            newer = self._pending.get(user_id)
+            if newer:
+                chat = dict(newer, messages=f"{chat['messages']}\n\n{newer['messages']}")
+            self._pending[user_id] = chat
+
+    def _dead_letter(self, rows: Dict[int, list], error: Exception) -> None:
+        """Отклоненные переписки - строками листа в failed_file"""
+        self.failed_chats += len(rows)
+        logger.error(f"❌ Sheets rejected support chats for {list(rows)}, moved to {self.failed_file}: {error}")
+        try:
+            directory = os.path.dirname(self.failed_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.failed_file, "a", encoding="utf-8") as f:
+                for values in rows.values():
+                    f.write(json.dumps(values, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error(f"❌ Failed to save rejected support chats: {e}")
+
+    def _index_appended_rows(self, rows: List[list], response) -> None:
+        """Номера добавленных строк - из updatedRange ответа append_rows"""
+        first_row = self._next_row
+        try:
+            start = response["updates"]["updatedRange"].split("!")[-1].split(":")[0]
+            first_row = int("".join(ch for ch in start if ch.isdigit()))
+        except (TypeError, KeyError, ValueError):
+            pass
+        for offset, row in enumerate(rows):
+            self._row_by_telegram_id[str(row[0])] = first_row + offset
+        self._next_row = first_row + len(rows)
+
+    def stats(self) -> dict:
+        return {
+            'rows': len(self._row_by_telegram_id),
+            'pending': len(self._pending),
+            'flushes': self.flushes,
+            'saved_chats': self.saved_chats,
+            'failed_flushes': self.failed_flushes,
+            'failed_chats': self.failed_chats,
+        }
+
 
 # Глобальный экземпляр сервиса
-support_chat_logger = SupportChatLogger()
+support_chat_logger = SupportChatLogger(flush_interval=settings.SUPPORT_CHAT_FLUSH_INTERVAL)
 
 
 async def init_support_chat_logger():
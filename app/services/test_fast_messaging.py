@@ -19,6 +19,7 @@ from app.config import settings
 from app.database.connection import AsyncSessionLocal
 from app.database.crud import UserCRUD, AutomatedMessageCRUD
 from app.database.models import OnboardingStage
+from app.database.user_cache import user_state_cache
 
 logger = logging.getLogger(__name__)
 
@@ -279,6 +280,7 @@ async def test_stage_update_with_fast_messaging(
         .values(onboarding_stage=new_stage)
     )
     await session.commit()
+    user_state_cache.update(telegram_id, onboarding_stage=new_stage)
     
     if result.rowcount > 0:
         # Планируем УСКОРЕННЫЕ сообщения
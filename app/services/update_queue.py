@@ -0,0 +1,138 @@
+"""
+Очередь входящих Telegram-обновлений для webhook-режима
+app/services/update_queue.py
+
+Webhook-эндпоинт сразу отвечает Telegram и кладет апдейт в ограниченную очередь,
+а пул воркеров передает апдейты в Dispatcher.feed_update.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue:
+    """Ограниченная очередь апдейтов с дедупликацией по update_id и пулом воркеров"""
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        max_size: int = 10000,
+        workers: int = 8,
+        dedup_window: int = 50000
+    ):
+        """
+        Args:
+            dp: Диспетчер, в который передаются апдейты
+            bot: Экземпляр бота
+            max_size: Максимальная длина очереди (при переполнении апдейт отклоняется)
+            workers: Количество воркеров-потребителей
+            dedup_window: Сколько последних update_id помнить для отсева повторов
+        """
+        self.dp = dp
+        self.bot = bot
+        self.workers_count = workers
+        self.dedup_window = dedup_window
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._seen_ids: "OrderedDict[int, None]" = OrderedDict()
+        self._workers: List[asyncio.Task] = []
+        self.is_running = False
+
+        # Счетчики
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def submit(self, payload: Dict[str, Any]) -> bool:
+        """
+        Постановка апдейта в очередь (без ожидания).
+
+        Returns:
+            False если очередь переполнена - Telegram должен повторить доставку
+        """
+        update_id = payload.get("update_id")
+
+        if update_id is not None and update_id in self._seen_ids:
+            self.duplicates += 1
+            logger.debug(f"Duplicate update {update_id} dropped")
+            return True
+
+        try:
+            self._queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning(f"⚠️ Update queue is full ({self._queue.maxsize}), update {update_id} rejected")
+            return False
+
+        if update_id is not None:
+            self._remember(update_id)
+        self.accepted += 1
+        return True
+
+    def _remember(self, update_id: int) -> None:
+        self._seen_ids[update_id] = None
+        while len(self._seen_ids) > self.dedup_window:
+            self._seen_ids.popitem(last=False)
+
+    async def start(self) -> None:
+        """Запуск воркеров"""
+        if self.is_running:
+            return
+        self.is_running = True
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"update-worker-{i}")
+            for i in range(self.workers_count)
+        ]
+        logger.info(f"✅ Update queue started: {self.workers_count} workers, max size {self._queue.maxsize}")
+
+    async def stop(self, drain_timeout: float = 10.0) -> None:
+        """Остановка: дожидаемся обработки очереди (с таймаутом) и гасим воркеры"""
+        if not self.is_running:
+            return
+        self.is_running = False
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Update queue not drained in {drain_timeout}s, {self._queue.qsize()} updates left")
+
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("🛑 Update queue stopped")
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            payload = await self._queue.get()
+            try:
+                update = Update.model_validate(payload, context={"bot": self.bot})
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ Worker {worker_id} failed to process update {payload.get('update_id')}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        """Состояние очереди для мониторинга"""
+        return {
+            'queue_depth': self._queue.qsize(),
+            'max_size': self._queue.maxsize,
+            'workers': len(self._workers),
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
@@ -0,0 +1,186 @@
+"""
+Инвалидация user_state_cache между процессами через Redis pub/sub
+app/services/user_cache_sync.py
+
+Бот и веб-приложение (Robokassa) держат свои копии кэша. Любое изменение
+пользователя (invalidate/update в UserStateCache) публикуется в канал
+USER_CACHE_CHANNEL, остальные процессы удаляют запись и перечитывают ее из
+БД на следующем апдейте. Публикация не блокирует путь записи: id кладутся
+в очередь и уходят из фоновой задачи. Пока подписки нет (Redis недоступен),
+записи без оплаты живут короткий USER_CACHE_PREPAYMENT_TTL.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from typing import Optional
+
+from app.config import settings
+from app.database.user_cache import UserStateCache, user_state_cache
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед переподключением к Redis (сек)
+RECONNECT_DELAY = 5.0
+
+# Предел очереди публикаций: при долгой недоступности Redis старые id теряются
+MAX_PENDING = 10000
+
+
+class UserCacheSync:
+    """Публикация и прием инвалидаций кэша пользователей"""
+
+    def __init__(
+        self,
+        cache: UserStateCache,
+        channel: str,
+        redis_url: Optional[str] = None,
+        redis=None
+    ):
+        """
+        Args:
+            cache: Локальный кэш процесса
+            channel: Канал Redis pub/sub
+            redis_url: Адрес Redis (если клиент не передан)
+            redis: Готовый клиент redis.asyncio (для тестов - fakeredis)
+        """
+        self.cache = cache
+        self.channel = channel
+        self.redis_url = redis_url
+        self.redis = redis
+        # Метка процесса: свои сообщения не обрабатываем
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._pending: asyncio.Queue = asyncio.Queue(maxsize=MAX_PENDING)
+        self._tasks = []
+        self._subscribed = asyncio.Event()
+        self.is_running = False
+
+        # Счетчики
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+
+    def publish(self, telegram_id: int) -> None:
+        """Постановка инвалидации в очередь (без ожидания)"""
+        try:
+            self._pending.put_nowait(telegram_id)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def start(self) -> None:
+        """Подписка на канал и подключение публикации к кэшу"""
+        if self.is_running:
+            return
+        if self.redis is None:
+            from redis.asyncio import Redis
+            self.redis = Redis.from_url(self.redis_url)
+
+        self.is_running = True
+        self._tasks = [
+            asyncio.create_task(self._listen(), name="user-cache-listen"),
+            asyncio.create_task(self._publish_loop(), name="user-cache-publish"),
+        ]
+        self.cache.set_publisher(self.publish)
+        logger.info(f"✅ User cache sync started (channel {self.channel})")
+
+    async def stop(self) -> None:
+        """Отключение от кэша, отправка оставшихся инвалидаций"""
+        if not self.is_running:
+            return
+        self.cache.set_publisher(None)
+        self.is_running = False
+        try:
+            await asyncio.wait_for(self._pending.join(), timeout=2.0)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ {self._pending.qsize()} user cache invalidations not published")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.redis.aclose()
+
+    async def _publish_loop(self) -> None:
+        while True:
+            telegram_id = await self._pending.get()
+            try:
+                while True:
+                    try:
+                        await self.redis.publish(self.channel, f"{self.origin}|{telegram_id}")
+                        self.published += 1
+                        break
+                    except Exception as e:
+                        if not self.is_running:
+                            break
+                        logger.error(f"❌ Failed to publish user cache invalidation: {e}")
+                        await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                self._pending.task_done()
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                self._subscribed.set()
+                self.cache.set_synced(True)
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self._handle(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ User cache sync subscription lost, reconnecting: {e}")
+                # Пока подписки не было, изменения могли пройти мимо
+                self.cache.set_synced(False)
+                self.cache.clear()
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                self._subscribed.clear()
+                self.cache.set_synced(False)
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def _handle(self, data) -> None:
+        if isinstance(data, bytes):
+            data = data.decode()
+        origin, _, telegram_id = data.rpartition("|")
+        if origin == self.origin:
+            return
+        try:
+            self.cache.invalidate(int(telegram_id), broadcast=False)
+        except ValueError:
+            logger.warning(f"⚠️ Malformed user cache invalidation: {data!r}")
+            return
+        self.received += 1
+
+    def stats(self) -> dict:
+        return {
+            'pending': self._pending.qsize(),
+            'published': self.published,
+            'received': self.received,
+            'dropped': self.dropped,
+        }
+
+
+# Глобальный экземпляр
+user_cache_sync = UserCacheSync(
+    user_state_cache,
+    channel=settings.USER_CACHE_CHANNEL,
+    redis_url=settings.REDIS_URL
+)
+
+
+async def start_user_cache_sync() -> None:
+    """Запуск синхронизации, если она включена в настройках (ошибки только логируются)"""
+    if settings.USER_CACHE_SYNC.lower() != "redis":
+        logger.info("ℹ️ User cache sync disabled, relying on short pre-payment TTL")
+        return
+    try:
+        await user_cache_sync.start()
+    except Exception as e:
+        logger.error(f"❌ Failed to start user cache sync: {e}")
@@ -0,0 +1,39 @@
+"""
+Общие фикстуры тестов
+app/tests/conftest.py
+"""
+import asyncio
+from typing import Awaitable, Callable, TypeVar
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database.models import Base
+
+T = TypeVar("T")
+
+
+@pytest.fixture
+def run_in_sqlite():
+    """
+    Запуск сценария на SQLite в памяти
+
+        result = run_in_sqlite(scenario, User, Sale)
+
+    Создает таблицы указанных моделей, вызывает scenario(session_factory)
+    в asyncio.run и закрывает движок.
+    """
+    def run(scenario: Callable[[sessionmaker], Awaitable[T]], *models) -> T:
+        async def main():
+            engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all, tables=[model.__table__ for model in models])
+            try:
+                return await scenario(sessionmaker(engine, class_=AsyncSession, expire_on_commit=False))
+            finally:
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
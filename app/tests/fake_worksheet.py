@@ -0,0 +1,180 @@
+"""
+Лист Google Sheets в памяти для проверки без сети
+app/tests/fake_worksheet.py
+
+Повторяет используемую часть интерфейса gspread.Worksheet, ведет журнал
+вызовов API и умеет имитировать ошибки (429 квоты, 5xx), чтобы проверять
+пакетную запись и повторы офлайн:
+
+    worksheet = FakeWorksheet(headers=[...])
+    worksheet.fail_next(2, status_code=429)
+    await sheets_service.bind_worksheet(worksheet)
+"""
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+
+class FakeAPIError(Exception):
+    """Ошибка API с response.status_code, как у gspread.exceptions.APIError"""
+
+    def __init__(self, status_code: int, message: str = ""):
+        super().__init__(message or f"Fake Sheets API error {status_code}")
+        self.response = SimpleNamespace(status_code=status_code)
+
+
+class FakeWorksheet:
+    """Лист в памяти; методы потокобезопасны (вызываются из потока Sheets)"""
+
+    def __init__(self, headers: Optional[List[str]] = None, title: str = "Fake", latency: float = 0.0):
+        """
+        Args:
+            headers: Строка заголовков (первая строка листа)
+            latency: Задержка каждого вызова API (сек), как у сетевого запроса
+        """
+        self.title = title
+        self.latency = latency
+        self.rows: List[list] = [list(headers)] if headers else []
+        self.revision = 0  # растет при каждой записи (для modifiedTime FakeSpreadsheet)
+        self.calls: List[str] = []
+        self._failures: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def fail_next(self, count: int = 1, status_code: int = 429, method: Optional[str] = None) -> None:
+        """
+        Следующие count вызовов API завершатся ошибкой status_code
+
+        method - падает только этот метод (например "append_rows"), остальные
+        вызовы до него проходят: так имитируется частичная запись.
+        """
+        self._failures.extend([(status_code, method)] * count)
+
+    def _call(self, name: str) -> None:
+        self.calls.append(name)
+        if self.latency:
+            time.sleep(self.latency)
+        if self._failures and self._failures[0][1] in (None, name):
+            raise FakeAPIError(self._failures.pop(0)[0])
+
+    # ---- Интерфейс gspread.Worksheet ----
+
+    def append_row(self, values: list, value_input_option: str = "RAW") -> dict:
+        return self.append_rows([values], value_input_option=value_input_option)
+
+    def append_rows(self, values: List[list], value_input_option: str = "RAW") -> dict:
+        """Ответ как у Sheets API: updates.updatedRange с номерами новых строк"""
+        with self._lock:
+            self._call("append_rows")
+            first_row = len(self.rows) + 1
+            self.rows.extend([list(row) for row in values])
+            self.revision += 1
+            last_col = chr(ord("A") + max(len(row) for row in values) - 1)
+            return {"updates": {"updatedRange": f"'{self.title}'!A{first_row}:{last_col}{len(self.rows)}"}}
+
+    def col_values(self, col: int) -> List[str]:
+        with self._lock:
+            self._call("col_values")
+            return [str(row[col - 1]) if len(row) >= col else "" for row in self.rows]
+
+    def get_all_values(self) -> List[list]:
+        with self._lock:
+            self._call("get_all_values")
+            return [[str(value) for value in row] for row in self.rows]
+
+    def get_all_records(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._call("get_all_records")
+            if not self.rows:
+                return []
+            headers = self.rows[0]
+            return [
+                {header: (row[i] if i < len(row) else "") for i, header in enumerate(headers)}
+                for row in self.rows[1:]
+            ]
+
+    def update(self, range_name: str, values: List[list], **kwargs) -> None:
+        with self._lock:
+            self._call("update")
+            self._write_range(range_name, values)
+            self.revision += 1
+
+    def batch_update(self, data: List[Dict[str, Any]], **kwargs) -> None:
+        """data: [{"range": "F2", "values": [[...]]}, ...] - один вызов API"""
+        with self._lock:
+            self._call("batch_update")
+            for item in data:
+                self._write_range(item["range"], item["values"])
+            self.revision += 1
+
+    # ---- Адресация A1 ----
+
+    def _write_range(self, range_name: str, values: List[list]) -> None:
+        start = range_name.split(":")[0]
+        row, col = _parse_a1(start)
+        for row_offset, row_values in enumerate(values):
+            for col_offset, value in enumerate(row_values):
+                self._set_cell(row + row_offset, col + col_offset, value)
+
+    def _set_cell(self, row: int, col: int, value: Any) -> None:
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = value
+
+
+class FakeSpreadsheet:
+    """Таблица из нескольких FakeWorksheet: metadata Drive и values:batchGet"""
+
+    def __init__(self, worksheets: List[FakeWorksheet], title: str = "Fake"):
+        self.title = title
+        self.worksheets = {worksheet.title: worksheet for worksheet in worksheets}
+        self.calls: List[str] = []
+        self._failures: List[int] = []
+
+    def fail_next(self, count: int = 1, status_code: int = 503) -> None:
+        self._failures.extend([status_code] * count)
+
+    def _call(self, name: str) -> None:
+        self.calls.append(name)
+        if self._failures:
+            raise FakeAPIError(self._failures.pop(0))
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self._call("worksheet")
+        if title not in self.worksheets:
+            raise FakeAPIError(404, f"Worksheet {title} not found")
+        return self.worksheets[title]
+
+    def get_lastUpdateTime(self) -> str:
+        """Аналог Drive modifiedTime: меняется при любой записи в листы"""
+        self._call("get_lastUpdateTime")
+        return str(sum(worksheet.revision for worksheet in self.worksheets.values()))
+
+    def values_batch_get(self, ranges: List[str], params: Optional[dict] = None) -> Dict[str, Any]:
+        """ranges вида "'Лист'!A:B" - значения колонок листа, как в ответе batchGet"""
+        self._call("values_batch_get")
+        value_ranges = []
+        for range_name in ranges:
+            title, _, columns = range_name.rpartition("!")
+            start, _, end = columns.partition(":")
+            first = _parse_a1(f"{start}1")[1]
+            last = _parse_a1(f"{end or start}1")[1]
+            rows = self.worksheets[title.strip("'")].get_all_values()
+            value_ranges.append({
+                "range": range_name,
+                "values": [row[first - 1:last] for row in rows]
+            })
+        return {"valueRanges": value_ranges}
+
+
+def _parse_a1(address: str) -> tuple:
+    """'F12' -> (12, 6)"""
+    letters = "".join(ch for ch in address if ch.isalpha()).upper()
+    digits = "".join(ch for ch in address if ch.isdigit())
+    col = 0
+    for ch in letters:
+        col = col * 26 + (ord(ch) - ord("A") + 1)
+    return int(digits), col
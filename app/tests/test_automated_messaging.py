@@ -0,0 +1,60 @@
+"""
+Тесты обработки наступивших кружков на SQLite в памяти
+app/tests/test_automated_messaging.py
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app.database.crud import AutomatedMessageCRUD
+from app.database.models import AutomatedMessage, AutomatedMessageStatus, OnboardingStage, User
+from app.services import automated_messaging
+from app.services.automated_messaging import AutomatedMessagingService
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_video_note(self, chat_id, video_note):
+        self.sent.append(chat_id)
+
+
+def test_failed_status_write_does_not_resend(monkeypatch, run_in_sqlite):
+    async def broken_bulk_update(session, updates):
+        raise RuntimeError("db is down")
+
+    monkeypatch.setattr(AutomatedMessageCRUD, "bulk_update_status", broken_bulk_update)
+    monkeypatch.setattr(automated_messaging, "PENDING_BATCH_SIZE", 2)
+    monkeypatch.setattr(automated_messaging, "STATUS_WRITE_RETRY_DELAY", 0)
+
+    async def scenario(session_factory):
+        monkeypatch.setattr(automated_messaging, "async_session_maker", session_factory)
+        async with session_factory() as session:
+            session.add(User(id=1, telegram_id=10, ref_code="ref_10",
+                             onboarding_stage=OnboardingStage.WAIT_PAYMENT))
+            session.add_all([
+                AutomatedMessage(
+                    user_id=1, telegram_id=10, video_file_id=f"video_{i}", video_type=f"type_{i}",
+                    required_stage=OnboardingStage.WAIT_PAYMENT,
+                    scheduled_at=datetime.now() - timedelta(minutes=1)
+                )
+                for i in range(2)
+            ])
+            await session.commit()
+
+        bot = FakeBot()
+        service = AutomatedMessagingService(bot)
+        first = await service.process_pending_messages()
+        second = await service.process_pending_messages()
+
+        async with session_factory() as session:
+            statuses = (await session.execute(select(AutomatedMessage.status))).scalars().all()
+        return first, second, bot.sent, statuses
+
+    first, second, sent, statuses = run_in_sqlite(scenario, User, AutomatedMessage)
+    # Пачка полная, но результат не записан - планировщик не должен крутить проход сразу
+    assert first == 0
+    assert second == 0
+    assert sent == [10, 10]
+    assert statuses == [AutomatedMessageStatus.SENDING.value] * 2
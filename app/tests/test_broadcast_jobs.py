@@ -0,0 +1,187 @@
+"""
+Тесты аренды рассылок и счетчиков record_batch на SQLite в памяти
+app/tests/test_broadcast_jobs.py
+
+Истечение аренды по времени считается часами БД (func.now()) и
+проверяется только на PostgreSQL; здесь - захват свободной задачи,
+отказ второму процессу, освобождение и heartbeat во время отправки пачки.
+"""
+import asyncio
+
+from sqlalchemy import select, update
+
+from app.database.broadcast_crud import BroadcastJobCRUD
+from app.database.models import BroadcastDelivery, BroadcastJob, BroadcastJobStatus, OnboardingStage, User
+from app.services import broadcast_jobs
+from app.services.broadcast_jobs import BroadcastJobRunner
+
+
+def add_users(session, *users):
+    """users: (telegram_id, onboarding_stage, payment_completed, status)"""
+    session.add_all([
+        User(telegram_id=telegram_id, ref_code=f"ref_{telegram_id}", onboarding_stage=stage,
+             payment_completed=paid, status=status)
+        for telegram_id, stage, paid, status in users
+    ])
+
+
+def run_with_job(run_in_sqlite, scenario, recipients=(1, 2, 3, 4)):
+    async def main(session_factory):
+        async with session_factory() as session:
+            add_users(session, *[(telegram_id, OnboardingStage.NEW_USER, False, "active") for telegram_id in recipients])
+            await session.commit()
+            job = await BroadcastJobCRUD.create_job(
+                session, admin_id=1, admin_name="admin", audience_type="all_users",
+                media_data={"type": "text", "text": "hi"}
+            )
+            return await scenario(session, job.id)
+
+    return run_in_sqlite(main, User, BroadcastJob, BroadcastDelivery)
+
+
+def test_create_job_selects_audience_from_users(run_in_sqlite):
+    async def scenario(session_factory):
+        async with session_factory() as session:
+            add_users(
+                session,
+                (1, OnboardingStage.PAYMENT_OK, True, "active"),
+                (2, OnboardingStage.WAIT_PAYMENT, False, "active"),
+                (3, OnboardingStage.PAYMENT_OK, True, "blocked"),
+                (4, OnboardingStage.COMPLETED, True, "active"),
+            )
+            await session.commit()
+
+            counts = {
+                audience: await BroadcastJobCRUD.count_audience(session, audience)
+                for audience in ("all_users", "paid_users", "payment_page_users", "partners_without_team")
+            }
+            jobs = {}
+            for audience, telegram_ids in (("paid_users", None), ("specific_users", [2, 3, 99])):
+                job = await BroadcastJobCRUD.create_job(
+                    session, admin_id=1, admin_name="admin", audience_type=audience,
+                    media_data={"type": "text", "text": "hi"}, telegram_ids=telegram_ids
+                )
+                result = await session.execute(
+                    select(BroadcastDelivery.telegram_id)
+                    .where(BroadcastDelivery.job_id == job.id)
+                    .order_by(BroadcastDelivery.id)
+                )
+                jobs[audience] = (job.total_count, result.scalars().all())
+            return counts, jobs
+
+    counts, jobs = run_in_sqlite(scenario, User, BroadcastJob, BroadcastDelivery)
+    assert counts == {"all_users": 3, "paid_users": 2, "payment_page_users": 1, "partners_without_team": 2}
+    assert jobs["paid_users"] == (2, [1, 4])
+    # Заблокированный и отсутствующий в БД ID не попадают в рассылку
+    assert jobs["specific_users"] == (1, [2])
+
+
+def test_only_one_process_owns_a_job(run_in_sqlite):
+    async def scenario(session, job_id):
+        first = await BroadcastJobCRUD.claim_job(session, job_id, "replica-a", 120)
+        second = await BroadcastJobCRUD.claim_job(session, job_id, "replica-b", 120)
+        again = await BroadcastJobCRUD.claim_job(session, job_id, "replica-a", 120)
+        resumable = await BroadcastJobCRUD.get_resumable_jobs(session, 120)
+
+        status_owner = await BroadcastJobCRUD.renew_lease(session, job_id, "replica-a")
+        status_other = await BroadcastJobCRUD.renew_lease(session, job_id, "replica-b")
+
+        await BroadcastJobCRUD.release_job(session, job_id, "replica-a")
+        resumable_after_release = await BroadcastJobCRUD.get_resumable_jobs(session, 120)
+        taken_over = await BroadcastJobCRUD.claim_job(session, job_id, "replica-b", 120)
+        return first, second, again, resumable, status_owner, status_other, resumable_after_release, taken_over
+
+    first, second, again, resumable, status_owner, status_other, after_release, taken_over = run_with_job(
+        run_in_sqlite, scenario
+    )
+    assert first is True and second is False and again is True
+    assert resumable == []
+    assert status_owner == BroadcastJobStatus.RUNNING and status_other is None
+    assert [job.id for job in after_release] == [1]
+    assert taken_over is True
+
+
+def test_record_batch_counts_each_delivery_once(run_in_sqlite):
+    async def scenario(session, job_id):
+        result = await session.execute(select(BroadcastDelivery.id).order_by(BroadcastDelivery.id))
+        ids = result.scalars().all()
+
+        await BroadcastJobCRUD.record_batch(session, job_id, ids[:2], {"blocked": [ids[2]]}, ids[2])
+        # Та же пачка повторно (вторая реплика) и новая доставка
+        await BroadcastJobCRUD.record_batch(session, job_id, ids[:3], {"other": [ids[3]]}, ids[3])
+        session.expire_all()
+        return await BroadcastJobCRUD.get_job(session, job_id)
+
+    job = run_with_job(run_in_sqlite, scenario)
+    assert job.sent_count == 2
+    assert job.blocked_count == 1
+    assert job.other_error_count == 1
+    assert job.last_delivery_id == 4
+
+
+
+class SlowSender:
+    """Отправка пачки дольше аренды (как долгий RetryAfter)"""
+
+    def __init__(self, seconds, during_send=None):
+        self.seconds = seconds
+        self.during_send = during_send
+
+    async def run(self, chat_ids, media_data, on_result=None):
+        if self.during_send:
+            await self.during_send()
+        await asyncio.sleep(self.seconds)
+        for chat_id in chat_ids:
+            on_result(chat_id, None)
+
+
+def run_slow_batch(monkeypatch, run_in_sqlite, steal_lease=False):
+    renewals = []
+    renew_lease = BroadcastJobCRUD.renew_lease
+
+    async def counting_renew_lease(session, job_id, owner):
+        renewals.append(owner)
+        return await renew_lease(session, job_id, owner)
+
+    monkeypatch.setattr(BroadcastJobCRUD, "renew_lease", counting_renew_lease)
+
+    async def main(session_factory):
+        monkeypatch.setattr(broadcast_jobs, "AsyncSessionLocal", session_factory)
+        async with session_factory() as session:
+            add_users(session, *[(telegram_id, OnboardingStage.NEW_USER, False, "active") for telegram_id in (1, 2)])
+            await session.commit()
+            job = await BroadcastJobCRUD.create_job(
+                session, admin_id=1, admin_name="admin", audience_type="all_users",
+                media_data={"type": "text", "text": "hi"}
+            )
+            runner = BroadcastJobRunner(batch_size=10, lease_seconds=0.15)
+            await BroadcastJobCRUD.claim_job(session, job.id, runner.owner, runner.lease_seconds)
+
+        async def other_replica_takes_over():
+            async with session_factory() as session:
+                await session.execute(update(BroadcastJob).values(claimed_by="replica-b"))
+                await session.commit()
+
+        monkeypatch.setattr(broadcast_jobs, "BroadcastSender", lambda bot: SlowSender(
+            seconds=5 if steal_lease else 0.3,
+            during_send=other_replica_takes_over if steal_lease else None
+        ))
+        stopped = await asyncio.wait_for(runner._process(None, job), timeout=2)
+        async with session_factory() as session:
+            return stopped, await BroadcastJobCRUD.get_job(session, job.id), renewals
+
+    return run_in_sqlite(main, User, BroadcastJob, BroadcastDelivery)
+
+
+def test_lease_is_renewed_while_batch_sends(monkeypatch, run_in_sqlite):
+    stopped, job, renewals = run_slow_batch(monkeypatch, run_in_sqlite)
+    assert stopped is None
+    assert job.sent_count == 2
+    # Перед пачкой и несколько раз, пока она отправлялась
+    assert len(renewals) >= 3
+
+
+def test_lost_lease_stops_batch(monkeypatch, run_in_sqlite):
+    stopped, job, _ = run_slow_batch(monkeypatch, run_in_sqlite, steal_lease=True)
+    assert stopped == "lease lost"
+    assert job.sent_count == 0
@@ -0,0 +1,90 @@
+"""
+Тесты ClickBuffer без БД: flush подменяется заглушкой
+app/tests/test_click_buffer.py
+"""
+import asyncio
+import json
+
+from sqlalchemy.exc import OperationalError
+
+from app.services import click_buffer as click_buffer_module
+from app.services.click_buffer import ClickBuffer, is_data_error
+from app.utils.helpers import is_valid_ref_code
+
+
+def test_submit_rejects_malformed_ref_codes():
+    buffer = ClickBuffer()
+    assert buffer.submit("ref_1A2B3C", "127.0.0.1", "test") is True
+    assert buffer.submit("ab\x00cd", "127.0.0.1", "test") is False
+    assert buffer.submit("x" * 100, "127.0.0.1", "test") is False
+    assert buffer.submit("", "127.0.0.1", "test") is False
+    assert buffer.stats()["queue_depth"] == 1
+    assert buffer.invalid == 3
+    assert not is_valid_ref_code("ref_1A2B3C\n")
+
+
+def test_poisoned_click_is_isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(click_buffer_module, "RETRY_DELAY", 0.001)
+    dead_letter_file = tmp_path / "clicks_failed.jsonl"
+    buffer = ClickBuffer(batch_size=8, flush_interval=0.01, max_attempts=2, dead_letter_file=str(dead_letter_file))
+    written = []
+
+    async def flush(clicks):
+        if any(click["ref_code"] == "bad" for click in clicks):
+            raise ValueError("invalid byte sequence")
+        written.extend(click["ref_code"] for click in clicks)
+        return len(clicks)
+
+    buffer.flush = flush
+    buffer._next_refresh = float("inf")
+
+    async def scenario():
+        buffer.is_running = True
+        buffer._task = asyncio.create_task(buffer._flusher())
+        for i in range(8):
+            buffer.submit("bad" if i == 3 else f"ref_{i}", "127.0.0.1", "test")
+        await asyncio.sleep(0.2)
+        buffer.submit("ref_after", "127.0.0.1", "test")
+        await buffer.stop(drain_timeout=2)
+
+    asyncio.run(scenario())
+    assert sorted(written) == sorted([f"ref_{i}" for i in range(8) if i != 3] + ["ref_after"])
+    assert buffer.dead_lettered == 1
+    assert buffer.split_batches == 3
+    rejected = [json.loads(line) for line in dead_letter_file.read_text(encoding="utf-8").splitlines()]
+    assert [click["ref_code"] for click in rejected] == ["bad"]
+
+
+def test_connection_errors_are_retried_without_splitting(tmp_path, monkeypatch):
+    monkeypatch.setattr(click_buffer_module, "RETRY_DELAY", 0.001)
+    monkeypatch.setattr(click_buffer_module, "MAX_RETRY_DELAY", 0.001)
+    dead_letter_file = tmp_path / "clicks_failed.jsonl"
+    buffer = ClickBuffer(batch_size=8, flush_interval=0.01, max_attempts=2, dead_letter_file=str(dead_letter_file))
+    failures = {"left": 10}
+    written = []
+
+    async def flush(clicks):
+        if failures["left"]:
+            failures["left"] -= 1
+            raise OperationalError("INSERT INTO clicks", {}, ConnectionRefusedError("connection refused"))
+        written.append(len(clicks))
+        return len(clicks)
+
+    buffer.flush = flush
+    buffer._next_refresh = float("inf")
+
+    async def scenario():
+        buffer.is_running = True
+        buffer._task = asyncio.create_task(buffer._flusher())
+        for i in range(8):
+            buffer.submit(f"ref_{i}", "127.0.0.1", "test")
+        await asyncio.sleep(0.2)
+        await buffer.stop(drain_timeout=2)
+
+    asyncio.run(scenario())
+    # Пачка пережила 10 ошибок соединения (max_attempts=2) целиком
+    assert written == [8]
+    assert buffer.failed_flushes == 10
+    assert buffer.split_batches == 0 and buffer.dead_lettered == 0
+    assert not dead_letter_file.exists()
+    assert not is_data_error(OperationalError("SELECT 1", {}, ConnectionResetError()))
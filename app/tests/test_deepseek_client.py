@@ -0,0 +1,269 @@
+"""
+Тесты DeepSeekClient против локальной заглушки chat/completions
+app/tests/test_deepseek_client.py
+
+Заглушка - aiohttp-сервер на 127.0.0.1: отвечает заданной очередью
+статусов и считает соединения и одновременные запросы.
+"""
+import asyncio
+import time
+from typing import List
+
+from aiohttp import web
+
+from app.services.answer_cache import answer_cache, normalize_question
+from app.services.auto_answers import SHEET_NON_PAID, SHEET_PARTNERS, AutoAnswersService
+from app.services.deepseek_client import DeepSeekClient
+from app.tests.fake_worksheet import FakeSpreadsheet, FakeWorksheet
+
+
+class StubCompletions:
+    """Заглушка DeepSeek API"""
+
+    def __init__(self, content: str = "2", statuses: List[int] = None, delay: float = 0.0, retry_after: str = None):
+        self.content = content
+        self.statuses = list(statuses or [])
+        self.delay = delay
+        self.retry_after = retry_after
+        self.requests = 0
+        self.connections = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        self.connections.add(request.transport.get_extra_info("peername"))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await request.json()
+            await asyncio.sleep(self.delay)
+            status = self.statuses.pop(0) if self.statuses else 200
+            if status != 200:
+                headers = {"Retry-After": self.retry_after} if self.retry_after else None
+                return web.json_response({"error": "stub"}, status=status, headers=headers)
+            return web.json_response({"choices": [{"message": {"content": self.content}}]})
+        finally:
+            self.in_flight -= 1
+
+
+async def run_with_stub(stub: StubCompletions, scenario, **client_kwargs):
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", stub.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    client = DeepSeekClient(api_url=f"http://127.0.0.1:{port}/v1/chat/completions", **client_kwargs)
+    try:
+        return await scenario(client)
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+QA_PAIRS = [
+    {"question": "Как получить ссылку?", "answer": "В меню 'Моя ссылка'"},
+    {"question": "Когда выплата?", "answer": "Раз в неделю"},
+]
+
+
+def test_reuses_one_connection():
+    stub = StubCompletions(content="2")
+
+    async def scenario(client):
+        return [await client.find_matching_answer("выплата?", QA_PAIRS) for _ in range(5)]
+
+    answers = asyncio.run(run_with_stub(stub, scenario))
+    assert answers == ["Раз в неделю"] * 5
+    assert stub.requests == 5
+    assert len(stub.connections) == 1
+
+
+def test_retries_429_and_5xx():
+    stub = StubCompletions(content="greeting", statuses=[429, 503])
+
+    async def scenario(client):
+        return await client.classify_message_type("Привет"), client.stats()
+
+    result, stats = asyncio.run(run_with_stub(stub, scenario, max_retries=3))
+    assert result == "greeting"
+    assert stub.requests == 3
+    assert stats["retries"] == 2
+
+
+def test_gives_up_after_retries():
+    stub = StubCompletions(statuses=[500] * 10)
+
+    async def scenario(client):
+        return await client.generate_greeting_response("Привет")
+
+    result = asyncio.run(run_with_stub(stub, scenario, max_retries=2))
+    assert result == "👋 Здравствуйте! Чем могу помочь?"
+    assert stub.requests == 3
+
+
+def test_gives_up_on_long_retry_after():
+    stub = StubCompletions(statuses=[429] * 3, retry_after="120")
+
+    async def scenario(client):
+        started = time.monotonic()
+        return await client.classify_message_type("Привет"), time.monotonic() - started, client.stats()
+
+    result, elapsed, stats = asyncio.run(run_with_stub(stub, scenario, max_retries=3))
+    assert result == "question"
+    assert stub.requests == 1 and stats["errors"] == 1
+    assert elapsed < 1
+
+
+def test_call_is_limited_by_deadline():
+    stub = StubCompletions(content="greeting", statuses=[503] * 10, delay=0.1)
+
+    async def scenario(client):
+        started = time.monotonic()
+        return await client.classify_message_type("Привет"), time.monotonic() - started, client.stats()
+
+    result, elapsed, stats = asyncio.run(run_with_stub(stub, scenario, max_retries=10, deadline=0.3))
+    assert result == "question"
+    assert elapsed < 0.6 and stats["errors"] == 1
+
+
+def test_does_not_retry_client_errors():
+    stub = StubCompletions(statuses=[401])
+
+    async def scenario(client):
+        return await client.find_matching_answer("выплата?", QA_PAIRS)
+
+    assert asyncio.run(run_with_stub(stub, scenario)) is None
+    assert stub.requests == 1
+
+
+def test_limits_concurrent_requests():
+    stub = StubCompletions(content="question", delay=0.05)
+
+    async def scenario(client):
+        return await asyncio.gather(*(client.classify_message_type(f"вопрос {i}") for i in range(12)))
+
+    results = asyncio.run(run_with_stub(stub, scenario, max_concurrency=3))
+    assert results == ["question"] * 12
+    assert stub.max_in_flight == 3
+
+
+def test_timeout_falls_back():
+    stub = StubCompletions(delay=1.0)
+
+    async def scenario(client):
+        return await client.classify_message_type("Привет")
+
+    assert asyncio.run(run_with_stub(stub, scenario, timeout=0.1, max_retries=1)) == "question"
+    assert stub.requests == 2
+
+
+def test_answer_cache_hits_and_negative_results():
+    answer_cache.clear()
+    stub = StubCompletions(content="2")
+
+    async def scenario(client):
+        first = await client.find_matching_answer("Когда выплата?", QA_PAIRS, sheet="S", qa_version=1)
+        again = await client.find_matching_answer("  когда ВЫПЛАТА ", QA_PAIRS, sheet="S", qa_version=1)
+        stub.content = "НЕТ"
+        missing = await client.find_matching_answer("Что-то другое", QA_PAIRS, sheet="S", qa_version=1)
+        missing_again = await client.find_matching_answer("что то другое!", QA_PAIRS, sheet="S", qa_version=1)
+        return first, again, missing, missing_again
+
+    first, again, missing, missing_again = asyncio.run(run_with_stub(stub, scenario))
+    assert first == again == "Раз в неделю"
+    assert missing is None and missing_again is None
+    assert stub.requests == 2
+
+    stats = answer_cache.stats()
+    assert stats["hits"] == 2 and stats["negative_hits"] == 1
+    assert stats["hit_rate"] == 0.5
+    assert stats["saved_seconds"] > 0
+
+
+def test_answer_cache_skips_errors_and_respects_version():
+    answer_cache.clear()
+    stub = StubCompletions(content="1", statuses=[401])
+
+    async def scenario(client):
+        failed = await client.find_matching_answer("ссылка", QA_PAIRS, sheet="S", qa_version=1)
+        found = await client.find_matching_answer("ссылка", QA_PAIRS, sheet="S", qa_version=1)
+        other_sheet = await client.find_matching_answer("ссылка", QA_PAIRS, sheet="P", qa_version=1)
+        new_version = await client.find_matching_answer("ссылка", QA_PAIRS, sheet="S", qa_version=2)
+        return failed, found, other_sheet, new_version
+
+    failed, found, other_sheet, new_version = asyncio.run(run_with_stub(stub, scenario))
+    assert failed is None
+    assert found == other_sheet == new_version == "В меню 'Моя ссылка'"
+    assert stub.requests == 4
+
+
+def test_changed_pairs_invalidate_cache(tmp_path):
+    answer_cache.clear()
+    snapshot_file = str(tmp_path / "snapshot.json")
+    partners = FakeWorksheet(headers=["Вопрос", "Ответ"], title=SHEET_PARTNERS)
+    partners.rows.append(["Когда выплата?", "Раз в неделю"])
+    non_paid = FakeWorksheet(headers=["Вопрос", "Ответ"], title=SHEET_NON_PAID)
+    spreadsheet = FakeSpreadsheet([non_paid, partners])
+
+    async def scenario():
+        service = AutoAnswersService(snapshot_file=snapshot_file, refresh_interval=3600)
+        await service.bind_spreadsheet(spreadsheet)
+        try:
+            assert service.qa_version == 1
+            answer_cache.put(SHEET_PARTNERS, "выплата", service.qa_version, "Раз в неделю", 1.0)
+
+            # Таблица не менялась - значения не скачиваются
+            assert await service.refresh() is False
+            assert spreadsheet.calls.count("values_batch_get") == 1
+            assert answer_cache.stats()["size"] == 1
+
+            partners.update("B2", [["Каждый понедельник"]])
+            assert await service.refresh() is True
+            assert service.qa_version == 2
+            assert answer_cache.stats()["size"] == 0
+
+            pairs = await service.get_qa_pairs_for_stage("completed")
+            assert pairs[0]["answer"] == "Каждый понедельник"
+        finally:
+            await service.close()
+
+    asyncio.run(scenario())
+    assert spreadsheet.calls.count("values_batch_get") == 2
+
+
+def test_snapshot_file_survives_sheets_outage(tmp_path):
+    snapshot_file = str(tmp_path / "snapshot.json")
+    partners = FakeWorksheet(headers=["Вопрос", "Ответ"], title=SHEET_PARTNERS)
+    partners.rows.append(["Когда выплата?", "Раз в неделю"])
+    spreadsheet = FakeSpreadsheet([FakeWorksheet(headers=["Вопрос", "Ответ"], title=SHEET_NON_PAID), partners])
+
+    async def first_start():
+        service = AutoAnswersService(snapshot_file=snapshot_file, refresh_interval=3600)
+        await service.bind_spreadsheet(spreadsheet)
+        await service.close()
+
+    async def cold_start_during_outage():
+        service = AutoAnswersService(snapshot_file=snapshot_file, refresh_interval=3600)
+        spreadsheet.fail_next(2)
+        await service.bind_spreadsheet(spreadsheet)
+        try:
+            pairs = await service.get_qa_pairs_for_stage("completed")
+            assert await service.reload_answers() is False
+            return service.qa_version, pairs, service.stats()
+        finally:
+            await service.close()
+
+    asyncio.run(first_start())
+    version, pairs, stats = asyncio.run(cold_start_during_outage())
+    assert version == 1
+    assert pairs[0]["answer"] == "Раз в неделю"
+    assert stats["failed_refreshes"] == 2
+
+
+def test_normalize_question():
+    assert normalize_question("  Где   ССЫЛКА?!  ") == "где ссылка"
+    assert normalize_question("Ещё вопрос") == "еще вопрос"
@@ -0,0 +1,64 @@
+"""
+Тесты FSM-хранилища: сериализация данных и RedisStorage на fakeredis
+app/tests/test_fsm_storage.py
+"""
+import asyncio
+from datetime import date, datetime
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from fakeredis.aioredis import FakeRedis
+
+from app.config import settings
+from app.utils.fsm_storage import create_events_isolation, create_fsm_storage, fsm_json_dumps, fsm_json_loads
+
+KEY = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+FSM_DATA = {
+    "start_date": datetime(2026, 3, 1, 12, 30),
+    "report_day": date(2026, 3, 2),
+    "admin_name": "Админ",
+    "requested_ids": (1, 2),
+}
+
+
+def test_json_round_trip_keeps_dates():
+    raw = fsm_json_dumps(FSM_DATA)
+    # Компактно и без \u-экранирования кириллицы
+    assert " " not in raw and "Админ" in raw
+    assert fsm_json_loads(raw) == dict(FSM_DATA, requested_ids=[1, 2])
+
+
+def test_plain_dict_with_tag_like_key_is_not_decoded():
+    data = {"__dt__": "2026-03-01T12:30:00", "other": 1}
+    assert fsm_json_loads(fsm_json_dumps(data)) == data
+
+
+def test_redis_storage_set_and_get(monkeypatch):
+    monkeypatch.setattr(settings, "FSM_STORAGE", "redis")
+    monkeypatch.setattr(settings, "FSM_KEY_PREFIX", "test_fsm")
+
+    async def scenario():
+        storage = create_fsm_storage()
+        storage.redis = FakeRedis()
+        try:
+            await storage.set_state(KEY, "BroadcastStates:confirming")
+            await storage.set_data(KEY, FSM_DATA)
+            keys = sorted(key.decode() for key in await storage.redis.keys("test_fsm:*"))
+            ttl = await storage.redis.ttl(keys[0])
+            return await storage.get_state(KEY), await storage.get_data(KEY), keys, ttl
+        finally:
+            await storage.close()
+
+    state, data, keys, ttl = asyncio.run(scenario())
+    assert state == "BroadcastStates:confirming"
+    assert data == dict(FSM_DATA, requested_ids=[1, 2])
+    assert keys == ["test_fsm:42:42:default:data", "test_fsm:42:42:default:state"]
+    assert 0 < ttl <= settings.FSM_DATA_TTL
+
+
+def test_memory_storage_by_default(monkeypatch):
+    monkeypatch.setattr(settings, "FSM_STORAGE", "memory")
+    storage = create_fsm_storage()
+    assert isinstance(storage, MemoryStorage)
+    assert create_events_isolation(storage) is None
@@ -0,0 +1,91 @@
+"""
+Тесты отложенного пересчета daily_funnel_stats на SQLite в памяти
+app/tests/test_funnel_stats.py
+"""
+import asyncio
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import update
+
+from app.database.funnel_crud import FunnelStatsCRUD
+from app.database.models import DailyFunnelStats, OnboardingStage, Payment, Sale, User
+
+FUNNEL_MODELS = (User, Payment, Sale, DailyFunnelStats)
+
+
+def test_touch_marks_days_and_refresh_recomputes(run_in_sqlite):
+    yesterday = datetime.combine(date.today() - timedelta(days=1), datetime.min.time()) + timedelta(hours=12)
+
+    async def scenario(session_factory):
+        async with session_factory() as session:
+            session.add_all([
+                User(telegram_id=1, ref_code="ref_1", created_at=yesterday,
+                     onboarding_stage=OnboardingStage.WAIT_PAYMENT),
+                User(telegram_id=2, ref_code="ref_2", onboarding_stage=OnboardingStage.NEW_USER),
+            ])
+            await session.commit()
+
+            # Пометка без запросов, пересчет - одним проходом
+            FunnelStatsCRUD.touch()
+            FunnelStatsCRUD.touch_user(1)
+            assert await FunnelStatsCRUD.refresh_dirty(session) == 2
+            assert await FunnelStatsCRUD.refresh_dirty(session) == 0
+
+            before = await FunnelStatsCRUD.get_totals(session, yesterday.date(), yesterday.date())
+            assert before["stage_wait_payment"] == 1 and before["paid_users"] == 0
+
+            await session.execute(
+                update(User).where(User.telegram_id == 1)
+                .values(onboarding_stage=OnboardingStage.PAYMENT_OK, payment_completed=True,
+                        stage_payment_ok_at=datetime.now())
+            )
+            await session.commit()
+            FunnelStatsCRUD.touch_user(1)
+            await FunnelStatsCRUD.refresh_dirty(session)
+
+            cohort = await FunnelStatsCRUD.get_totals(session, yesterday.date(), yesterday.date())
+            today = await FunnelStatsCRUD.get_totals(session, date.today(), date.today())
+            return before, cohort, today
+
+    before, cohort, today = run_in_sqlite(scenario, *FUNNEL_MODELS)
+    assert before["new_users"] == 1
+    assert cohort["stage_wait_payment"] == 0
+    assert cohort["stage_payment_ok"] == 1 and cohort["paid_users"] == 1
+    assert today["new_users"] == 1 and today["partners_without_team"] == 1
+
+
+def test_failed_refresh_keeps_marks(run_in_sqlite):
+    class BrokenSession:
+        async def execute(self, *args, **kwargs):
+            raise RuntimeError("db is down")
+
+        async def scalar(self, *args, **kwargs):
+            raise RuntimeError("db is down")
+
+    FunnelStatsCRUD.touch_user(42)
+    try:
+        asyncio.run(FunnelStatsCRUD.refresh_dirty(BrokenSession()))
+    except RuntimeError:
+        pass
+
+    async def scenario(session_factory):
+        async with session_factory() as session:
+            return await FunnelStatsCRUD.refresh_dirty(session)
+
+    assert run_in_sqlite(scenario, *FUNNEL_MODELS) == 1
+
+
+def test_days_of_user_collects_every_affected_day(run_in_sqlite):
+    noon = datetime.combine(date.today(), datetime.min.time()) + timedelta(hours=12)
+    registered, paid, sold = noon - timedelta(days=5), noon - timedelta(days=3), noon - timedelta(days=1)
+
+    async def scenario(session_factory):
+        async with session_factory() as session:
+            session.add(User(id=1, telegram_id=1, ref_code="ref_1", created_at=registered,
+                             stage_payment_ok_at=paid, onboarding_stage=OnboardingStage.PAYMENT_OK))
+            session.add(Payment(user_id=1, invoice_id="inv_1", amount=100, status="paid", paid_at=paid))
+            session.add(Sale(ref_code="ref_1", amount=100, commission_amount=50, created_at=sold))
+            await session.commit()
+            return await FunnelStatsCRUD.days_of_user(session, 1)
+
+    assert run_in_sqlite(scenario, *FUNNEL_MODELS) == {registered.date(), paid.date(), sold.date()}
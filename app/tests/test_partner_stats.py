@@ -0,0 +1,48 @@
+"""
+Тесты пересчета и сверки partner_stats на SQLite в памяти
+app/tests/test_partner_stats.py
+
+Блокировки FOR UPDATE SQLite игнорирует; здесь - результат сверки.
+"""
+from app.database.models import Click, PartnerStats, Sale, User
+from app.database.partner_stats_crud import PartnerStatsCRUD
+
+MODELS = (User, Click, Sale, PartnerStats)
+
+
+def test_reconcile_repairs_drift_and_creates_missing_rows(run_in_sqlite):
+    async def scenario(session_factory):
+        async with session_factory() as session:
+            session.add_all([
+                Click(ref_code="ref_a"), Click(ref_code="ref_a"), Click(ref_code="ref_b"),
+                Sale(ref_code="ref_a", status="confirmed", amount=100, commission_amount=40),
+                PartnerStats(ref_code="ref_a", clicks=1, total_sales=1, confirmed_sales=1,
+                             pending_sales=0, cancelled_sales=0, confirmed_commission=40, pending_commission=0),
+            ])
+            await session.commit()
+
+            report = await PartnerStatsCRUD.reconcile(session, repair=False)
+            drift = await PartnerStatsCRUD.reconcile(session)
+            after = await PartnerStatsCRUD.reconcile(session)
+            stats_a = await PartnerStatsCRUD.get(session, "ref_a")
+            stats_b = await PartnerStatsCRUD.get(session, "ref_b")
+            return report, drift, after, stats_a.clicks, stats_b.clicks
+
+    report, drift, after, clicks_a, clicks_b = run_in_sqlite(scenario, *MODELS)
+    assert report == drift
+    assert {(item["ref_code"], item["column"]) for item in drift} == {("ref_a", "clicks"), ("ref_b", "clicks")}
+    assert after == []
+    assert clicks_a == 2 and clicks_b == 1
+
+
+def test_recalculate_creates_row_for_new_partner(run_in_sqlite):
+    async def scenario(session_factory):
+        async with session_factory() as session:
+            session.add(Sale(ref_code="ref_c", status="pending", amount=100, commission_amount=25))
+            await session.flush()
+            await PartnerStatsCRUD.recalculate(session, ["ref_c", "ref_c"])
+            await session.commit()
+            stats = await PartnerStatsCRUD.get(session, "ref_c")
+            return stats.total_sales, stats.pending_sales, stats.pending_commission
+
+    assert run_in_sqlite(scenario, *MODELS) == (1, 1, 25)
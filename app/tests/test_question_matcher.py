@@ -0,0 +1,34 @@
+"""
+Тесты локального сопоставления вопросов поддержки
+app/tests/test_question_matcher.py
+"""
+from app.services.question_matcher import QuestionMatcher
+
+QA_PAIRS = [
+    {"question": "Как оплатить курс?", "answer": "Кнопка «Оплатить» в меню."},
+    {"question": "Где взять реферальную ссылку?", "answer": "Раздел «Моя ссылка»."},
+    {"question": "Когда выплачивают комиссию?", "answer": "Раз в неделю."},
+]
+
+
+def test_unseen_words_lower_the_score():
+    matcher = QuestionMatcher(QA_PAIRS)
+    exact = matcher.match("как оплатить курс")
+    # "не" нет ни в одном вопросе листа - раньше такие n-граммы отбрасывались
+    negated = matcher.match("Как не оплатить курс?")
+    longer = matcher.match("как оплатить курс картой из казахстана через сбербанк")
+
+    assert exact.best_score > 0.99 and exact.confident
+    assert negated.best_score < exact.best_score
+    assert longer.best_score < 0.8 and not longer.confident
+    assert longer.candidates[0] is QA_PAIRS[0]
+
+
+def test_negation_is_never_a_confident_match():
+    # "не" есть в словаре листа - близость остается высокой, решает модель
+    matcher = QuestionMatcher(QA_PAIRS + [{"question": "Не пришло видео урока", "answer": "Напишите нам."}])
+    result = matcher.match("Как не оплатить курс?")
+
+    assert result.candidates[0] is QA_PAIRS[0]
+    assert not result.confident
+    assert matcher.match("не пришло видео урока").confident
@@ -0,0 +1,133 @@
+"""
+Тесты очереди SheetsWriter против FakeWorksheet
+app/tests/test_sheets_writer.py
+"""
+import asyncio
+import json
+
+from app.services import sheets_writer
+from app.services.sheets_writer import SheetsWriter
+from app.tests.fake_worksheet import FakeWorksheet
+
+HEADERS = ["Дата", "Имя"]
+
+
+def make_writer(tmp_path, **kwargs) -> SheetsWriter:
+    return SheetsWriter("test", str(tmp_path / "queue.json"), **kwargs)
+
+
+def rows(count: int, start: int = 0) -> list:
+    return [[f"2026-01-{i + 1:02d}", f"user_{i}"] for i in range(start, start + count)]
+
+
+async def wait_written(worksheet: FakeWorksheet, count: int, timeout: float = 2.0) -> None:
+    """Ожидание, пока в листе (без заголовка) не окажется count строк"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while len(worksheet.rows) - 1 < count:
+        assert asyncio.get_running_loop().time() < deadline, "rows were not written in time"
+        await asyncio.sleep(0.01)
+
+
+def test_rows_are_written_in_batches(tmp_path):
+    worksheet = FakeWorksheet(headers=HEADERS)
+    writer = make_writer(tmp_path, batch_size=2)
+
+    async def scenario():
+        for row in rows(5):
+            writer.append(row)
+        writer.bind(worksheet)
+        return await writer.flush()
+
+    assert asyncio.run(scenario()) == 5
+    # 5 строк пачками по 2 - три вызова API, порядок сохранен
+    assert worksheet.calls == ["append_rows"] * 3
+    assert worksheet.rows[1:] == rows(5)
+    assert writer.stats()["batches"] == 3 and writer.stats()["pending"] == 0
+    assert not (tmp_path / "queue.json").exists()
+
+
+def test_quota_errors_are_retried_with_backoff(tmp_path, monkeypatch):
+    monkeypatch.setattr(sheets_writer, "INITIAL_BACKOFF", 0.01)
+    worksheet = FakeWorksheet(headers=HEADERS)
+    worksheet.fail_next(2, status_code=429)
+    writer = make_writer(tmp_path, batch_size=10, flush_interval=0.01, max_backoff=0.02)
+
+    async def scenario():
+        writer.bind(worksheet)
+        await writer.start()
+        for row in rows(3):
+            writer.append(row)
+        await wait_written(worksheet, 3)
+        await writer.stop()
+
+    asyncio.run(scenario())
+    # Две неудачные попытки и одна успешная, строки записаны один раз
+    assert worksheet.calls == ["append_rows"] * 3
+    assert worksheet.rows[1:] == rows(3)
+    assert writer.stats()["retries"] == 2 and writer.stats()["failed"] == 0
+
+
+def test_rejected_batch_goes_to_failed_file(tmp_path):
+    worksheet = FakeWorksheet(headers=HEADERS)
+    worksheet.fail_next(1, status_code=400)
+    writer = make_writer(tmp_path, batch_size=2)
+
+    async def scenario():
+        for row in rows(3):
+            writer.append(row)
+        writer.bind(worksheet)
+        await writer.flush()
+
+    asyncio.run(scenario())
+    # Первая пачка отклонена и не блокирует очередь - вторая записана
+    failed = (tmp_path / "queue.json.failed").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line) for line in failed] == rows(2)
+    assert worksheet.rows[1:] == rows(1, start=2)
+    assert writer.stats()["failed"] == 2 and writer.stats()["pending"] == 0
+
+
+def test_queue_survives_restart(tmp_path):
+    first = make_writer(tmp_path)
+    for row in rows(2):
+        first.append(row)
+    assert json.loads((tmp_path / "queue.json").read_text(encoding="utf-8")) == rows(2)
+    # Процесс завершился - блокировка файла очереди снята
+    first._lock_file.close()
+
+    worksheet = FakeWorksheet(headers=HEADERS)
+    second = make_writer(tmp_path)
+
+    async def scenario():
+        second.append(rows(1, start=2)[0])
+        second.bind(worksheet)
+        return await second.flush()
+
+    # Восстановленные строки идут перед новыми
+    assert asyncio.run(scenario()) == 3
+    assert worksheet.rows[1:] == rows(3)
+    assert not (tmp_path / "queue.json").exists()
+
+
+def test_fallback_queue_is_merged_after_restart(tmp_path):
+    owner = make_writer(tmp_path)
+    owner.append(rows(1)[0])
+    # Второй процесс с тем же файлом очереди пишет в <queue>.<pid>
+    duplicate = make_writer(tmp_path)
+    duplicate.append(rows(1, start=1)[0])
+    assert duplicate.queue_file != owner.queue_file
+
+    # Живой процесс-дубль: его файл не трогаем
+    owner._lock_file.close()
+    restarted = make_writer(tmp_path)
+    restarted.append(rows(1, start=2)[0])
+    assert restarted.stats()["pending"] == 2
+
+    # Оба процесса завершились - следующий владелец забирает строки дубля
+    restarted._lock_file.close()
+    duplicate._lock_file.close()
+    worksheet = FakeWorksheet(headers=HEADERS)
+    merged = make_writer(tmp_path)
+    merged.bind(worksheet)
+    asyncio.run(merged.flush())
+    assert worksheet.rows[1:] == [rows(1)[0], rows(1, start=2)[0], rows(1, start=1)[0]]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["queue.json.lock"]
@@ -0,0 +1,99 @@
+"""
+Тесты записи переписок поддержки против FakeWorksheet
+app/tests/test_support_chat_logger.py
+"""
+import asyncio
+import json
+
+from app.services.support_chat_logger import CHAT_HEADERS, SupportChatLogger
+from app.tests.fake_worksheet import FakeAPIError, FakeWorksheet
+
+
+def run_with_logger(tmp_path, scenario, rows=()):
+    """scenario(chat_logger, worksheet) с подключенным листом; фоновая запись не мешает (интервал 60 с)"""
+    worksheet = FakeWorksheet(headers=CHAT_HEADERS, title="Чат админов")
+    worksheet.rows.extend(list(row) for row in rows)
+    chat_logger = SupportChatLogger(flush_interval=60, failed_file=str(tmp_path / "support_chats.failed"))
+
+    async def main():
+        await chat_logger.bind_worksheet(worksheet)
+        try:
+            return await scenario(chat_logger, worksheet)
+        finally:
+            await chat_logger.close()
+
+    return asyncio.run(main()), chat_logger, worksheet
+
+
+async def save(chat_logger, user_id, text, user_name="Иван"):
+    chat_logger.add_message_to_buffer(user_id, "Пользователь", text, "male")
+    assert await chat_logger.save_chat_to_sheets(user_id, user_name, "male")
+
+
+def test_appended_row_is_indexed(tmp_path):
+    async def scenario(chat_logger, worksheet):
+        await save(chat_logger, 1, "первый вопрос")
+        await chat_logger.flush()
+        row = chat_logger.find_user_row(1)
+        await save(chat_logger, 1, "второй вопрос")
+        await chat_logger.flush()
+        return row
+
+    row, _, worksheet = run_with_logger(tmp_path, scenario, rows=[[7, "", "", "", "Пользователь: Петр"]])
+    assert row == 3
+    # Вторая запись - обновление найденной строки, а не новая строка
+    assert worksheet.calls[1:] == ["append_rows", "batch_update"]
+    assert len(worksheet.rows) == 3
+    chat = worksheet.rows[2][4]
+    assert chat.count("Пользователь: Иван") == 1
+    assert "первый вопрос" in chat and "второй вопрос" in chat
+
+
+def test_retry_after_partial_write_does_not_duplicate(tmp_path):
+    async def scenario(chat_logger, worksheet):
+        await save(chat_logger, 1, "старый пользователь пишет")
+        await save(chat_logger, 2, "новый пользователь пишет", user_name="Анна")
+        # batch_update для пользователя 1 проходит, append_rows для 2 - 503
+        worksheet.fail_next(1, status_code=503, method="append_rows")
+        try:
+            await chat_logger.flush()
+        except FakeAPIError:
+            pass
+        else:
+            raise AssertionError("retryable error must be raised")
+        return await chat_logger.flush()
+
+    saved, _, worksheet = run_with_logger(tmp_path, scenario, rows=[[1, "", "", "", "Пользователь: Иван"]])
+    assert saved == 1
+    assert worksheet.calls[1:] == ["batch_update", "append_rows", "append_rows"]
+    assert [str(row[0]) for row in worksheet.rows[1:]] == ["1", "2"]
+    assert worksheet.rows[1][4].count("старый пользователь пишет") == 1
+    assert worksheet.rows[2][4].count("новый пользователь пишет") == 1
+
+
+def test_several_saves_are_merged(tmp_path):
+    async def scenario(chat_logger, worksheet):
+        await save(chat_logger, 1, "раз")
+        await save(chat_logger, 1, "два")
+        return await chat_logger.flush()
+
+    saved, _, worksheet = run_with_logger(tmp_path, scenario)
+    assert saved == 1
+    assert worksheet.calls[1:] == ["append_rows"]
+    assert len(worksheet.rows) == 2
+    chat = worksheet.rows[1][4]
+    assert chat.index("раз") < chat.index("два")
+
+
+def test_rejected_chats_go_to_failed_file(tmp_path):
+    async def scenario(chat_logger, worksheet):
+        await save(chat_logger, 1, "потерянный вопрос")
+        worksheet.fail_next(1, status_code=400)
+        return await chat_logger.flush()
+
+    saved, chat_logger, worksheet = run_with_logger(tmp_path, scenario)
+    assert saved == 0
+    assert len(worksheet.rows) == 1
+    failed = [json.loads(line) for line in (tmp_path / "support_chats.failed").read_text(encoding="utf-8").splitlines()]
+    assert len(failed) == 1 and failed[0][0] == 1 and "потерянный вопрос" in failed[0][4]
+    assert chat_logger.stats()["failed_chats"] == 1 and chat_logger.stats()["pending"] == 0
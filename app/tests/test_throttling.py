@@ -0,0 +1,45 @@
+"""
+Тесты ThrottlingMiddleware: счетчики пропущенных и отброшенных апдейтов
+app/tests/test_throttling.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+from prometheus_client import REGISTRY
+
+from app.middlewares.throttling import MemoryTokenBucket, ThrottlingMiddleware
+
+
+class FakeEvent:
+    def __init__(self, user_id: int):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.answers = []
+
+    async def answer(self, text: str):
+        self.answers.append(text)
+
+
+def sample(result: str) -> float:
+    return REGISTRY.get_sample_value("bot_throttling_updates_total", {"result": result}) or 0.0
+
+
+def test_shed_and_allowed_are_exported():
+    clock = SimpleNamespace(now=0.0)
+    middleware = ThrottlingMiddleware(limiter=MemoryTokenBucket(rate=1, burst=2, clock=lambda: clock.now))
+    event = FakeEvent(user_id=-1)
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event)
+
+    allowed, shed = sample("allowed"), sample("shed")
+
+    async def scenario():
+        for _ in range(3):
+            await middleware(handler, event, {})
+
+    asyncio.run(scenario())
+    assert len(handled) == 2 and len(event.answers) == 1
+    assert middleware.stats()["allowed"] == 2 and middleware.stats()["shed"] == 1
+    assert sample("allowed") - allowed == 2
+    assert sample("shed") - shed == 1
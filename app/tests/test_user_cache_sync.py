@@ -0,0 +1,103 @@
+"""
+Тесты инвалидации user_state_cache между процессами (fakeredis)
+app/tests/test_user_cache_sync.py
+"""
+import asyncio
+
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeRedis
+from prometheus_client import REGISTRY
+
+from app.database.user_cache import CachedUser, UserStateCache
+from app.services.user_cache_sync import UserCacheSync
+
+
+def cached(telegram_id: int, paid: bool) -> CachedUser:
+    return CachedUser(
+        telegram_id=telegram_id,
+        onboarding_stage="payment_ok" if paid else "wait_payment",
+        gender=None,
+        ref_code=f"ref_{telegram_id}",
+        payment_completed=paid
+    )
+
+
+def test_unpaid_users_expire_quickly():
+    cache = UserStateCache(ttl=300, prepayment_ttl=0)
+    cache.put(cached(1, paid=False))
+    cache.put(cached(2, paid=True))
+    assert cache.get(1) is None
+    assert cache.get(2) is not None
+
+
+def test_prepayment_ttl_only_without_subscription():
+    cache = UserStateCache(ttl=300, prepayment_ttl=0)
+
+    async def scenario():
+        sync = UserCacheSync(cache, "test:invalidate", redis=FakeRedis(server=FakeServer()))
+        await sync.start()
+        await asyncio.wait_for(sync._subscribed.wait(), 1)
+        try:
+            cache.put(cached(1, paid=False))
+            synced = cache.get(1)
+        finally:
+            await sync.stop()
+        cache.put(cached(2, paid=False))
+        return synced, cache.get(2)
+
+    synced, unsynced = asyncio.run(scenario())
+    # С подпиской запись без оплаты живет полный TTL, без нее - prepayment_ttl
+    assert synced is not None
+    assert unsynced is None
+
+
+def test_payment_in_web_process_invalidates_bot_cache():
+    server = FakeServer()
+    bot_cache = UserStateCache()
+    web_cache = UserStateCache()
+
+    async def scenario():
+        bot_sync = UserCacheSync(bot_cache, "test:invalidate", redis=FakeRedis(server=server))
+        web_sync = UserCacheSync(web_cache, "test:invalidate", redis=FakeRedis(server=server))
+        await bot_sync.start()
+        await web_sync.start()
+        await asyncio.wait_for(bot_sync._subscribed.wait(), 1)
+        await asyncio.wait_for(web_sync._subscribed.wait(), 1)
+        try:
+            bot_cache.put(cached(1, paid=True))
+            bot_cache.put(cached(2, paid=True))
+
+            # UserCRUD.complete_payment в веб-процессе
+            web_cache.invalidate(1)
+            for _ in range(50):
+                if bot_cache.get(1) is None:
+                    break
+                await asyncio.sleep(0.02)
+
+            # Свое изменение не сбрасывает собственный кэш
+            bot_cache.update(2, gender="female")
+            await asyncio.sleep(0.1)
+            return bot_cache.get(1), bot_cache.get(2), bot_sync.stats(), web_sync.stats()
+        finally:
+            await bot_sync.stop()
+            await web_sync.stop()
+
+    first, second, bot_stats, web_stats = asyncio.run(scenario())
+    assert first is None
+    assert second is not None and second.gender == "female"
+    assert web_stats["published"] == 1 and bot_stats["received"] == 1
+    assert web_stats["received"] == 1
+    assert bot_cache._publish is None
+
+
+def test_lookups_are_exported_to_prometheus():
+    def sample(result):
+        return REGISTRY.get_sample_value("bot_user_cache_lookups_total", {"result": result}) or 0.0
+
+    cache = UserStateCache(ttl=300)
+    hits, misses = sample("hit"), sample("miss")
+    cache.put(cached(1, paid=True))
+    cache.get(1)
+    cache.get(2)
+    assert sample("hit") - hits == 1 and sample("miss") - misses == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
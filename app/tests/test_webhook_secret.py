@@ -0,0 +1,41 @@
+"""
+Тесты проверки секрета Telegram webhook
+app/tests/test_webhook_secret.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from app.bot import run_webhook
+from app.config import settings
+from app.webapp import check_webhook_secret
+
+
+def make_request(headers: dict):
+    return SimpleNamespace(
+        headers=headers,
+        url=SimpleNamespace(path=settings.WEBHOOK_PATH),
+        client=SimpleNamespace(host="203.0.113.1")
+    )
+
+
+def test_empty_secret_rejects_everything(monkeypatch):
+    monkeypatch.setattr(settings, "WEBHOOK_SECRET", "")
+    with pytest.raises(HTTPException) as error:
+        check_webhook_secret(make_request({}))
+    assert error.value.status_code == 403
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_webhook(bot=None, dp=None))
+
+
+def test_secret_header_is_required(monkeypatch):
+    monkeypatch.setattr(settings, "WEBHOOK_SECRET", "s3cret")
+    check_webhook_secret(make_request({"X-Telegram-Bot-Api-Secret-Token": "s3cret"}))
+
+    for headers in ({}, {"X-Telegram-Bot-Api-Secret-Token": "wrong"}):
+        with pytest.raises(HTTPException) as error:
+            check_webhook_secret(make_request(headers))
+        assert error.value.status_code == 403
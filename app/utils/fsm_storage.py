@@ -0,0 +1,93 @@
+"""
+Выбор FSM-хранилища по настройкам (memory / redis)
+app/utils/fsm_storage.py
+"""
+import json
+import logging
+from datetime import date, datetime
+from typing import Any, Optional
+
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Маркеры для дат: FSM хранит datetime (например, start_date в отчетах),
+# а обычный json их не умеет
+_DATETIME_TAG = "__dt__"
+_DATE_TAG = "__d__"
+
+
+def _encode_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {_DATETIME_TAG: value.isoformat()}
+    if isinstance(value, date):
+        return {_DATE_TAG: value.isoformat()}
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_hook(obj: dict) -> Any:
+    if len(obj) == 1:
+        if _DATETIME_TAG in obj:
+            return datetime.fromisoformat(obj[_DATETIME_TAG])
+        if _DATE_TAG in obj:
+            return date.fromisoformat(obj[_DATE_TAG])
+    return obj
+
+
+def fsm_json_dumps(data: Any) -> str:
+    """Компактная сериализация данных FSM (без пробелов, кириллица без \\u-экранирования)"""
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=_encode_default)
+
+
+def fsm_json_loads(raw: Any) -> Any:
+    """Обратная операция для fsm_json_dumps"""
+    return json.loads(raw, object_hook=_decode_hook)
+
+
+def create_fsm_storage() -> BaseStorage:
+    """
+    Создание FSM-хранилища согласно settings.FSM_STORAGE
+
+    memory - состояние живет в процессе (один инстанс бота)
+    redis  - состояние в Redis, переживает рестарт и доступно всем репликам
+    """
+    mode = settings.FSM_STORAGE.lower()
+
+    if mode == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+
+        storage = RedisStorage.from_url(
+            settings.REDIS_URL,
+            key_builder=DefaultKeyBuilder(prefix=settings.FSM_KEY_PREFIX, with_destiny=True),
+            state_ttl=settings.FSM_STATE_TTL or None,
+            data_ttl=settings.FSM_DATA_TTL or None,
+            json_dumps=fsm_json_dumps,
+            json_loads=fsm_json_loads,
+        )
+        logger.info(f"💾 FSM storage: Redis (prefix={settings.FSM_KEY_PREFIX})")
+        return storage
+
+    if mode != "memory":
+        logger.warning(f"⚠️ Unknown FSM_STORAGE '{settings.FSM_STORAGE}', falling back to memory")
+
+    logger.info("💾 FSM storage: Memory")
+    return MemoryStorage()
+
+
+def create_events_isolation(storage: BaseStorage) -> Optional[BaseEventIsolation]:
+    """
+    Изоляция событий одного пользователя между репликами.
+
+    Для Redis апдейты одного чата обрабатываются под распределенной блокировкой,
+    поэтому два воркера не перезапишут FSM-данные друг друга.
+    """
+    if hasattr(storage, "create_isolation"):
+        return storage.create_isolation(
+            lock_kwargs={"timeout": settings.FSM_LOCK_TIMEOUT}
+        )
+    return None
@@ -3,8 +3,12 @@
 """
 import hashlib
 import random
+import re
 import string
 
+# Допустимый ref_code: generate_ref_code дает "ref_XXXXXX", запас на старые коды
+REF_CODE_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
 
 def generate_ref_code(user_id: int) -> str:
     """Генерация уникального реферального кода"""
@@ -16,6 +20,11 @@ def generate_ref_code(user_id: int) -> str:
     return f"ref_{hash_hex[:6].upper()}"
 
 
+def is_valid_ref_code(ref_code: str) -> bool:
+    """Проверка формата ref_code из ссылки (до обращения к БД)"""
+    return bool(ref_code) and REF_CODE_PATTERN.fullmatch(ref_code) is not None
+
+
 def generate_random_string(length: int = 8) -> str:
     """Генерация случайной строки"""
     characters = string.ascii_letters + string.digits
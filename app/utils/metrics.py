@@ -0,0 +1,175 @@
+"""
+Prometheus-метрики бота и веб-приложения
+app/utils/metrics.py
+
+Бот отдает метрики на локальном порту (METRICS_PORT),
+FastAPI-приложение - на /metrics.
+"""
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger(__name__)
+
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_latency_seconds",
+    "Время выполнения хендлера",
+    ["router", "handler"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total",
+    "Исключения в хендлерах",
+    ["router", "handler", "error"]
+)
+TELEGRAM_API_LATENCY = Histogram(
+    "bot_telegram_api_latency_seconds",
+    "Время запроса к Telegram Bot API",
+    ["method"],
+    buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+TELEGRAM_API_ERRORS = Counter(
+    "bot_telegram_api_errors_total",
+    "Ошибки запросов к Telegram Bot API по классу исключения",
+    ["method", "error"]
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_latency_seconds",
+    "Время выполнения SQL-запроса",
+    ["operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+AUTOMATED_MESSAGES_BACKLOG = Gauge(
+    "bot_automated_messages_backlog",
+    "Запланированные автосообщения, время отправки которых уже наступило"
+)
+AUTOMATED_MESSAGES_SENDING = Gauge(
+    "bot_automated_messages_sending",
+    "Автосообщения в статусе sending (взяты в отправку, результат не записан)"
+)
+AUTOMATED_MESSAGES_STUCK = Counter(
+    "bot_automated_messages_stuck_total",
+    "Автосообщения, зависшие в sending и помеченные failed"
+)
+ACTIVE_BROADCASTS = Gauge(
+    "bot_active_broadcasts",
+    "Рассылки, выполняющиеся в данный момент"
+)
+DEEPSEEK_API_LATENCY = Histogram(
+    "deepseek_api_latency_seconds",
+    "Время запроса к DeepSeek API (с повторами)",
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 30, 60)
+)
+DEEPSEEK_CACHE_LOOKUPS = Counter(
+    "deepseek_answer_cache_lookups_total",
+    "Обращения к кэшу сопоставления вопросов",
+    ["result"]
+)
+SUPPORT_PREMATCH_RESULTS = Counter(
+    "support_prematch_results_total",
+    "Вопросы поддержки: ответ локальным сопоставлением (local) или через DeepSeek (llm)",
+    ["result"]
+)
+THROTTLED_UPDATES = Counter(
+    "bot_throttling_updates_total",
+    "Апдейты, прошедшие лимит частоты (allowed) и отброшенные им (shed)",
+    ["result"]
+)
+USER_CACHE_LOOKUPS = Counter(
+    "bot_user_cache_lookups_total",
+    "Обращения к кэшу состояния пользователей (hit/miss)",
+    ["result"]
+)
+USER_CACHE_EVICTIONS = Counter(
+    "bot_user_cache_evictions_total",
+    "Записи кэша пользователей, вытесненные по размеру (LRU)"
+)
+USER_CACHE_ENTRIES = Gauge(
+    "bot_user_cache_entries",
+    "Записи в кэше состояния пользователей"
+)
+DEEPSEEK_LATENCY_SAVED = Counter(
+    "deepseek_answer_cache_saved_seconds_total",
+    "Время запросов к DeepSeek API, сэкономленное попаданиями в кэш"
+)
+
+
+def _handler_labels(data: Dict[str, Any]) -> tuple:
+    """Метки router/handler: имя роутера (или модуль хендлера, если роутер безымянный)"""
+    handler = data.get("handler")
+    callback = getattr(handler, "callback", None)
+    handler_name = getattr(callback, "__name__", "unknown")
+
+    router = data.get("event_router")
+    router_name = getattr(router, "name", "") or ""
+    if not router_name or router_name.startswith("0x"):
+        router_name = getattr(callback, "__module__", "unknown").removeprefix("app.")
+
+    return router_name, handler_name
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: замер времени сработавшего хендлера"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        router_name, handler_name = _handler_labels(data)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.labels(router_name, handler_name, type(e).__name__).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(router_name, handler_name).observe(time.perf_counter() - start)
+
+
+class TelegramApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время и ошибки вызовов Bot API"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[Any],
+        bot,
+        method: TelegramMethod[Any]
+    ) -> Any:
+        method_name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_API_ERRORS.labels(method_name, type(e).__name__).inc()
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.labels(method_name).observe(time.perf_counter() - start)
+
+
+def observe_db_query(statement: str, elapsed: float) -> None:
+    """Вызывается из app/database/engine.py после каждого запроса"""
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+    DB_QUERY_LATENCY.labels(operation).observe(elapsed)
+
+
+def setup_bot_metrics(dp, bot) -> None:
+    """Подключение метрик хендлеров и Bot API к диспетчеру и боту"""
+    handler_metrics = HandlerMetricsMiddleware()
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
+    bot.session.middleware(TelegramApiMetricsMiddleware())
+
+
+def start_metrics_server(port: int, addr: str = "127.0.0.1") -> None:
+    """HTTP-сервер с метриками для процесса бота"""
+    start_http_server(port, addr=addr)
+    logger.info(f"📈 Prometheus metrics on http://{addr}:{port}/metrics")
@@ -2,18 +2,27 @@
 FastAPI приложение для обработки webhooks с поддержкой Robokassa
 """
 from fastapi import FastAPI, Request, HTTPException, Form, Query
-from fastapi.responses import RedirectResponse, HTMLResponse, PlainTextResponse
+from fastapi.responses import RedirectResponse, HTMLResponse, PlainTextResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import hashlib
 import hmac
 import logging
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
 
 from app.config import settings
-from app.database.connection import AsyncSessionLocal
-from app.database.crud import ClickCRUD, SaleCRUD
+from app.database.connection import AsyncSessionLocal, engine
+from app.database.engine import db_stats, get_pool_status
+from app.database.crud import ClickCRUD, ReferralHistoryCRUD, SaleCRUD
+from app.database.models import Click
+from app.database.user_cache import user_state_cache
+from app.services.click_buffer import click_buffer
+from app.services.funnel_refresher import funnel_refresher
+from app.services.user_cache_sync import start_user_cache_sync, user_cache_sync
 from app.services.robokassa_handler import robokassa_handler
-from app.services.google_sheets import init_google_sheets
+from app.services.google_sheets import init_google_sheets, sheets_service
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +41,21 @@ async def startup_event():
     except Exception as e:
         logger.error(f"❌ Failed to initialize Google Sheets: {e}")
 
+    await click_buffer.start()
+    await funnel_refresher.start()
+    await start_user_cache_sync()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Запись оставшихся кликов и строк Sheets, закрытие пула соединений при остановке FastAPI"""
+    await click_buffer.stop()
+    await funnel_refresher.stop()
+    await user_cache_sync.stop()
+    await sheets_service.close()
+    await engine.dispose()
+    logger.info("🛑 DB engine disposed")
+
 
 @app.get("/")
 async def root():
@@ -52,10 +76,19 @@ async def health_check():
         "service": "referral-bot-webhooks",
         "timestamp": datetime.now().isoformat(),
         "robokassa_enabled": not settings.ONBOARDING_MOCK_PAYMENT,
-        "test_mode": settings.ROBOKASSA_TEST_MODE if not settings.ONBOARDING_MOCK_PAYMENT else None
+        "test_mode": settings.ROBOKASSA_TEST_MODE if not settings.ONBOARDING_MOCK_PAYMENT else None,
+        "database": {**get_pool_status(engine), **db_stats.snapshot()},
+        "clicks": click_buffer.stats(),
+        "user_cache": {**user_state_cache.stats(), "sync": user_cache_sync.stats()}
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus-метрики (время SQL-запросов и др.)"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 # ========================================
 # ИСПРАВЛЕННЫЙ RESULT ENDPOINT
 # ========================================
@@ -282,48 +315,19 @@ async def robokassa_fail(
 
 @app.get("/track/{ref_code}")
 async def track_click(ref_code: str, request: Request):
-    """Отслеживание переходов по реферальной ссылке с поддержкой user_telegram_id"""
-    client_ip = request.client.host
-    user_agent = request.headers.get("user-agent", "Unknown")
-    
-    async with AsyncSessionLocal() as session:
-        from app.database.crud import ClickCRUD, ReferralHistoryCRUD, UserCRUD
-        
-        # Пытаемся определить пользователя по IP и user-agent
-        # (это приблизительный метод, можно улучшить)
-        user_telegram_id = None
-        
-        # TODO: Здесь можно добавить более сложную логику определения пользователя
-        # Например, через cookies, fingerprinting и т.д.
-        # Пока оставляем None для веб-кликов
-        
-        try:
-            # Записываем клик
-            await ClickCRUD.create_click(
-                session=session,
-                ref_code=ref_code,
-                ip_address=client_ip,
-                user_agent=user_agent,
-                source=request.query_params.get("utm_source", "web"),
-                user_telegram_id=user_telegram_id  # Пока None для веб-трафика
-            )
-            
-            # Если удалось определить пользователя - логируем в историю
-            if user_telegram_id:
-                await ReferralHistoryCRUD.log_action(
-                    session=session,
-                    user_telegram_id=user_telegram_id,
-                    ref_code=ref_code,
-                    action_type="click",
-                    ip_address=client_ip,
-                    user_agent=user_agent
-                )
-                logger.info(f"✅ Web click with user_id {user_telegram_id} tracked for {ref_code}")
-            else:
-                logger.info(f"✅ Anonymous web click tracked for {ref_code}")
-                
-        except Exception as e:
-            logger.error(f"❌ Error tracking click: {e}")
+    """
+    Отслеживание переходов по реферальной ссылке
+
+    Клик ставится в очередь click_buffer и пишется в БД пачкой в фоне,
+    редирект отдается сразу, не дожидаясь commit.
+    """
+    # user_telegram_id для веб-кликов неизвестен, его проставляет /api/link-user-click
+    click_buffer.submit(
+        ref_code=ref_code,
+        ip_address=request.client.host,
+        user_agent=request.headers.get("user-agent", "Unknown"),
+        source=request.query_params.get("utm_source", "web")
+    )
     
     # Редирект на лендинг
     landing_url = f"{settings.LANDING_URL}?ref={ref_code}"
@@ -349,18 +353,9 @@ async def link_user_click(request: Request):
         async with AsyncSessionLocal() as session:
             # Ищем последний анонимный клик с этим ref_code
             # и обновляем его user_telegram_id
-            result = await session.execute(
-                select(Click)
-                .where(
-                    Click.ref_code == ref_code,
-                    Click.user_telegram_id.is_(None),
-                    Click.created_at >= datetime.now() - timedelta(hours=1)  # Последний час
-                )
-                .order_by(Click.created_at.desc())
-                .limit(1)
+            click = await ClickCRUD.get_last_anonymous_click(
+                session, ref_code, since=datetime.now() - timedelta(hours=1)  # Последний час
             )
-            
-            click = result.scalar_one_or_none()
             if click:
                 # Обновляем клик
                 await session.execute(
@@ -2,6 +2,7 @@
 FastAPI приложение для обработки webhooks
 Создайте этот файл как: app.py (в корне проекта, рядом с bot.py)
 """
+import hmac
 import logging
 from fastapi import FastAPI, Request, HTTPException, Form
 from fastapi.responses import RedirectResponse, PlainTextResponse, HTMLResponse
@@ -64,13 +65,57 @@ async def track_click(ref_code: str, request: Request):
     return RedirectResponse(url=landing_url, status_code=302)
 
 
-@app.post("/webhook/telegram")
+def check_webhook_secret(request: Request):
+    """
+    Проверка X-Telegram-Bot-Api-Secret-Token
+
+    Без настроенного WEBHOOK_SECRET запросы отклоняются всегда
+    (run_webhook в этом случае не запускается).
+    """
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not settings.WEBHOOK_SECRET or not hmac.compare_digest(
+        secret.encode(), settings.WEBHOOK_SECRET.encode()
+    ):
+        logger.warning(f"Request to {request.url.path} with invalid secret from {request.client.host}")
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.post(settings.WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
-    """Webhook для Telegram обновлений"""
-    # Этот эндпоинт будет использоваться aiogram
+    """
+    Webhook для Telegram обновлений.
+    Апдейт кладется в очередь, ответ Telegram отдается сразу.
+    Очередь подключает app/bot.py в режиме BOT_MODE=webhook.
+    """
+    check_webhook_secret(request)
+    
+    update_queue = getattr(request.app.state, "update_queue", None)
+    if update_queue is None:
+        raise HTTPException(status_code=503, detail="Update queue is not running")
+    
+    payload = await request.json()
+    
+    # При переполнении отвечаем ошибкой - Telegram доставит апдейт повторно
+    if not update_queue.submit(payload):
+        raise HTTPException(status_code=503, detail="Update queue is full")
+    
     return {"ok": True}
 
 
+@app.get(settings.WEBHOOK_PATH + "/stats")
+async def telegram_webhook_stats(request: Request):
+    """
+    Глубина очереди апдейтов и счетчики воркеров
+
+    Только с заголовком X-Telegram-Bot-Api-Secret-Token = WEBHOOK_SECRET
+    """
+    check_webhook_secret(request)
+    update_queue = getattr(request.app.state, "update_queue", None)
+    if update_queue is None:
+        return {"running": False}
+    return {"running": update_queue.is_running, **update_queue.stats()}
+
+
 @app.post("/webhook/robokassa/result")
 async def robokassa_result_webhook(
     OutSum: float = Form(...),
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк обработки наступивших автосообщений: 10k строк
+
+Сравнивает старый цикл (пользователь + UPDATE + COMMIT на каждое сообщение)
+с пакетной обработкой AutomatedMessagingService.process_pending_messages.
+БД - SQLite во временном файле, бот - заглушка с настраиваемой задержкой.
+
+Запуск (нужны переменные окружения из .env):
+    python benchmark_automated_messages.py [--rows 10000] [--latency 0.0]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, '.')
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import app.services.automated_messaging as automated_messaging
+from app.database.crud import AutomatedMessageCRUD, UserCRUD
+from app.database.engine import _attach_instrumentation, db_stats
+from app.database.models import AutomatedMessage, AutomatedMessageStatus, OnboardingStage, User
+from app.services import broadcast_sender
+
+
+class FakeBot:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_video_note(self, chat_id: int, video_note: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+async def seed(session_maker, rows: int) -> None:
+    """rows пользователей и по одному наступившему сообщению на каждого (10% - сменили стадию)"""
+    past = datetime.now() - timedelta(minutes=5)
+    async with session_maker() as session:
+        session.add_all([
+            User(
+                telegram_id=100000 + i,
+                ref_code=f"ref{i}",
+                onboarding_stage=OnboardingStage.WAIT_PAYMENT if i % 10 == 0 else OnboardingStage.NEW_USER
+            )
+            for i in range(rows)
+        ])
+        await session.flush()
+        user_ids = (await session.execute(select(User.id).order_by(User.id))).scalars().all()
+        session.add_all([
+            AutomatedMessage(
+                user_id=user_id,
+                telegram_id=100000 + i,
+                video_file_id=f"video{i % 4}",
+                video_type=f"K_VIDEO_ID{i % 4 + 1}",
+                required_stage='["new_user","intro_shown"]',
+                blocked_stages=json.dumps([OnboardingStage.WAIT_PAYMENT]),
+                scheduled_at=past,
+                status=AutomatedMessageStatus.SCHEDULED
+            )
+            for i, user_id in enumerate(user_ids)
+        ])
+        await session.commit()
+
+
+async def run_legacy(session_maker, bot: FakeBot) -> None:
+    """Старый process_pending_messages (по 100 сообщений, N+1 запросов)"""
+    while True:
+        async with session_maker() as session:
+            messages = await AutomatedMessageCRUD.get_pending_messages(session)
+            if not messages:
+                return
+            for message in messages:
+                user = await UserCRUD.get_user_by_telegram_id(session, message.telegram_id)
+                if not user:
+                    await AutomatedMessageCRUD.update_message_status(
+                        session, message.id, AutomatedMessageStatus.FAILED, "User not found"
+                    )
+                    continue
+                allowed_stages = json.loads(message.required_stage)
+                if user.onboarding_stage not in allowed_stages:
+                    await AutomatedMessageCRUD.update_message_status(
+                        session, message.id, AutomatedMessageStatus.CANCELLED,
+                        f"User stage changed to {user.onboarding_stage}"
+                    )
+                    continue
+                await bot.send_video_note(chat_id=message.telegram_id, video_note=message.video_file_id)
+                await AutomatedMessageCRUD.update_message_status(session, message.id, AutomatedMessageStatus.SENT)
+
+
+async def run_batched(bot: FakeBot) -> None:
+    service = automated_messaging.AutomatedMessagingService(bot)
+    while await service.process_pending_messages() >= automated_messaging.PENDING_BATCH_SIZE:
+        pass
+
+
+async def measure(title: str, rows: int, latency: float, batched: bool) -> None:
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(lambda sync_conn: User.__table__.create(sync_conn))
+        await conn.run_sync(lambda sync_conn: AutomatedMessage.__table__.create(sync_conn))
+    session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    automated_messaging.async_session_maker = session_maker
+
+    await seed(session_maker, rows)
+    _attach_instrumentation(engine, slow_query_ms=0)
+    db_stats.reset()
+
+    bot = FakeBot(latency)
+    started = time.perf_counter()
+    if batched:
+        await run_batched(bot)
+    else:
+        await run_legacy(session_maker, bot)
+    elapsed = time.perf_counter() - started
+
+    async with session_maker() as session:
+        statuses = dict((await session.execute(
+            select(AutomatedMessage.status, func.count()).group_by(AutomatedMessage.status)
+        )).all())
+    await engine.dispose()
+
+    print(f"\n{title}")
+    print(f"  time:        {elapsed:.2f}s ({rows / elapsed:.0f} msg/s)")
+    print(f"  statements:  {db_stats.statements}")
+    print(f"  sent:        {bot.sent}")
+    print(f"  statuses:    {statuses}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка send_video_note, сек")
+    parser.add_argument("--rate", type=float, default=100_000, help="лимит отправок в секунду")
+    args = parser.parse_args()
+
+    broadcast_sender.telegram_send_limiter.rate = args.rate
+    broadcast_sender.telegram_send_limiter.capacity = args.rate
+
+    print(f"🧪 {args.rows} due automated messages, send latency {args.latency * 1000:.0f} ms")
+    await measure("Legacy loop (N+1, commit per message):", args.rows, args.latency, batched=False)
+    await measure("Set-based batch processing:", args.rows, args.latency, batched=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Микро-бенчмарк ThrottlingMiddleware: память при 1M уникальных пользователей
+
+Сравнивает старый подход (словарь user_id -> timestamp, растет бесконечно)
+с MemoryTokenBucket, который выбрасывает наполнившиеся ведра.
+Время симулируется: N апдейтов в секунду от всё новых пользователей.
+
+Запуск: python benchmark_throttling.py [--users 1000000] [--rps 2000]
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, '.')
+
+from app.middlewares.throttling import MemoryTokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def run_legacy(users: int, rps: int, checkpoints: list) -> list:
+    """Старый ThrottlingMiddleware: user_timestamps без очистки"""
+    user_timestamps = {}
+    results = []
+    tracemalloc.start()
+    for i in range(users):
+        now = i / rps
+        last = user_timestamps.get(i)
+        if last is None or now - last >= 1:
+            user_timestamps[i] = now
+        if i + 1 in checkpoints:
+            current, _ = tracemalloc.get_traced_memory()
+            results.append((i + 1, len(user_timestamps), current))
+    tracemalloc.stop()
+    return results
+
+
+def run_token_bucket(users: int, rps: int, checkpoints: list, rate: float, burst: float) -> list:
+    clock = FakeClock()
+    limiter = MemoryTokenBucket(rate, burst, sweep_interval=10.0, clock=clock)
+    results = []
+    tracemalloc.start()
+    for i in range(users):
+        clock.now = i / rps
+        limiter.try_consume(i, 1)
+        if i + 1 in checkpoints:
+            current, _ = tracemalloc.get_traced_memory()
+            results.append((i + 1, len(limiter), current))
+    tracemalloc.stop()
+    return results
+
+
+def print_results(title: str, results: list) -> None:
+    print(f"\n{title}")
+    print(f"{'updates':>10} {'tracked':>10} {'memory, KB':>12}")
+    for updates, tracked, memory in results:
+        print(f"{updates:>10} {tracked:>10} {memory / 1024:>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--rps", type=int, default=2000, help="апдейтов в секунду (симуляция)")
+    parser.add_argument("--rate", type=float, default=1.0)
+    parser.add_argument("--burst", type=float, default=5.0)
+    args = parser.parse_args()
+
+    checkpoints = [args.users * k // 10 for k in range(1, 11)]
+
+    print(f"🧪 {args.users} distinct users at {args.rps} updates/s (simulated)")
+
+    started = time.perf_counter()
+    legacy = run_legacy(args.users, args.rps, checkpoints)
+    print_results("Legacy dict (user_timestamps):", legacy)
+
+    bucket = run_token_bucket(args.users, args.rps, checkpoints, args.rate, args.burst)
+    print_results("MemoryTokenBucket with eviction:", bucket)
+
+    print(f"\n⏱ Total: {time.perf_counter() - started:.1f}s")
+    print(f"📈 Legacy growth: {legacy[0][2] / 1024:.0f} KB -> {legacy[-1][2] / 1024:.0f} KB")
+    print(f"📉 Token bucket: {bucket[0][2] / 1024:.0f} KB -> {bucket[-1][2] / 1024:.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
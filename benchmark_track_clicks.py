@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест /track/{ref_code}: задержка редиректа
+
+Сравнивает старый эндпоинт (INSERT + COMMIT до ответа) с буферизованным
+(click_buffer + фоновая пакетная запись). Запросы идут через ASGI-транспорт
+httpx без сети, БД - SQLite во временном файле. После остановки буфера
+проверяется, что все клики записаны и partner_stats совпадает.
+
+Запуск (нужны переменные окружения из .env):
+    python benchmark_track_clicks.py [--requests 20000] [--rate 500] [--concurrency 10] [--partners 1000]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '.')
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import RedirectResponse
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import app.services.click_buffer as click_buffer_module
+from app.config import settings
+from app.database.crud import ClickCRUD
+from app.database.engine import _attach_instrumentation, db_stats
+from app.database.models import Click, PartnerStats, User
+from app.services.click_buffer import ClickBuffer
+from app.web.app import app as web_app
+
+
+WARMUP_REQUESTS = 100
+
+
+def legacy_app(session_maker) -> FastAPI:
+    """Старый /track: клик пишется и коммитится до редиректа"""
+    legacy = FastAPI()
+
+    @legacy.get("/track/{ref_code}")
+    async def track_click(ref_code: str, request: Request):
+        async with session_maker() as session:
+            await ClickCRUD.create_click(
+                session=session,
+                ref_code=ref_code,
+                ip_address=request.client.host,
+                user_agent=request.headers.get("user-agent", "Unknown"),
+                source=request.query_params.get("utm_source", "web")
+            )
+        return RedirectResponse(url=f"{settings.LANDING_URL}?ref={ref_code}", status_code=302)
+
+    return legacy
+
+
+async def create_db(partners: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    # busy timeout: старый эндпоинт пишет из многих соединений параллельно
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}", connect_args={"timeout": 60})
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _wal(dbapi_connection, _):
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+    async with engine.begin() as conn:
+        for model in (User, Click, PartnerStats):
+            await conn.run_sync(lambda sync_conn, table=model.__table__: table.create(sync_conn))
+    session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with session_maker() as session:
+        session.add_all([User(telegram_id=100000 + i, ref_code=f"ref{i}") for i in range(partners)])
+        await session.commit()
+    return engine, session_maker
+
+
+def timed(asgi_app, latencies: list):
+    """ASGI-обертка: время обработки запроса приложением (без клиента httpx), мс"""
+    async def wrapper(scope, receive, send):
+        started = time.perf_counter()
+        await asgi_app(scope, receive, send)
+        if scope["type"] == "http":
+            latencies.append((time.perf_counter() - started) * 1000)
+    return wrapper
+
+
+async def fire(asgi_app, args) -> tuple:
+    """
+    args.requests запросов с темпом args.rate в секунду (открытая модель:
+    запрос уходит по расписанию, не дожидаясь предыдущих).
+    Параллельность ограничена args.concurrency клиентами.
+
+    Returns:
+        (задержки клиента, задержки эндпоинта) в мс
+    """
+    client_latencies, server_latencies = [], []
+    transport = httpx.ASGITransport(app=timed(asgi_app, server_latencies), client=("10.0.0.1", 12345))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # Прогрев: первый запрос собирает middleware-стек и роутинг FastAPI
+        for i in range(WARMUP_REQUESTS):
+            await client.get(f"/track/ref{i % args.partners}")
+        # ...и первая пачка флашера (компиляция операторов SQLAlchemy, однократно)
+        await asyncio.sleep(1)
+        server_latencies.clear()
+
+        started = time.perf_counter()
+        next_index = iter(range(args.requests))
+
+        async def worker():
+            for index in next_index:
+                delay = started + index / args.rate - time.perf_counter()
+                # ASGI-транспорт не отдает управление циклу (в uvicorn это делает сетевой ввод-вывод)
+                await asyncio.sleep(max(0.0, delay))
+                ref_code = f"ref{random.randrange(args.partners)}"
+                request_started = time.perf_counter()
+                response = await client.get(f"/track/{ref_code}", params={"utm_source": "bench"})
+                client_latencies.append((time.perf_counter() - request_started) * 1000)
+                assert response.status_code == 302, response.status_code
+
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    return client_latencies, server_latencies
+
+
+def percentiles(latencies: list) -> str:
+    quantiles = statistics.quantiles(latencies, n=100)
+    return f"p50 {quantiles[49]:.2f} | p95 {quantiles[94]:.2f} | p99 {quantiles[98]:.2f} | max {max(latencies):.2f}"
+
+
+def report(title: str, latencies: tuple, elapsed: float) -> None:
+    client_latencies, server_latencies = latencies
+    print(f"\n{title}")
+    print(f"  requests:    {len(client_latencies)} in {elapsed:.2f}s ({len(client_latencies) / elapsed:.0f} req/s)")
+    print(f"  endpoint ms: {percentiles(server_latencies)}")
+    print(f"  client ms:   {percentiles(client_latencies)}")
+    print(f"  statements:  {db_stats.statements}")
+
+
+async def count_clicks(session_maker) -> tuple:
+    async with session_maker() as session:
+        clicks = (await session.execute(select(func.count(Click.id)))).scalar()
+        counters = (await session.execute(select(func.coalesce(func.sum(PartnerStats.clicks), 0)))).scalar()
+    return clicks, counters
+
+
+async def measure_legacy(args) -> None:
+    engine, session_maker = await create_db(args.partners)
+    import app.database.crud as crud
+    crud.AsyncSessionLocal = session_maker
+    _attach_instrumentation(engine, slow_query_ms=10_000)
+    db_stats.reset()
+
+    started = time.perf_counter()
+    latencies = await fire(legacy_app(session_maker), args)
+    report("Legacy /track (INSERT + COMMIT per click):", latencies, time.perf_counter() - started)
+    print(f"  clicks/counters: {await count_clicks(session_maker)} (expected {args.requests + WARMUP_REQUESTS})")
+    await engine.dispose()
+
+
+async def measure_buffered(args) -> None:
+    engine, session_maker = await create_db(args.partners)
+    click_buffer_module.AsyncSessionLocal = session_maker
+    buffer = ClickBuffer(
+        batch_size=args.batch_size,
+        flush_interval=args.interval / 1000,
+        max_size=args.requests + 1
+    )
+    click_buffer_module.click_buffer = buffer
+    # Эндпоинт ссылается на click_buffer, импортированный в app.web.app
+    import app.web.app as web_module
+    web_module.click_buffer = buffer
+
+    await buffer.start()
+    _attach_instrumentation(engine, slow_query_ms=10_000)
+    db_stats.reset()
+
+    started = time.perf_counter()
+    latencies = await fire(web_app, args)
+    report(f"Buffered /track (batch {args.batch_size}, {args.interval} ms):", latencies, time.perf_counter() - started)
+    print(f"  queue after load: {buffer.stats()['queue_depth']}")
+
+    drain_started = time.perf_counter()
+    await buffer.stop()
+    print(f"  drain:       {(time.perf_counter() - drain_started) * 1000:.0f} ms")
+    print(f"  buffer:      {buffer.stats()}")
+    print(f"  clicks/counters: {await count_clicks(session_maker)} (expected {args.requests + WARMUP_REQUESTS})")
+    await engine.dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=500, help="запросов в секунду")
+    parser.add_argument("--partners", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=settings.CLICK_FLUSH_BATCH_SIZE)
+    parser.add_argument("--interval", type=int, default=settings.CLICK_FLUSH_INTERVAL_MS, help="мс")
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    # Строка лога httpx на каждый запрос - это задержка клиента, а не эндпоинта
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    print(
+        f"🧪 {args.requests} clicks at {args.rate:.0f}/s, "
+        f"{args.concurrency} concurrent clients, {args.partners} partners"
+    )
+    if not args.skip_legacy:
+        await measure_legacy(args)
+    await measure_buffered(args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -23,6 +23,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.database.connection import AsyncSessionLocal, init_db
 from app.database.crud import UserCRUD
+from app.database.funnel_crud import FunnelStatsCRUD
 from app.database.models import User, OnboardingStage
 from app.services.google_sheets import GoogleSheetsService
 from app.config import settings
@@ -257,132 +258,37 @@ class ConversionAnalyticsFinal:
     
     async def get_users_by_stages_for_dates(self, date_list: List[str]) -> Dict[str, Dict[str, int]]:
         """
-        ПОЛНОСТЬЮ ПЕРЕПИСАННАЯ функция с правильным подсчетом payment_completed
+        Стадии и оплаты по датам из daily_funnel_stats (один запрос на весь список)
+
+        PAYMENT_OK - пользователи, зарегистрированные в этот день и оплатившие;
+        DAILY_PAYMENTS - оплаты Robokassa (по дню оплаты paid_at, до среза
+        считались по дню создания платежа) + продажи GetCourse за день.
         """
         result = {}
-        
-        async with AsyncSessionLocal() as session:
-            for date_str in date_list:
-                logger.info(f"📄 Processing date: {date_str}")
-                
-                try:
-                    date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-                    date_start = date_obj.replace(hour=0, minute=0, second=0, microsecond=0)
-                    date_end = date_start + timedelta(days=1)
-                    
-                    stage_counts = {
-                        OnboardingStage.NEW_USER: 0,
-                        OnboardingStage.INTRO_SHOWN: 0,
-                        OnboardingStage.WAIT_PAYMENT: 0,
-                        OnboardingStage.PAYMENT_OK: 0,
-                        "DAILY_PAYMENTS": 0
-                    }
-                    
-                    # 1. INTRO_SHOWN: пользователи ТОЧНО в стадии INTRO_SHOWN
-                    try:
-                        intro_result = await session.execute(
-                            select(func.count(User.id))
-                            .where(
-                                and_(
-                                    User.created_at >= date_start,
-                                    User.created_at < date_end,
-                                    User.onboarding_stage == OnboardingStage.INTRO_SHOWN
-                                )
-                            )
-                        )
-                        stage_counts[OnboardingStage.INTRO_SHOWN] = intro_result.scalar() or 0
-                    except Exception as e:
-                        logger.error(f"❌ Error getting INTRO_SHOWN for {date_str}: {e}")
-                        stage_counts[OnboardingStage.INTRO_SHOWN] = 0
-                    
-                    # 2. WAIT_PAYMENT: пользователи в стадии ожидания оплаты
-                    try:
-                        wait_result = await session.execute(
-                            select(func.count(User.id))
-                            .where(
-                                and_(
-                                    User.created_at >= date_start,
-                                    User.created_at < date_end,
-                                    User.onboarding_stage == OnboardingStage.WAIT_PAYMENT
-                                )
-                            )
-                        )
-                        stage_counts[OnboardingStage.WAIT_PAYMENT] = wait_result.scalar() or 0
-                    except Exception as e:
-                        logger.error(f"❌ Error getting WAIT_PAYMENT for {date_str}: {e}")
-                        stage_counts[OnboardingStage.WAIT_PAYMENT] = 0
-                    
-                    # 3. PAYMENT_OK: пользователи с payment_completed=True И регистрацией в этот день
-                    try:
-                        same_day_payment_result = await session.execute(
-                            select(func.count(User.id))
-                            .where(
-                                and_(
-                                    User.created_at >= date_start,
-                                    User.created_at < date_end,
-                                    User.payment_completed == True
-                                )
-                            )
-                        )
-                        same_day_payments = same_day_payment_result.scalar() or 0
-                        stage_counts[OnboardingStage.PAYMENT_OK] = same_day_payments
-                        
-                    except Exception as e:
-                        logger.error(f"❌ Error getting PAYMENT_OK for {date_str}: {e}")
-                        stage_counts[OnboardingStage.PAYMENT_OK] = 0
-                    
-                    # 4. DAILY_PAYMENTS: ВСЕ платежи за день
-                    try:
-                        # Robokassa платежи за этот день
-                        robokassa_count = 0
-                        try:
-                            from app.database.models import Payment
-                            robokassa_payments = await session.execute(
-                                select(func.count(Payment.id))
-                                .where(
-                                    and_(
-                                        func.date(Payment.created_at) == date_obj.date(),
-                                        Payment.status == "paid"
-                                    )
-                                )
-                            )
-                            robokassa_count = robokassa_payments.scalar() or 0
-                        except Exception as e:
-                            logger.warning(f"⚠️ Could not get Robokassa payments for {date_str}: {e}")
-                        
-                        # GetCourse платежи за этот день
-                        sales_count = 0
-                        try:
-                            from app.database.models import Sale
-                            sales_payments = await session.execute(
-                                select(func.count(Sale.id))
-                                .where(func.date(Sale.created_at) == date_obj.date())
-                            )
-                            sales_count = sales_payments.scalar() or 0
-                        except Exception as e:
-                            logger.warning(f"⚠️ Could not get GetCourse sales for {date_str}: {e}")
-                        
-                        # Итоговый подсчет
-                        daily_payments_count = robokassa_count + sales_count
-                        stage_counts["DAILY_PAYMENTS"] = daily_payments_count
-                        
-                    except Exception as e:
-                        logger.error(f"❌ Error getting DAILY_PAYMENTS for {date_str}: {e}")
-                        stage_counts["DAILY_PAYMENTS"] = 0
-                    
-                    result[date_str] = stage_counts
-                    
-                except Exception as date_error:
-                    logger.error(f"❌ Error processing date {date_str}: {date_error}")
-                    result[date_str] = {
-                        OnboardingStage.NEW_USER: 0,
-                        OnboardingStage.INTRO_SHOWN: 0,
-                        OnboardingStage.WAIT_PAYMENT: 0,
-                        OnboardingStage.PAYMENT_OK: 0,
-                        "DAILY_PAYMENTS": 0
-                    }
-                    continue
-        
+        if not date_list:
+            return result
+
+        days = sorted(datetime.strptime(date_str, '%Y-%m-%d').date() for date_str in date_list)
+
+        try:
+            async with AsyncSessionLocal() as session:
+                rows = await FunnelStatsCRUD.get_days(session, days[0], days[-1])
+        except Exception as e:
+            logger.error(f"❌ Error reading daily funnel stats: {e}")
+            rows = []
+
+        stats_by_date = {row.day.strftime('%Y-%m-%d'): row for row in rows}
+
+        for date_str in date_list:
+            row = stats_by_date.get(date_str)
+            result[date_str] = {
+                OnboardingStage.NEW_USER: 0,
+                OnboardingStage.INTRO_SHOWN: row.stage_intro_shown if row else 0,
+                OnboardingStage.WAIT_PAYMENT: row.stage_wait_payment if row else 0,
+                OnboardingStage.PAYMENT_OK: row.paid_users if row else 0,
+                "DAILY_PAYMENTS": (row.payments_count + row.sales_count) if row else 0
+            }
+
         logger.info(f"✅ Successfully processed {len(result)} dates for stages")
         return result
     
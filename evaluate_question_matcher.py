@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Офлайн-оценка локального сопоставления вопросов поддержки (QuestionMatcher)
+
+На размеченном наборе вопросов считает для каждого порога:
+- local      - доля вопросов, отвеченных без DeepSeek
+- precision  - доля правильных среди локальных ответов
+- wrong      - локальные ответы не на тот вопрос (в т.ч. на вопрос без ответа)
+- recall@k   - доля вопросов с ответом, у которых верный вопрос попал в top-k
+                (только он и нужен модели, чтобы ответить правильно)
+и латентность сопоставления (p50/p99) и построения индекса.
+
+С --llm вопросы, не отвеченные локально, отправляются в DeepSeek
+(top-k кандидатов) - сквозная точность и время ответа. Нужен DEEPSEEK_API_KEY.
+
+Формат --dataset (JSON):
+    {"qa_pairs": [{"question": "...", "answer": "..."}, ...],
+     "questions": [{"text": "...", "expected": "вопрос из qa_pairs" | null}, ...]}
+Без --dataset используется встроенный пример.
+
+Запуск: python evaluate_question_matcher.py [--dataset file.json] [--top-k 5] [--llm]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+from app.services.question_matcher import QuestionMatcher
+
+SAMPLE_QA_PAIRS = [
+    {"question": "Как оплатить курс?", "answer": "Нажмите «Оплатить» в меню бота и выберите способ оплаты."},
+    {"question": "Где взять реферальную ссылку?", "answer": "Раздел «Моя ссылка» в главном меню."},
+    {"question": "Когда выплачивают комиссию?", "answer": "Выплаты раз в неделю по понедельникам."},
+    {"question": "Какой процент комиссии?", "answer": "Партнер получает процент с каждой оплаты приглашенного."},
+    {"question": "Как вывести деньги?", "answer": "Раздел «Вывод средств», минимальная сумма указана там же."},
+    {"question": "Не пришло видео урока", "answer": "Нажмите «Следующий урок» еще раз или напишите нам."},
+    {"question": "Можно ли оплатить картой иностранного банка?", "answer": "Да, через GetCourse."},
+    {"question": "Сколько длится курс?", "answer": "Курс состоит из уроков, проходить можно в своем темпе."},
+    {"question": "Как посмотреть статистику переходов?", "answer": "Раздел «Статистика» в меню партнера."},
+    {"question": "Оплатил, но доступ не открылся", "answer": "Пришлите чек, проверим оплату вручную."},
+    {"question": "Можно ли вернуть деньги?", "answer": "Возврат возможен в течение 14 дней."},
+    {"question": "Как сменить реквизиты для выплат?", "answer": "Напишите новые реквизиты в поддержку."},
+]
+
+SAMPLE_QUESTIONS = [
+    {"text": "как оплатить курс", "expected": "Как оплатить курс?"},
+    {"text": "Как оплатить?", "expected": "Как оплатить курс?"},
+    {"text": "как оплотить курс", "expected": "Как оплатить курс?"},
+    {"text": "где моя реферальная ссылка", "expected": "Где взять реферальную ссылку?"},
+    {"text": "где ссылка?", "expected": "Где взять реферальную ссылку?"},
+    {"text": "реферальную ссылку где взять", "expected": "Где взять реферальную ссылку?"},
+    {"text": "когда выплата комиссии", "expected": "Когда выплачивают комиссию?"},
+    {"text": "когда выплачивают", "expected": "Когда выплачивают комиссию?"},
+    {"text": "какой процент", "expected": "Какой процент комиссии?"},
+    {"text": "сколько процентов комиссия", "expected": "Какой процент комиссии?"},
+    {"text": "как вывести деньги", "expected": "Как вывести деньги?"},
+    {"text": "как вывести заработок", "expected": "Как вывести деньги?"},
+    {"text": "не пришло видео", "expected": "Не пришло видео урока"},
+    {"text": "видео урока не приходит", "expected": "Не пришло видео урока"},
+    {"text": "можно оплатить иностранной картой", "expected": "Можно ли оплатить картой иностранного банка?"},
+    {"text": "сколько длится обучение", "expected": "Сколько длится курс?"},
+    {"text": "сколько длиться курс", "expected": "Сколько длится курс?"},
+    {"text": "статистика переходов", "expected": "Как посмотреть статистику переходов?"},
+    {"text": "где посмотреть переходы по ссылке", "expected": "Как посмотреть статистику переходов?"},
+    {"text": "оплатил а доступа нет", "expected": "Оплатил, но доступ не открылся"},
+    {"text": "я оплатила но доступ не открылся", "expected": "Оплатил, но доступ не открылся"},
+    {"text": "можно вернуть деньги", "expected": "Можно ли вернуть деньги?"},
+    {"text": "хочу возврат", "expected": "Можно ли вернуть деньги?"},
+    {"text": "как поменять реквизиты", "expected": "Как сменить реквизиты для выплат?"},
+    {"text": "Привет, какая погода в Москве?", "expected": None},
+    {"text": "у вас есть офлайн встречи?", "expected": None},
+    {"text": "можно ли подарить курс другу", "expected": None},
+    {"text": "работаете ли вы в выходные", "expected": None},
+]
+
+
+def load_dataset(path: str):
+    if not path:
+        return SAMPLE_QA_PAIRS, SAMPLE_QUESTIONS
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data["qa_pairs"], data["questions"]
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def evaluate(matcher: QuestionMatcher, questions, top_k: int, accept_score: float, margin: float) -> dict:
+    local = correct_local = wrong_local = in_top_k = answerable = 0
+    for item in questions:
+        result = matcher.match(item["text"], top_k=top_k, accept_score=accept_score, margin=margin)
+        candidates = [qa["question"] for qa in result.candidates]
+        if item["expected"] is not None:
+            answerable += 1
+            in_top_k += item["expected"] in candidates
+        if result.confident:
+            local += 1
+            if candidates[0] == item["expected"]:
+                correct_local += 1
+            else:
+                wrong_local += 1
+    return {
+        "local": local / len(questions),
+        "precision": correct_local / local if local else 1.0,
+        "wrong": wrong_local,
+        "recall_at_k": in_top_k / answerable if answerable else 1.0,
+    }
+
+
+async def evaluate_with_llm(matcher: QuestionMatcher, questions, top_k: int, accept_score: float, margin: float):
+    from app.services.deepseek_client import deepseek_client
+
+    correct = 0
+    latencies = []
+    try:
+        for item in questions:
+            started = time.perf_counter()
+            result = matcher.match(item["text"], top_k=top_k, accept_score=accept_score, margin=margin)
+            if result.confident:
+                answer = result.answer
+            else:
+                answer = await deepseek_client.find_matching_answer(item["text"], result.candidates)
+            latencies.append(time.perf_counter() - started)
+
+            expected_answer = next(
+                (qa["answer"] for qa in matcher.qa_pairs if qa["question"] == item["expected"]), None
+            )
+            correct += answer == expected_answer
+    finally:
+        await deepseek_client.close()
+
+    print(f"\nEnd-to-end with DeepSeek (accept {accept_score}, top-{top_k}):")
+    print(f"  accuracy {correct / len(questions):.1%} ({correct}/{len(questions)})")
+    print(f"  latency p50 {percentile(latencies, 0.5) * 1000:.0f} ms, p99 {percentile(latencies, 0.99) * 1000:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", help="JSON с qa_pairs и размеченными questions")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--margin", type=float, default=0.1)
+    parser.add_argument("--thresholds", default="0.6,0.7,0.8,0.9", help="пороги accept_score через запятую")
+    parser.add_argument("--llm", action="store_true", help="сквозная проверка с DeepSeek (нужен API-ключ)")
+    parser.add_argument("--llm-threshold", type=float, default=0.8)
+    args = parser.parse_args()
+
+    qa_pairs, questions = load_dataset(args.dataset)
+    print(f"{len(qa_pairs)} Q&A pairs, {len(questions)} labelled questions "
+          f"({sum(q['expected'] is None for q in questions)} without answer)")
+
+    started = time.perf_counter()
+    matcher = QuestionMatcher(qa_pairs)
+    build_ms = (time.perf_counter() - started) * 1000
+    print(f"Index: {len(matcher.vocabulary)} n-grams, built in {build_ms:.1f} ms")
+
+    timings = []
+    for _ in range(20):
+        for item in questions:
+            started = time.perf_counter()
+            matcher.match(item["text"], top_k=args.top_k)
+            timings.append(time.perf_counter() - started)
+    print(f"Match latency: p50 {percentile(timings, 0.5) * 1e6:.0f} µs, p99 {percentile(timings, 0.99) * 1e6:.0f} µs")
+    print(f"Prompt size: top-{args.top_k} instead of {len(qa_pairs)} questions")
+
+    print(f"\n{'accept':>7} {'local':>7} {'precision':>10} {'wrong':>6} {'recall@' + str(args.top_k):>9}")
+    for threshold in (float(value) for value in args.thresholds.split(",")):
+        report = evaluate(matcher, questions, args.top_k, threshold, args.margin)
+        print(
+            f"{threshold:>7.2f} {report['local']:>7.1%} {report['precision']:>10.1%} "
+            f"{report['wrong']:>6} {report['recall_at_k']:>9.1%}"
+        )
+
+    if args.llm:
+        asyncio.run(evaluate_with_llm(matcher, questions, args.top_k, args.llm_threshold, args.margin))
+
+
+if __name__ == "__main__":
+    main()
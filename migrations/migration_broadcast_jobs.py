@@ -0,0 +1,95 @@
+"""
+Миграция для сохраняемых рассылок: broadcast_jobs и broadcast_deliveries
+"""
+from sqlalchemy import text
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from app.database.connection import AsyncSessionLocal
+
+
+async def run_migration():
+    """Выполнение миграции"""
+    async with AsyncSessionLocal() as session:
+        try:
+            print("Creating broadcast_jobs table...")
+            
+            await session.execute(text("""
+                CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    id SERIAL PRIMARY KEY,
+                    admin_id BIGINT NOT NULL,
+                    admin_name VARCHAR,
+                    audience_type VARCHAR,
+                    media_data TEXT NOT NULL,
+                    status VARCHAR NOT NULL DEFAULT 'running',
+                    total_count INTEGER DEFAULT 0,
+                    sent_count INTEGER DEFAULT 0,
+                    blocked_count INTEGER DEFAULT 0,
+                    not_found_count INTEGER DEFAULT 0,
+                    other_error_count INTEGER DEFAULT 0,
+                    last_delivery_id INTEGER DEFAULT 0,
+                    progress_chat_id BIGINT,
+                    progress_message_id INTEGER,
+                    claimed_by VARCHAR,
+                    heartbeat_at TIMESTAMP WITH TIME ZONE,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    started_at TIMESTAMP WITH TIME ZONE,
+                    finished_at TIMESTAMP WITH TIME ZONE,
+                    updated_at TIMESTAMP WITH TIME ZONE
+                )
+            """))
+            
+            print("✓ broadcast_jobs table created")
+            
+            # Аренда задач (для таблиц, созданных до появления колонок)
+            await session.execute(text("""
+                ALTER TABLE broadcast_jobs
+                ADD COLUMN IF NOT EXISTS claimed_by VARCHAR,
+                ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP WITH TIME ZONE
+            """))
+            
+            print("✓ broadcast_jobs lease columns added")
+            
+            print("Creating broadcast_deliveries table...")
+            
+            await session.execute(text("""
+                CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                    id SERIAL PRIMARY KEY,
+                    job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+                    telegram_id BIGINT NOT NULL,
+                    status VARCHAR NOT NULL DEFAULT 'pending',
+                    error_kind VARCHAR,
+                    processed_at TIMESTAMP WITH TIME ZONE,
+                    CONSTRAINT uq_broadcast_deliveries_job_recipient UNIQUE (job_id, telegram_id)
+                )
+            """))
+            
+            print("✓ broadcast_deliveries table created")
+            
+            print("Creating indexes...")
+            
+            await session.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_broadcast_jobs_status 
+                ON broadcast_jobs(status)
+            """))
+            
+            await session.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_job_status_id 
+                ON broadcast_deliveries(job_id, status, id)
+            """))
+            
+            print("✓ Indexes created")
+            
+            await session.commit()
+            print("\n✅ Migration completed successfully!")
+            
+        except Exception as e:
+            await session.rollback()
+            print(f"\n❌ Migration failed: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    asyncio.run(run_migration())
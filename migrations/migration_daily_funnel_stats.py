@@ -0,0 +1,62 @@
+"""
+Миграция для дневного среза воронки: daily_funnel_stats + заполнение истории
+
+Повторный запуск пересобирает срез целиком (backfill за один проход),
+поэтому скрипт же служит командой сверки.
+"""
+from sqlalchemy import text
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from app.database.connection import AsyncSessionLocal
+from app.database.funnel_crud import FunnelStatsCRUD
+
+
+async def run_migration():
+    """Выполнение миграции"""
+    async with AsyncSessionLocal() as session:
+        try:
+            print("Creating daily_funnel_stats table...")
+
+            await session.execute(text("""
+                CREATE TABLE IF NOT EXISTS daily_funnel_stats (
+                    day DATE PRIMARY KEY,
+                    new_users INTEGER DEFAULT 0,
+                    stage_new_user INTEGER DEFAULT 0,
+                    stage_intro_shown INTEGER DEFAULT 0,
+                    stage_wait_payment INTEGER DEFAULT 0,
+                    stage_payment_ok INTEGER DEFAULT 0,
+                    stage_want_join INTEGER DEFAULT 0,
+                    stage_completed INTEGER DEFAULT 0,
+                    paid_users INTEGER DEFAULT 0,
+                    paid_without_team INTEGER DEFAULT 0,
+                    partners INTEGER DEFAULT 0,
+                    partners_without_team INTEGER DEFAULT 0,
+                    payments_count INTEGER DEFAULT 0,
+                    payments_amount DOUBLE PRECISION DEFAULT 0,
+                    sales_count INTEGER DEFAULT 0,
+                    sales_amount DOUBLE PRECISION DEFAULT 0,
+                    sales_commission DOUBLE PRECISION DEFAULT 0,
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """))
+
+            await session.commit()
+            print("✓ daily_funnel_stats table created")
+
+            print("Backfilling history...")
+            days = await FunnelStatsCRUD.backfill(session)
+            print(f"✓ {days} days rebuilt")
+
+            print("\n✅ Migration completed successfully!")
+
+        except Exception as e:
+            await session.rollback()
+            print(f"\n❌ Migration failed: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    asyncio.run(run_migration())
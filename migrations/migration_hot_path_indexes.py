@@ -0,0 +1,83 @@
+"""
+Миграция: составные индексы для частых запросов
+
+CREATE INDEX CONCURRENTLY не блокирует запись в clicks/sales/payments на
+время построения, но не выполняется внутри транзакции - поэтому соединение
+в режиме AUTOCOMMIT. Прерванное построение оставляет невалидный индекс,
+его удаляет повторный запуск.
+
+Проверка планов: app/tests/test_query_plans.py
+"""
+from sqlalchemy import text
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from app.database.connection import engine
+
+# (имя, таблица, колонки, запрос)
+INDEXES = [
+    ("idx_clicks_user_created", "clicks", "user_telegram_id, created_at",
+     "ClickCRUD.get_last_click_by_user"),
+    ("idx_clicks_ref_code_created", "clicks", "ref_code, created_at",
+     "ClickCRUD.get_last_anonymous_click (/api/link-user-click)"),
+    ("idx_sales_ref_code_status", "sales", "ref_code, status",
+     "продажи партнера по статусу, сверка partner_stats"),
+    ("idx_payments_status_paid_at", "payments", "status, paid_at",
+     "оплаты за день/период в отчетах и срезе воронки"),
+    ("idx_users_stage_created", "users", "onboarding_stage, created_at",
+     "аудитории рассылок по стадии, лиды по стадии за период"),
+    ("idx_ticket_messages_telegram_message_id", "ticket_messages", "telegram_message_id",
+     "TicketCRUD.find_ticket_by_message_id"),
+    ("idx_users_created_at", "users", "created_at",
+     "пересчет дня daily_funnel_stats: когорта регистрации"),
+    ("idx_users_stage_completed_at", "users", "stage_completed_at",
+     "пересчет дня daily_funnel_stats: партнеры дня"),
+    ("idx_users_stage_payment_ok_at", "users", "stage_payment_ok_at",
+     "пересчет дня daily_funnel_stats: партнеры без команды"),
+    ("idx_sales_created_at", "sales", "created_at",
+     "пересчет дня daily_funnel_stats: продажи дня"),
+    ("idx_users_referred_by", "users", "referred_by",
+     "UserCRUD.get_invite_counts: оплатившие приглашенные партнера"),
+]
+
+
+async def run_migration():
+    """Выполнение миграции"""
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            for name, table, columns, purpose in INDEXES:
+                print(f"Creating {name} ON {table}({columns}) - {purpose}...")
+
+                invalid = await conn.execute(text("""
+                    SELECT 1 FROM pg_index i
+                    JOIN pg_class c ON c.oid = i.indexrelid
+                    WHERE c.relname = :name AND NOT i.indisvalid
+                """), {"name": name})
+                if invalid.scalar():
+                    print(f"  dropping invalid {name} left by an interrupted build")
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+                await conn.execute(text(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table}({columns})"
+                ))
+                print(f"✓ {name} created")
+
+            print("Updating planner statistics...")
+            for table in sorted({table for _, table, _, _ in INDEXES}):
+                await conn.execute(text(f"ANALYZE {table}"))
+            print("✓ Tables analyzed")
+
+            print("\n✅ Migration completed successfully!")
+
+        except Exception as e:
+            print(f"\n❌ Migration failed: {e}")
+            raise
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_migration())
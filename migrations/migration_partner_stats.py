@@ -0,0 +1,52 @@
+"""
+Миграция для счетчиков партнеров: partner_stats + заполнение из clicks/sales
+
+Повторный запуск сверяет счетчики и исправляет расхождения.
+"""
+from sqlalchemy import text
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from app.database.connection import AsyncSessionLocal
+from app.database.partner_stats_crud import PartnerStatsCRUD
+
+
+async def run_migration():
+    """Выполнение миграции"""
+    async with AsyncSessionLocal() as session:
+        try:
+            print("Creating partner_stats table...")
+
+            await session.execute(text("""
+                CREATE TABLE IF NOT EXISTS partner_stats (
+                    ref_code VARCHAR(50) PRIMARY KEY,
+                    clicks INTEGER DEFAULT 0,
+                    total_sales INTEGER DEFAULT 0,
+                    confirmed_sales INTEGER DEFAULT 0,
+                    pending_sales INTEGER DEFAULT 0,
+                    cancelled_sales INTEGER DEFAULT 0,
+                    confirmed_commission DOUBLE PRECISION DEFAULT 0,
+                    pending_commission DOUBLE PRECISION DEFAULT 0,
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """))
+
+            await session.commit()
+            print("✓ partner_stats table created")
+
+            print("Backfilling counters...")
+            drift = await PartnerStatsCRUD.reconcile(session, repair=True)
+            print(f"✓ {len({item['ref_code'] for item in drift})} partners filled")
+
+            print("\n✅ Migration completed successfully!")
+
+        except Exception as e:
+            await session.rollback()
+            print(f"\n❌ Migration failed: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    asyncio.run(run_migration())